@@ -0,0 +1,336 @@
+"""Кэш состояния пользователей Telegram-бота.
+
+Для каждого пользователя хранится снимок: активен ли он, его учетные
+данные, данные для проверки права отметиться через бота (число активных
+разрешенных IP, последний приход, есть ли опубликованный график) и
+состояние смены на сегодня. Нажатие кнопки в боте обычно обслуживается
+из снимка без запросов к БД.
+
+Инвалидация событийная, по событиям ORM (см. конец модуля). При flush
+изменения только запоминаются в сессии, а снимки сбрасываются после
+коммита: иначе читатель между flush и коммитом успел бы положить в кэш
+еще старые данные, а откат сбрасывал бы снимки зря.
+  * любая запись Attendance сбрасывает снимок ее пользователя; свои
+    приход/уход бот после коммита сразу кладет в кэш обновленным снимком;
+  * изменения опубликованного графика, списка IP и пользователей сбрасывают
+    все снимки (invalidate_all).
+
+Инвалидации видны и другим процессам (веб-воркеры, cron, бот) через
+файл-журнал BOT_CACHE_MARKER_FILE: сброс снимка пользователя дописывает
+в него строку «автор user_id», глобальный сброс заменяет файл новым. При
+каждом чтении кэш проверяет файл (stat) и дочитывает только новые строки;
+сменился файл — сбрасывается все. Без файла-журнала изменения из других
+процессов ограничены по давности BOT_CACHE_TTL.
+"""
+
+import os
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Optional
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from app.models import AllowedIP, Attendance, ScheduleEntry, User
+
+
+BOT_CACHE_TTL = float(os.getenv("BOT_CACHE_TTL", "120"))
+BOT_CACHE_SIZE = int(os.getenv("BOT_CACHE_SIZE", "10000"))
+BOT_CACHE_MARKER_FILE = os.getenv(
+    "BOT_CACHE_MARKER_FILE", os.path.join(tempfile.gettempdir(), "time_tracker_bot_cache.gen")
+)
+# Журнал больше этого размера заменяется новым (это глобальный сброс)
+BOT_CACHE_JOURNAL_SIZE = int(os.getenv("BOT_CACHE_JOURNAL_SIZE", str(1024 * 1024)))
+
+
+class UserSnapshotCache:
+    """LRU снимков по user_id плюс общие значения (например, число разрешенных IP)"""
+
+    def __init__(self, ttl: float = BOT_CACHE_TTL, max_entries: int = BOT_CACHE_SIZE, marker_file: Optional[str] = BOT_CACHE_MARKER_FILE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.marker_file = marker_file
+        self._lock = threading.Lock()
+        self._snapshots: "OrderedDict[int, tuple]" = OrderedDict()  # user_id -> (снимок, загружен_в)
+        self._shared: Dict[Hashable, tuple] = {}
+        self._epoch = 0  # растет при каждой инвалидации
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0, "global_invalidations": 0, "remote_invalidations": 0}
+        # Прочитанная часть журнала: (inode, заголовок) и смещение
+        self._journal_id: Optional[tuple] = None
+        self._journal_offset = 0
+        self._token = secrets.token_hex(4)
+        self._skip_journal()
+
+    # --- журнал инвалидаций между процессами ---
+
+    def _skip_journal(self) -> None:
+        """Запоминает текущий журнал целиком прочитанным"""
+        self._journal_id = None
+        self._journal_offset = 0
+        if not self.marker_file:
+            return
+        try:
+            with open(self.marker_file, "rb") as journal:
+                self._journal_id = (os.fstat(journal.fileno()).st_ino, journal.readline())
+                journal.seek(0, os.SEEK_END)
+                self._journal_offset = journal.tell()
+        except OSError:
+            pass
+
+    def _writer(self) -> bytes:
+        # pid меняется после fork, токен различает экземпляры в одном процессе
+        return f"{os.getpid()}.{self._token}".encode()
+
+    def _clear(self) -> None:
+        self._epoch += 1
+        self._snapshots.clear()
+        self._shared.clear()
+
+    def _sync_generation(self) -> None:
+        """Применяет инвалидации, объявленные другими процессами"""
+        if not self.marker_file:
+            return
+        try:
+            stat = os.stat(self.marker_file)
+        except OSError:
+            stat = None
+        if stat is None:
+            if self._journal_id is not None:
+                # Журнал удален — что в нем было, уже не узнать
+                self._clear()
+                self._journal_id = None
+                self._journal_offset = 0
+            return
+        if self._journal_id is not None and stat.st_ino == self._journal_id[0] and stat.st_size == self._journal_offset:
+            return
+        try:
+            with open(self.marker_file, "rb") as journal:
+                journal_id = (os.fstat(journal.fileno()).st_ino, journal.readline())
+                if journal_id != self._journal_id or stat.st_size < self._journal_offset:
+                    # Журнал заменен (глобальный сброс) или inode переиспользован
+                    self._clear()
+                    self._journal_id = journal_id
+                    journal.seek(0, os.SEEK_END)
+                    self._journal_offset = journal.tell()
+                    return
+                journal.seek(self._journal_offset)
+                tail = journal.read()
+        except OSError:
+            return
+        # Незаконченную строку дочитаем в следующий раз
+        complete = tail[:tail.rfind(b"\n") + 1]
+        self._journal_offset += len(complete)
+        own = self._writer()
+        for line in complete.splitlines():
+            try:
+                writer, user_id = line.split()
+                user_id = int(user_id)
+            except ValueError:
+                continue
+            if writer == own:
+                # Свои инвалидации уже применены при записи
+                continue
+            self._epoch += 1
+            if self._snapshots.pop(user_id, None) is not None:
+                self._stats["remote_invalidations"] += 1
+
+    def _append_journal(self, user_ids: Iterable[int]) -> None:
+        if not self.marker_file:
+            return
+        writer = self._writer().decode()
+        data = "".join(f"{writer} {user_id}\n" for user_id in user_ids)
+        try:
+            # Дозапись небольшой строки в режиме append атомарна, процессам не нужна блокировка
+            with open(self.marker_file, "a") as journal:
+                size = journal.tell()
+                if size == 0 or size >= BOT_CACHE_JOURNAL_SIZE:
+                    self._replace_journal()
+                    return
+                journal.write(data)
+        except OSError:
+            pass
+
+    def _replace_journal(self) -> None:
+        """Атомарно заменяет журнал новым с уникальным заголовком: все процессы сбрасывают кэш"""
+        directory = os.path.dirname(os.path.abspath(self.marker_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".bot_cache.")
+        try:
+            with os.fdopen(fd, "w") as journal:
+                journal.write(secrets.token_hex(8) + "\n")
+            os.replace(tmp_path, self.marker_file)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    # --- снимки пользователей ---
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            self._sync_generation()
+            entry = self._snapshots.get(user_id)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self._stats["misses"] += 1
+                return None
+            self._snapshots.move_to_end(user_id)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def epoch(self) -> int:
+        """Запоминается перед загрузкой снимка из БД и передается в put"""
+        with self._lock:
+            return self._epoch
+
+    def put(self, user_id: int, snapshot: Dict, epoch: Optional[int] = None) -> None:
+        with self._lock:
+            self._sync_generation()
+            if epoch is not None and epoch != self._epoch:
+                # Пока снимок читался из БД, данные успели инвалидировать (в том числе в другом процессе)
+                return
+            self._snapshots[user_id] = (snapshot, time.monotonic())
+            self._snapshots.move_to_end(user_id)
+            while len(self._snapshots) > self.max_entries:
+                self._snapshots.popitem(last=False)
+
+    def update(self, user_id: int, **changes) -> None:
+        """Обновляет поля закэшированного снимка после собственной записи в БД"""
+        with self._lock:
+            entry = self._snapshots.get(user_id)
+            if entry is not None:
+                # Новый словарь: уже выданные снимки не меняются у читателей под ногами
+                self._snapshots[user_id] = ({**entry[0], **changes}, entry[1])
+
+    def invalidate_user(self, user_id: int) -> None:
+        self.invalidate_users([user_id])
+
+    def invalidate_users(self, user_ids: Iterable[int]) -> None:
+        """Сбрасывает снимки пользователей в этом процессе и объявляет сброс остальным"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        with self._lock:
+            self._epoch += 1
+            for user_id in user_ids:
+                if self._snapshots.pop(user_id, None) is not None:
+                    self._stats["invalidations"] += 1
+            self._append_journal(user_ids)
+
+    def invalidate_all(self) -> None:
+        """Сбрасывает все снимки во всех процессах"""
+        with self._lock:
+            self._clear()
+            self._stats["global_invalidations"] += 1
+            if self.marker_file:
+                try:
+                    self._replace_journal()
+                except OSError:
+                    pass
+                self._skip_journal()
+
+    # --- общие значения ---
+
+    def get_shared(self, key: Hashable):
+        with self._lock:
+            self._sync_generation()
+            entry = self._shared.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                return None
+            return entry[0]
+
+    def put_shared(self, key: Hashable, value, epoch: Optional[int] = None) -> None:
+        with self._lock:
+            self._sync_generation()
+            if epoch is not None and epoch != self._epoch:
+                return
+            self._shared[key] = (value, time.monotonic())
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._snapshots)
+        return stats
+
+
+# Общий экземпляр: бот читает из него, веб-маршруты сбрасывают
+user_snapshots = UserSnapshotCache()
+
+
+# --- инвалидация по событиям ORM: при flush запоминаем, после коммита сбрасываем ---
+
+_PENDING_KEY = "bot_cache_pending"
+_ALL = "all"
+
+
+def _defer(target, user_id=_ALL) -> None:
+    """Запоминает инвалидацию в сессии объекта до коммита"""
+    session = object_session(target)
+    if session is None:
+        if user_id is _ALL:
+            user_snapshots.invalidate_all()
+        else:
+            user_snapshots.invalidate_user(user_id)
+        return
+    session.info.setdefault(_PENDING_KEY, set()).add(user_id)
+
+
+def _after_commit(session) -> None:
+    # Коммит точки сохранения еще не виден другим соединениям
+    if session.in_nested_transaction():
+        return
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    if _ALL in pending:
+        user_snapshots.invalidate_all()
+    else:
+        user_snapshots.invalidate_users(pending)
+
+
+def _after_soft_rollback(session, previous_transaction) -> None:
+    # Откат точки сохранения не отменяет изменений внешней транзакции
+    if not previous_transaction.nested:
+        session.info.pop(_PENDING_KEY, None)
+
+
+def _changed(target, *attributes: str) -> bool:
+    state = inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in attributes)
+
+
+def _on_attendance_change(mapper, connection, target):
+    _defer(target, target.user_id)
+
+
+def _on_allowed_ip_change(mapper, connection, target):
+    _defer(target)
+
+
+def _on_schedule_change(mapper, connection, target):
+    # Неопубликованные черновики на бота не влияют
+    if target.published or _changed(target, "published"):
+        _defer(target)
+
+
+def _on_user_update(mapper, connection, target):
+    # Деактивация должна сразу дойти и до бота в другом процессе
+    if _changed(target, "is_active", "telegram_id", "web_username", "web_password_plain"):
+        _defer(target)
+
+
+def _on_user_delete(mapper, connection, target):
+    _defer(target)
+
+
+for _event in ("after_insert", "after_update", "after_delete"):
+    event.listen(Attendance, _event, _on_attendance_change)
+    event.listen(AllowedIP, _event, _on_allowed_ip_change)
+    event.listen(ScheduleEntry, _event, _on_schedule_change)
+event.listen(User, "after_update", _on_user_update)
+event.listen(User, "after_delete", _on_user_delete)
+event.listen(Session, "after_commit", _after_commit)
+event.listen(Session, "after_soft_rollback", _after_soft_rollback)
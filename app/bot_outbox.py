@@ -0,0 +1,317 @@
+"""Очередь исходящих сообщений Telegram-бота.
+
+Рассылки идут не быстрее лимитов Telegram: общий token bucket на бота и
+отдельный на каждый чат. Ответ 429 (RetryAfter) приостанавливает всю
+отправку на указанное время, сетевые ошибки повторяются с экспоненциальной
+задержкой. Несколько сообщений, накопившихся для одного получателя,
+склеиваются в одно; сообщение с тем же coalesce_key заменяет еще не
+отправленное.
+
+Состояние очереди меняется только в цикле событий бота; enqueue можно
+вызывать и из других потоков (например, из синхронных маршрутов админки).
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from app.ratelimit import KeyedTokenBuckets, TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram допускает около 30 сообщений в секунду на бота и 1 в секунду в один чат
+BOT_SEND_RATE = float(os.getenv("BOT_SEND_RATE", "25"))
+BOT_SEND_CHAT_RATE = float(os.getenv("BOT_SEND_CHAT_RATE", "1"))
+BOT_SEND_CHAT_BURST = float(os.getenv("BOT_SEND_CHAT_BURST", "3"))
+# Сколько запросов к Bot API может выполняться одновременно
+BOT_SEND_CONCURRENCY = int(os.getenv("BOT_SEND_CONCURRENCY", "8"))
+BOT_SEND_MAX_ATTEMPTS = int(os.getenv("BOT_SEND_MAX_ATTEMPTS", "5"))
+
+# Предельная длина текста сообщения в Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+
+@dataclass
+class OutboundMessage:
+    chat_id: int
+    text: str
+    reply_markup: Optional[object] = None
+    coalesce_key: Optional[str] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+    parts: int = 1  # сколько исходных сообщений склеено в это
+
+
+def _seconds(value) -> float:
+    # В разных версиях PTB retry_after — число секунд или timedelta
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class OutboundQueue:
+    """Исходящие сообщения с ограничением частоты, повторами и склейкой"""
+
+    def __init__(
+        self,
+        send: Callable[[int, str, Optional[object]], Awaitable[object]],
+        rate: float = BOT_SEND_RATE,
+        chat_rate: float = BOT_SEND_CHAT_RATE,
+        chat_burst: float = BOT_SEND_CHAT_BURST,
+        concurrency: int = BOT_SEND_CONCURRENCY,
+        max_attempts: int = BOT_SEND_MAX_ATTEMPTS,
+    ):
+        self._send = send
+        self._global_bucket = TokenBucket(rate, max(1.0, rate))
+        self._chat_buckets = KeyedTokenBuckets(chat_rate, chat_burst)
+        self._concurrency = concurrency
+        self.max_attempts = max_attempts
+
+        self._pending: Dict[int, List[OutboundMessage]] = {}
+        self._ready: Deque[int] = deque()  # чаты, готовые к отправке, по очереди
+        self._scheduled: set = set()  # чаты в _ready, в _delayed или в процессе отправки
+        self._delayed: list = []  # куча (готов_в, номер, chat_id)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._outstanding = 0  # сообщения в очереди и в отправке
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+
+        self._latencies: Deque[float] = deque(maxlen=1024)
+        self._stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "replaced": 0,
+            "sent": 0,
+            "sent_messages": 0,
+            "failed": 0,
+            "retried": 0,
+            "rate_limited": 0,
+        }
+
+    # --- жизненный цикл ---
+
+    def start(self) -> None:
+        """Запускает диспетчер в текущем цикле событий"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._slots = asyncio.Semaphore(self._concurrency)
+        self._task = asyncio.create_task(self._dispatch(), name="bot-outbox")
+
+    async def join(self, timeout: Optional[float] = None) -> bool:
+        """Ждет, пока очередь опустеет. False — если не дождались за timeout"""
+        if self._idle is None:
+            return True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Дает очереди доотправить сообщения и останавливает диспетчер"""
+        if self._task is None:
+            return
+        if not await self.join(timeout):
+            logger.warning("Очередь бота остановлена, не отправлено сообщений: %s", self._outstanding)
+        self._task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(self._task, *self._tasks, return_exceptions=True)
+        self._task = None
+
+    # --- постановка в очередь ---
+
+    def enqueue(self, chat_id: int, text: str, reply_markup=None, coalesce_key: Optional[str] = None) -> None:
+        """Ставит сообщение в очередь; можно вызывать из любого потока"""
+        if self._loop is None:
+            raise RuntimeError("Очередь сообщений не запущена")
+        message = OutboundMessage(chat_id, text, reply_markup, coalesce_key)
+        if threading.get_ident() == self._thread_id:
+            self._add(message)
+        else:
+            self._loop.call_soon_threadsafe(self._add, message)
+
+    def _add(self, message: OutboundMessage) -> None:
+        self._stats["enqueued"] += 1
+        queue = self._pending.setdefault(message.chat_id, [])
+        if message.coalesce_key is not None:
+            for index, queued in enumerate(queue):
+                if queued.coalesce_key == message.coalesce_key:
+                    # Более свежая версия того же уведомления заменяет неотправленную
+                    queue[index] = message
+                    self._stats["replaced"] += 1
+                    return
+        queue.append(message)
+        self._outstanding += 1
+        self._idle.clear()
+        self._make_ready(message.chat_id)
+
+    def _make_ready(self, chat_id: int) -> None:
+        if chat_id in self._scheduled or not self._pending.get(chat_id):
+            return
+        self._scheduled.add(chat_id)
+        self._ready.append(chat_id)
+        self._wakeup.set()
+
+    def _delay(self, chat_id: int, seconds: float) -> None:
+        # Чат уже в _scheduled: он не попадет в _ready повторно, пока не выйдет из кучи
+        heapq.heappush(self._delayed, (time.monotonic() + seconds, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    # --- отправка ---
+
+    async def _dispatch(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                self._ready.append(chat_id)
+
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # После 429 Telegram требует подождать всему боту
+            pause = self._paused_until - now
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            chat_id = self._ready.popleft()
+            if not self._pending.get(chat_id):
+                self._scheduled.discard(chat_id)
+                continue
+
+            wait = self._chat_buckets.try_acquire(chat_id)
+            if wait > 0:
+                self._delay(chat_id, wait)
+                continue
+
+            wait = self._global_bucket.try_acquire()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._global_bucket.try_acquire()
+
+            await self._slots.acquire()
+            task = asyncio.create_task(self._deliver(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _take_batch(self, chat_id: int) -> OutboundMessage:
+        """Склеивает подряд идущие сообщения одному получателю в одно"""
+        queue = self._pending[chat_id]
+        first = queue.pop(0)
+        if first.reply_markup is not None or first.attempts:
+            return first
+        texts = [first.text]
+        length = len(first.text)
+        merged = OutboundMessage(chat_id, first.text, None, None, first.enqueued_at)
+        while queue and queue[0].attempts == 0:
+            candidate = queue[0]
+            if length + 2 + len(candidate.text) > MAX_MESSAGE_LENGTH:
+                break
+            queue.pop(0)
+            texts.append(candidate.text)
+            length += 2 + len(candidate.text)
+            merged.parts += 1
+            if candidate.reply_markup is not None:
+                # Клавиатура может быть только у последнего сообщения склейки
+                merged.reply_markup = candidate.reply_markup
+                break
+        if merged.parts == 1:
+            return first
+        merged.text = "\n\n".join(texts)
+        self._stats["coalesced"] += merged.parts - 1
+        return merged
+
+    async def _deliver(self, chat_id: int) -> None:
+        message = self._take_batch(chat_id)
+        retry_in = None
+        try:
+            await self._send(chat_id, message.text, message.reply_markup)
+        except RetryAfter as e:
+            retry_in = _seconds(e.retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_in)
+            self._stats["rate_limited"] += 1
+            logger.warning("Telegram ограничил отправку (429), пауза %.1f с", retry_in)
+        except (BadRequest, Forbidden) as e:
+            # Пользователь заблокировал бота или чат не существует — повтор не поможет
+            self._finish(message, delivered=False)
+            logger.info("Сообщение в чат %s не доставлено: %s", chat_id, e)
+        except NetworkError as e:
+            message.attempts += 1
+            if message.attempts >= self.max_attempts:
+                self._finish(message, delivered=False)
+                logger.warning("Сообщение в чат %s не доставлено после %s попыток: %s", chat_id, message.attempts, e)
+            else:
+                retry_in = min(60.0, 2.0 ** message.attempts)
+        except TelegramError as e:
+            self._finish(message, delivered=False)
+            logger.warning("Ошибка отправки в чат %s: %s", chat_id, e)
+        except Exception:
+            self._finish(message, delivered=False)
+            logger.exception("Ошибка отправки в чат %s", chat_id)
+        else:
+            self._finish(message, delivered=True)
+        finally:
+            self._slots.release()
+
+        if retry_in is not None:
+            self._stats["retried"] += 1
+            self._pending[chat_id].insert(0, message)
+            self._delay(chat_id, retry_in)
+        elif self._pending.get(chat_id):
+            self._ready.append(chat_id)
+            self._wakeup.set()
+        else:
+            self._pending.pop(chat_id, None)
+            self._scheduled.discard(chat_id)
+
+    def _finish(self, message: OutboundMessage, delivered: bool) -> None:
+        if delivered:
+            self._stats["sent"] += 1
+            self._stats["sent_messages"] += message.parts
+            self._latencies.append(time.monotonic() - message.enqueued_at)
+        else:
+            self._stats["failed"] += message.parts
+        self._outstanding -= message.parts
+        if self._outstanding <= 0:
+            self._outstanding = 0
+            self._idle.set()
+
+    def stats(self) -> Dict:
+        """Метрики доставки: счетчики, глубина очереди, задержка от постановки до отправки"""
+        stats = dict(self._stats)
+        stats["queued"] = self._outstanding
+        stats["chats_waiting"] = len(self._scheduled)
+        stats["paused_seconds"] = max(0.0, self._paused_until - time.monotonic())
+        latencies = sorted(self._latencies)
+        if latencies:
+            stats["latency_seconds_p50"] = latencies[len(latencies) // 2]
+            stats["latency_seconds_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return stats
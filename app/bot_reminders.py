@@ -0,0 +1,344 @@
+"""Напоминания сотрудникам о начале смены и об отметке ухода.
+
+Опубликованные смены на вчера, сегодня и завтра загружаются в память, по каждой
+заводится два таймера: за BOT_REMINDER_BEFORE_START минут до начала и через
+BOT_REMINDER_AFTER_END минут после конца. Таймеры лежат в min-куче, цикл
+спит до ближайшего. Изменения графика подтягиваются инкрементально по
+schedule_entries.updated_at (периодически и сразу по request_refresh()).
+Перед отправкой состояние проверяется одним запросом на пачку таймеров:
+удаленные и снятые с публикации смены пропускаются, «Я ушел» напоминается
+только при открытой смене, а приход — только если смена еще не начата.
+
+В процессе работает не больше одного планировщика: при нескольких воркерах
+gunicorn таймеры ведет тот, кто захватил файловую блокировку.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import tempfile
+import time
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.models import Attendance, ScheduleEntry, Store, User
+
+
+logger = logging.getLogger(__name__)
+
+BOT_REMINDERS_ENABLED = os.getenv("BOT_REMINDERS_ENABLED", "1") == "1"
+BOT_REMINDER_BEFORE_START = int(os.getenv("BOT_REMINDER_BEFORE_START", "15"))  # минут
+BOT_REMINDER_AFTER_END = int(os.getenv("BOT_REMINDER_AFTER_END", "30"))  # минут
+# Как часто подтягивать изменения графика из других процессов (секунды)
+BOT_REMINDER_REFRESH_SECONDS = int(os.getenv("BOT_REMINDER_REFRESH_SECONDS", "300"))
+BOT_REMINDER_LOCK_FILE = os.getenv(
+    "BOT_REMINDER_LOCK_FILE", os.path.join(tempfile.gettempdir(), "time_tracker_bot_reminders.lock")
+)
+
+MOSCOW_TZ = timezone(timedelta(hours=3))
+
+KIND_START = "start"
+KIND_END = "end"
+
+
+def _moscow_now() -> datetime:
+    return datetime.now(MOSCOW_TZ)
+
+
+def _entry_timers(work_date: date, start: Optional[dt_time], end: Optional[dt_time]) -> List[Tuple[float, str]]:
+    """Моменты срабатывания (epoch) для смены; время в графике — московское"""
+    timers = []
+    if start is not None:
+        started = datetime.combine(work_date, start, MOSCOW_TZ)
+        timers.append(((started - timedelta(minutes=BOT_REMINDER_BEFORE_START)).timestamp(), KIND_START))
+        if end is not None:
+            ended = datetime.combine(work_date, end, MOSCOW_TZ)
+            if ended <= started:
+                # Ночная смена заканчивается на следующий день
+                ended += timedelta(days=1)
+            timers.append(((ended + timedelta(minutes=BOT_REMINDER_AFTER_END)).timestamp(), KIND_END))
+    return timers
+
+
+def _acquire_instance_lock(path: str):
+    """Файловая блокировка единственного планировщика; None — если уже занята"""
+    try:
+        import fcntl
+    except ImportError:  # Windows: блокировки нет, считаем себя единственными
+        return True
+    handle = open(path, "a")
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+
+class ReminderScheduler:
+    """Таймеры напоминаний по опубликованным сменам"""
+
+    def __init__(
+        self,
+        run_db: Callable[..., Awaitable],
+        send: Callable[..., None],
+        refresh_seconds: int = BOT_REMINDER_REFRESH_SECONDS,
+        lock_file: Optional[str] = BOT_REMINDER_LOCK_FILE,
+    ):
+        self._run_db = run_db
+        self._send = send
+        self.refresh_seconds = refresh_seconds
+        self.lock_file = lock_file
+
+        # entry_id -> (версия, work_date, start_time, end_time)
+        self._entries: Dict[int, Tuple[int, date, Optional[dt_time], Optional[dt_time]]] = {}
+        self._heap: List[Tuple[float, int, int, int, str]] = []  # (когда, seq, entry_id, версия, вид)
+        self._seq = itertools.count()
+        self._versions = itertools.count(1)
+        self._watermark: Optional[datetime] = None  # максимальный updated_at из загруженных
+        self._horizon: Optional[date] = None  # день, для которого загружены смены
+        self._next_refresh = 0.0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._refresh_requested = False
+        self._task: Optional[asyncio.Task] = None
+        self._lock_handle = None
+        self._stats = {"loads": 0, "refreshes": 0, "fired": 0, "sent": 0, "skipped": 0, "errors": 0}
+
+    # --- жизненный цикл ---
+
+    def start(self) -> bool:
+        """Запускает планировщик в текущем цикле событий. False — если он уже работает в другом процессе"""
+        if self._task is not None:
+            return True
+        if self.lock_file:
+            self._lock_handle = _acquire_instance_lock(self.lock_file)
+            if self._lock_handle is None:
+                logger.info("Напоминания ведет другой процесс (%s)", self.lock_file)
+                return False
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="bot-reminders")
+        return True
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._lock_handle not in (None, True):
+            self._lock_handle.close()
+        self._lock_handle = None
+
+    def request_refresh(self) -> None:
+        """Просит подтянуть изменения графика; можно вызывать из любого потока"""
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._on_refresh_requested)
+
+    def _on_refresh_requested(self) -> None:
+        self._refresh_requested = True
+        self._wakeup.set()
+
+    # --- загрузка графика ---
+
+    @staticmethod
+    def _load_changes(db: Session, first_day: date, last_day: date, since: Optional[datetime]) -> list:
+        """Смены в горизонте; при since — только измененные с этого момента (включая снятые с публикации)"""
+        query = db.query(
+            ScheduleEntry.id,
+            ScheduleEntry.work_date,
+            ScheduleEntry.start_time,
+            ScheduleEntry.end_time,
+            ScheduleEntry.shift_type,
+            ScheduleEntry.published,
+            ScheduleEntry.updated_at,
+        ).filter(ScheduleEntry.work_date >= first_day, ScheduleEntry.work_date <= last_day)
+        if since is None:
+            query = query.filter(ScheduleEntry.published == True, ScheduleEntry.shift_type == "work")
+        else:
+            query = query.filter(ScheduleEntry.updated_at >= since)
+        return [tuple(row) for row in query.all()]
+
+    def _apply(self, rows: list, now: float) -> None:
+        for entry_id, work_date, start, end, shift_type, published, updated_at in rows:
+            if updated_at is not None and (self._watermark is None or updated_at > self._watermark):
+                self._watermark = updated_at
+            current = self._entries.get(entry_id)
+            if not published or shift_type != "work" or start is None:
+                # Старые таймеры отбрасываются при срабатывании по несовпадению версии
+                self._entries.pop(entry_id, None)
+                continue
+            if current is not None and current[1:] == (work_date, start, end):
+                continue
+            version = next(self._versions)
+            self._entries[entry_id] = (version, work_date, start, end)
+            for fire_at, kind in _entry_timers(work_date, start, end):
+                if fire_at > now:
+                    heapq.heappush(self._heap, (fire_at, next(self._seq), entry_id, version, kind))
+
+    async def _refresh(self) -> None:
+        today = _moscow_now().date()
+        now = time.time()
+        # Вчерашний день нужен для ночных смен, которые заканчиваются сегодня
+        first_day, last_day = today - timedelta(days=1), today + timedelta(days=1)
+        if self._horizon != today:
+            # Новые сутки: полная перезагрузка
+            rows = await self._run_db(self._load_changes, first_day, last_day, None)
+            self._entries.clear()
+            self._heap.clear()
+            self._watermark = None
+            self._horizon = today
+            self._apply(rows, now)
+            self._stats["loads"] += 1
+            logger.info("Напоминания: загружено смен %s, таймеров %s", len(self._entries), len(self._heap))
+        elif self._watermark is not None:
+            rows = await self._run_db(self._load_changes, first_day, last_day, self._watermark)
+            self._apply(rows, now)
+            self._stats["refreshes"] += 1
+        else:
+            # В горизонте не было ни одной смены — ориентира для инкремента нет
+            rows = await self._run_db(self._load_changes, first_day, last_day, None)
+            self._apply(rows, now)
+            self._stats["refreshes"] += 1
+        self._next_refresh = time.monotonic() + self.refresh_seconds
+
+    # --- срабатывание ---
+
+    @staticmethod
+    def _load_fire_state(db: Session, entry_ids: List[int]) -> dict:
+        """Актуальные данные по пачке смен: получатель, магазин, открытая смена"""
+        rows = (
+            db.query(
+                ScheduleEntry.id,
+                ScheduleEntry.user_id,
+                ScheduleEntry.work_date,
+                ScheduleEntry.start_time,
+                ScheduleEntry.end_time,
+                ScheduleEntry.published,
+                ScheduleEntry.shift_type,
+                User.telegram_id,
+                User.is_active,
+                Store.name,
+            )
+            .join(User, User.id == ScheduleEntry.user_id)
+            .outerjoin(Store, Store.id == ScheduleEntry.store_id)
+            .filter(ScheduleEntry.id.in_(entry_ids))
+            .all()
+        )
+        user_ids = {row[1] for row in rows}
+        open_users = set()
+        if user_ids:
+            open_users = {
+                user_id
+                for (user_id,) in db.query(Attendance.user_id)
+                .filter(Attendance.user_id.in_(user_ids), Attendance.ended_at.is_(None))
+                .distinct()
+                .all()
+            }
+        return {
+            row[0]: {
+                "user_id": row[1],
+                "work_date": row[2],
+                "start_time": row[3],
+                "end_time": row[4],
+                "valid": bool(row[5]) and row[6] == "work" and bool(row[8]) and row[7] is not None,
+                "telegram_id": row[7],
+                "store_name": row[9],
+                "on_shift": row[1] in open_users,
+            }
+            for row in rows
+        }
+
+    async def _fire(self, due: List[Tuple[int, str]]) -> None:
+        state = await self._run_db(self._load_fire_state, list({entry_id for entry_id, _ in due}))
+        for entry_id, kind in due:
+            self._stats["fired"] += 1
+            info = state.get(entry_id)
+            if info is None or not info["valid"]:
+                self._stats["skipped"] += 1
+                continue
+            # Смена могла измениться в другом процессе после загрузки таймера
+            if (info["work_date"], info["start_time"], info["end_time"]) != self._entries.get(entry_id, (None,))[1:]:
+                self._stats["skipped"] += 1
+                continue
+
+            if kind == KIND_START and not info["on_shift"]:
+                store = f" ({info['store_name']})" if info["store_name"] else ""
+                text = (
+                    f"⏰ В {info['start_time'].strftime('%H:%M')} начинается ваша смена{store}.\n"
+                    "Не забудьте отметить приход: «✅ Я пришел»."
+                )
+            elif kind == KIND_END and info["on_shift"]:
+                end_time = info["end_time"].strftime("%H:%M")
+                text = (
+                    f"🔔 Ваша смена по графику закончилась в {end_time}, а уход не отмечен.\n"
+                    "Нажмите «❌ Я ушел», иначе смена будет закрыта с нулем часов."
+                )
+            else:
+                self._stats["skipped"] += 1
+                continue
+
+            try:
+                self._send(info["telegram_id"], text, coalesce_key=f"reminder:{entry_id}:{kind}")
+                self._stats["sent"] += 1
+            except Exception:
+                self._stats["errors"] += 1
+                logger.exception("Не удалось поставить напоминание в очередь")
+
+    def _pop_due(self, now: float) -> List[Tuple[int, str]]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, entry_id, version, kind = heapq.heappop(self._heap)
+            current = self._entries.get(entry_id)
+            if current is not None and current[0] == version:
+                due.append((entry_id, kind))
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if (
+                    self._refresh_requested
+                    or time.monotonic() >= self._next_refresh
+                    or self._horizon != _moscow_now().date()
+                ):
+                    self._refresh_requested = False
+                    await self._refresh()
+
+                due = self._pop_due(time.time())
+                if due:
+                    await self._fire(due)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._stats["errors"] += 1
+                logger.exception("Ошибка планировщика напоминаний")
+                self._next_refresh = time.monotonic() + self.refresh_seconds
+
+            # Спим до ближайшего таймера, обновления графика или полуночи по Москве
+            now_moscow = _moscow_now()
+            midnight = datetime.combine(now_moscow.date() + timedelta(days=1), dt_time(0, 0), MOSCOW_TZ)
+            sleep_for = min(
+                self._next_refresh - time.monotonic(),
+                midnight.timestamp() - time.time(),
+                (self._heap[0][0] - time.time()) if self._heap else float("inf"),
+            )
+            if sleep_for > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), sleep_for)
+                except asyncio.TimeoutError:
+                    pass
+
+    def stats(self) -> Dict:
+        stats = dict(self._stats)
+        stats["entries"] = len(self._entries)
+        stats["timers"] = len(self._heap)
+        stats["next_fire_in"] = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+        return stats
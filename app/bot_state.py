@@ -0,0 +1,321 @@
+"""Хранилище состояний диалога Telegram-бота.
+
+Перед хранилищем стоит ограниченный LRU-кэш в памяти, за ним — подключаемый
+бэкенд (таблица bot_conversation_states в основной БД или только память).
+Изменения пишутся в бэкенд отложенно, пачками, из фонового потока.
+Незавершенные регистрации истекают по TTL.
+
+Запись кэша считается свежей BOT_STATE_CACHE_TTL секунд, затем состояние
+перечитывается из бэкенда: его мог продвинуть другой процесс. Пароль с шага
+регистрации в состояние не попадает — он лежит только в памяти процесса
+(put_secret/take_secret) и в таблицу не пишется.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from app.database import dialect_insert, engine, session_scope
+from app.models import BotConversationState
+
+
+logger = logging.getLogger(__name__)
+
+BOT_STATE_BACKEND = os.getenv("BOT_STATE_BACKEND", "sql")  # sql | memory
+BOT_STATE_CACHE_SIZE = int(os.getenv("BOT_STATE_CACHE_SIZE", "5000"))
+# Сколько секунд доверять кэшу без перечитывания из бэкенда
+BOT_STATE_CACHE_TTL = float(os.getenv("BOT_STATE_CACHE_TTL", "5"))
+# Сколько живет брошенная на полпути регистрация (секунды)
+BOT_STATE_REGISTRATION_TTL = int(os.getenv("BOT_STATE_REGISTRATION_TTL", str(24 * 3600)))
+BOT_STATE_FLUSH_SECONDS = float(os.getenv("BOT_STATE_FLUSH_SECONDS", "1.0"))
+BOT_STATE_FLUSH_BATCH = int(os.getenv("BOT_STATE_FLUSH_BATCH", "200"))
+# Как часто удалять истекшие регистрации из таблицы (секунды)
+BOT_STATE_PURGE_SECONDS = int(os.getenv("BOT_STATE_PURGE_SECONDS", "600"))
+
+# Признак промаха кэша (None — закэшированное «состояния нет»)
+MISSING = object()
+
+
+def _is_expired(step: Optional[str], updated_at: float, now: float) -> bool:
+    """Истекла ли сессия: TTL применяется только к шагам регистрации"""
+    return bool(step) and step.startswith("register_") and now - updated_at > BOT_STATE_REGISTRATION_TTL
+
+
+class MemoryStateBackend:
+    """Бэкенд без персистентности: состояние живет только в LRU-кэше"""
+
+    def load(self, db, telegram_id: int) -> Optional[Tuple[Dict, float]]:
+        return None
+
+    def save_many(self, items: Iterable[Tuple[int, Optional[str], Optional[str], int]]) -> None:
+        pass
+
+    def purge_expired(self, cutoff: int) -> int:
+        return 0
+
+
+class SQLStateBackend:
+    """Бэкенд на таблице bot_conversation_states в основной БД приложения"""
+
+    def __init__(self):
+        self._table_ready = False
+
+    def _ensure_table(self) -> None:
+        # Бот может стартовать раньше веб-приложения, которое обычно создает таблицы
+        if not self._table_ready:
+            BotConversationState.__table__.create(bind=engine, checkfirst=True)
+            self._table_ready = True
+
+    def load(self, db, telegram_id: int) -> Optional[Tuple[Dict, float]]:
+        self._ensure_table()
+        row = db.get(BotConversationState, telegram_id)
+        if row is None:
+            return None
+        return json.loads(row.data), float(row.updated_at)
+
+    def save_many(self, items: Iterable[Tuple[int, Optional[str], Optional[str], int]]) -> None:
+        """Сохраняет пачку изменений одной транзакцией (data=None означает удаление)"""
+        self._ensure_table()
+        table = BotConversationState.__table__
+        upserts = []
+        deletes = []
+        for telegram_id, step, data, updated_at in items:
+            if data is None:
+                deletes.append(telegram_id)
+            else:
+                upserts.append({"telegram_id": telegram_id, "step": step, "data": data, "updated_at": updated_at})
+
+        with session_scope() as db:
+            if deletes:
+                db.execute(table.delete().where(table.c.telegram_id.in_(deletes)))
+            if upserts:
+                insert = dialect_insert(engine.dialect)
+                if insert is not None:
+                    stmt = insert(table)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[table.c.telegram_id],
+                        set_={"step": stmt.excluded.step, "data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at},
+                    )
+                    db.execute(stmt, upserts)
+                else:
+                    for values in upserts:
+                        db.merge(BotConversationState(**values))
+            db.commit()
+
+    def purge_expired(self, cutoff: int) -> int:
+        """Удаляет брошенные регистрации одним запросом по индексу updated_at"""
+        self._ensure_table()
+        table = BotConversationState.__table__
+        with session_scope() as db:
+            result = db.execute(
+                table.delete().where(table.c.updated_at < cutoff, table.c.step.like("register\\_%", escape="\\"))
+            )
+            db.commit()
+            return result.rowcount or 0
+
+
+class ConversationStateStore:
+    """Ограниченный LRU-кэш состояний с отложенной пакетной записью в бэкенд.
+
+    Чтение из бэкенда — синхронная операция с сессией БД (load), поэтому бот
+    выполняет его в своем пуле потоков. Остальные методы работают только с памятью.
+    """
+
+    def __init__(self, backend=None, max_entries: int = BOT_STATE_CACHE_SIZE, cache_ttl: float = BOT_STATE_CACHE_TTL):
+        self.backend = backend or (SQLStateBackend() if BOT_STATE_BACKEND == "sql" else MemoryStateBackend())
+        self.max_entries = max_entries
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        # telegram_id -> (состояние, updated_at, когда положено в кэш по time.monotonic)
+        self._cache: "OrderedDict[int, Tuple[Optional[Dict], float, float]]" = OrderedDict()
+        # telegram_id -> {ключ: значение}: секреты диалога, только в памяти
+        self._secrets: "OrderedDict[int, Tuple[Dict[str, str], float]]" = OrderedDict()
+        self._dirty: Dict[int, Tuple[Optional[str], Optional[str], int]] = {}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._last_purge = 0.0
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "expired": 0, "flushes": 0, "flushed_rows": 0, "flush_errors": 0}
+
+    def _remember(self, telegram_id: int, data: Optional[Dict], updated_at: float) -> None:
+        """Кладет значение в LRU и вытесняет самые давние записи сверх лимита"""
+        self._cache[telegram_id] = (data, updated_at, time.monotonic())
+        self._cache.move_to_end(telegram_id)
+        while len(self._cache) > self.max_entries:
+            # Несохраненные изменения лежат в self._dirty отдельно, вытеснение их не теряет
+            self._cache.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get_cached(self, telegram_id: int):
+        """Состояние из памяти; MISSING, если его нужно загрузить из бэкенда"""
+        with self._lock:
+            entry = self._cache.get(telegram_id)
+            if entry is None:
+                self._stats["misses"] += 1
+                return MISSING
+            data, updated_at, cached_at = entry
+            if data is not None and _is_expired(data.get("step"), updated_at, time.time()):
+                self._stats["expired"] += 1
+                self._cache.pop(telegram_id, None)
+                self._mark(telegram_id, None)
+                return None
+            if time.monotonic() - cached_at > self.cache_ttl and telegram_id not in self._dirty:
+                # Свои несохраненные изменения свежее таблицы; иначе состояние мог продвинуть другой процесс
+                self._stats["stale"] += 1
+                self._cache.pop(telegram_id, None)
+                return MISSING
+            self._cache.move_to_end(telegram_id)
+            self._stats["hits"] += 1
+            return data
+
+    def load(self, db, telegram_id: int) -> Optional[Dict]:
+        """Загружает состояние из бэкенда (синхронно, вызывать вне цикла событий)"""
+        with self._lock:
+            pending = self._dirty.get(telegram_id)
+        if pending is not None:
+            # Свежее изменение еще не записано — оно и есть актуальное состояние
+            step, raw, updated_at = pending
+            loaded = (json.loads(raw), float(updated_at)) if raw is not None else None
+        else:
+            loaded = self.backend.load(db, telegram_id)
+
+        data = None
+        updated_at = time.time()
+        if loaded is not None:
+            data, updated_at = loaded
+            if _is_expired(data.get("step"), updated_at, time.time()):
+                data = None
+        with self._lock:
+            # Отсутствие состояния тоже кэшируем, чтобы не ходить в БД на каждый апдейт
+            self._remember(telegram_id, data, updated_at)
+        return data
+
+    def __setitem__(self, telegram_id: int, data: Dict) -> None:
+        with self._lock:
+            self._remember(telegram_id, data, time.time())
+            self._mark(telegram_id, data)
+        self._signal()
+
+    def mark_dirty(self, telegram_id: int) -> None:
+        """Сообщает, что сессия изменена на месте и должна быть сохранена"""
+        with self._lock:
+            entry = self._cache.get(telegram_id)
+            if entry is None or entry[0] is None:
+                return
+            self._cache[telegram_id] = (entry[0], time.time(), time.monotonic())
+            self._mark(telegram_id, entry[0])
+        self._signal()
+
+    def pop(self, telegram_id: int) -> None:
+        with self._lock:
+            self._remember(telegram_id, None, time.time())
+            self._mark(telegram_id, None)
+            self._secrets.pop(telegram_id, None)
+        self._signal()
+
+    def put_secret(self, telegram_id: int, key: str, value: str) -> None:
+        """Значение на время диалога (пароль регистрации): только в памяти процесса"""
+        with self._lock:
+            secrets, _ = self._secrets.pop(telegram_id, ({}, 0.0))
+            secrets[key] = value
+            self._secrets[telegram_id] = (secrets, time.time())
+            while len(self._secrets) > self.max_entries:
+                self._secrets.popitem(last=False)
+
+    def take_secret(self, telegram_id: int, key: str) -> Optional[str]:
+        """Забирает секрет; None, если его нет (перезапуск, вытеснение, истек TTL регистрации)"""
+        with self._lock:
+            entry = self._secrets.get(telegram_id)
+            if entry is None:
+                return None
+            secrets, stored_at = entry
+            if time.time() - stored_at > BOT_STATE_REGISTRATION_TTL:
+                self._secrets.pop(telegram_id, None)
+                return None
+            value = secrets.pop(key, None)
+            if not secrets:
+                self._secrets.pop(telegram_id, None)
+            return value
+
+    def _mark(self, telegram_id: int, data: Optional[Dict]) -> None:
+        # Снимок сериализуется сразу: дальнейшие изменения словаря требуют нового mark_dirty
+        raw = json.dumps(data, ensure_ascii=False, default=str) if data is not None else None
+        step = data.get("step") if data is not None else None
+        self._dirty[telegram_id] = (step, raw, int(time.time()))
+
+    def _signal(self) -> None:
+        if self._flusher is None:
+            self._start_flusher()
+        if len(self._dirty) >= BOT_STATE_FLUSH_BATCH:
+            self._wakeup.set()
+
+    def _start_flusher(self) -> None:
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="bot-state-flusher", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(BOT_STATE_FLUSH_SECONDS)
+            self._wakeup.clear()
+            self.flush()
+            if time.time() - self._last_purge >= BOT_STATE_PURGE_SECONDS:
+                self._last_purge = time.time()
+                try:
+                    purged = self.backend.purge_expired(int(time.time()) - BOT_STATE_REGISTRATION_TTL)
+                    if purged:
+                        logger.info("Удалено истекших регистраций в боте: %s", purged)
+                except Exception:
+                    logger.exception("Не удалось удалить истекшие состояния бота")
+
+    def flush(self) -> int:
+        """Записывает накопленные изменения в бэкенд. Возвращает число строк"""
+        with self._lock:
+            if not self._dirty:
+                return 0
+            batch = self._dirty
+            self._dirty = {}
+        try:
+            self.backend.save_many(
+                (telegram_id, step, raw, updated_at) for telegram_id, (step, raw, updated_at) in batch.items()
+            )
+        except Exception:
+            logger.exception("Не удалось сохранить состояния бота (%s шт.), повтор при следующей записи", len(batch))
+            with self._lock:
+                # Возвращаем пачку, не перетирая более свежие изменения
+                for telegram_id, value in batch.items():
+                    self._dirty.setdefault(telegram_id, value)
+                self._stats["flush_errors"] += 1
+            return 0
+        with self._lock:
+            self._stats["flushes"] += 1
+            self._stats["flushed_rows"] += len(batch)
+        return len(batch)
+
+    def close(self) -> None:
+        """Останавливает фоновую запись и сохраняет все несохраненное"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+            if not self._flusher.is_alive():
+                # Бот может быть запущен снова: следующая запись поднимет новый поток
+                self._flusher = None
+                self._stopped.clear()
+        self.flush()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._cache)
+            stats["secrets"] = len(self._secrets)
+            stats["dirty"] = len(self._dirty)
+        stats["max_entries"] = self.max_entries
+        stats["backend"] = type(self.backend).__name__
+        return stats
@@ -0,0 +1,150 @@
+"""Единый сервис отметки прихода (веб, QR, WebApp, бот).
+
+Раньше каждый маршрут делал SELECT открытой смены, а затем INSERT, и
+двойное нажатие или повтор запроса при плохом Wi-Fi создавали вторую
+открытую смену. Теперь уникальность гарантирует БД:
+
+  * частичный уникальный индекс ux_attendance_open — не больше одной
+    открытой смены (ended_at IS NULL) на сотрудника;
+  * уникальный attendance.checkin_key — ключ идемпотентности клиента.
+
+Приход — один INSERT ... ON CONFLICT DO NOTHING RETURNING (в БД без
+ON CONFLICT — INSERT в точке сохранения). Конфликт означает, что смена
+уже открыта (или запрос с этим ключом уже выполнен), и только тогда
+делается чтение, чтобы сообщить состояние. Зависшая смена
+прошлого дня закрывается на нуле, после чего вставка повторяется один раз.
+"""
+
+import os
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.bot_cache import user_snapshots
+from app.daily_totals import mark_open, refresh_daily_totals
+from app.database import dialect_insert
+from app.metrics import record_checkin, registry, store_label
+from app.models import Attendance, to_epoch
+
+
+CHECKIN_KEY_MAX_LENGTH = 64
+
+# Время последнего полного закрытия зависших смен (scripts/close_overdue_shifts.py) —
+# mtime этого файла, чтобы /health/ready в любом воркере видел запуск из cron
+OVERDUE_SWEEP_FILE = os.getenv(
+    "OVERDUE_SWEEP_FILE", os.path.join(os.path.dirname(__file__), "..", "logs", "overdue_sweep")
+)
+
+
+def note_overdue_sweep() -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(OVERDUE_SWEEP_FILE)), exist_ok=True)
+    with open(OVERDUE_SWEEP_FILE, "a"):
+        pass
+    os.utime(OVERDUE_SWEEP_FILE)
+
+
+def last_overdue_sweep() -> Optional[float]:
+    try:
+        return os.stat(OVERDUE_SWEEP_FILE).st_mtime
+    except OSError:
+        return None
+
+
+@dataclass
+class CheckinResult:
+    status: str  # started | already_active
+    attendance_id: int
+    started_at: datetime
+    work_date: date
+    replayed: bool = False  # повтор запроса с тем же ключом идемпотентности
+
+
+def _moscow_now() -> datetime:
+    return datetime.now(timezone(timedelta(hours=3)))
+
+
+def _try_insert(db: Session, user_id: int, started_at: datetime, work_date: date, key: Optional[str]):
+    """id новой смены или None при конфликте уникальности"""
+    values = dict(user_id=user_id, started_at=started_at, started_ts=to_epoch(started_at), work_date=work_date, checkin_key=key)
+    upsert = dialect_insert(db.get_bind().dialect)
+    if upsert is not None:
+        stmt = upsert(Attendance.__table__).values(**values).on_conflict_do_nothing().returning(Attendance.__table__.c.id)
+        return db.execute(stmt).scalar()
+    # Без ON CONFLICT: конфликт откатывает только точку сохранения
+    try:
+        with db.begin_nested():
+            return db.execute(insert(Attendance.__table__).values(**values)).inserted_primary_key[0]
+    except IntegrityError:
+        return None
+
+
+def _close_stale(db: Session, user_id: int, today: date) -> List[Tuple[int, date]]:
+    """Закрывает на нуле открытые смены прошлых дней (как _auto_close_overdue_session)"""
+    rows = db.execute(
+        update(Attendance.__table__)
+        .where(
+            Attendance.__table__.c.user_id == user_id,
+            Attendance.__table__.c.ended_at.is_(None),
+            Attendance.__table__.c.work_date < today,
+        )
+        .values(
+            ended_at=Attendance.__table__.c.started_at,
+            ended_ts=Attendance.__table__.c.started_ts,
+            duration_s=0,
+            hours=0.0,
+        )
+        .returning(Attendance.__table__.c.user_id, Attendance.__table__.c.work_date)
+    ).all()
+    return [tuple(row) for row in rows]
+
+
+def check_in(db: Session, user_id: int, now: Optional[datetime] = None, idempotency_key: Optional[str] = None) -> CheckinResult:
+    """Открывает смену или сообщает об уже открытой. Фиксирует транзакцию."""
+    now = now or _moscow_now()
+    started_at = now.replace(tzinfo=None)  # так время хранится в БД
+    today = now.date()
+    key = idempotency_key.strip()[:CHECKIN_KEY_MAX_LENGTH] if idempotency_key and idempotency_key.strip() else None
+    table = Attendance.__table__
+
+    # Не больше трех попыток: зависшая смена и чужой ключ — по одной повторной вставке
+    for _ in range(3):
+        attendance_id = _try_insert(db, user_id, started_at, today, key)
+        if attendance_id is not None:
+            mark_open(db.connection(), user_id, today, started_at)
+            store = store_label(db, user_id) if registry.enabled else None
+            db.commit()
+            if store is not None:
+                record_checkin(store)
+            # Вставка мимо ORM не вызывает событий — сбрасываем снимок бота явно
+            user_snapshots.invalidate_user(user_id)
+            return CheckinResult("started", attendance_id, started_at, today)
+
+        if key is not None:
+            replay = db.execute(
+                select(table.c.id, table.c.user_id, table.c.started_at, table.c.work_date).where(table.c.checkin_key == key)
+            ).first()
+            if replay is not None and replay.user_id == user_id:
+                db.rollback()
+                return CheckinResult("started", replay.id, replay.started_at, replay.work_date, replayed=True)
+
+        open_row = db.execute(
+            select(table.c.id, table.c.started_at, table.c.work_date)
+            .where(table.c.user_id == user_id, table.c.ended_at.is_(None))
+        ).first()
+        if open_row is None:
+            # Конфликт по чужому ключу идемпотентности — отмечаем без ключа
+            key = None
+            continue
+        if open_row.work_date >= today:
+            db.rollback()
+            return CheckinResult("already_active", open_row.id, open_row.started_at, open_row.work_date)
+
+        # Открыта смена прошлого дня: закрываем на нуле и пробуем еще раз
+        refresh_daily_totals(db.connection(), _close_stale(db, user_id, today))
+
+    db.rollback()
+    raise RuntimeError(f"Не удалось отметить приход пользователя {user_id}")
@@ -0,0 +1,151 @@
+"""Итоги дня по сменам (таблица daily_totals).
+
+Строка на (сотрудник, дата): сумма закрытых смен в секундах, их число и
+начало открытой смены. Чтобы показать «отработано сегодня», достаточно
+прочитать одну строку по первичному ключу и добавить время открытой
+смены — без перечитывания всех отметок за день.
+
+Итог пересчитывается после каждого flush, затронувшего отметки
+(Attendance), в той же транзакции: по индексу (user_id, work_date)
+читаются отметки только затронутых дней. Массовые UPDATE/DELETE мимо ORM
+события не вызывают — после них нужен refresh_daily_totals.
+"""
+
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable, Optional, Set, Tuple
+
+from sqlalchemy import case, delete, event, func, insert, inspect, select, update
+from sqlalchemy.orm import Session
+
+from app.database import dialect_insert
+from app.models import Attendance, DailyTotal
+
+
+MOSCOW_TZ = timezone(timedelta(hours=3))
+
+DayKey = Tuple[int, date]
+
+
+def _as_moscow(value: datetime) -> datetime:
+    # Время в БД хранится без зоны и означает московское
+    if value.tzinfo is None:
+        return value.replace(tzinfo=MOSCOW_TZ)
+    return value.astimezone(MOSCOW_TZ)
+
+
+def _recompute(connection, user_id: int, work_date: date) -> None:
+    # Одна агрегатная выборка по индексу (user_id, work_date); длительности уже в duration_s
+    closed_seconds, sessions, open_started_at, rows = connection.execute(
+        select(
+            func.coalesce(func.sum(Attendance.duration_s), 0),
+            func.count(Attendance.duration_s),
+            func.max(case((Attendance.ended_at.is_(None), Attendance.started_at))),
+            func.count(),
+        ).where(Attendance.user_id == user_id, Attendance.work_date == work_date)
+    ).one()
+    if not rows:
+        connection.execute(
+            delete(DailyTotal).where(DailyTotal.user_id == user_id, DailyTotal.work_date == work_date)
+        )
+        return
+
+    values = {
+        "user_id": user_id,
+        "work_date": work_date,
+        "closed_seconds": float(closed_seconds),
+        "sessions": sessions,
+        "open_started_at": open_started_at,
+    }
+    upsert = dialect_insert(connection.dialect)
+    if upsert is None:
+        # Без ON CONFLICT: строку дня заменяем целиком в той же транзакции
+        connection.execute(
+            delete(DailyTotal).where(DailyTotal.user_id == user_id, DailyTotal.work_date == work_date)
+        )
+        connection.execute(insert(DailyTotal.__table__).values(**values))
+        return
+    stmt = upsert(DailyTotal.__table__).values(**values)
+    connection.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["user_id", "work_date"],
+            set_={key: stmt.excluded[key] for key in ("closed_seconds", "sessions", "open_started_at")},
+        )
+    )
+
+
+def refresh_daily_totals(connection, keys: Iterable[DayKey]) -> None:
+    """Пересчитывает итоги указанных дней (после массовых изменений мимо ORM)"""
+    for user_id, work_date in set(keys):
+        _recompute(connection, user_id, work_date)
+
+
+def mark_open(connection, user_id: int, work_date: date, started_at: datetime) -> None:
+    """Открытие смены одним UPSERT — для вставок мимо ORM (см. app/checkin.py)"""
+    values = dict(user_id=user_id, work_date=work_date, closed_seconds=0.0, sessions=0, open_started_at=started_at)
+    upsert = dialect_insert(connection.dialect)
+    if upsert is None:
+        updated = connection.execute(
+            update(DailyTotal)
+            .where(DailyTotal.user_id == user_id, DailyTotal.work_date == work_date)
+            .values(open_started_at=started_at)
+        )
+        if not updated.rowcount:
+            connection.execute(insert(DailyTotal.__table__).values(**values))
+        return
+    stmt = upsert(DailyTotal.__table__).values(**values)
+    connection.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["user_id", "work_date"],
+            set_={"open_started_at": stmt.excluded.open_started_at},
+        )
+    )
+
+
+def rebuild_daily_totals(connection) -> int:
+    """Полностью пересобирает daily_totals по таблице attendance"""
+    connection.execute(delete(DailyTotal))
+    keys = connection.execute(select(Attendance.user_id, Attendance.work_date).distinct()).all()
+    refresh_daily_totals(connection, keys)
+    return len(keys)
+
+
+def _touched_days(session: Session) -> Set[DayKey]:
+    keys: Set[DayKey] = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Attendance):
+            continue
+        keys.add((obj.user_id, obj.work_date))
+        # Отметку могли перенести на другой день или другому сотруднику — старый день тоже пересчитываем
+        state = inspect(obj)
+        old_user = state.attrs.user_id.history.deleted
+        old_date = state.attrs.work_date.history.deleted
+        if old_user or old_date:
+            keys.add((old_user[0] if old_user else obj.user_id, old_date[0] if old_date else obj.work_date))
+    return keys
+
+
+@event.listens_for(Session, "after_flush")
+def _on_flush(session: Session, flush_context) -> None:
+    keys = _touched_days(session)
+    if keys:
+        refresh_daily_totals(session.connection(), keys)
+
+
+def day_state(db: Session, user_id: int, work_date: date, now: Optional[datetime] = None) -> dict:
+    """Состояние дня одним чтением по первичному ключу"""
+    total = db.get(DailyTotal, (user_id, work_date))
+    if total is None:
+        return {"on_shift": False, "started_at": None, "worked_seconds": 0, "closed_seconds": 0, "sessions": 0}
+    worked = total.closed_seconds
+    started_at = None
+    if total.open_started_at is not None:
+        started_at = _as_moscow(total.open_started_at)
+        now = _as_moscow(now) if now is not None else datetime.now(MOSCOW_TZ)
+        worked += max(0.0, (now - started_at).total_seconds())
+    return {
+        "on_shift": started_at is not None,
+        "started_at": started_at,
+        "worked_seconds": int(worked),
+        "closed_seconds": int(total.closed_seconds),
+        "sessions": total.sessions,
+    }
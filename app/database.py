@@ -1,8 +1,13 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 
 import os
+import time
 
 # Prefer DATABASE_URL from environment (used in Docker), fallback to host-local sqlite file
 DATABASE_URL = os.getenv(
@@ -11,11 +16,78 @@ DATABASE_URL = os.getenv(
 )
 
 
+# Настройки SQLite; пустое значение — как у драйвера. Подбираются замером
+# benchmarks/bench_sqlite_contention.py, а не наугад
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "")  # delete | truncate | wal ...
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "")  # off | normal | full
+# Сколько ждать чужую блокировку до ошибки "database is locked" (у драйвера 5 с)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# deferred | immediate: явный BEGIN для каждой транзакции (immediate сразу берет блокировку записи);
+# пусто — драйвер сам открывает транзакцию перед первым изменением
+SQLITE_BEGIN = os.getenv("SQLITE_BEGIN", "")
+
+
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False},
+    connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
 )
 
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _sqlite_on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            if SQLITE_JOURNAL_MODE:
+                cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            if SQLITE_SYNCHRONOUS:
+                cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        finally:
+            cursor.close()
+        if SQLITE_BEGIN:
+            # Транзакциями управляет событие begin ниже, а не драйвер
+            dbapi_connection.isolation_level = None
+
+    if SQLITE_BEGIN:
+        @event.listens_for(engine, "begin")
+        def _sqlite_begin(conn):
+            conn.exec_driver_sql(f"BEGIN {SQLITE_BEGIN.upper()}")
+
+def dialect_insert(dialect) -> Optional[Callable]:
+    """insert с ON CONFLICT (on_conflict_do_update/do_nothing) для диалекта соединения.
+
+    None — диалект так не умеет, вызывающий код делает то же обычными запросами.
+    """
+    return {"sqlite": sqlite.insert, "postgresql": postgresql.insert}.get(dialect.name)
+
+
+# Наблюдатели за SQL-запросами: observer(conn, statement, parameters, duration_seconds, context)
+QueryObserver = Callable[[object, str, object, float, object], None]
+_query_observers: List[QueryObserver] = []
+
+
+def add_query_observer(observer: QueryObserver) -> None:
+    """Подписывает функцию на завершение каждого запроса через engine (метрики, медленные запросы)"""
+    if observer not in _query_observers:
+        _query_observers.append(observer)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _query_observers:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("query_started")
+    if not started:
+        return
+    duration = time.perf_counter() - started.pop()
+    for observer in _query_observers:
+        observer(conn, statement, parameters, duration, context)
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -29,3 +101,18 @@ def get_db():
         db.close()
 
 
+@contextmanager
+def session_scope():
+    """Сессия на одну единицу работы (например, одно обновление бота).
+
+    При ошибке откатывает транзакцию, в любом случае закрывает сессию и
+    возвращает соединение в пул. Коммит остается за вызывающим кодом.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
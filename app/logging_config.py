@@ -1,54 +1,348 @@
+"""Настройка логирования: JSON-записи через очередь, без файлового I/O в потоке запроса.
+
+Корневой логгер получает только QueueHandler: вызов logger.info() кладет
+запись в очередь, а запись в файл и консоль делает поток QueueListener.
+Каждая запись — строка JSON с request_id, user_id и маршрутом текущего
+запроса (из contextvars, которые заполняет AccessLogMiddleware).
+
+Файл ротируется и по размеру (LOG_MAX_BYTES), и по времени
+(LOG_ROTATE_SECONDS); при нескольких воркерах ротацию делает один из них
+(см. SizeAndTimeRotatingFileHandler). С внешним logrotate обе настройки — 0. Журнал доступа (логгер app.access) при нагрузке
+прореживается: в секунду пишутся первые LOG_ACCESS_BURST запросов, дальше
+— доля LOG_ACCESS_SAMPLE_RATE; ошибки и медленные запросы пишутся всегда.
+"""
+
+import atexit
+import copy
+import json
 import logging
 import os
-from datetime import datetime
+import queue
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import fcntl
+except ImportError:  # Windows: ротация без межпроцессной блокировки
+    fcntl = None
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FILE = os.getenv("LOG_FILE", "logs/app.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_ROTATE_SECONDS = int(os.getenv("LOG_ROTATE_SECONDS", str(24 * 3600)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "14"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_ACCESS_ENABLED = os.getenv("LOG_ACCESS_ENABLED", "1") == "1"
+LOG_ACCESS_BURST = int(os.getenv("LOG_ACCESS_BURST", "50"))
+LOG_ACCESS_SAMPLE_RATE = float(os.getenv("LOG_ACCESS_SAMPLE_RATE", "0.1"))
+LOG_ACCESS_SLOW_MS = float(os.getenv("LOG_ACCESS_SLOW_MS", "1000"))
+
+# Текущий запрос: {"request_id": ..., "scope": ASGI scope}
+_request_context: ContextVar[Optional[dict]] = ContextVar("request_context", default=None)
+
+
+def current_request_id() -> Optional[str]:
+    context = _request_context.get()
+    return context["request_id"] if context else None
+
+
+def current_route() -> Optional[str]:
+    """Шаблон маршрута текущего запроса (или путь, если маршрут еще не выбран)"""
+    context = _request_context.get()
+    if context is None:
+        return None
+    scope = context["scope"]
+    return getattr(scope.get("route"), "path", None) or scope.get("path")
+
+
+class RequestContextFilter(logging.Filter):
+    """Добавляет в запись request_id, user_id и маршрут (выполняется в потоке вызова)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _request_context.get()
+        if context is None:
+            record.request_id = record.user_id = record.route = None
+            return True
+        scope = context["scope"]
+        record.request_id = context["request_id"]
+        # Сессию и маршрут заполняют внутренние слои, поэтому читаем их в момент записи
+        session = scope.get("session")
+        record.user_id = session.get("user_id") if isinstance(session, dict) else None
+        record.route = current_route()
+        return True
+
+
+class AccessLogSampler(logging.Filter):
+    """Прореживает журнал доступа при высокой нагрузке"""
+
+    def __init__(self, burst: int = LOG_ACCESS_BURST, rate: float = LOG_ACCESS_SAMPLE_RATE, slow_ms: float = LOG_ACCESS_SLOW_MS):
+        super().__init__()
+        self.burst = burst
+        self.rate = rate
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._second = 0
+        self._count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name != "app.access":
+            return True
+        if getattr(record, "status", 0) >= 400 or getattr(record, "duration_ms", 0) >= self.slow_ms:
+            return True
+        second = int(time.monotonic())
+        with self._lock:
+            if second != self._second:
+                self._second, self._count = second, 0
+            self._count += 1
+            if self._count <= self.burst:
+                return True
+        if random.random() < self.rate:
+            record.sampled = self.rate
+            return True
+        return False
+
+
+# Поля LogRecord, которые не переносятся в JSON как дополнительные
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id", "user_id", "route"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "user_id": getattr(record, "user_id", None),
+            "route": getattr(record, "route", None),
+        }
+        # extra={...} из вызова: duration_ms, status и т. п.
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc_info"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class SizeAndTimeRotatingFileHandler(RotatingFileHandler):
+    """Ротация по размеру файла или по истечении интервала — что наступит раньше.
+
+    В файл пишут несколько процессов (воркеры gunicorn, бот). Границы интервала
+    общие для всех — кратны interval_seconds от начала эпохи, — а ротацию делает
+    один процесс под блокировкой файла {filename}.lock, в котором записано время
+    последней ротации. Остальные видят, что файл подменили (другой inode), и
+    открывают новый; так же подхватывается и внешний logrotate.
+    """
+
+    def __init__(self, filename: str, max_bytes: int, interval_seconds: int, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.interval_seconds = interval_seconds
+        self.rollover_at = self._next_boundary(time.time()) if interval_seconds > 0 else None
+        self.lock_filename = self.baseFilename + ".lock"
+        self._pending_bytes = 0  # размер записи, из-за которой понадобилась ротация
+
+    def _next_boundary(self, now: float) -> float:
+        return (now // self.interval_seconds + 1) * self.interval_seconds
+
+    def _stream_replaced(self) -> bool:
+        """Файл переименован или удален другим процессом после того, как мы его открыли"""
+        if self.stream is None:
+            return False
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except OSError:
+            return True
+
+    def _reopen(self) -> None:
+        self.stream.close()
+        self.stream = self._open()
+
+    def _size_due(self) -> bool:
+        # Размер общего файла, а не позиция в своем потоке: пишут все процессы
+        if self.maxBytes <= 0:
+            return False
+        try:
+            size = os.stat(self.baseFilename).st_size
+        except OSError:
+            return False
+        return size + self._pending_bytes >= self.maxBytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        # См. bpo-45401: ротируются только обычные файлы (не /dev/null и т. п.)
+        if os.path.exists(self.baseFilename) and not os.path.isfile(self.baseFilename):
+            return False
+        if self._stream_replaced():
+            self._reopen()
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        if self.maxBytes > 0:
+            self._pending_bytes = len(self.format(record).encode("utf-8")) + 1
+        return self._size_due()
+
+    def doRollover(self) -> None:
+        now = time.time()
+        with open(self.lock_filename, "a+", encoding="utf-8") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            lock_file.seek(0)
+            try:
+                last_rotation = float(lock_file.read().strip() or "-inf")
+            except ValueError:
+                last_rotation = float("-inf")
+
+            # Пока ждали блокировку, файл мог ротировать другой процесс — условия проверяются заново
+            time_due = self.rollover_at is not None and now >= self.rollover_at and last_rotation < self.rollover_at
+            if time_due or self._size_due():
+                super().doRollover()
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(repr(now))
+                lock_file.flush()
+            elif self._stream_replaced():
+                self._reopen()
+        if self.rollover_at is not None and now >= self.rollover_at:
+            self.rollover_at = self._next_boundary(now)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Стандартный prepare склеивает трейсбек с сообщением; оставляем его отдельным полем
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # При переполненной очереди запись теряется, но запрос не ждет диск
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+_listener: Optional[QueueListener] = None
+
 
 def setup_logging():
-    """Настройка логирования для приложения"""
-    
-    # Создаем директорию для логов
-    log_dir = Path("logs")
-    log_dir.mkdir(exist_ok=True)
-    
-    # Настройки логирования
-    log_level = os.getenv("LOG_LEVEL", "INFO")
-    log_file = os.getenv("LOG_FILE", "logs/app.log")
-    
-    # Формат логов
-    log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    date_format = "%Y-%m-%d %H:%M:%S"
-    
-    # Настройка root logger
-    logging.basicConfig(
-        level=getattr(logging, log_level.upper()),
-        format=log_format,
-        datefmt=date_format,
-        handlers=[
-            # Файловый логгер
-            logging.FileHandler(log_file, encoding='utf-8'),
-            # Консольный логгер
-            logging.StreamHandler()
-        ]
+    """Настройка логирования для приложения (повторный вызов ничего не меняет)"""
+    global _listener
+    if _listener is not None:
+        return logging.getLogger('app')
+
+    level = getattr(logging, LOG_LEVEL.upper(), logging.INFO)
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s", "%Y-%m-%d %H:%M:%S"
     )
-    
-    # Настройка логгеров для разных компонентов
-    loggers = {
-        'app': logging.getLogger('app'),
-        'app.routers': logging.getLogger('app.routers'),
-        'app.database': logging.getLogger('app.database'),
-        'uvicorn': logging.getLogger('uvicorn'),
-        'uvicorn.access': logging.getLogger('uvicorn.access'),
-    }
-    
-    # Настройка уровня для каждого логгера
-    for logger_name, logger in loggers.items():
-        logger.setLevel(getattr(logging, log_level.upper()))
-    
+
+    Path(LOG_FILE).parent.mkdir(parents=True, exist_ok=True)
+    file_handler = SizeAndTimeRotatingFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUP_COUNT)
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(AccessLogSampler())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    if LOG_ACCESS_ENABLED:
+        # Доступ пишет AccessLogMiddleware с request_id и временем, журнал uvicorn его дублировал бы
+        logging.getLogger('uvicorn.access').setLevel(logging.WARNING)
     return logging.getLogger('app')
 
+
+def setup_file_logger(name: str, path: str) -> logging.Logger:
+    """Отдельный JSON-журнал со своей очередью и ротацией; в общий журнал не попадает"""
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    file_handler = SizeAndTimeRotatingFileHandler(path, LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger
+
+
 def get_logger(name: str) -> logging.Logger:
     """Получить логгер для конкретного модуля"""
     return logging.getLogger(f'app.{name}')
 
+
+access_logger = logging.getLogger('app.access')
+
+
+class AccessLogMiddleware:
+    """ASGI middleware: request_id для всех записей запроса и строка журнала доступа"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = Headers(scope=scope).get("x-request-id") or uuid.uuid4().hex[:16]
+        token = _request_context.set({"request_id": request_id[:64], "scope": scope})
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append("X-Request-ID", request_id[:64])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if LOG_ACCESS_ENABLED:
+                access_logger.info(
+                    "%s %s %s", scope["method"], scope["path"], status_code,
+                    extra={"status": status_code, "method": scope["method"],
+                           "duration_ms": round((time.perf_counter() - started) * 1000, 2)},
+                )
+            _request_context.reset(token)
+
+
 # Создаем логгер для использования в приложении
 logger = setup_logging()
@@ -1,16 +1,42 @@
+import os
+
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.responses import RedirectResponse
 
+from app.logging_config import AccessLogMiddleware, setup_logging
+from app.metrics import MetricsMiddleware
+from app.profiler import PROFILER_ENABLED
+from app.ratelimit import RateLimitMiddleware
+from app import slow_queries  # noqa: F401  регистрирует наблюдатель медленных SQL-запросов
+
 
 # AutoLoginMiddleware temporarily removed
 
 
+setup_logging()
+
 app = FastAPI(title="Time Tracker")
-app.add_middleware(SessionMiddleware, secret_key="dev-secret-change-me")
+if PROFILER_ENABLED:
+    # Самый внутренний слой: видит роль из сессии и профилирует только сам обработчик
+    from app.profiler import ProfilerMiddleware  # noqa: E402
+
+    app.add_middleware(ProfilerMiddleware)
+# Добавлен раньше сессий, поэтому выполняется внутри них и видит user_id
+app.add_middleware(RateLimitMiddleware)
+if os.getenv("SESSION_BACKEND", "cookie") == "server":
+    # В cookie только идентификатор, содержимое сессии — в таблице web_sessions
+    from app.sessions import ServerSessionMiddleware  # noqa: E402
+
+    app.add_middleware(ServerSessionMiddleware)
+else:
+    app.add_middleware(SessionMiddleware, secret_key="dev-secret-change-me")
 # app.add_middleware(AutoLoginMiddleware)  # Temporarily disabled
+app.add_middleware(AccessLogMiddleware)
+# Добавлен последним — внешний слой, время запроса учитывает все middleware
+app.add_middleware(MetricsMiddleware)
 
 # Static files and templates
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
@@ -21,14 +47,21 @@ from app.routers.health import router as health_router  # noqa: E402
 from app.routers.auth import router as auth_router  # noqa: E402
 from app.routers.attendance import router as attendance_router  # noqa: E402
 from app.routers.admin import router as admin_router  # noqa: E402
+from app.routers.telegram_webhook import (  # noqa: E402
+    router as telegram_webhook_router,
+    start_telegram_webhook,
+    stop_telegram_webhook,
+)
 from app.database import engine, Base
 from app import models
 from app.migrations import run_sqlite_migrations
+from app.qr_sheets import shutdown_render_pool
 
 app.include_router(health_router)
 app.include_router(auth_router)
 app.include_router(attendance_router)
 app.include_router(admin_router)
+app.include_router(telegram_webhook_router)
 
 
 @app.get("/", include_in_schema=False)
@@ -41,4 +74,20 @@ def on_startup():
     # Create tables on first run
     Base.metadata.create_all(bind=engine)
     # Apply lightweight migrations for SQLite schema drift
-    run_sqlite_migrations(engine)
\ No newline at end of file
+    run_sqlite_migrations(engine)
+
+
+@app.on_event("startup")
+async def on_startup_telegram():
+    # В режиме webhook бот работает в цикле событий веб-приложения, отдельный процесс не нужен
+    await start_telegram_webhook()
+
+
+@app.on_event("shutdown")
+async def on_shutdown_telegram():
+    await stop_telegram_webhook()
+
+
+@app.on_event("shutdown")
+def on_shutdown_qr_pool():
+    shutdown_render_pool()
@@ -0,0 +1,364 @@
+"""Метрики в текстовом формате Prometheus (/metrics).
+
+Каждый процесс (воркеры gunicorn, отдельный процесс бота) копит счетчики
+и гистограммы в памяти и не чаще раза в METRICS_FLUSH_SECONDS сбрасывает
+снимок в свой файл METRICS_DIR/<pid>.json (запись во временный файл и
+атомарное переименование). /metrics читает файлы всех процессов и
+суммирует: счетчики и гистограммы — по всем файлам, включая завершенные
+процессы, текущие значения (запросы в обработке, занятые соединения) —
+только по живым. Файл завершенного процесса удаляется через
+METRICS_DEAD_PROCESS_SECONDS: его последние значения успевают попасть в
+выборку, а Prometheus воспринимает исчезновение как сброс счетчика.
+
+Отметки по магазинам — счетчики; «в минуту» считает Prometheus:
+rate(attendance_checkins_total[5m]) * 60.
+"""
+
+import atexit
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+
+from app.database import add_query_observer, engine
+from app.models import Attendance, User
+
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "time_tracker_metrics"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+METRICS_DEAD_PROCESS_SECONDS = float(os.getenv("METRICS_DEAD_PROCESS_SECONDS", "300"))
+# Если задан — /metrics отдается только с заголовком Authorization: Bearer <токен>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# имя -> (тип, описание, границы корзин для гистограмм)
+METRICS = {
+    "http_request_duration_seconds": ("histogram", "Время обработки HTTP-запроса", REQUEST_BUCKETS),
+    "http_requests_in_flight": ("gauge", "HTTP-запросы в обработке", None),
+    "db_query_duration_seconds": ("histogram", "Время выполнения SQL-запроса", QUERY_BUCKETS),
+    "db_pool_connections_in_use": ("gauge", "Соединения, выданные из пула", None),
+    "db_pool_connections_open": ("gauge", "Открытые соединения пула", None),
+    "db_pool_checkouts_total": ("counter", "Выдачи соединений из пула", None),
+    "attendance_checkins_total": ("counter", "Отметки прихода по магазинам", None),
+    "attendance_checkouts_total": ("counter", "Отметки ухода по магазинам", None),
+    "telegram_update_duration_seconds": ("histogram", "Время обработки апдейта бота", REQUEST_BUCKETS),
+    "bot_db_queued": ("gauge", "Операции БД бота в очереди пула потоков", None),
+    "bot_db_in_flight": ("gauge", "Операции БД бота в работе", None),
+    "bot_db_wait_seconds": ("histogram", "Ожидание свободного потока пула БД бота", REQUEST_BUCKETS),
+    "bot_db_run_seconds": ("histogram", "Время операции БД бота", REQUEST_BUCKETS),
+    "bot_db_errors_total": ("counter", "Операции БД бота, завершившиеся ошибкой", None),
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsRegistry:
+    """Значения метрик процесса и их слияние по файлам всех процессов"""
+
+    def __init__(self, directory: str = METRICS_DIR, flush_seconds: float = METRICS_FLUSH_SECONDS, enabled: bool = METRICS_ENABLED,
+                 dead_process_seconds: float = METRICS_DEAD_PROCESS_SECONDS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.enabled = enabled
+        self.dead_process_seconds = dead_process_seconds
+        self._lock = threading.Lock()
+        # Сброс вызывают и цикл событий, и пул потоков; пишет в файл только один из них
+        self._flush_lock = threading.Lock()
+        # (имя, метки) -> число или [счетчики корзин..., +Inf, сумма]
+        self._values: Dict[Tuple[str, LabelKey], object] = {}
+        self._last_flush = 0.0
+        self._atexit_registered = False
+
+    def inc(self, name: str, amount: float = 1.0, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        buckets = METRICS[name][2]
+        key = (name, _labels(labels))
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(buckets) + 1) + [0.0]
+            series[bisect_left(buckets, value)] += 1
+            series[-1] += value
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            values = [[name, list(labels), value[:] if isinstance(value, list) else value]
+                      for (name, labels), value in self._values.items()]
+        return {"pid": os.getpid(), "values": values}
+
+    def flush(self, force: bool = False) -> None:
+        """Сбрасывает снимок процесса в файл, если подошло время"""
+        if not self.enabled:
+            return
+        # Плановый сброс не ждет чужой: цикл событий не должен блокироваться на записи файла
+        if not self._flush_lock.acquire(blocking=force):
+            return
+        try:
+            now = time.monotonic()
+            if not force and now - self._last_flush < self.flush_seconds:
+                return
+            self._last_flush = now
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.json")
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{os.getpid()}.", suffix=".tmp", dir=self.directory)
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                    json.dump(self.snapshot(), fh, separators=(",", ":"))
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            if not self._atexit_registered:
+                # Последние секунды работы процесса не теряются при штатной остановке
+                self._atexit_registered = True
+                atexit.register(self.flush, True)
+        finally:
+            self._flush_lock.release()
+
+    def _merged(self) -> Dict[Tuple[str, LabelKey], object]:
+        merged: Dict[Tuple[str, LabelKey], object] = {}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for file_name in names:
+            if not file_name.endswith(".json"):
+                continue
+            file_path = os.path.join(self.directory, file_name)
+            try:
+                with open(file_path, encoding="utf-8") as fh:
+                    data = json.load(fh)
+                modified = os.path.getmtime(file_path)
+            except (OSError, ValueError):
+                continue
+            alive = data["pid"] == os.getpid() or _pid_alive(data["pid"])
+            if not alive and time.time() - modified > self.dead_process_seconds:
+                try:
+                    os.unlink(file_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            for name, labels, value in data["values"]:
+                if name not in METRICS or (METRICS[name][0] == "gauge" and not alive):
+                    continue
+                key = (name, tuple(tuple(pair) for pair in labels))
+                if isinstance(value, list):
+                    current = merged.get(key)
+                    merged[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    merged[key] = merged.get(key, 0.0) + value
+        return merged
+
+    def collect(self) -> str:
+        """Текст для /metrics по всем процессам"""
+        self.flush(force=True)
+        merged = self._merged()
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            series = sorted((labels, value) for (metric, labels), value in merged.items() if metric == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], value[:-1]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: LabelKey) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+registry = MetricsRegistry()
+
+
+# --- отметки прихода и ухода ---
+
+def store_label(session: Session, user_id: int) -> str:
+    """Магазин сотрудника для метки: из identity map, иначе одно чтение по ключу"""
+    user = session.identity_map.get(identity_key(User, user_id))
+    state = inspect(user).dict if user is not None else {}
+    if "store_id" in state:
+        store_id = state["store_id"]
+    else:
+        store_id = session.connection().execute(select(User.store_id).where(User.id == user_id)).scalar()
+    return str(store_id) if store_id else "none"
+
+
+def record_checkin(store: str) -> None:
+    registry.inc("attendance_checkins_total", store=store)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_checkouts(session: Session, flush_context) -> None:
+    # Уход — ended_at у отметки стал заполненным; засчитывается только после коммита
+    if not registry.enabled:
+        return
+    for obj in session.dirty:
+        if not isinstance(obj, Attendance) or obj.ended_at is None:
+            continue
+        history = inspect(obj).attrs.ended_at.history
+        if history.added and not [value for value in history.deleted if value is not None]:
+            session.info.setdefault("metrics_checkouts", []).append(store_label(session, obj.user_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _count_checkouts(session: Session) -> None:
+    for store in session.info.pop("metrics_checkouts", ()):
+        registry.inc("attendance_checkouts_total", store=store)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_checkouts(session: Session) -> None:
+    session.info.pop("metrics_checkouts", None)
+
+
+# --- БД: время запросов и пул соединений ---
+
+def _observe_query(conn, statement: str, parameters, duration: float, context) -> None:
+    operation = statement.lstrip()[:6].upper()
+    if operation not in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+        operation = "OTHER"
+    registry.observe("db_query_duration_seconds", duration, operation=operation)
+
+
+def _pool_connect(dbapi_connection, connection_record) -> None:
+    registry.inc("db_pool_connections_open")
+
+
+def _pool_close(dbapi_connection, connection_record) -> None:
+    registry.inc("db_pool_connections_open", -1)
+
+
+def _pool_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    registry.inc("db_pool_connections_in_use")
+    registry.inc("db_pool_checkouts_total")
+
+
+def _pool_checkin(dbapi_connection, connection_record) -> None:
+    registry.inc("db_pool_connections_in_use", -1)
+
+
+if METRICS_ENABLED:
+    add_query_observer(_observe_query)
+    event.listen(engine, "connect", _pool_connect)
+    event.listen(engine, "close", _pool_close)
+    event.listen(engine, "checkout", _pool_checkout)
+    event.listen(engine, "checkin", _pool_checkin)
+
+
+# --- HTTP ---
+
+class MetricsMiddleware:
+    """ASGI middleware: гистограмма времени по маршруту и статусу, запросы в обработке"""
+
+    def __init__(self, app, metrics: MetricsRegistry = registry):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        self.metrics.inc("http_requests_in_flight")
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.inc("http_requests_in_flight", -1)
+            # Шаблон пути, а не сам путь: иначе каждый id и токен — новый ряд
+            route = getattr(scope.get("route"), "path", None) or "<other>"
+            self.metrics.observe(
+                "http_request_duration_seconds", time.perf_counter() - started,
+                method=scope["method"], route=route, status=status_code,
+            )
+            self.metrics.flush()
+
+
+def observe_bot_update(kind: str, duration: float) -> None:
+    registry.observe("telegram_update_duration_seconds", duration, kind=kind)
+    registry.flush()
+
+
+# --- пул потоков БД бота ---
+
+def bot_db_submitted() -> None:
+    registry.inc("bot_db_queued")
+
+
+def bot_db_started(wait: float) -> None:
+    registry.inc("bot_db_queued", -1)
+    registry.inc("bot_db_in_flight")
+    registry.observe("bot_db_wait_seconds", wait)
+
+
+def bot_db_finished(operation: str, duration: float, failed: bool) -> None:
+    registry.inc("bot_db_in_flight", -1)
+    registry.observe("bot_db_run_seconds", duration, operation=operation)
+    if failed:
+        registry.inc("bot_db_errors_total", operation=operation)
+    registry.flush()
+
+
+def metrics_authorized(authorization: Optional[str]) -> bool:
+    if not METRICS_TOKEN:
+        return True
+    return secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}")
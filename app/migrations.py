@@ -1,4 +1,7 @@
-from sqlalchemy import text
+from datetime import date
+from typing import List
+
+from sqlalchemy import inspect, text
 from sqlalchemy.engine import Engine
 
 
@@ -178,4 +181,111 @@ def run_sqlite_migrations(engine: Engine) -> None:
                 text("CREATE UNIQUE INDEX ix_users_telegram_id ON users(telegram_id)")
             )
 
+    # schedule_entries.updated_at column (инкрементальная загрузка графика для напоминаний)
+    if not _column_exists(engine, "schedule_entries", "updated_at"):
+        with engine.begin() as connection:
+            connection.execute(
+                text("ALTER TABLE schedule_entries ADD COLUMN updated_at DATETIME NULL")
+            )
+            connection.execute(
+                text("UPDATE schedule_entries SET updated_at = created_at WHERE updated_at IS NULL")
+            )
+            connection.execute(
+                text("CREATE INDEX IF NOT EXISTS ix_schedule_entries_updated_at ON schedule_entries(updated_at)")
+            )
+
+    # stores.qr_generation column (отзыв подписанных QR-токенов магазина)
+    if not _column_exists(engine, "stores", "qr_generation"):
+        with engine.begin() as connection:
+            connection.execute(
+                text("ALTER TABLE stores ADD COLUMN qr_generation INTEGER NOT NULL DEFAULT 0")
+            )
+
+    # attendance(user_id, work_date) index — выборки отметок сотрудника за день
+    if _table_exists(engine, "attendance"):
+        with engine.begin() as connection:
+            connection.execute(
+                text("CREATE INDEX IF NOT EXISTS ix_attendance_user_date ON attendance(user_id, work_date)")
+            )
+
+    # attendance.started_ts/ended_ts/duration_s (секунды UTC; started_at/ended_at хранятся как московское время)
+    if _table_exists(engine, "attendance") and not _column_exists(engine, "attendance", "started_ts"):
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE attendance ADD COLUMN started_ts INTEGER NULL"))
+            connection.execute(text("ALTER TABLE attendance ADD COLUMN ended_ts INTEGER NULL"))
+            connection.execute(text("ALTER TABLE attendance ADD COLUMN duration_s INTEGER NULL"))
+            connection.execute(
+                text(
+                    "UPDATE attendance SET "
+                    "started_ts = CAST(strftime('%s', started_at) AS INTEGER) - 10800, "
+                    "ended_ts = CAST(strftime('%s', ended_at) AS INTEGER) - 10800"
+                )
+            )
+            connection.execute(
+                text("UPDATE attendance SET duration_s = MAX(0, ended_ts - started_ts) WHERE ended_ts IS NOT NULL")
+            )
+            connection.execute(
+                text("CREATE INDEX IF NOT EXISTS ix_attendance_started_ts ON attendance(started_ts)")
+            )
+
+    # daily_totals: первичное заполнение по существующим отметкам
+    if _table_exists(engine, "daily_totals") and _table_exists(engine, "attendance"):
+        with engine.begin() as connection:
+            is_empty = connection.execute(text("SELECT 1 FROM daily_totals LIMIT 1")).fetchone() is None
+            has_attendance = connection.execute(text("SELECT 1 FROM attendance LIMIT 1")).fetchone() is not None
+            if is_empty and has_attendance:
+                from app.daily_totals import rebuild_daily_totals
+
+                rebuild_daily_totals(connection)
+
+    # attendance.checkin_key column (ключ идемпотентности прихода)
+    if _table_exists(engine, "attendance") and not _column_exists(engine, "attendance", "checkin_key"):
+        with engine.begin() as connection:
+            connection.execute(
+                text("ALTER TABLE attendance ADD COLUMN checkin_key VARCHAR(64) NULL")
+            )
+            connection.execute(
+                text("CREATE UNIQUE INDEX IF NOT EXISTS ix_attendance_checkin_key ON attendance(checkin_key)")
+            )
+
+    # ux_attendance_open: не больше одной открытой смены на сотрудника
+    if _table_exists(engine, "attendance"):
+        with engine.begin() as connection:
+            index_exists = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type='index' AND name='ux_attendance_open'")
+            ).fetchone() is not None
+            if not index_exists:
+                # Накопившиеся дубли открытых смен: оставляем последнюю, остальные закрываем на нуле
+                closed = connection.execute(
+                    text(
+                        "UPDATE attendance SET ended_at = started_at, hours = 0, ended_ts = started_ts, duration_s = 0 "
+                        "WHERE ended_at IS NULL AND id NOT IN "
+                        "(SELECT MAX(id) FROM attendance WHERE ended_at IS NULL GROUP BY user_id) "
+                        "RETURNING user_id, work_date"
+                    )
+                ).all()
+                connection.execute(
+                    text("CREATE UNIQUE INDEX ux_attendance_open ON attendance(user_id) WHERE ended_at IS NULL")
+                )
+                if closed and _table_exists(engine, "daily_totals"):
+                    from app.daily_totals import refresh_daily_totals
+
+                    refresh_daily_totals(
+                        connection, [(user_id, date.fromisoformat(work_date)) for user_id, work_date in closed]
+                    )
+
+
+def pending_schema_changes(engine: Engine) -> List[str]:
+    """Таблицы и колонки моделей, которых еще нет в БД (пусто — миграции применены)"""
+    from app.database import Base
 
+    existing = inspect(engine)
+    tables = set(existing.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            missing.append(table.name)
+            continue
+        columns = {column["name"] for column in existing.get_columns(table.name)}
+        missing.extend(f"{table.name}.{column.name}" for column in table.columns if column.name not in columns)
+    return missing
@@ -1,6 +1,6 @@
 from datetime import datetime, date, time, timezone, timedelta
 
-from sqlalchemy import Boolean, Column, Date, DateTime, Float, ForeignKey, Integer, String, Text, Time
+from sqlalchemy import Boolean, Column, Date, DateTime, Float, ForeignKey, Index, Integer, String, Text, Time, event, text
 from sqlalchemy.orm import relationship
 
 from app.database import Base
@@ -43,9 +43,37 @@ class Attendance(Base):
     ended_at = Column(DateTime, nullable=True)
     work_date = Column(Date, nullable=False)
     hours = Column(Float, nullable=True)
+    # Ключ идемпотентности клиента: повтор того же прихода не создает новую смену
+    checkin_key = Column(String(64), nullable=True, unique=True)
+    # То же время в секундах UTC: суммы и диапазоны считаются в SQL без разбора строк
+    started_ts = Column(Integer, nullable=True, index=True)
+    ended_ts = Column(Integer, nullable=True)
+    duration_s = Column(Integer, nullable=True)  # заполняется при закрытии смены
     
     user = relationship("User")
 
+    __table_args__ = (
+        Index("ix_attendance_user_date", "user_id", "work_date"),
+        # Не больше одной открытой смены на сотрудника (см. app/checkin.py)
+        Index("ux_attendance_open", "user_id", unique=True,
+              sqlite_where=text("ended_at IS NULL"), postgresql_where=text("ended_at IS NULL")),
+    )
+
+def to_epoch(value: datetime) -> int:
+    """Секунды UTC; время без зоны в БД означает московское"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone(timedelta(hours=3)))
+    return int(value.timestamp())
+
+
+@event.listens_for(Attendance, "before_insert")
+@event.listens_for(Attendance, "before_update")
+def _fill_attendance_timestamps(mapper, connection, target):
+    target.started_ts = to_epoch(target.started_at) if target.started_at else None
+    target.ended_ts = to_epoch(target.ended_at) if target.ended_at else None
+    target.duration_s = max(0, target.ended_ts - target.started_ts) if target.ended_ts and target.started_ts else None
+
+
 class ScheduleEntry(Base):
     __tablename__ = "schedule_entries"
 
@@ -59,6 +87,8 @@ class ScheduleEntry(Base):
     shift_type = Column(String(20), nullable=False, default="work")  # work, off, vacation, sick, weekend
     published = Column(Boolean, nullable=False, default=False)
     created_at = Column(DateTime, default=_get_moscow_time, nullable=False)
+    # Для инкрементальной загрузки изменений графика (напоминания бота)
+    updated_at = Column(DateTime, default=_get_moscow_time, onupdate=_get_moscow_time, nullable=True, index=True)
 
     user = relationship("User")
     store = relationship("Store")
@@ -77,6 +107,8 @@ class Store(Base):
     address = Column(Text, nullable=True)
     phone = Column(String(20), nullable=True)
     qr_token = Column(String(64), unique=True, nullable=True)
+    # Поколение подписанных QR-токенов: увеличивается при перевыпуске, старые перестают приниматься
+    qr_generation = Column(Integer, default=0, nullable=False)
     is_active = Column(Boolean, default=True, nullable=False)
 
     employees = relationship("User", back_populates="store")
@@ -94,3 +126,43 @@ class AllowedIP(Base):
 
     creator = relationship("User")
 
+
+
+class BotConversationState(Base):
+    """Состояние диалога с Telegram-ботом (шаг регистрации, привязка к пользователю)"""
+    __tablename__ = "bot_conversation_states"
+
+    telegram_id = Column(Integer, primary_key=True)
+    step = Column(String(50), nullable=True)
+    data = Column(Text, nullable=False)  # JSON с данными сессии
+    updated_at = Column(Integer, nullable=False, index=True)  # epoch seconds
+
+
+class WebSession(Base):
+    """Серверная сессия веб-интерфейса (в cookie только непрозрачный идентификатор)"""
+    __tablename__ = "web_sessions"
+
+    id = Column(String(64), primary_key=True)  # sha256 от значения cookie
+    user_id = Column(Integer, nullable=True, index=True)
+    data = Column(Text, nullable=False)  # JSON содержимого сессии
+    expires_at = Column(Integer, nullable=False, index=True)  # epoch seconds
+
+
+class RateLimitCounter(Base):
+    """Общий для всех воркеров счетчик запросов в окне (RATE_LIMIT_BACKEND=sqlite)"""
+    __tablename__ = "rate_limit_counters"
+
+    key = Column(String(255), primary_key=True)  # правило:ключ, например login_ip:10.0.0.1
+    window_start = Column(Integer, nullable=False, index=True)  # epoch seconds
+    count = Column(Integer, nullable=False, default=0)
+
+
+class DailyTotal(Base):
+    """Итог дня сотрудника: время закрытых смен и начало открытой (см. app/daily_totals.py)"""
+    __tablename__ = "daily_totals"
+
+    user_id = Column(Integer, primary_key=True)
+    work_date = Column(Date, primary_key=True)
+    closed_seconds = Column(Float, nullable=False, default=0.0)
+    sessions = Column(Integer, nullable=False, default=0)
+    open_started_at = Column(DateTime, nullable=True)
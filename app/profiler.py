@@ -0,0 +1,236 @@
+"""Профилирование отдельных запросов по требованию.
+
+Включается PROFILER_ENABLED=1; без него middleware не подключается вовсе.
+Профилируется запрос администратора с заголовком X-Profile: 1 или
+параметром ?_profile=1, а также каждый PROFILER_SAMPLE_EVERY-й запрос.
+
+Профиль статистический: поток-сэмплер раз в PROFILER_INTERVAL_MS снимает
+стеки потока цикла событий и потока пула, в котором выполняется
+синхронный обработчик этого запроса (cProfile видит только свой поток).
+Вместе со стеками сохраняется время каждого SQL-запроса. Результат —
+HTML с flame graph (logs/profiles/<id>.html) и стеки в свернутом формате
+(<id>.folded) для flamegraph.pl/speedscope; id возвращается в X-Profile-Id.
+"""
+
+import html
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders, QueryParams
+
+from app.database import add_query_observer
+
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_DIR = os.getenv("PROFILER_DIR", "logs/profiles")
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+# 0 — только по запросу администратора
+PROFILER_SAMPLE_EVERY = int(os.getenv("PROFILER_SAMPLE_EVERY", "0"))
+PROFILER_KEEP = int(os.getenv("PROFILER_KEEP", "200"))
+MAX_STACK_DEPTH = 128
+
+_current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+
+def _frame_label(code) -> str:
+    path = code.co_filename.replace("\\", "/").split("/")
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+class RequestProfile:
+    """Стеки и SQL одного запроса"""
+
+    def __init__(self, scope, interval: float):
+        self.scope = scope
+        self.interval = interval
+        self.loop_thread = threading.get_ident()
+        self.stacks: Counter = Counter()
+        self.queries: List[tuple] = []
+        self.samples = 0
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.duration = time.perf_counter() - self.started
+        self._stop.set()
+        self._thread.join()
+
+    def _handles_request(self, frame) -> bool:
+        # Поток пула считается нашим, если в его стеке обработчик этого маршрута с нашим request
+        endpoint = self.scope.get("endpoint")
+        code = getattr(endpoint, "__code__", None)
+        while frame is not None:
+            if frame.f_code is code:
+                request = frame.f_locals.get("request")
+                return request is None or getattr(request, "scope", None) is self.scope
+            frame = frame.f_back
+        return False
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if thread_id != self.loop_thread and not self._handles_request(frame):
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    # --- отчет ---
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def _tree(self) -> Dict:
+        root = {"name": "all", "value": 0, "children": {}}
+        for stack, count in self.stacks.items():
+            root["value"] += count
+            node = root
+            for name in stack.split(";"):
+                node = node["children"].setdefault(name, {"name": name, "value": 0, "children": {}})
+                node["value"] += count
+        return root
+
+    def _render_node(self, node: Dict, total: int, parent: int) -> str:
+        if node["value"] * 200 < total:  # узлы меньше 0,5% не рисуем
+            return ""
+        children = "".join(
+            self._render_node(child, total, node["value"])
+            for child in sorted(node["children"].values(), key=lambda item: -item["value"])
+        )
+        title = f"{node['name']} — {node['value']} ({node['value'] * 100 / total:.1f}%)"
+        return (
+            f'<div class="n" style="width:{node["value"] * 100 / parent:.3f}%" title="{html.escape(title)}">'
+            f'<span>{html.escape(node["name"])}</span><div class="c">{children}</div></div>'
+        )
+
+    def to_html(self, title: str) -> str:
+        tree = self._tree()
+        total = max(tree["value"], 1)
+        query_time = sum(duration for _, duration in self.queries)
+        rows = "".join(
+            f"<tr><td>{duration * 1000:.2f}</td><td><code>{html.escape(statement)}</code></td></tr>"
+            for statement, duration in sorted(self.queries, key=lambda item: -item[1])
+        )
+        return f"""<!doctype html>
+<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>
+<style>
+body {{ font-family: sans-serif; font-size: 13px; }}
+.c {{ display: flex; }}
+.n {{ box-sizing: border-box; overflow: hidden; }}
+.n > span {{ display: block; white-space: nowrap; overflow: hidden; text-overflow: ellipsis;
+  background: #f3a95c; border: 1px solid #fff; padding: 1px 3px; }}
+.n:hover > span {{ background: #e0673a; }}
+td {{ vertical-align: top; padding: 2px 8px; }}
+</style></head>
+<body>
+<h2>{html.escape(title)}</h2>
+<p>{self.duration * 1000:.1f} мс, {self.samples} сэмплов по {self.interval * 1000:.1f} мс;
+SQL: {len(self.queries)} запросов, {query_time * 1000:.1f} мс</p>
+<div class="c">{self._render_node(tree, total, total)}</div>
+<h3>SQL</h3>
+<table><tr><th>мс</th><th>запрос</th></tr>{rows}</table>
+</body></html>"""
+
+
+def _record_query(conn, statement: str, parameters, duration: float, context) -> None:
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.queries.append((statement, duration))
+
+
+def list_profiles(directory: str = PROFILER_DIR) -> List[Dict]:
+    """Сохраненные профили, новые первыми"""
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith(".html")]
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in sorted(names, reverse=True):
+        path = os.path.join(directory, name)
+        profiles.append({"id": name[:-5], "size": os.path.getsize(path), "mtime": os.path.getmtime(path)})
+    return profiles
+
+
+def profile_path(profile_id: str, suffix: str = ".html", directory: str = PROFILER_DIR) -> Optional[str]:
+    # id приходит из URL: допускаем только имена, которые сами и создавали
+    if not profile_id or not all(char.isalnum() or char in "-_" for char in profile_id):
+        return None
+    path = os.path.join(directory, profile_id + suffix)
+    return path if os.path.isfile(path) else None
+
+
+class ProfilerMiddleware:
+    """Профилирует выбранные запросы; добавляется внутри слоя сессий, чтобы видеть роль"""
+
+    def __init__(self, app, directory: str = PROFILER_DIR, sample_every: int = PROFILER_SAMPLE_EVERY,
+                 interval_ms: float = PROFILER_INTERVAL_MS, keep: int = PROFILER_KEEP):
+        self.app = app
+        self.directory = directory
+        self.sample_every = sample_every
+        self.interval = interval_ms / 1000.0
+        self.keep = keep
+        self._requests = itertools.count(1)
+        self._profiles = itertools.count(1)
+        add_query_observer(_record_query)
+
+    def _requested(self, scope) -> bool:
+        session = scope.get("session") or {}
+        if session.get("role") == "admin":
+            headers = dict(scope["headers"])
+            if headers.get(b"x-profile") == b"1" or QueryParams(scope["query_string"]).get("_profile") == "1":
+                return True
+        return self.sample_every > 0 and next(self._requests) % self.sample_every == 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope, self.interval)
+        profile_id = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{next(self._profiles)}"
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Profile-Id", profile_id)
+            await send(message)
+
+        token = _current_profile.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.stop()
+            _current_profile.reset(token)
+            await run_in_threadpool(self._save, profile, profile_id, f"{scope['method']} {scope['path']}")
+
+    def _save(self, profile: RequestProfile, profile_id: str, title: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, f"{profile_id}.html"), "w", encoding="utf-8") as fh:
+            fh.write(profile.to_html(title))
+        with open(os.path.join(self.directory, f"{profile_id}.folded"), "w", encoding="utf-8") as fh:
+            fh.write(profile.folded())
+        # Старые профили удаляем, чтобы каталог не рос бесконечно
+        for old in list_profiles(self.directory)[self.keep:]:
+            for suffix in (".html", ".folded"):
+                path = os.path.join(self.directory, old["id"] + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
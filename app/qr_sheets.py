@@ -0,0 +1,217 @@
+"""QR-коды магазинов: кэш PNG и печатные листы для всех магазинов сразу.
+
+PNG кэшируются в памяти процесса по закодированной строке (URL), поэтому
+перевыпуск токена просто дает новые ключи, а старые вытесняются LRU.
+Листы (PDF — страница на магазин, или ZIP с PNG) собираются из кэша;
+недостающие коды рендерятся параллельно в пуле процессов.
+
+Модуль не импортирует приложение: дочерние процессы пула (spawn)
+поднимаются быстро.
+"""
+
+import functools
+import io
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+
+QR_IMAGE_CACHE_SIZE = int(os.getenv("QR_IMAGE_CACHE_SIZE", "2000"))
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Меньше этого числа кодов рендерим в текущем процессе: запуск пула дороже
+QR_RENDER_POOL_MIN = int(os.getenv("QR_RENDER_POOL_MIN", "8"))
+QR_SHEET_FONT = os.getenv("QR_SHEET_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+
+# A4 при 150 dpi
+PAGE_SIZE = (1240, 1754)
+PAGE_DPI = 150.0
+
+
+def render_qr_png(data: str) -> bytes:
+    """Рендерит один QR-код в PNG (выполняется и в дочерних процессах)"""
+    img = qrcode.make(data)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class QRImageCache:
+    """LRU готовых PNG по закодированной строке"""
+
+    def __init__(self, max_entries: int = QR_IMAGE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._images: "OrderedDict[str, bytes]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get(self, data: str) -> Optional[bytes]:
+        with self._lock:
+            png = self._images.get(data)
+            if png is None:
+                self._stats["misses"] += 1
+                return None
+            self._images.move_to_end(data)
+            self._stats["hits"] += 1
+            return png
+
+    def put(self, data: str, png: bytes) -> None:
+        with self._lock:
+            self._images[data] = png
+            self._images.move_to_end(data)
+            while len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._images)
+        return stats
+
+
+qr_images = QRImageCache()
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: форк процесса с потоками бота и пулов небезопасен
+            _pool = ProcessPoolExecutor(max_workers=QR_RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_render_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def qr_png(data: str) -> bytes:
+    """PNG одного кода: из кэша или рендер в текущем процессе"""
+    png = qr_images.get(data)
+    if png is None:
+        png = render_qr_png(data)
+        qr_images.put(data, png)
+    return png
+
+
+def qr_png_many(datas: Iterable[str]) -> Dict[str, bytes]:
+    """PNG для набора строк; отсутствующие в кэше рендерятся в пуле процессов"""
+    result: Dict[str, bytes] = {}
+    missing: List[str] = []
+    for data in dict.fromkeys(datas):
+        png = qr_images.get(data)
+        if png is None:
+            missing.append(data)
+        else:
+            result[data] = png
+
+    if len(missing) < QR_RENDER_POOL_MIN or QR_RENDER_WORKERS <= 1:
+        rendered = map(render_qr_png, missing)
+    else:
+        chunksize = max(1, len(missing) // (QR_RENDER_WORKERS * 4))
+        rendered = _get_pool().map(render_qr_png, missing, chunksize=chunksize)
+    for data, png in zip(missing, rendered):
+        qr_images.put(data, png)
+        result[data] = png
+    return result
+
+
+# --- печатные листы ---
+
+# Магазин на листе: (имя, [(подпись, строка для QR), ...])
+SheetStore = Tuple[str, Sequence[Tuple[str, str]]]
+
+
+@functools.lru_cache(maxsize=8)
+def _font(size: int):
+    try:
+        return ImageFont.truetype(QR_SHEET_FONT, size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+
+def _compose_page(name: str, codes: Sequence[Tuple[str, bytes]]) -> Image.Image:
+    """Страница A4: название магазина и коды с подписями сеткой в две колонки"""
+    page = Image.new("L", PAGE_SIZE, 255)
+    draw = ImageDraw.Draw(page)
+    title_font, label_font = _font(56), _font(36)
+    draw.text((PAGE_SIZE[0] // 2, 90), name, fill=0, font=title_font, anchor="mm")
+
+    cell = 560
+    columns = 2
+    left = (PAGE_SIZE[0] - columns * cell) // 2
+    for index, (label, png) in enumerate(codes):
+        row, column = divmod(index, columns)
+        x, y = left + column * cell, 180 + row * (cell + 80)
+        img = Image.open(io.BytesIO(png)).convert("L").resize((cell - 40, cell - 40), Image.NEAREST)
+        page.paste(img, (x + 20, y))
+        draw.text((x + cell // 2, y + cell - 10), label, fill=0, font=label_font, anchor="mm")
+    # Однобитная страница без дизеринга: в PDF ~6 КБ вместо ~130 КБ в JPEG
+    return page.convert("1", dither=Image.Dither.NONE)
+
+
+def render_sheet_page(name: str, codes: Sequence[Tuple[str, str]], cached: Dict[str, bytes]) -> Tuple[bytes, Dict[str, bytes]]:
+    """Рендерит страницу магазина (выполняется в дочерних процессах).
+
+    Возвращает страницу в PNG и заново отрендеренные коды — для кэша родителя.
+    """
+    rendered = {data: render_qr_png(data) for _, data in codes if data not in cached}
+    page = _compose_page(name, [(label, cached.get(data) or rendered[data]) for label, data in codes])
+    buf = io.BytesIO()
+    page.save(buf, format="PNG")
+    return buf.getvalue(), rendered
+
+
+def build_qr_pdf(stores: Sequence[SheetStore]) -> bytes:
+    """Многостраничный PDF: по странице на магазин, страницы рендерятся в пуле процессов"""
+    jobs = []
+    for name, codes in stores:
+        cached = {data: png for _, data in codes if (png := qr_images.get(data)) is not None}
+        jobs.append((name, codes, cached))
+
+    if len(jobs) < QR_RENDER_POOL_MIN or QR_RENDER_WORKERS <= 1:
+        results = [render_sheet_page(*job) for job in jobs]
+    else:
+        pool = _get_pool()
+        results = [future.result() for future in [pool.submit(render_sheet_page, *job) for job in jobs]]
+
+    pages = []
+    for page_png, rendered in results:
+        for data, png in rendered.items():
+            qr_images.put(data, png)
+        pages.append(Image.open(io.BytesIO(page_png)))
+    buf = io.BytesIO()
+    if pages:
+        pages[0].save(buf, format="PDF", save_all=True, append_images=pages[1:], resolution=PAGE_DPI)
+    return buf.getvalue()
+
+
+def _slug(name: str) -> str:
+    return re.sub(r"[^\w\-]+", "_", name, flags=re.UNICODE).strip("_") or "store"
+
+
+def build_qr_zip(stores: Sequence[SheetStore]) -> bytes:
+    """ZIP с PNG: папка на магазин, файл на код"""
+    images = qr_png_many(data for _, codes in stores for _, data in codes)
+    buf = io.BytesIO()
+    # PNG уже сжаты — складываем без повторного сжатия
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as archive:
+        for index, (name, codes) in enumerate(stores, start=1):
+            folder = f"{index:03d}_{_slug(name)}"
+            for label, data in codes:
+                archive.writestr(f"{folder}/{_slug(label)}.png", images[data])
+    return buf.getvalue()
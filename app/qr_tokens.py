@@ -0,0 +1,127 @@
+"""Подписанные QR-токены магазинов.
+
+Токен вида {store_id}.{action}.{generation}.{window}.{подпись} проверяется
+без обращения к БД: подпись HMAC (как у компактных токенов WebApp),
+действие (start/stop) и, при QR_TOKEN_ROTATION_SECONDS > 0, окно времени —
+принимаются текущее и предыдущее окно, так что фотография экрана с QR
+быстро устаревает. БД нужна только для списка отзыва: поколение QR каждого
+активного магазина. Список кэшируется в процессе на QR_REVOCATION_TTL
+секунд; перевыпуск QR увеличивает поколение и сбрасывает кэш.
+
+Старые токены (Store.qr_token, без точек) по-прежнему проверяются запросом к БД.
+"""
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import event
+
+from app.models import Store
+from app.security import SECRET_KEY
+
+
+QR_TOKEN_FORMAT = os.getenv("QR_TOKEN_FORMAT", "static")  # static | signed
+# 0 — токен не истекает (печатный QR); иначе QR на экране обновляется с этим периодом
+QR_TOKEN_ROTATION_SECONDS = int(os.getenv("QR_TOKEN_ROTATION_SECONDS", "0"))
+QR_REVOCATION_TTL = float(os.getenv("QR_REVOCATION_TTL", "30"))
+
+QR_ACTIONS = ("start", "stop")
+
+
+def is_signed_qr_token(token: str) -> bool:
+    # token_urlsafe не содержит точек, подписанный токен — всегда с точками
+    return "." in token
+
+
+def _signature(payload: str) -> str:
+    return hmac.new(SECRET_KEY.encode(), f"qr.{payload}".encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def _current_window(now: Optional[float] = None) -> int:
+    if QR_TOKEN_ROTATION_SECONDS <= 0:
+        return 0
+    return int((time.time() if now is None else now) // QR_TOKEN_ROTATION_SECONDS)
+
+
+def generate_qr_token(store: Store, action: str, now: Optional[float] = None) -> str:
+    if action not in QR_ACTIONS:
+        raise ValueError(f"Неизвестное действие QR: {action}")
+    payload = f"{store.id}.{action}.{store.qr_generation or 0}.{_current_window(now)}"
+    return f"{payload}.{_signature(payload)}"
+
+
+class QRRevocationList:
+    """Кэш поколений QR активных магазинов: store_id -> qr_generation"""
+
+    def __init__(self, ttl: float = QR_REVOCATION_TTL, session_factory=None):
+        self.ttl = ttl
+        self._session_factory = session_factory
+        self._lock = threading.Lock()
+        self._generations: Optional[Dict[int, int]] = None
+        self._loaded_at = 0.0
+        self.loads = 0
+
+    def _load(self) -> Dict[int, int]:
+        if self._session_factory is None:
+            from app.database import SessionLocal
+            db = SessionLocal()
+        else:
+            db = self._session_factory()
+        try:
+            rows = db.query(Store.id, Store.qr_generation).filter(Store.is_active == True).all()
+        finally:
+            db.close()
+        return {store_id: generation or 0 for store_id, generation in rows}
+
+    def generations(self) -> Dict[int, int]:
+        with self._lock:
+            if self._generations is not None and time.monotonic() - self._loaded_at <= self.ttl:
+                return self._generations
+        generations = self._load()
+        with self._lock:
+            self._generations = generations
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+        return generations
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generations = None
+
+
+qr_revocations = QRRevocationList()
+
+
+def verify_qr_token(token: str, action: str, now: Optional[float] = None) -> Optional[int]:
+    """Возвращает store_id для действительного подписанного токена, иначе None"""
+    parts = token.split(".")
+    if len(parts) != 5:
+        return None
+    store_part, action_part, generation_part, window_part, sig_part = parts
+    payload = f"{store_part}.{action_part}.{generation_part}.{window_part}"
+    if not hmac.compare_digest(sig_part, _signature(payload)):
+        return None
+    if action_part != action:
+        return None
+    try:
+        store_id, generation, window = int(store_part), int(generation_part), int(window_part)
+    except ValueError:
+        return None
+    if QR_TOKEN_ROTATION_SECONDS > 0 and _current_window(now) - window not in (0, 1):
+        return None
+    if qr_revocations.generations().get(store_id) != generation:
+        # Магазин деактивирован или QR перевыпущен
+        return None
+    return store_id
+
+
+def _on_store_change(mapper, connection, target):
+    qr_revocations.invalidate()
+
+
+for _event in ("after_insert", "after_update", "after_delete"):
+    event.listen(Store, _event, _on_store_change)
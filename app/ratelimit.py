@@ -0,0 +1,289 @@
+"""Ограничители частоты на основе token bucket.
+
+Используются для исходящих сообщений бота (app/bot_outbox.py) и для
+входящих запросов к дорогим маршрутам — вход, QR и tgapi (RateLimitMiddleware).
+"""
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, Iterable, Optional, Tuple
+from urllib.parse import parse_qs
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+
+
+class TokenBucket:
+    """Ведро токенов: пополняется со скоростью rate в секунду, вмещает не больше capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at", "_clock")
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self._clock = clock
+        self.updated_at = clock()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Забирает токены, если их хватает, и возвращает 0.
+
+        Иначе ничего не списывает и возвращает, сколько секунд подождать.
+        """
+        now = self._clock()
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+
+class KeyedTokenBuckets:
+    """Отдельное ведро на каждый ключ (чат, IP, учетную запись).
+
+    Число ведер ограничено: дольше всех не использовавшиеся вытесняются.
+    Вытесненное ведро к этому моменту обычно уже полное, так что лимит
+    от вытеснения не ослабевает.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 100_000, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key: Hashable, tokens: float = 1.0) -> float:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity, self._clock)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.try_acquire(tokens)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+# --- ограничение входящих запросов (вход, QR, tgapi) ---
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# memory — ведра в каждом процессе; sqlite — плюс общий счетчик в БД для всех воркеров
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))
+# Лимиты — запросов за окно. По IP щедрее: сотрудники магазина часто выходят через один NAT
+RATE_LIMIT_LOGIN_PER_IP = int(os.getenv("RATE_LIMIT_LOGIN_PER_IP", "60"))
+RATE_LIMIT_LOGIN_PER_ACCOUNT = int(os.getenv("RATE_LIMIT_LOGIN_PER_ACCOUNT", "10"))
+RATE_LIMIT_QR_PER_IP = int(os.getenv("RATE_LIMIT_QR_PER_IP", "120"))
+RATE_LIMIT_QR_PER_ACCOUNT = int(os.getenv("RATE_LIMIT_QR_PER_ACCOUNT", "10"))
+RATE_LIMIT_TGAPI_PER_IP = int(os.getenv("RATE_LIMIT_TGAPI_PER_IP", "120"))
+RATE_LIMIT_TGAPI_PER_ACCOUNT = int(os.getenv("RATE_LIMIT_TGAPI_PER_ACCOUNT", "20"))
+# Тело формы читается для ключа учетной записи только до этого размера
+RATE_LIMIT_MAX_FORM_BYTES = 16 * 1024
+
+
+class SharedWindowCounter:
+    """Счетчик с фиксированным окном в таблице rate_limit_counters.
+
+    Один UPSERT ... RETURNING на запрос. Ключ, превысивший лимит, запоминается
+    в процессе до конца окна, так что дальнейший поток с него БД уже не трогает.
+    """
+
+    def __init__(self, window: int = RATE_LIMIT_WINDOW, session_factory=None):
+        self.window = window
+        self._session_factory = session_factory
+        self._blocked: Dict[str, int] = {}  # ключ -> конец окна (epoch)
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    def _session(self):
+        if self._session_factory is None:
+            from app.database import SessionLocal
+            return SessionLocal()
+        return self._session_factory()
+
+    def hit(self, key: str, limit: int) -> float:
+        """Учитывает запрос; возвращает 0 или сколько секунд ждать до нового окна"""
+        now = int(time.time())
+        window_start = now - now % self.window
+        window_end = window_start + self.window
+        with self._lock:
+            blocked_until = self._blocked.get(key)
+            if blocked_until is not None:
+                if blocked_until > now:
+                    return float(blocked_until - now)
+                del self._blocked[key]
+
+        db = self._session()
+        try:
+            count = db.execute(
+                text(
+                    "INSERT INTO rate_limit_counters (key, window_start, count) VALUES (:key, :window_start, 1) "
+                    "ON CONFLICT(key) DO UPDATE SET "
+                    "count = CASE WHEN window_start = excluded.window_start THEN count + 1 ELSE 1 END, "
+                    "window_start = excluded.window_start "
+                    "RETURNING count"
+                ),
+                {"key": key, "window_start": window_start},
+            ).scalar_one()
+            if time.monotonic() - self._last_cleanup > self.window * 10:
+                self._last_cleanup = time.monotonic()
+                db.execute(text("DELETE FROM rate_limit_counters WHERE window_start < :old"), {"old": window_start - self.window})
+            db.commit()
+        finally:
+            db.close()
+
+        if count > limit:
+            with self._lock:
+                self._blocked[key] = window_end
+                if len(self._blocked) > 100_000:
+                    self._blocked = {k: v for k, v in self._blocked.items() if v > now}
+            return float(window_end - now)
+        return 0.0
+
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    name: str
+    methods: Tuple[str, ...]
+    path_prefix: str
+    per_ip: int
+    per_account: int
+    account_field: Optional[str] = None  # поле формы с учетной записью; иначе — user_id из сессии
+
+
+DEFAULT_RULES = (
+    RateLimitRule("login", ("POST",), "/login", RATE_LIMIT_LOGIN_PER_IP, RATE_LIMIT_LOGIN_PER_ACCOUNT, "email"),
+    RateLimitRule("qr", ("GET",), "/q/", RATE_LIMIT_QR_PER_IP, RATE_LIMIT_QR_PER_ACCOUNT),
+    RateLimitRule("tgapi", ("POST",), "/tgapi/", RATE_LIMIT_TGAPI_PER_IP, RATE_LIMIT_TGAPI_PER_ACCOUNT, "token"),
+)
+
+
+class RateLimitMiddleware:
+    """ASGI middleware: отсекает частые запросы по IP и по учетной записи до обращения к БД.
+
+    Должен стоять внутри middleware сессий, чтобы видеть user_id для QR-маршрутов.
+    """
+
+    def __init__(self, app, rules: Iterable[RateLimitRule] = DEFAULT_RULES, backend: str = RATE_LIMIT_BACKEND,
+                 window: int = RATE_LIMIT_WINDOW, shared: Optional[SharedWindowCounter] = None):
+        from app.routers.attendance import _get_client_ip, _verify_compact_token
+
+        self.app = app
+        self.rules = tuple(rules)
+        self.window = window
+        self._client_ip = _get_client_ip
+        self._verify_token = _verify_compact_token
+        self._buckets = {
+            (rule.name, kind): KeyedTokenBuckets(limit / window, limit)
+            for rule in self.rules
+            for kind, limit in (("ip", rule.per_ip), ("account", rule.per_account))
+            if limit > 0
+        }
+        self.shared = shared if shared is not None else (SharedWindowCounter(window) if backend == "sqlite" else None)
+        self.rejected = 0
+
+    def _match(self, scope) -> Optional[RateLimitRule]:
+        method, path = scope["method"], scope["path"]
+        for rule in self.rules:
+            if method in rule.methods and path.startswith(rule.path_prefix):
+                return rule
+        return None
+
+    async def _check(self, rule: RateLimitRule, kind: str, key: str, limit: int) -> float:
+        buckets = self._buckets.get((rule.name, kind))
+        if buckets is None or not key:
+            return 0.0
+        # Сначала дешевое ведро процесса: основной поток злоупотреблений отсекается здесь
+        wait = buckets.try_acquire(key)
+        if wait or self.shared is None:
+            return wait
+        return await run_in_threadpool(self.shared.hit, f"{rule.name}_{kind}:{key}", limit)
+
+    def _account_from_token(self, token: str) -> Optional[str]:
+        """Пользователь из токена WebApp (user_id.ts.подпись) — только при верной подписи.
+
+        Иначе любой мог бы подставить чужой user_id и исчерпать лимит его учетной
+        записи; запросы с неверным токеном ограничиваются только по IP.
+        """
+        user_id = self._verify_token(token)
+        return str(user_id) if user_id is not None else None
+
+    async def _read_form(self, receive):
+        """Читает тело формы и возвращает (поля, receive для приложения с тем же телом)"""
+        messages, body, more = [], b"", True
+        while more:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+            if len(body) > RATE_LIMIT_MAX_FORM_BYTES:
+                break
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        fields = parse_qs(body.decode("latin-1"), max_num_fields=50) if not more else {}
+        return fields, replay
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        rule = self._match(scope)
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        wait = await self._check(rule, "ip", self._client_ip(request), rule.per_ip)
+        if not wait:
+            account = None
+            if rule.account_field:
+                content_type = request.headers.get("content-type", "")
+                if content_type.startswith("application/x-www-form-urlencoded"):
+                    fields, receive = await self._read_form(receive)
+                    values = fields.get(rule.account_field)
+                    if values and rule.account_field == "token":
+                        account = self._account_from_token(values[0].strip())
+                    elif values:
+                        account = values[0].strip().lower()
+                elif rule.account_field == "token" and request.headers.get("authorization", "").startswith("Bearer "):
+                    # API v2 WebApp передает токен в заголовке
+                    account = self._account_from_token(request.headers["authorization"][7:].strip())
+            else:
+                user_id = scope.get("session", {}).get("user_id")
+                account = str(user_id) if user_id else None
+            if account:
+                wait = await self._check(rule, "account", account, rule.per_account)
+
+        if wait:
+            self.rejected += 1
+            retry_after = str(max(1, math.ceil(wait)))
+            if rule.name == "tgapi":
+                response = JSONResponse({"ok": False, "error": "rate_limited"}, status_code=429)
+            else:
+                response = PlainTextResponse("Слишком много запросов, попробуйте позже", status_code=429)
+            response.headers["Retry-After"] = retry_after
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
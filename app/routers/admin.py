@@ -1,22 +1,32 @@
 from datetime import date, datetime, time, timedelta, timezone
 from typing import List, Optional
 import io
+import logging
+import os
 import secrets
-import qrcode
 
 from fastapi import APIRouter, Depends, Form, Request, status
 from typing import Optional
-from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse, Response
+from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, StreamingResponse, Response
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session, joinedload
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 
 from app.database import get_db
 from app.models import User, ScheduleEntry, Store, Attendance, AllowedIP
 from app.routers.attendance import _get_current_user, _check_ip_allowed, _to_moscow_time, _get_moscow_time
+from app.routers.telegram_bot import telegram_bot
+from app.sessions import revoke_user_sessions
+from app.qr_tokens import QR_TOKEN_FORMAT, QR_TOKEN_ROTATION_SECONDS, generate_qr_token
+from app.qr_sheets import build_qr_pdf, build_qr_zip, qr_png
+from app.profiler import list_profiles, profile_path
+from app.slow_queries import SLOW_QUERY_MS, statement_stats
 
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 templates = Jinja2Templates(directory="app/templates")
 
@@ -127,7 +137,7 @@ def admin_planning(request: Request, db: Session = Depends(get_db)):
         ).order_by(ScheduleEntry.work_date, ScheduleEntry.start_time).all()
         
     except Exception as e:
-        print(f"Ошибка при получении данных: {e}")
+        logger.exception("Ошибка при получении данных")
         employees = []
         stores = []
         current_schedules = []
@@ -198,7 +208,7 @@ def create_schedule(
         return RedirectResponse(url="/admin/planning?success=created", status_code=status.HTTP_303_SEE_OTHER)
         
     except Exception as e:
-        print(f"Ошибка при создании расписания: {e}")
+        logger.exception("Ошибка при создании расписания")
         return RedirectResponse(url="/admin/planning?error=server_error", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -217,7 +227,7 @@ def delete_schedule(schedule_id: int, request: Request, db: Session = Depends(ge
         return RedirectResponse(url="/admin/planning?success=deleted", status_code=status.HTTP_303_SEE_OTHER)
 
     except Exception as e:
-        print(f"Ошибка при удалении расписания: {e}")
+        logger.exception("Ошибка при удалении расписания")
         return RedirectResponse(url="/admin/planning?error=delete_error", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -296,7 +306,7 @@ def admin_scheduling_table(
                 key = f"{employee.id}_{work_date}"
                 if key not in schedule_dict:
                     # Создаем запись с рабочим днем по умолчанию (не опубликована)
-                    default_schedule = ScheduleEntry(
+                    default_schedule = dict(
                         user_id=employee.id,
                         work_date=work_date,
                         shift_type="work",
@@ -305,13 +315,12 @@ def admin_scheduling_table(
                         published=False
                     )
                     default_schedules_to_create.append(default_schedule)
-                    schedule_dict[key] = default_schedule
+                    schedule_dict[key] = ScheduleEntry(**default_schedule)
 
         # Сохраняем записи по умолчанию в базу данных
         if default_schedules_to_create:
-            for schedule in default_schedules_to_create:
-                db.add(schedule)
-            db.commit()
+            # Одной пакетной вставкой (executemany): id черновиков шаблону не нужны, а на бота они не влияют
+            db.execute(insert(ScheduleEntry), default_schedules_to_create)
 
         # Определяем типы смен для выпадающего списка
         shift_types = [
@@ -324,7 +333,9 @@ def admin_scheduling_table(
         ]
 
     except Exception as e:
-        print(f"Ошибка при получении данных для таблицы планирования: {e}")
+        logger.exception("Ошибка при получении данных для таблицы планирования")
+        db.rollback()
+        default_schedules_to_create = []
         month_dates = []
         employees = []
         stores = []
@@ -351,7 +362,7 @@ def admin_scheduling_table(
     current_year = date.today().year
     years = [{"value": y, "name": str(y)} for y in range(current_year - 1, current_year + 3)]
 
-    return templates.TemplateResponse(
+    response = templates.TemplateResponse(
         "admin.html",
         {
             "request": request,
@@ -370,6 +381,15 @@ def admin_scheduling_table(
             "message": "Интерактивная таблица планирования смен",
         },
     )
+    if default_schedules_to_create:
+        # Коммитим после рендера: коммит сбрасывает загруженные объекты, и шаблон перечитывал бы их по одному
+        try:
+            db.commit()
+        except Exception:
+            # Черновики создадутся при следующем просмотре
+            db.rollback()
+            logger.exception("Не удалось сохранить черновики графика")
+    return response
 
 
 @router.post("/admin/scheduling-table/toggle", include_in_schema=False)
@@ -424,6 +444,8 @@ def toggle_schedule_slot(
                 existing.end_time = end_time_obj
                 existing.store_id = store_id if store_id else existing.store_id
                 db.commit()
+                if existing.published:
+                    telegram_bot.request_reminder_refresh()
                 return JSONResponse({"success": True, "action": "updated"})
             else:
                 # Создаем новую смену
@@ -440,7 +462,7 @@ def toggle_schedule_slot(
                 return JSONResponse({"success": True, "action": "created"})
 
     except Exception as e:
-        print(f"Ошибка при изменении типа смены: {e}")
+        logger.exception("Ошибка при изменении типа смены")
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
 
 
@@ -478,17 +500,74 @@ def publish_schedules(
 
         db.commit()
 
+        # Уведомляем сотрудников в Telegram, если бот работает в этом процессе (режим webhook)
+        notified_count = 0
+        if telegram_bot.outbox is not None and unpublished_schedules:
+            user_ids = list({schedule.user_id for schedule in unpublished_schedules})
+            recipients = telegram_bot._load_broadcast_recipients(db, None, user_ids)
+            for telegram_id in recipients:
+                telegram_bot.send_message(
+                    telegram_id,
+                    f"📅 Опубликован ваш график на {month:02d}.{year}.\n"
+                    "Посмотреть его можно кнопкой «Мой график».",
+                    coalesce_key=f"schedule:{year}-{month:02d}",
+                )
+            notified_count = len(recipients)
+        telegram_bot.request_reminder_refresh()
+
         return JSONResponse({
             "success": True,
             "message": f"Опубликовано {published_count} смен за {month:02d}.{year}",
-            "published_count": published_count
+            "published_count": published_count,
+            "notified_count": notified_count
         })
 
     except Exception as e:
-        print(f"Ошибка при публикации расписания: {e}")
+        logger.exception("Ошибка при публикации расписания")
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
 
 
+@router.post("/admin/broadcast", include_in_schema=False)
+async def broadcast_message(
+    request: Request,
+    text: str = Form(...),
+    store_id: Optional[int] = Form(None),
+    db: Session = Depends(get_db)
+):
+    """Рассылка сообщения сотрудникам в Telegram (всем или сотрудникам одного магазина)"""
+    result = _ensure_admin(request, db)
+    if isinstance(result, RedirectResponse):
+        return result
+
+    text = text.strip()
+    if not text:
+        return JSONResponse({"success": False, "error": "Пустое сообщение"}, status_code=400)
+    if telegram_bot.outbox is None:
+        return JSONResponse({"success": False, "error": "Telegram бот не запущен в режиме webhook"}, status_code=503)
+
+    try:
+        queued = await telegram_bot.broadcast(text, store_id=store_id)
+        return JSONResponse({
+            "success": True,
+            "message": f"Рассылка поставлена в очередь: {queued} получателей",
+            "queued": queued
+        })
+    except Exception as e:
+        logger.exception("Ошибка при рассылке")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+@router.get("/admin/broadcast/stats", include_in_schema=False)
+def broadcast_stats(request: Request, db: Session = Depends(get_db)):
+    """Метрики очереди рассылок бота"""
+    result = _ensure_admin(request, db)
+    if isinstance(result, RedirectResponse):
+        return result
+    if telegram_bot.outbox is None:
+        return JSONResponse({"running": False})
+    return JSONResponse({"running": True, **telegram_bot.outbox.stats()})
+
+
 @router.get("/admin/schedule", include_in_schema=False)
 def admin_schedule(
     request: Request,
@@ -534,7 +613,7 @@ def admin_schedule(
         stores = db.query(Store).all()
 
         # Получаем всех активных сотрудников (опционально фильтруем по магазину) и сортируем как в таблице планирования
-        employees_query = db.query(User).filter(User.is_active == True)
+        employees_query = db.query(User).options(joinedload(User.store)).filter(User.is_active == True)
         if store_id and str(store_id).strip().isdigit():
             employees_query = employees_query.filter(User.store_id == int(store_id))
         employees = employees_query.all()
@@ -561,42 +640,27 @@ def admin_schedule(
         # Массив id сотрудников для выборки
         employee_ids = [e.id for e in employees]
         if employee_ids:
-            month_att = db.query(Attendance).filter(
+            # Первый приход и последний уход за день считает БД по секундам UTC
+            day_bounds = db.query(
+                Attendance.user_id,
+                Attendance.work_date,
+                func.min(Attendance.started_ts),
+                func.max(Attendance.ended_ts),
+            ).filter(
                 Attendance.user_id.in_(employee_ids),
                 Attendance.work_date >= first_day,
                 Attendance.work_date <= last_day,
-            ).all()
+            ).group_by(Attendance.user_id, Attendance.work_date).all()
 
-            # Группируем по (user_id, work_date)
-            from collections import defaultdict
-            grouped = defaultdict(list)
-            for att in month_att:
-                grouped[(att.user_id, att.work_date)].append(att)
-
-            # Для каждого дня берём минимальный приход и максимальный уход (если есть)
-            for (uid, wdate), recs in grouped.items():
-                # Переводим во временную зону Москвы
-                starts = []
-                ends = []
-                for r in recs:
-                    if r.started_at:
-                        starts.append(_to_moscow_time(r.started_at))
-                    if r.ended_at:
-                        ends.append(_to_moscow_time(r.ended_at))
-
-                if starts:
-                    start_min = min(starts)
-                else:
-                    start_min = None
-                end_max = max(ends) if ends else None
+            moscow_tz = timezone(timedelta(hours=3))
 
-                # Форматируем строки времени HH:MM
-                def _fmt(dt):
-                    return dt.strftime('%H:%M') if dt else None
+            def _fmt(ts):
+                return datetime.fromtimestamp(ts, moscow_tz).strftime('%H:%M') if ts is not None else None
 
+            for uid, wdate, start_ts, end_ts in day_bounds:
                 attendance_map[f"{uid}_{wdate}"] = {
-                    "start": _fmt(start_min),
-                    "end": _fmt(end_max),
+                    "start": _fmt(start_ts),
+                    "end": _fmt(end_ts),
                 }
 
         # Определяем типы смен для выпадающего списка
@@ -610,7 +674,7 @@ def admin_schedule(
         ]
 
     except Exception as e:
-        print(f"Ошибка при получении данных для просмотра графика: {e}")
+        logger.exception("Ошибка при получении данных для просмотра графика")
         month_dates = []
         employees = []
         stores = []
@@ -659,6 +723,56 @@ def admin_schedule(
     )
 
 
+def _report_stats(db: Session, employee_ids: List[int], start_date_obj: date, end_date_obj: date) -> dict:
+    """Часы, смены и дни графика по сотрудникам за период.
+
+    Часы — сумма duration_s завершенных сессий, смена — день хотя бы с одной завершенной сессией.
+    """
+    stats = {
+        employee_id: {
+            'total_hours': 0,
+            'working_shifts': 0,
+            'work_days': 0,
+            'days_off': 0,
+            'vacations': 0,
+            'sick_days': 0,
+        }
+        for employee_id in employee_ids
+    }
+    if not employee_ids:
+        return stats
+
+    worked = db.query(
+        Attendance.user_id,
+        func.sum(Attendance.duration_s),
+        func.count(func.distinct(Attendance.work_date)),
+    ).filter(
+        Attendance.user_id.in_(employee_ids),
+        Attendance.work_date >= start_date_obj,
+        Attendance.work_date <= end_date_obj,
+        Attendance.duration_s.isnot(None),
+    ).group_by(Attendance.user_id).all()
+    for user_id, seconds, days in worked:
+        stats[user_id]['total_hours'] = round((seconds or 0) / 3600.0, 2)
+        stats[user_id]['working_shifts'] = days
+
+    shift_keys = {'work': 'work_days', 'off': 'days_off', 'vacation': 'vacations', 'sick': 'sick_days'}
+    shifts = db.query(
+        ScheduleEntry.user_id,
+        ScheduleEntry.shift_type,
+        func.count(ScheduleEntry.id),
+    ).filter(
+        ScheduleEntry.user_id.in_(employee_ids),
+        ScheduleEntry.work_date >= start_date_obj,
+        ScheduleEntry.work_date <= end_date_obj,
+        ScheduleEntry.published == True,
+        ScheduleEntry.shift_type.in_(list(shift_keys)),
+    ).group_by(ScheduleEntry.user_id, ScheduleEntry.shift_type).all()
+    for user_id, shift_type, count in shifts:
+        stats[user_id][shift_keys[shift_type]] = count
+    return stats
+
+
 @router.get("/admin/reports", include_in_schema=False)
 def admin_reports(
     request: Request,
@@ -719,7 +833,7 @@ def admin_reports(
                 end_date_obj = date(today.year, today.month + 1, 1) - timedelta(days=1)
 
         # Получаем всех активных сотрудников (опционально по магазину) и сортируем по магазину, затем по имени
-        employees_query = db.query(User).filter(User.is_active == True)
+        employees_query = db.query(User).options(joinedload(User.store)).filter(User.is_active == True)
         if store_id and str(store_id).strip().isdigit():
             employees_query = employees_query.filter(User.store_id == int(store_id))
         employees = employees_query.all()
@@ -728,81 +842,9 @@ def admin_reports(
             (u.full_name or u.email or "").lower()
         ))
 
-        # Собираем данные для каждого сотрудника
-        report_data = []
-        for employee in employees:
-            # Получаем записи посещаемости за период
-            attendances = db.query(Attendance).filter(
-                Attendance.user_id == employee.id,
-                Attendance.work_date >= start_date_obj,
-                Attendance.work_date <= end_date_obj
-            ).all()
-
-            # Получаем записи расписания за период
-            schedules = db.query(ScheduleEntry).filter(
-                ScheduleEntry.user_id == employee.id,
-                ScheduleEntry.work_date >= start_date_obj,
-                ScheduleEntry.work_date <= end_date_obj,
-                ScheduleEntry.published == True
-            ).all()
-
-            # Рассчитываем статистику - правильно подсчитываем время за каждый день
-            total_hours = 0
-            working_shifts = 0
-            
-            # Группируем записи по дням
-            daily_attendance = {}
-            for att in attendances:
-                work_date = att.work_date
-                if work_date not in daily_attendance:
-                    daily_attendance[work_date] = []
-                daily_attendance[work_date].append(att)
-            
-            # Подсчитываем время для каждого дня
-            for work_date, day_attendances in daily_attendance.items():
-                # Сортируем записи по времени начала
-                day_attendances.sort(key=lambda x: x.started_at)
-                
-                # Подсчитываем общее время за день
-                day_total_seconds = 0
-                day_has_work = False
-                
-                for att in day_attendances:
-                    if att.ended_at is not None:
-                        # Завершенная сессия - добавляем её время
-                        started_at = att.started_at
-                        ended_at = att.ended_at
-                        
-                        # Convert to Moscow timezone for consistent calculations
-                        started_at = _to_moscow_time(started_at)
-                        ended_at = _to_moscow_time(ended_at)
-
-                        session_seconds = (ended_at - started_at).total_seconds()
-                        day_total_seconds += session_seconds
-                        day_has_work = True
-                
-                if day_has_work:
-                    day_hours = day_total_seconds / 3600.0
-                    total_hours += day_hours
-                    working_shifts += 1
-
-            # Считаем типы смен из расписания
-            days_off = len([s for s in schedules if s.shift_type == 'off'])
-            vacations = len([s for s in schedules if s.shift_type == 'vacation'])
-            sick_days = len([s for s in schedules if s.shift_type == 'sick'])
-            work_days = len([s for s in schedules if s.shift_type == 'work'])
-
-            report_data.append({
-                'employee': employee,
-                'total_hours': round(total_hours, 2),
-                'working_shifts': working_shifts,
-                'work_days': work_days,
-                'days_off': days_off,
-                'vacations': vacations,
-                'sick_days': sick_days,
-                'attendances': attendances,
-                'schedules': schedules
-            })
+        # Два агрегирующих запроса на весь отчет вместо двух запросов на сотрудника
+        stats_by_user = _report_stats(db, [e.id for e in employees], start_date_obj, end_date_obj)
+        report_data = [{'employee': employee, **stats_by_user[employee.id]} for employee in employees]
 
         # Общая статистика
         total_employees = len(employees)
@@ -833,7 +875,7 @@ def admin_reports(
         selected_year = year if year is not None else today.year
 
     except Exception as e:
-        print(f"Ошибка при получении отчетов: {e}")
+        logger.exception("Ошибка при получении отчетов")
         report_data = []
         total_employees = 0
         total_hours_all = 0
@@ -926,76 +968,9 @@ def export_reports(
             employees_query = employees_query.filter(User.store_id == store_id)
         employees = employees_query.order_by(User.full_name).all()
 
-        # Собираем данные для каждого сотрудника
-        report_data = []
-        for employee in employees:
-            attendances = db.query(Attendance).filter(
-                Attendance.user_id == employee.id,
-                Attendance.work_date >= start_date_obj,
-                Attendance.work_date <= end_date_obj
-            ).all()
-
-            schedules = db.query(ScheduleEntry).filter(
-                ScheduleEntry.user_id == employee.id,
-                ScheduleEntry.work_date >= start_date_obj,
-                ScheduleEntry.work_date <= end_date_obj,
-                ScheduleEntry.published == True
-            ).all()
-
-            # Рассчитываем статистику - правильно подсчитываем время за каждый день
-            total_hours = 0
-            working_shifts = 0
-            
-            # Группируем записи по дням
-            daily_attendance = {}
-            for att in attendances:
-                work_date = att.work_date
-                if work_date not in daily_attendance:
-                    daily_attendance[work_date] = []
-                daily_attendance[work_date].append(att)
-            
-            # Подсчитываем время для каждого дня
-            for work_date, day_attendances in daily_attendance.items():
-                # Сортируем записи по времени начала
-                day_attendances.sort(key=lambda x: x.started_at)
-                
-                # Подсчитываем общее время за день
-                day_total_seconds = 0
-                day_has_work = False
-                
-                for att in day_attendances:
-                    if att.ended_at is not None:
-                        # Завершенная сессия - добавляем её время
-                        started_at = att.started_at
-                        ended_at = att.ended_at
-                        
-                        # Convert to Moscow timezone for consistent calculations
-                        started_at = _to_moscow_time(started_at)
-                        ended_at = _to_moscow_time(ended_at)
-
-                        session_seconds = (ended_at - started_at).total_seconds()
-                        day_total_seconds += session_seconds
-                        day_has_work = True
-                
-                if day_has_work:
-                    day_hours = day_total_seconds / 3600.0
-                    total_hours += day_hours
-                    working_shifts += 1
-
-            days_off = len([s for s in schedules if s.shift_type == 'off'])
-            vacations = len([s for s in schedules if s.shift_type == 'vacation'])
-            sick_days = len([s for s in schedules if s.shift_type == 'sick'])
-            work_days = len([s for s in schedules if s.shift_type == 'work'])
-
-            report_data.append({
-                'employee': employee,
-                'total_hours': round(total_hours, 2),
-                'working_shifts': working_shifts,
-                'work_days': work_days,
-                'days_off': days_off,
-                'vacations': vacations,
-                'sick_days': sick_days,
-            })
+        # Два агрегирующих запроса на весь отчет вместо двух запросов на сотрудника
+        stats_by_user = _report_stats(db, [e.id for e in employees], start_date_obj, end_date_obj)
+        report_data = [{'employee': employee, **stats_by_user[employee.id]} for employee in employees]
 
         # Создаем Excel файл
         wb = Workbook()
@@ -1149,7 +1124,7 @@ def export_reports(
         )
 
     except Exception as e:
-        print(f"Ошибка при экспорте в Excel: {e}")
+        logger.exception("Ошибка при экспорте в Excel")
         return RedirectResponse(
             url="/admin/reports?error=export_failed",
             status_code=status.HTTP_303_SEE_OTHER
@@ -1188,7 +1163,7 @@ def admin_attendance(
         ).order_by(Attendance.work_date.desc(), Attendance.started_at.desc()).limit(10).all()
 
     except Exception as e:
-        print(f"Ошибка при получении данных о присутствии: {e}")
+        logger.exception("Ошибка при получении данных о присутствии")
         employees = []
         attendance_record = None
         recent_attendances = []
@@ -1318,7 +1293,7 @@ def save_attendance(
                 )
 
     except Exception as e:
-        print(f"Ошибка при сохранении присутствия: {e}")
+        logger.exception("Ошибка при сохранении присутствия")
         return RedirectResponse(
             url=f"/admin/attendance?employee_id={employee_id}&selected_date={work_date}&error=server_error",
             status_code=status.HTTP_303_SEE_OTHER
@@ -1353,7 +1328,7 @@ def delete_attendance(attendance_id: int, request: Request, db: Session = Depend
             db.commit()
         except Exception as e:
             db.rollback()
-            print(f"Ошибка при удалении присутствия (id={attendance_id}): {e}")
+            logger.exception("Ошибка при удалении присутствия (id=%s)", attendance_id)
             return RedirectResponse(
                 url=f"/admin/attendance?employee_id={employee_id}&selected_date={work_date}&error=delete_error",
                 status_code=status.HTTP_303_SEE_OTHER
@@ -1365,7 +1340,7 @@ def delete_attendance(attendance_id: int, request: Request, db: Session = Depend
         )
 
     except Exception as e:
-        print(f"Ошибка при удалении присутствия (общая): {e}")
+        logger.exception("Ошибка при удалении присутствия (общая)")
         return RedirectResponse(
             url="/admin/attendance?error=delete_error",
             status_code=status.HTTP_303_SEE_OTHER
@@ -1389,7 +1364,7 @@ def admin_stores(request: Request, db: Session = Depends(get_db)):
         stores = db.query(Store).all()
         
     except Exception as e:
-        print(f"Ошибка при получении магазинов: {e}")
+        logger.exception("Ошибка при получении магазинов")
         stores = []
     
     return templates.TemplateResponse(
@@ -1415,11 +1390,37 @@ def regenerate_store_qr(store_id: int, request: Request, db: Session = Depends(g
         return RedirectResponse(url="/admin/stores?error=store_not_found", status_code=status.HTTP_303_SEE_OTHER)
 
     store.qr_token = secrets.token_urlsafe(24)
+    # Ранее выданные подписанные QR-токены магазина перестают приниматься
+    store.qr_generation = (store.qr_generation or 0) + 1
     db.add(store)
     db.commit()
     return RedirectResponse(url=f"/admin/stores?ok=qr_updated", status_code=status.HTTP_303_SEE_OTHER)
 
 
+def _store_qr_token(store: Store, action: str) -> str:
+    if QR_TOKEN_FORMAT == "signed":
+        return generate_qr_token(store, action)
+    return store.qr_token
+
+
+def _telegram_bot_username() -> str:
+    bot_username = os.getenv("TELEGRAM_BOT_USERNAME", "").strip()
+    if not bot_username:
+        # Fallback: try to read from .env in app root (container/host)
+        try:
+            env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".env"))
+            if os.path.exists(env_path):
+                with open(env_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if line.startswith("TELEGRAM_BOT_USERNAME="):
+                            bot_username = line.split("=", 1)[1].strip()
+                            break
+        except Exception:
+            bot_username = bot_username
+    return bot_username
+
+
 @router.get("/admin/stores/{store_id}/qr.png", include_in_schema=False)
 def store_qr_image(store_id: int, request: Request, db: Session = Depends(get_db)):
     result = _ensure_admin(request, db)
@@ -1431,13 +1432,10 @@ def store_qr_image(store_id: int, request: Request, db: Session = Depends(get_db
         return RedirectResponse(url="/admin/stores?error=no_qr", status_code=status.HTTP_303_SEE_OTHER)
 
     base_url = str(request.base_url).rstrip('/')
-    qr_url = f"{base_url}/q/start/{store.qr_token}"
+    qr_url = f"{base_url}/q/start/{_store_qr_token(store, 'start')}"
 
-    img = qrcode.make(qr_url)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="image/png")
+    # Ротируемый токен нельзя кэшировать
+    return Response(qr_png(qr_url), media_type="image/png", headers={"Cache-Control": "no-store"})
 
 
 @router.get("/admin/stores/{store_id}/qr-stop.png", include_in_schema=False)
@@ -1451,13 +1449,28 @@ def store_qr_stop_image(store_id: int, request: Request, db: Session = Depends(g
         return RedirectResponse(url="/admin/stores?error=no_qr", status_code=status.HTTP_303_SEE_OTHER)
 
     base_url = str(request.base_url).rstrip('/')
-    qr_url = f"{base_url}/q/stop/{store.qr_token}"
+    qr_url = f"{base_url}/q/stop/{_store_qr_token(store, 'stop')}"
 
-    img = qrcode.make(qr_url)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="image/png")
+    # Ротируемый токен нельзя кэшировать
+    return Response(qr_png(qr_url), media_type="image/png", headers={"Cache-Control": "no-store"})
+
+
+@router.get("/admin/stores/{store_id}/qr-live", include_in_schema=False)
+def store_qr_live(store_id: int, request: Request, db: Session = Depends(get_db)):
+    """Страница для экрана в магазине: QR прихода и ухода обновляются вместе с окном ротации"""
+    result = _ensure_admin(request, db)
+    if isinstance(result, RedirectResponse):
+        return result
+
+    store = db.get(Store, store_id)
+    if not store or not store.qr_token:
+        return RedirectResponse(url="/admin/stores?error=no_qr", status_code=status.HTTP_303_SEE_OTHER)
+
+    refresh_ms = max(5, QR_TOKEN_ROTATION_SECONDS // 2 or 300) * 1000
+    return templates.TemplateResponse(
+        "store_qr_live.html",
+        {"request": request, "store": store, "refresh_ms": refresh_ms},
+    )
 
 
 @router.get("/admin/stores/{store_id}/qr-bot.png", include_in_schema=False)
@@ -1470,30 +1483,101 @@ def store_qr_bot_image(store_id: int, request: Request, db: Session = Depends(ge
     if not store or not store.qr_token:
         return RedirectResponse(url="/admin/stores?error=no_qr", status_code=status.HTTP_303_SEE_OTHER)
 
-    bot_username = os.getenv("TELEGRAM_BOT_USERNAME", "").strip()
-    if not bot_username:
-        # Fallback: try to read from .env in app root (container/host)
-        try:
-            env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".env"))
-            if os.path.exists(env_path):
-                with open(env_path, "r", encoding="utf-8") as f:
-                    for line in f:
-                        line = line.strip()
-                        if line.startswith("TELEGRAM_BOT_USERNAME="):
-                            bot_username = line.split("=", 1)[1].strip()
-                            break
-        except Exception:
-            bot_username = bot_username
+    bot_username = _telegram_bot_username()
     if not bot_username:
         return RedirectResponse(url="/admin/stores?error=bot_username_missing", status_code=status.HTTP_303_SEE_OTHER)
 
     bot_link = f"https://t.me/{bot_username}?start=qr_{store.qr_token}"
+    return Response(qr_png(bot_link), media_type="image/png")
 
-    img = qrcode.make(bot_link)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="image/png")
+
+@router.get("/admin/profiles", include_in_schema=False)
+def admin_profiles(request: Request, db: Session = Depends(get_db)):
+    """Сохраненные профили запросов (PROFILER_ENABLED=1, заголовок X-Profile: 1)"""
+    result = _ensure_admin(request, db)
+    if isinstance(result, RedirectResponse):
+        return result
+
+    profiles = [{**item, "created": datetime.fromtimestamp(item["mtime"])} for item in list_profiles()]
+    return templates.TemplateResponse(
+        "admin_profiles.html",
+        {"request": request, "title": "Профили запросов", "profiles": profiles},
+    )
+
+
+@router.get("/admin/profiles/{profile_id}", include_in_schema=False)
+def admin_profile_download(profile_id: str, request: Request, format: str = "html", db: Session = Depends(get_db)):
+    result = _ensure_admin(request, db)
+    if isinstance(result, RedirectResponse):
+        return result
+
+    folded = format == "folded"
+    path = profile_path(profile_id, ".folded" if folded else ".html")
+    if path is None:
+        return Response(status_code=404)
+    if folded:
+        return FileResponse(path, media_type="text/plain; charset=utf-8", filename=f"{profile_id}.folded")
+    return FileResponse(path, media_type="text/html; charset=utf-8")
+
+
+@router.get("/admin/slow-queries", include_in_schema=False)
+def admin_slow_queries(request: Request, db: Session = Depends(get_db)):
+    """Формы SQL-запросов с наибольшим суммарным временем по всем процессам, с планами"""
+    result = _ensure_admin(request, db)
+    if isinstance(result, RedirectResponse):
+        return result
+
+    return templates.TemplateResponse(
+        "admin_slow_queries.html",
+        {
+            "request": request,
+            "title": "Медленные запросы",
+            "statements": statement_stats.top(),
+            "slow_query_ms": SLOW_QUERY_MS,
+        },
+    )
+
+
+@router.get("/admin/stores/qr-sheet", include_in_schema=False)
+def store_qr_sheet(request: Request, format: str = "pdf", db: Session = Depends(get_db)):
+    """Все QR активных магазинов одним файлом: PDF для печати (страница на магазин) или ZIP с PNG"""
+    result = _ensure_admin(request, db)
+    if isinstance(result, RedirectResponse):
+        return result
+
+    if QR_TOKEN_FORMAT == "signed" and QR_TOKEN_ROTATION_SECONDS > 0:
+        # Напечатанный ротируемый токен перестанет приниматься через пару окон ротации,
+        # а бессрочный подписанный токен обесценил бы ротацию — для магазинов есть экран qr-live
+        return RedirectResponse(url="/admin/stores?error=qr_sheet_rotating", status_code=status.HTTP_303_SEE_OTHER)
+
+    base_url = str(request.base_url).rstrip('/')
+    bot_username = _telegram_bot_username()
+    stores = (
+        db.query(Store)
+        .filter(Store.is_active == True, Store.qr_token.isnot(None))
+        .order_by(Store.name)
+        .all()
+    )
+    sheet = []
+    for store in stores:
+        codes = [
+            ("Приход", f"{base_url}/q/start/{_store_qr_token(store, 'start')}"),
+            ("Уход", f"{base_url}/q/stop/{_store_qr_token(store, 'stop')}"),
+        ]
+        if bot_username:
+            codes.append(("Бот", f"https://t.me/{bot_username}?start=qr_{store.qr_token}"))
+        sheet.append((store.name, codes))
+
+    if format == "zip":
+        content, media_type, extension = build_qr_zip(sheet), "application/zip", "zip"
+    else:
+        content, media_type, extension = build_qr_pdf(sheet), "application/pdf", "pdf"
+    filename = f"store_qr_{date.today().isoformat()}.{extension}"
+    return Response(
+        content,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 @router.get("/admin/employees", include_in_schema=False)
@@ -1510,7 +1594,7 @@ def admin_employees(request: Request, db: Session = Depends(get_db)):
         stores = db.query(Store).all()
         
     except Exception as e:
-        print(f"Ошибка при получении данных: {e}")
+        logger.exception("Ошибка при получении данных")
         employees = []
         stores = []
     
@@ -1559,7 +1643,7 @@ def assign_store_to_employee(
         return RedirectResponse(url="/admin/employees?success=store_assigned", status_code=status.HTTP_303_SEE_OTHER)
         
     except Exception as e:
-        print(f"Ошибка при назначении магазина: {e}")
+        logger.exception("Ошибка при назначении магазина")
         return RedirectResponse(url="/admin/employees?error=server_error", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -1581,12 +1665,15 @@ def toggle_employee_status(
         
         # Переключаем статус
         employee.is_active = not employee.is_active
+        if not employee.is_active:
+            # Деактивированный сотрудник сразу теряет открытые веб-сессии
+            revoke_user_sessions(db, employee.id)
         db.commit()
         
         return RedirectResponse(url="/admin/employees?success=status_changed", status_code=status.HTTP_303_SEE_OTHER)
         
     except Exception as e:
-        print(f"Ошибка при изменении статуса: {e}")
+        logger.exception("Ошибка при изменении статуса")
         return RedirectResponse(url="/admin/employees?error=server_error", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -1615,7 +1702,7 @@ def create_store(
         return RedirectResponse(url="/admin/stores?success=created", status_code=status.HTTP_303_SEE_OTHER)
         
     except Exception as e:
-        print(f"Ошибка при создании магазина: {e}")
+        logger.exception("Ошибка при создании магазина")
 @router.get("/admin/allowed-ips", include_in_schema=False)
 def admin_allowed_ips(request: Request, db: Session = Depends(get_db)):
     result = _ensure_admin(request, db)
@@ -1627,7 +1714,7 @@ def admin_allowed_ips(request: Request, db: Session = Depends(get_db)):
         allowed_ips = db.query(AllowedIP).order_by(AllowedIP.created_at.desc()).all()
 
     except Exception as e:
-        print(f"Ошибка при получении разрешенных IP: {e}")
+        logger.exception("Ошибка при получении разрешенных IP")
         allowed_ips = []
 
     return templates.TemplateResponse(
@@ -1675,7 +1762,7 @@ def create_allowed_ip(
         return RedirectResponse(url="/admin/allowed-ips?success=created", status_code=status.HTTP_303_SEE_OTHER)
 
     except Exception as e:
-        print(f"Ошибка при создании разрешенного IP: {e}")
+        logger.exception("Ошибка при создании разрешенного IP")
         return RedirectResponse(url="/admin/allowed-ips?error=server_error", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -1694,7 +1781,7 @@ def delete_allowed_ip(ip_id: int, request: Request, db: Session = Depends(get_db
         return RedirectResponse(url="/admin/allowed-ips?success=deleted", status_code=status.HTTP_303_SEE_OTHER)
 
     except Exception as e:
-        print(f"Ошибка при удалении разрешенного IP: {e}")
+        logger.exception("Ошибка при удалении разрешенного IP")
         return RedirectResponse(url="/admin/allowed-ips?error=delete_error", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -1713,6 +1800,6 @@ def toggle_allowed_ip_status(ip_id: int, request: Request, db: Session = Depends
         return RedirectResponse(url="/admin/allowed-ips?success=status_changed", status_code=status.HTTP_303_SEE_OTHER)
 
     except Exception as e:
-        print(f"Ошибка при изменении статуса IP: {e}")
+        logger.exception("Ошибка при изменении статуса IP")
         return RedirectResponse(url="/admin/allowed-ips?error=status_error", status_code=status.HTTP_303_SEE_OTHER)
         return RedirectResponse(url="/admin/stores?error=server_error", status_code=status.HTTP_303_SEE_OTHER)
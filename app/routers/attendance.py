@@ -2,8 +2,9 @@ from datetime import datetime, date, timezone, timedelta
 from typing import Optional
 
 from fastapi import APIRouter, Depends, Request, status, Form
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
+from sqlalchemy import case, func
 from sqlalchemy.orm import Session
 
 from app.database import get_db
@@ -12,8 +13,19 @@ from fastapi.responses import StreamingResponse
 import io
 import os
 from app.security import create_access_token, SECRET_KEY
+from app.qr_tokens import is_signed_qr_token, verify_qr_token
+from app.checkin import check_in
+from app.daily_totals import day_state
+
+try:
+    # orjson заметно быстрее стандартного json на горячем пути WebApp; без него — обычный JSONResponse
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:
+    FastJSONResponse = JSONResponse
 from datetime import timedelta
 import hmac, hashlib, time, base64
+import secrets
 
 
 router = APIRouter()
@@ -87,34 +99,19 @@ def _calculate_total_work_time_today(user_id: int, db: Session, current_time: da
     # Ensure current_time is in Moscow timezone
     current_time = _to_moscow_time(current_time)
     today = current_time.date()
-    total_work_seconds = 0
 
-    # Get all attendance records for today
-    today_records = (
-        db.query(Attendance)
-        .filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today
+    # Закрытые сессии суммируются в SQL по duration_s, для активной берем started_ts
+    closed_seconds, open_started_ts = (
+        db.query(
+            func.coalesce(func.sum(Attendance.duration_s), 0),
+            func.max(case((Attendance.ended_ts.is_(None), Attendance.started_ts))),
         )
-        .order_by(Attendance.started_at)
-        .all()
+        .filter(Attendance.user_id == user_id, Attendance.work_date == today)
+        .one()
     )
-
-    # Calculate total time from all completed sessions
-    for record in today_records:
-        if record.ended_at is not None:
-            # This session is completed, add its duration
-            started_at = _to_moscow_time(record.started_at)
-            ended_at = _to_moscow_time(record.ended_at)
-
-            session_seconds = (ended_at - started_at).total_seconds()
-            total_work_seconds += session_seconds
-        else:
-            # This is the active session, add time from start to now
-            started_at = _to_moscow_time(record.started_at)
-
-            current_session_seconds = (current_time - started_at).total_seconds()
-            total_work_seconds += current_session_seconds
+    total_work_seconds = closed_seconds
+    if open_started_ts is not None:
+        total_work_seconds += int(current_time.timestamp()) - open_started_ts
 
     return total_work_seconds / 3600.0  # Convert to hours
 
@@ -492,6 +489,8 @@ def dashboard(request: Request, db: Session = Depends(get_db)):
             "title": "Dashboard",
             "user": user,
             "is_active": bool(active),
+            # Ключ идемпотентности формы «Я пришел»: двойное нажатие не откроет вторую смену
+            "checkin_key": secrets.token_urlsafe(16),
             "start_time": _to_moscow_time(active.started_at) if active else None,  # Moscow time for display
             "start_time_moscow": active.started_at if active else None,  # Moscow time for JavaScript
             "total_work_hours_today": total_work_hours_today,
@@ -515,7 +514,7 @@ def dashboard(request: Request, db: Session = Depends(get_db)):
 
 
 @router.post("/attendance/start", include_in_schema=False)
-def start_attendance(request: Request, db: Session = Depends(get_db)):
+def start_attendance(request: Request, idempotency_key: str = Form(None), db: Session = Depends(get_db)):
     user = _get_current_user(request, db)
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
@@ -524,53 +523,18 @@ def start_attendance(request: Request, db: Session = Depends(get_db)):
     if not _check_ip_allowed(request, db):
         return RedirectResponse(url="/dashboard?error=ip_not_allowed", status_code=status.HTTP_303_SEE_OTHER)
 
-    # Перед стартом новой смены закроем зависшие смены прошлых дней
-    _auto_close_overdue_session(user.id, db)
-
-    now = _get_moscow_time()
-    today = now.date()
-
-    # If already started today, just redirect
-    existing_active = (
-        db.query(Attendance)
-        .filter(Attendance.user_id == user.id, Attendance.ended_at.is_(None))
-        .first()
-    )
-    if existing_active:
-        return RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
+    # Одна вставка: уже открытая смена или повтор формы с тем же ключом новую не создают,
+    # зависшие смены прошлых дней закрываются внутри сервиса
+    check_in(db, user.id, idempotency_key=idempotency_key)
+    return RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
 
-    # Check if there's a completed record for today that we can continue
-    existing_today = (
-        db.query(Attendance)
-        .filter(
-            Attendance.user_id == user.id, 
-            Attendance.work_date == today,
-            Attendance.ended_at.isnot(None)
-        )
-        .order_by(Attendance.ended_at.desc())
-        .first()
-    )
 
-    if existing_today:
-        # Continue the previous timer by creating a new session
-        # We don't modify the existing record, we create a new one
-        record = Attendance(
-            user_id=user.id,
-            started_at=now,
-            work_date=today,
-        )
-        db.add(record)
-    else:
-        # Create new record
-        record = Attendance(
-            user_id=user.id,
-            started_at=now,
-            work_date=today,
-        )
-        db.add(record)
-    
-    db.commit()
-    return RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
+def _resolve_qr_store(token: str, action: str, db: Session) -> Optional[int]:
+    """Возвращает id магазина по QR-токену: подписанный проверяется без запроса к БД"""
+    if is_signed_qr_token(token):
+        return verify_qr_token(token, action)
+    store = db.query(Store.id).filter(Store.qr_token == token, Store.is_active == True).first()
+    return store.id if store else None
 
 
 # QR-based attendance: user scans QR that encodes a URL like /q/start/{token}
@@ -580,34 +544,18 @@ def qr_start(token: str, request: Request, db: Session = Depends(get_db)):
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
 
-    store = db.query(Store).filter(Store.qr_token == token, Store.is_active == True).first()
-    if not store:
+    store_id = _resolve_qr_store(token, "start", db)
+    if not store_id:
         return RedirectResponse(url="/dashboard?error=qr_invalid", status_code=status.HTTP_303_SEE_OTHER)
 
     # Optional: ensure user belongs to the store if assigned
-    if user.store_id and user.store_id != store.id:
+    if user.store_id and user.store_id != store_id:
         return RedirectResponse(url="/dashboard?error=qr_wrong_store", status_code=status.HTTP_303_SEE_OTHER)
 
-    # Перед запуском по QR: авто-закрытие зависших смен
-    _auto_close_overdue_session(user.id, db)
-
     # Start attendance (QR bypasses IP check as presence proof)
-    existing = (
-        db.query(Attendance)
-        .filter(Attendance.user_id == user.id, Attendance.ended_at.is_(None))
-        .first()
-    )
-    if existing:
+    result = check_in(db, user.id)
+    if result.status == "already_active":
         return RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
-
-    now = _get_moscow_time()
-    record = Attendance(
-        user_id=user.id,
-        started_at=now,
-        work_date=now.date(),
-    )
-    db.add(record)
-    db.commit()
     return RedirectResponse(url="/dashboard?ok=started", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -617,11 +565,11 @@ def qr_stop(token: str, request: Request, db: Session = Depends(get_db)):
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
 
-    store = db.query(Store).filter(Store.qr_token == token, Store.is_active == True).first()
-    if not store:
+    store_id = _resolve_qr_store(token, "stop", db)
+    if not store_id:
         return RedirectResponse(url="/dashboard?error=qr_invalid", status_code=status.HTTP_303_SEE_OTHER)
 
-    if user.store_id and user.store_id != store.id:
+    if user.store_id and user.store_id != store_id:
         return RedirectResponse(url="/dashboard?error=qr_wrong_store", status_code=status.HTTP_303_SEE_OTHER)
 
     active = (
@@ -859,7 +807,7 @@ def tg_app(request: Request, token: str = "", db: Session = Depends(get_db)):
 
 
 @router.post("/tgapi/checkin", include_in_schema=False)
-def tgapi_checkin(token: str = Form(...), db: Session = Depends(get_db)):
+def tgapi_checkin(token: str = Form(...), idempotency_key: str = Form(None), db: Session = Depends(get_db)):
     user_id = _verify_compact_token(token)
     if not user_id:
         return JSONResponse({"ok": False, "error": "invalid_token"}, status_code=401)
@@ -867,23 +815,11 @@ def tgapi_checkin(token: str = Form(...), db: Session = Depends(get_db)):
     if not user or not user.is_active:
         return JSONResponse({"ok": False, "error": "user_inactive"}, status_code=403)
 
-    # Авто-закрытие зависших смен перед началом новой
-    _auto_close_overdue_session(user.id, db)
-
     now = _get_moscow_time()
-    today = now.date()
-    existing = (
-        db.query(Attendance)
-        .filter(Attendance.user_id == user.id, Attendance.work_date == today, Attendance.ended_at.is_(None))
-        .first()
-    )
-    if existing:
+    result = check_in(db, user.id, now, idempotency_key)
+    if result.status == "already_active":
         return JSONResponse({"ok": True, "status": "already_active"})
-
-    record = Attendance(user_id=user.id, started_at=now, work_date=today)
-    db.add(record)
-    db.commit()
-    return JSONResponse({"ok": True, "status": "started", "time": now.strftime('%H:%M')})
+    return JSONResponse({"ok": True, "status": "started", "time": result.started_at.strftime('%H:%M')})
 
 
 @router.post("/tgapi/checkout", include_in_schema=False)
@@ -930,6 +866,79 @@ def tgapi_checkout(token: str = Form(...), db: Session = Depends(get_db)):
     return JSONResponse({"ok": True, "status": "stopped", "time": now.strftime('%H:%M')})
 
 
+# ===== Telegram WebApp API v2: JSON, токен в заголовке Authorization: Bearer <token> =====
+def _tgapi_v2_user(request: Request, db: Session):
+    """Возвращает (user, None) или (None, ответ с ошибкой)"""
+    authorization = request.headers.get("Authorization", "")
+    token = authorization[7:] if authorization.startswith("Bearer ") else ""
+    user_id = _verify_compact_token(token) if token else None
+    if not user_id:
+        return None, FastJSONResponse({"ok": False, "error": "invalid_token"}, status_code=401)
+    user = db.get(User, user_id)
+    if not user or not user.is_active:
+        return None, FastJSONResponse({"ok": False, "error": "user_inactive"}, status_code=403)
+    return user, None
+
+
+def _tgapi_v2_state(status_name: str, state: dict, now: datetime):
+    started_at = state["started_at"]
+    return FastJSONResponse({
+        "ok": True,
+        "status": status_name,
+        "on_shift": state["on_shift"],
+        "started_at": started_at.strftime('%H:%M') if started_at else None,
+        "worked_seconds": state["worked_seconds"],
+        "time": now.strftime('%H:%M'),
+    })
+
+
+@router.get("/tgapi/v2/state", include_in_schema=False)
+def tgapi_v2_state(request: Request, db: Session = Depends(get_db)):
+    user, error = _tgapi_v2_user(request, db)
+    if error:
+        return error
+    now = _get_moscow_time()
+    return _tgapi_v2_state("ok", day_state(db, user.id, now.date(), now), now)
+
+
+@router.post("/tgapi/v2/checkin", include_in_schema=False)
+def tgapi_v2_checkin(request: Request, db: Session = Depends(get_db)):
+    user, error = _tgapi_v2_user(request, db)
+    if error:
+        return error
+
+    now = _get_moscow_time()
+    user_id = user.id
+    result = check_in(db, user_id, now, request.headers.get("Idempotency-Key"))
+    state = day_state(db, user_id, now.date(), now)
+    return _tgapi_v2_state("already_active" if result.status == "already_active" else "started", state, now)
+
+
+@router.post("/tgapi/v2/checkout", include_in_schema=False)
+def tgapi_v2_checkout(request: Request, db: Session = Depends(get_db)):
+    user, error = _tgapi_v2_user(request, db)
+    if error:
+        return error
+
+    now = _get_moscow_time()
+    today = now.date()
+    active = (
+        db.query(Attendance)
+        .filter(Attendance.user_id == user.id, Attendance.work_date == today, Attendance.ended_at.is_(None))
+        .first()
+    )
+    if not active:
+        return FastJSONResponse({"ok": False, "error": "no_active"}, status_code=400)
+
+    # Итог дня берем из daily_totals: закрытые смены уже просуммированы
+    state = day_state(db, user.id, today, now)
+    active.ended_at = now
+    # Итог дня на момент ухода, включая закрываемую смену
+    active.hours = round(state["worked_seconds"] / 3600.0, 4)
+    db.commit()
+    return _tgapi_v2_state("stopped", {**state, "on_shift": False, "started_at": None}, now)
+
+
 # Public test endpoint to verify deployment/version
 @router.get("/tg-link-test", include_in_schema=False)
 def tg_link_test():
@@ -5,10 +5,16 @@ from fastapi import APIRouter, Depends, Form, Request, status
 from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from app.database import get_db
 from app.models import User
-from app.security import create_refresh_token, hash_password, verify_password
+from app.security import (
+    PasswordHashBusy,
+    create_refresh_token,
+    hash_password_async,
+    verify_and_update_password_async,
+)
 
 
 router = APIRouter()
@@ -29,8 +35,20 @@ def register_page(request: Request):
     )
 
 
+def _user_by_email(db: Session, email: str) -> Optional[User]:
+    return db.query(User).filter(User.email == email).first()
+
+
+def _busy_response(request: Request, template: str, title: str):
+    return templates.TemplateResponse(
+        template,
+        {"request": request, "title": title, "error": "Сервер перегружен, попробуйте через минуту", "success": False},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
 @router.post("/register", include_in_schema=False)
-def register_user(
+async def register_user(
     request: Request,
     email: str = Form(...),
     password: str = Form(...),
@@ -58,7 +76,9 @@ def register_user(
                 status_code=status.HTTP_400_BAD_REQUEST,
             )
 
-    existing = db.query(User).filter(User.email == email).first()
+    # Обработчик асинхронный (ждет пул хэширования), поэтому запросы к БД — в пуле потоков,
+    # а не в цикле событий
+    existing = await run_in_threadpool(_user_by_email, db, email)
     if existing:
         return templates.TemplateResponse(
             "register.html",
@@ -71,15 +91,20 @@ def register_user(
             status_code=status.HTTP_400_BAD_REQUEST,
         )
 
+    try:
+        password_hash = await hash_password_async(password)
+    except PasswordHashBusy:
+        return _busy_response(request, "register.html", "Регистрация")
+
     user = User(
         email=email,
         full_name=full_name or None,
-        password_hash=hash_password(password),
+        password_hash=password_hash,
         role=role_normalized,
         date_of_birth=date_of_birth,
     )
     db.add(user)
-    db.commit()
+    await run_in_threadpool(db.commit)
 
     return RedirectResponse(url="/register?success=1", status_code=status.HTTP_303_SEE_OTHER)
 
@@ -97,14 +122,14 @@ def login_page(request: Request):
 
 
 @router.post("/login", include_in_schema=False)
-def login(
+async def login(
     request: Request,
     email: str = Form(...),
     password: str = Form(...),
     remember_me: str = Form(None),
     db: Session = Depends(get_db),
 ):
-    user = db.query(User).filter(User.email == email).first()
+    user = await run_in_threadpool(_user_by_email, db, email)
     if not user:
         return templates.TemplateResponse(
             "login.html",
@@ -112,21 +137,34 @@ def login(
             status_code=status.HTTP_400_BAD_REQUEST,
         )
 
-    if not verify_password(password, user.password_hash):
+    # bcrypt выполняется в отдельном пуле, цикл событий и общий пул потоков свободны
+    try:
+        verified, new_hash = await verify_and_update_password_async(password, user.password_hash)
+    except PasswordHashBusy:
+        return _busy_response(request, "login.html", "Вход")
+
+    if not verified:
         return templates.TemplateResponse(
             "login.html",
             {"request": request, "title": "Вход", "error": "Неверная почта или пароль"},
             status_code=status.HTTP_400_BAD_REQUEST,
         )
 
-    request.session["user_id"] = user.id
-    request.session["role"] = user.role
+    # Читаем до коммита: после него атрибуты перечитывались бы из БД прямо в цикле событий
+    user_id, user_role, user_email = user.id, user.role, user.email
+    if new_hash:
+        # Параметры хэширования изменились (например, BCRYPT_ROUNDS) — сохраняем новый хэш
+        user.password_hash = new_hash
+        await run_in_threadpool(db.commit)
+
+    request.session["user_id"] = user_id
+    request.session["role"] = user_role
 
     response = RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
 
     # If remember_me is checked, set refresh token cookie
     if remember_me:
-        refresh_token = create_refresh_token({"sub": str(user.id), "email": user.email})
+        refresh_token = create_refresh_token({"sub": str(user_id), "email": user_email})
         response.set_cookie(
             key="refresh_token",
             value=refresh_token,
@@ -1,11 +1,149 @@
-from fastapi import APIRouter
+"""Проверки состояния сервиса.
 
+/health/live — процесс жив и обслуживает запросы (без обращения к зависимостям).
+/health/ready — БД отвечает, схема соответствует моделям, на дисках с базой
+и резервными копиями есть место; плюс справочно — зависшие смены и бот.
+Результат готовности кэшируется на HEALTH_CACHE_SECONDS, чтобы частые
+пробы не нагружали БД.
+"""
+
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import APIRouter, Header
+from sqlalchemy import func, select, text
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+
+from app.checkin import last_overdue_sweep
+from app.database import engine
+from app.metrics import metrics_authorized, registry
+from app.migrations import pending_schema_changes
+from app.models import Attendance
+
+
+HEALTH_CACHE_SECONDS = float(os.getenv("HEALTH_CACHE_SECONDS", "5"))
+HEALTH_MIN_FREE_MB = int(os.getenv("HEALTH_MIN_FREE_MB", "200"))
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(__file__), "..", "..", "backups"))
 
 router = APIRouter()
 
+_started_at = time.time()
+_ready_lock = threading.Lock()
+_ready_cache: Optional[Tuple[float, int, Dict]] = None
+
 
 @router.get("/health")
 def health():
     return {"status": "ok"}
 
 
+@router.get("/health/live")
+def health_live():
+    return {"status": "ok", "pid": os.getpid(), "uptime_seconds": int(time.time() - _started_at)}
+
+
+def _check_database() -> Dict:
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1")).scalar()
+    return {"ok": True}
+
+
+def _check_migrations() -> Dict:
+    pending = pending_schema_changes(engine)
+    return {"ok": not pending, "pending": pending}
+
+
+def _existing_dir(path: str) -> str:
+    # Каталога еще может не быть (копий не делали) — место считаем по ближайшему существующему
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def _check_disk() -> Dict:
+    paths = {"backups": BACKUP_DIR}
+    if engine.url.get_backend_name() == "sqlite" and engine.url.database:
+        paths["database"] = os.path.dirname(os.path.abspath(engine.url.database))
+    result = {"ok": True, "min_free_mb": HEALTH_MIN_FREE_MB}
+    for name, path in paths.items():
+        free_mb = shutil.disk_usage(_existing_dir(path)).free // (1024 * 1024)
+        result[name] = {"path": os.path.abspath(path), "free_mb": free_mb}
+        if free_mb < HEALTH_MIN_FREE_MB:
+            result["ok"] = False
+    return result
+
+
+def _check_overdue_shifts() -> Dict:
+    today = datetime.now(timezone(timedelta(hours=3))).date()
+    with engine.connect() as connection:
+        # Открытые смены идут по частичному индексу ux_attendance_open
+        overdue = connection.execute(
+            select(func.count()).where(Attendance.ended_at.is_(None), Attendance.work_date < today)
+        ).scalar()
+    # Последний запуск scripts/close_overdue_shifts.py (None — ни разу)
+    swept = last_overdue_sweep()
+    return {
+        "ok": True,
+        "open_from_past_days": overdue,
+        "last_sweep_seconds_ago": int(time.time() - swept) if swept is not None else None,
+    }
+
+
+def _check_bot() -> Dict:
+    from app.routers.telegram_bot import telegram_bot
+
+    application = telegram_bot.application
+    return {"ok": True, "running": bool(application is not None and application.running)}
+
+
+# имя -> (проверка, влияет ли на готовность)
+READINESS_CHECKS: Dict[str, Tuple[Callable[[], Dict], bool]] = {
+    "database": (_check_database, True),
+    "migrations": (_check_migrations, True),
+    "disk": (_check_disk, True),
+    "overdue_shifts": (_check_overdue_shifts, False),
+    "bot": (_check_bot, False),
+}
+
+
+def _run_checks() -> Tuple[int, Dict]:
+    checks = {}
+    ready = True
+    for name, (check, critical) in READINESS_CHECKS.items():
+        started = time.perf_counter()
+        try:
+            result = check()
+        except Exception as exc:
+            result = {"ok": False, "error": f"{type(exc).__name__}: {exc}"}
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        result["critical"] = critical
+        checks[name] = result
+        if critical and not result["ok"]:
+            ready = False
+    body = {"status": "ok" if ready else "fail", "checked_at": int(time.time()), "checks": checks}
+    return (200 if ready else 503), body
+
+
+@router.get("/health/ready")
+def health_ready():
+    global _ready_cache
+    # Под блокировкой: одновременные пробы ждут одну проверку, а не запускают свои
+    with _ready_lock:
+        if _ready_cache is None or time.monotonic() >= _ready_cache[0]:
+            status_code, body = _run_checks()
+            _ready_cache = (time.monotonic() + HEALTH_CACHE_SECONDS, status_code, body)
+        _, status_code, body = _ready_cache
+    return JSONResponse(body, status_code=status_code)
+
+
+@router.get("/metrics", include_in_schema=False)
+def metrics(authorization: Optional[str] = Header(None)):
+    """Метрики всех процессов в текстовом формате Prometheus"""
+    if not metrics_authorized(authorization):
+        return Response(status_code=401)
+    return PlainTextResponse(registry.collect(), media_type="text/plain; version=0.0.4; charset=utf-8")
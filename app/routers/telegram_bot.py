@@ -1,53 +1,312 @@
 import os
 import asyncio
+import logging
 import secrets
 import string
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta, date
 import re
-from typing import Dict, Optional
+from typing import Dict, Iterable, Optional
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.ext import (
+    Application,
+    BaseUpdateProcessor,
+    CallbackQueryHandler,
+    CommandHandler,
+    ContextTypes,
+    MessageHandler,
+    filters,
+)
+from sqlalchemy import and_, func, or_
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 
-from app.database import get_db
-from app.models import User, Attendance, Store, AllowedIP
-from app.security import verify_password, hash_password
+from app.bot_cache import user_snapshots
+from app.bot_outbox import OutboundQueue
+from app.bot_reminders import BOT_REMINDERS_ENABLED, ReminderScheduler
+from app.bot_state import MISSING, ConversationStateStore
+from app.checkin import check_in
+from app import daily_totals  # также подключает пересчет итогов дня при отметках из бота
+from app.database import engine, session_scope
+from app.metrics import bot_db_finished, bot_db_started, bot_db_submitted, observe_bot_update
+from app.models import User, Attendance, Store, AllowedIP, ScheduleEntry, to_epoch
+from app.security import PasswordHashBusy, hash_password_async
+
+
+logger = logging.getLogger(__name__)
+
+# Размер пула потоков для обращений бота к БД. Значение не должно превышать
+# размер пула соединений SQLAlchemy (по умолчанию 5 + 10 overflow).
+BOT_DB_WORKERS = int(os.getenv("BOT_DB_WORKERS", "4"))
+# Операции дольше этого порога (в секундах) попадают в лог как медленные
+BOT_DB_SLOW_SECONDS = float(os.getenv("BOT_DB_SLOW_SECONDS", "0.5"))
+# Сколько апдейтов обрабатывается одновременно (апдейты одного чата — строго по очереди)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "32"))
+# Адрес Bot API; для тестов можно указать локальный поддельный сервер
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org").rstrip("/")
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40"))
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с сохранением порядка внутри одного чата.
+
+    Разные пользователи обслуживаются одновременно, а сообщения одного
+    пользователя (шаги регистрации, повторные нажатия кнопок) — по очереди,
+    в порядке поступления.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    @staticmethod
+    def _update_kind(update: object) -> str:
+        if isinstance(update, Update):
+            if update.callback_query is not None:
+                return "callback_query"
+            if update.message is not None:
+                return "message"
+        return "other"
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # Время считается с ожиданием своей очереди в чате — так его видит пользователь
+        started = time.perf_counter()
+        try:
+            await self._process_in_chat_order(update, coroutine)
+        finally:
+            observe_bot_update(self._update_kind(update), time.perf_counter() - started)
+
+    async def _process_in_chat_order(self, update: object, coroutine) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()
+        self._chat_waiters[key] = self._chat_waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            # Блокировку удаляем, когда чат больше никто не ждет, чтобы словарь не рос
+            self._chat_waiters[key] -= 1
+            if not self._chat_waiters[key]:
+                del self._chat_waiters[key]
+                del self._chat_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 class TelegramBot:
     def __init__(self):
         self.application = None
-        self.user_sessions: Dict[int, Dict] = {}  # telegram_id -> session data
+        # telegram_id -> session data; LRU в памяти с сохранением в БД
+        self.user_sessions = ConversationStateStore()
+        # Очередь исходящих рассылок; создается при запуске бота в его цикле событий
+        self.outbox: Optional[OutboundQueue] = None
+        # Напоминания о сменах по опубликованному графику
+        self.reminders: Optional[ReminderScheduler] = None
+
+        # Синхронные запросы SQLAlchemy выполняются в ограниченном пуле потоков,
+        # чтобы медленный запрос одного пользователя не останавливал цикл событий
+        # (пересоздается в setup_bot, если бот перезапускается после остановки)
+        self._db_executor = self._new_db_executor()
+        self._db_stats_lock = threading.Lock()
+        self._db_stats = {
+            "calls": 0,
+            "errors": 0,
+            "queued": 0,
+            "in_flight": 0,
+            "wait_seconds_total": 0.0,
+            "run_seconds_total": 0.0,
+            "run_seconds_max": 0.0,
+        }
+        self._db_latencies = deque(maxlen=1024)  # последние длительности операций, с
+
+    @staticmethod
+    def _new_db_executor() -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=BOT_DB_WORKERS, thread_name_prefix="bot-db")
 
     def _get_moscow_time(self) -> datetime:
         """Получает текущее время в московском часовом поясе (UTC+3)"""
         moscow_tz = timezone(timedelta(hours=3))
         return datetime.now(moscow_tz)
 
-    def _get_db_session(self) -> Session:
-        """Получает сессию базы данных"""
-        return next(get_db())
+    async def _run_db(self, func, *args):
+        """Выполняет func(db, *args) в пуле потоков бота с собственной сессией БД.
+
+        Каждая операция получает отдельную сессию, которая закрывается сразу
+        после завершения, поэтому соединения не утекают. Возвращаемое значение
+        не должно содержать ORM-объектов: после закрытия сессии они отсоединены.
+        """
+        submitted_at = time.perf_counter()
+        operation = getattr(func, "__name__", "other")
+        with self._db_stats_lock:
+            self._db_stats["queued"] += 1
+        bot_db_submitted()
+
+        def _call():
+            started_at = time.perf_counter()
+            with self._db_stats_lock:
+                self._db_stats["queued"] -= 1
+                self._db_stats["in_flight"] += 1
+                self._db_stats["wait_seconds_total"] += started_at - submitted_at
+            bot_db_started(started_at - submitted_at)
+            failed = False
+            try:
+                with session_scope() as db:
+                    return func(db, *args)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                elapsed = time.perf_counter() - started_at
+                with self._db_stats_lock:
+                    stats = self._db_stats
+                    stats["in_flight"] -= 1
+                    stats["calls"] += 1
+                    stats["errors"] += int(failed)
+                    stats["run_seconds_total"] += elapsed
+                    stats["run_seconds_max"] = max(stats["run_seconds_max"], elapsed)
+                    self._db_latencies.append(elapsed)
+                bot_db_finished(operation, elapsed, failed)
+                if elapsed >= BOT_DB_SLOW_SECONDS:
+                    logger.warning("Медленная операция БД в боте: %s — %.3f с", operation, elapsed)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_executor, _call)
+
+    async def _get_session(self, telegram_id: int) -> Optional[Dict]:
+        """Состояние диалога пользователя: из памяти или, при промахе, из хранилища"""
+        session = self.user_sessions.get_cached(telegram_id)
+        if session is MISSING:
+            session = await self._run_db(self.user_sessions.load, telegram_id)
+        return session
+
+    def db_stats(self) -> Dict:
+        """Сводка обращений бота к БД для журнала; в /metrics те же данные идут как bot_db_*"""
+        with self._db_stats_lock:
+            stats = dict(self._db_stats)
+            latencies = sorted(self._db_latencies)
+
+        calls = stats["calls"]
+        stats["workers"] = BOT_DB_WORKERS
+        stats["run_seconds_avg"] = stats["run_seconds_total"] / calls if calls else 0.0
+        stats["wait_seconds_avg"] = stats["wait_seconds_total"] / calls if calls else 0.0
+        if latencies:
+            stats["run_seconds_p50"] = latencies[len(latencies) // 2]
+            stats["run_seconds_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+        # Состояние пула соединений SQLAlchemy (у разных классов пулов разный набор методов)
+        pool = engine.pool
+        pool_stats = {"status": pool.status()}
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            method = getattr(pool, name, None)
+            if callable(method):
+                pool_stats[name] = method()
+        stats["pool"] = pool_stats
+        return stats
+
+    def _load_snapshot(self, db: Session, user_id: int) -> Optional[Dict]:
+        """Снимок пользователя из БД: статус, данные для проверки доступа и смена на сегодня"""
+        epoch = user_snapshots.epoch()
+        user = db.query(
+            User.is_active, User.web_username, User.web_password_plain
+        ).filter(User.id == user_id).first()
+        if not user:
+            return None
+
+        # Число активных разрешенных IP общее для всех пользователей
+        allowed_ip_count = user_snapshots.get_shared("allowed_ip_count")
+        if allowed_ip_count is None:
+            allowed_ip_count = db.query(func.count(AllowedIP.id)).filter(AllowedIP.is_active == True).scalar() or 0
+            user_snapshots.put_shared("allowed_ip_count", allowed_ip_count, epoch)
+
+        last_started_at = db.query(func.max(Attendance.started_at)).filter(Attendance.user_id == user_id).scalar()
+
+        current_month = date.today().replace(day=1)
+        next_month = (current_month + timedelta(days=32)).replace(day=1)
+        has_schedule = db.query(ScheduleEntry.id).filter(
+            ScheduleEntry.user_id == user_id,
+            ScheduleEntry.work_date >= current_month,
+            ScheduleEntry.work_date < next_month,
+            ScheduleEntry.published == True
+        ).first() is not None
 
-    def _check_telegram_user_allowed(self, user_id: int) -> tuple[bool, str]:
+        today = date.today()
+        today_records = db.query(Attendance.started_at, Attendance.ended_at, Attendance.hours).filter(
+            Attendance.user_id == user_id,
+            Attendance.work_date == today
+        ).all()
+        active = next((r for r in today_records if r.ended_at is None), None)
+        completed = next((r for r in today_records if r.ended_at is not None), None)
+
+        snapshot = {
+            "today": today,
+            "is_active": bool(user.is_active),
+            "web_username": user.web_username,
+            "web_password_plain": user.web_password_plain,
+            "allowed_ip_count": allowed_ip_count,
+            "last_started_at": last_started_at,
+            "has_schedule_this_month": has_schedule,
+            "on_shift": active is not None,
+            "active_started_at": active.started_at if active else None,
+            "active_hours": (active.hours or 0) if active else None,
+            "completed_hours": (completed.hours or 0) if completed else None,
+        }
+        user_snapshots.put(user_id, snapshot, epoch)
+        return snapshot
+
+    def _get_snapshot(self, db: Session, user_id: int) -> Optional[Dict]:
+        """Снимок пользователя из кэша, при промахе или смене дня — из БД"""
+        snapshot = user_snapshots.get(user_id)
+        if snapshot is None or snapshot["today"] != date.today():
+            snapshot = self._load_snapshot(db, user_id)
+        return snapshot
+
+    def _has_active_shift(self, db: Session, user_id: int) -> bool:
+        """Есть ли у пользователя незавершенная смена на сегодня"""
+        snapshot = self._get_snapshot(db, user_id)
+        return bool(snapshot and snapshot["on_shift"])
+
+    def _is_user_active(self, db: Session, user_id: int) -> bool:
+        """Существует ли пользователь и не деактивирован ли он"""
+        snapshot = self._get_snapshot(db, user_id)
+        return bool(snapshot and snapshot["is_active"])
+
+    def _check_telegram_user_allowed(self, db: Session, user_id: int) -> tuple[bool, str]:
         """Проверяет, разрешен ли Telegram пользователь для отметки прихода/ухода
 
         Returns:
             tuple: (is_allowed: bool, message: str)
         """
-        db = self._get_db_session()
-
-        # Получаем пользователя
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
+        snapshot = self._get_snapshot(db, user_id)
+        if not snapshot:
             return False, "Пользователь не найден"
 
-        # Получаем список разрешенных IP
-        allowed_ips = db.query(AllowedIP).filter(AllowedIP.is_active == True).all()
-
         # Если нет разрешенных IP вообще, разрешаем всем
-        if not allowed_ips:
+        if not snapshot["allowed_ip_count"]:
             return True, "IP проверка отключена (нет разрешенных IP)"
 
         # Для Telegram пользователей мы не можем получить реальный IP адрес,
@@ -55,57 +314,322 @@ class TelegramBot:
 
         # 1. Проверяем, есть ли у пользователя недавняя активность через веб-интерфейс
         # (это косвенно указывает на то, что пользователь имеет доступ к разрешенной сети)
-        recent_attendance = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.started_at >= datetime.now() - timedelta(days=3)  # Уменьшили до 3 дней
-        ).first()
-
-        if recent_attendance:
+        last_started_at = snapshot["last_started_at"]
+        if last_started_at and last_started_at >= datetime.now() - timedelta(days=3):  # Уменьшили до 3 дней
             return True, "✅ Разрешено на основе недавней активности через веб-интерфейс"
 
         # 2. Проверяем, есть ли у пользователя опубликованный график на текущий месяц
         # (это указывает на то, что пользователь является активным сотрудником)
-        current_month = date.today().replace(day=1)
-        next_month = (current_month + timedelta(days=32)).replace(day=1)
-
-        from app.models import ScheduleEntry
-        active_schedule = db.query(ScheduleEntry).filter(
-            ScheduleEntry.user_id == user_id,
-            ScheduleEntry.work_date >= current_month,
-            ScheduleEntry.work_date < next_month,
-            ScheduleEntry.published == True
-        ).first()
-
-        if active_schedule:
+        if snapshot["has_schedule_this_month"]:
             return True, "✅ Разрешено для активного сотрудника с опубликованным графиком"
 
         # 3. Проверяем, есть ли у пользователя веб-учетные данные
         # (это указывает на то, что пользователь должен использовать веб-интерфейс)
-        if user.web_username and user.web_password_plain:
+        if snapshot["web_username"] and snapshot["web_password_plain"]:
             return False, "❌ Доступ запрещен! У вас есть веб-учетные данные. Используйте веб-интерфейс с разрешенного IP адреса для отметки прихода/ухода."
 
         # Если ни одного критерия не выполнено, но есть разрешенные IP,
         # блокируем доступ и рекомендуем использовать веб-интерфейс
         return False, "❌ Доступ запрещен! IP проверка активна. Для отметки прихода/ухода используйте веб-интерфейс с разрешенного IP адреса или обратитесь к администратору."
 
-    def _generate_web_credentials(self, name: str) -> tuple[str, str]:
-        """Генерирует логин и пароль для веб-доступа"""
-        # Генерируем логин на основе имени
-        base_username = name.lower().replace(' ', '_').replace('-', '_')
-        username = base_username
+    @staticmethod
+    def _base_username(name: str) -> str:
+        """Логин на основе имени: «Иван Иванов» -> «иван_иванов»"""
+        return name.lower().replace(' ', '_').replace('-', '_')
+
+    @staticmethod
+    def _generate_password() -> str:
+        alphabet = string.ascii_letters + string.digits
+        return ''.join(secrets.choice(alphabet) for _ in range(8))
+
+    def _taken_usernames(self, db: Session, bases: Iterable[str]) -> set:
+        """Занятые логины вида base и base_N — одним запросом на пачку базовых логинов.
 
-        # Проверяем уникальность логина
-        db = self._get_db_session()
+        base_N ищется диапазоном [base + "_", base + "`") — символ «`» идет
+        сразу за «_», поэтому запрос использует уникальный индекс по web_username.
+        """
+        taken = set()
+        bases = sorted(set(bases))
+        for i in range(0, len(bases), 200):
+            chunk = bases[i:i + 200]
+            conditions = []
+            for base in chunk:
+                conditions.append(User.web_username == base)
+                conditions.append(and_(User.web_username > base + "_", User.web_username < base + "`"))
+            taken.update(username for (username,) in db.query(User.web_username).filter(or_(*conditions)).all())
+        return taken
+
+    @staticmethod
+    def _next_free_username(base: str, taken: set) -> str:
+        """Первый свободный логин: base, base_1, base_2, ..."""
+        if base not in taken:
+            return base
         counter = 1
-        while db.query(User).filter(User.web_username == username).first():
-            username = f"{base_username}_{counter}"
+        while f"{base}_{counter}" in taken:
             counter += 1
+        return f"{base}_{counter}"
 
-        # Генерируем случайный пароль
-        alphabet = string.ascii_letters + string.digits
-        password = ''.join(secrets.choice(alphabet) for _ in range(8))
+    def _generate_web_credentials(self, name: str, db: Optional[Session] = None) -> tuple[str, str]:
+        """Генерирует логин и пароль для веб-доступа"""
+        if db is None:
+            with session_scope() as db:
+                return self._generate_web_credentials(name, db)
+
+        # Генерируем логин на основе имени и проверяем уникальность одним запросом
+        base_username = self._base_username(name)
+        username = self._next_free_username(base_username, self._taken_usernames(db, [base_username]))
 
-        return username, password
+        return username, self._generate_password()
+
+    def _generate_web_credentials_bulk(self, names: Iterable[str], db: Optional[Session] = None) -> list:
+        """Логины и пароли для пачки пользователей (импорт): один запрос на 200 разных имен.
+
+        Логины уникальны и между собой, и среди уже существующих.
+        """
+        if db is None:
+            with session_scope() as db:
+                return self._generate_web_credentials_bulk(names, db)
+
+        bases = [self._base_username(name) for name in names]
+        taken = self._taken_usernames(db, bases)
+        credentials = []
+        for base in bases:
+            username = self._next_free_username(base, taken)
+            taken.add(username)
+            credentials.append((username, self._generate_password()))
+        return credentials
+
+    # ===== Операции с БД (выполняются в пуле потоков через _run_db) =====
+
+    def _load_user_by_telegram_id(self, db: Session, telegram_id: int) -> Optional[Dict]:
+        """Данные зарегистрированного пользователя для приветствия в /start"""
+        user = db.query(User).filter(User.telegram_id == telegram_id).first()
+        if not user:
+            return None
+        return {
+            "id": user.id,
+            "full_name": user.full_name,
+            "on_shift": self._has_active_shift(db, user.id),
+        }
+
+    def _email_exists(self, db: Session, email: str) -> bool:
+        """Занят ли email другим пользователем"""
+        return db.query(User.id).filter(User.email == email).first() is not None
+
+    def _create_user(self, db: Session, telegram_id: int, registration_data: Dict) -> Dict:
+        """Создает пользователя из данных регистрации"""
+        try:
+            # Создаем пользователя с предоставленными данными
+            user = User(
+                email=registration_data["email"],
+                full_name=registration_data["full_name"],
+                password_hash=registration_data["password_hash"],
+                date_of_birth=registration_data["date_of_birth"],
+                role="employee",
+                is_active=True,
+                telegram_id=telegram_id,  # Сохраняем Telegram ID для связи
+                web_username=registration_data["email"],  # Email как логин для веб
+                web_password_plain=registration_data["password"]  # Сохраняем пароль в открытом виде
+            )
+
+            db.add(user)
+            db.commit()
+            db.refresh(user)
+            return {"status": "created", "user_id": user.id}
+
+        except IntegrityError:
+            db.rollback()
+            return {"status": "integrity_error"}
+        except Exception:
+            db.rollback()
+            logger.exception("Ошибка при регистрации пользователя Telegram %s", telegram_id)
+            return {"status": "error"}
+
+    def _checkin(self, db: Session, user_id: int, proceed_on_warning: bool, idempotency_key: Optional[str] = None) -> Dict:
+        """Фиксирует приход. Возвращает статус операции и состояние смены для клавиатуры"""
+        snapshot = self._get_snapshot(db, user_id)
+        if not snapshot:
+            return {"status": "not_found", "on_shift": False}
+
+        # Проверяем разрешение для отметки прихода
+        is_allowed, message = self._check_telegram_user_allowed(db, user_id)
+        if not is_allowed:
+            return {"status": "forbidden", "message": message, "on_shift": self._has_active_shift(db, user_id)}
+
+        # Предупреждение: в чате показываем его, а в callback-режиме на этом останавливаемся
+        warning = message if "⚠️" in message else None
+        if warning and not proceed_on_warning:
+            return {"status": "warning", "message": warning, "on_shift": self._has_active_shift(db, user_id)}
+
+        now = self._get_moscow_time()
+
+        try:
+            # Одна вставка; повтор того же обновления Telegram (тот же ключ) вторую смену не откроет
+            result = check_in(db, user_id, now, idempotency_key)
+        except Exception:
+            db.rollback()
+            logger.exception("Ошибка при фиксации прихода пользователя %s", user_id)
+            return {"status": "error", "warning": warning, "on_shift": self._has_active_shift(db, user_id)}
+
+        if result.status == "already_active":
+            return {"status": "already_active", "started_at": result.started_at, "warning": warning, "on_shift": True}
+
+        # Своя запись уже сбросила снимок — кладем обновленный без лишних чтений
+        user_snapshots.put(user_id, {
+            **snapshot,
+            "on_shift": True,
+            "active_started_at": result.started_at,
+            "active_hours": 0,
+            "last_started_at": result.started_at,
+        })
+        return {"status": "started", "time": now, "warning": warning, "on_shift": True}
+
+    def _checkout(self, db: Session, user_id: int, proceed_on_warning: bool) -> Dict:
+        """Фиксирует уход и пересчитывает отработанное за день время"""
+        snapshot = self._get_snapshot(db, user_id)
+
+        # Проверяем разрешение для отметки ухода
+        is_allowed, message = self._check_telegram_user_allowed(db, user_id)
+        if not is_allowed:
+            return {"status": "forbidden", "message": message, "on_shift": self._has_active_shift(db, user_id)}
+
+        warning = message if "⚠️" in message else None
+        if warning and not proceed_on_warning:
+            return {"status": "warning", "message": warning, "on_shift": self._has_active_shift(db, user_id)}
+
+        now = self._get_moscow_time()
+        today = now.date()
+
+        # Находим активную смену на сегодня
+        active = db.query(Attendance).filter(
+            Attendance.user_id == user_id,
+            Attendance.work_date == today,
+            Attendance.ended_at.is_(None)
+        ).first()
+
+        if not active:
+            if snapshot and snapshot["on_shift"]:
+                # Смену закрыли в другом процессе, а снимок еще не устарел
+                user_snapshots.invalidate_user(user_id)
+            return {"status": "no_active", "warning": warning, "on_shift": False}
+
+        # Закрытые смены дня уже просуммированы в daily_totals — одно чтение по ключу
+        state = daily_totals.day_state(db, user_id, today, now)
+
+        # Завершаем смену; ее длительность считается так же, как duration_s при записи
+        active.ended_at = now
+        duration_s = max(0, to_epoch(now) - to_epoch(active.started_at))
+        active.hours = round((state["closed_seconds"] + duration_s) / 3600.0, 4)
+        worked_hours = active.hours
+
+        try:
+            db.add(active)
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("Ошибка при фиксации ухода пользователя %s", user_id)
+            return {"status": "error", "warning": warning, "on_shift": self._has_active_shift(db, user_id)}
+
+        user_snapshots.put(user_id, {
+            **snapshot,
+            "on_shift": False,
+            "active_started_at": None,
+            "active_hours": None,
+            "completed_hours": worked_hours,
+        })
+
+        return {"status": "stopped", "time": now, "hours": worked_hours, "warning": warning, "on_shift": False}
+
+    def _status(self, db: Session, user_id: int) -> Dict:
+        """Текущее состояние смены пользователя на сегодня"""
+        snapshot = self._get_snapshot(db, user_id)
+
+        if snapshot and snapshot["on_shift"]:
+            return {
+                "active": True,
+                "started_at": snapshot["active_started_at"],
+                "total_hours": snapshot["active_hours"] or 0,
+                "on_shift": True,
+            }
+
+        return {
+            "active": False,
+            "completed_hours": snapshot["completed_hours"] if snapshot else None,
+            "on_shift": False,
+        }
+
+    def _my_schedule(self, db: Session, user_id: int) -> Optional[Dict]:
+        """Опубликованные смены пользователя за текущий месяц"""
+        snapshot = self._get_snapshot(db, user_id)
+        if not snapshot:
+            return None
+
+        # Получаем текущий месяц
+        now = self._get_moscow_time()
+        current_month = now.replace(day=1)
+        next_month = (current_month + timedelta(days=32)).replace(day=1)
+
+        # График кэшируется в снимке до публикации изменений (invalidate_all)
+        cached = snapshot.get("schedule")
+        if cached is not None and cached[0] == current_month.date():
+            entries = cached[1]
+        else:
+            # Получаем опубликованные смены за текущий месяц
+            schedules = db.query(ScheduleEntry).filter(
+                ScheduleEntry.user_id == user_id,
+                ScheduleEntry.work_date >= current_month,
+                ScheduleEntry.work_date < next_month,
+                ScheduleEntry.published == True
+            ).order_by(ScheduleEntry.work_date).all()
+            entries = [
+                {
+                    "work_date": s.work_date,
+                    "shift_type": s.shift_type,
+                    "start_time": s.start_time,
+                    "end_time": s.end_time,
+                }
+                for s in schedules
+            ]
+            user_snapshots.update(user_id, schedule=(current_month.date(), entries))
+
+        return {
+            "current_month": current_month,
+            "entries": entries,
+            "on_shift": snapshot["on_shift"],
+        }
+
+    def _credentials(self, db: Session, user_id: int) -> Optional[Dict]:
+        """Сохраненные учетные данные для веб-версии"""
+        snapshot = self._get_snapshot(db, user_id)
+        if not snapshot:
+            return None
+        return {
+            "web_username": snapshot["web_username"],
+            "web_password_plain": snapshot["web_password_plain"],
+            "on_shift": snapshot["on_shift"],
+        }
+
+    def _process_callback(self, db: Session, user_id: int, action: str, update_id: Optional[int] = None) -> Optional[Dict]:
+        """Одна сессия на нажатие кнопки: проверка пользователя и само действие.
+
+        Возвращает None, если пользователь удален или деактивирован.
+        """
+        if not self._is_user_active(db, user_id):
+            return None
+
+        if action == "checkin":
+            return self._checkin(db, user_id, False, f"tg:{update_id}" if update_id else None)
+        if action == "checkout":
+            return self._checkout(db, user_id, False)
+        if action == "status":
+            return self._status(db, user_id)
+        if action == "my_schedule":
+            return self._my_schedule(db, user_id)
+        if action == "show_credentials":
+            return self._credentials(db, user_id)
+        return {}
+
+    # ===== Обработчики Telegram =====
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
@@ -113,15 +637,14 @@ class TelegramBot:
         username = update.effective_user.username or update.effective_user.first_name
 
         # Проверяем, зарегистрирован ли пользователь
-        db = self._get_db_session()
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
+        user = await self._run_db(self._load_user_by_telegram_id, telegram_id)
 
         if user:
-            self.user_sessions[telegram_id] = {"user_id": user.id, "step": "main_menu"}
+            self.user_sessions[telegram_id] = {"user_id": user["id"], "step": "main_menu"}
             await update.message.reply_text(
-                f"Привет, {user.full_name or username}!\n\n"
+                f"Привет, {user['full_name'] or username}!\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user.id)
+                reply_markup=self._get_main_menu_keyboard(user["on_shift"])
             )
         else:
             # Проверяем, есть ли пользователь с новыми учетными данными
@@ -154,18 +677,17 @@ class TelegramBot:
         telegram_id = update.effective_user.id
         text = update.message.text
 
-        if telegram_id not in self.user_sessions:
+        session = await self._get_session(telegram_id)
+        if session is None:
             await update.message.reply_text("Используйте /start для начала работы")
             return
 
-        session = self.user_sessions[telegram_id]
         step = session.get("step")
 
         # Если пользователь был удален в вебе, сбрасываем сессию и предлагаем регистрацию
         if step == "main_menu":
-            db = self._get_db_session()
             user_id = session.get("user_id")
-            user_exists = db.query(User).filter(User.id == user_id, User.is_active == True).first() if user_id else None
+            user_exists = await self._run_db(self._is_user_active, user_id) if user_id else False
             if not user_exists:
                 # Сбрасываем сессию и переводим в режим регистрации
                 self.user_sessions[telegram_id] = {"step": "register_full_name", "registration_data": {}}
@@ -177,16 +699,15 @@ class TelegramBot:
                 return
 
         if step.startswith("register_"):
-            await self._handle_registration_step(update, text)
+            await self._handle_registration_step(update, text, session)
         elif step == "main_menu":
-            await self._handle_main_menu(update, text)
+            await self._handle_main_menu(update, text, session)
         else:
             await update.message.reply_text("Неизвестная команда. Используйте меню.")
 
-    async def _handle_registration_step(self, update, text):
+    async def _handle_registration_step(self, update, text, session):
         """Обработка шагов регистрации пользователя"""
         telegram_id = update.effective_user.id
-        session = self.user_sessions[telegram_id]
         step = session["step"]
         registration_data = session["registration_data"]
 
@@ -198,6 +719,7 @@ class TelegramBot:
 
             registration_data["full_name"] = text.strip()
             session["step"] = "register_email"
+            self.user_sessions.mark_dirty(telegram_id)
             await update.message.reply_text(
                 "📧 Шаг 2 из 4: Введите ваш email адрес\n"
                 "(Этот email будет использоваться как логин для веб-версии):"
@@ -211,14 +733,13 @@ class TelegramBot:
                 return
 
             # Проверяем, не занят ли email
-            db = self._get_db_session()
-            existing_user = db.query(User).filter(User.email == text.strip()).first()
-            if existing_user:
+            if await self._run_db(self._email_exists, text.strip()):
                 await update.message.reply_text("Этот email уже зарегистрирован. Введите другой email:")
                 return
 
             registration_data["email"] = text.strip()
             session["step"] = "register_password"
+            self.user_sessions.mark_dirty(telegram_id)
             await update.message.reply_text(
                 "🔒 Шаг 3 из 4: Придумайте пароль для веб-версии\n"
                 "(Пароль должен содержать минимум 6 символов):"
@@ -230,8 +751,11 @@ class TelegramBot:
                 await update.message.reply_text("Пароль должен содержать минимум 6 символов. Придумайте пароль:")
                 return
 
-            registration_data["password"] = text.strip()
+            # Пароль не кладем в состояние: оно сохраняется в таблицу открытым JSON
+            registration_data.pop("password", None)
+            self.user_sessions.put_secret(telegram_id, "password", text.strip())
             session["step"] = "register_date_of_birth"
+            self.user_sessions.mark_dirty(telegram_id)
             await update.message.reply_text(
                 "📅 Шаг 4 из 4: Введите вашу дату рождения\n"
                 "(Формат: ДД.ММ.ГГГГ, например: 15.05.1990):"
@@ -259,62 +783,64 @@ class TelegramBot:
 
                 registration_data["date_of_birth"] = date_of_birth
 
+                password = self.user_sessions.take_secret(telegram_id, "password")
+                if password is None:
+                    # Пароль хранился только в памяти и потерян (например, бот перезапускался)
+                    session["step"] = "register_password"
+                    self.user_sessions.mark_dirty(telegram_id)
+                    await update.message.reply_text(
+                        "Пароль не сохранился. Придумайте пароль для веб-версии еще раз\n"
+                        "(минимум 6 символов):"
+                    )
+                    return
+
                 # Все данные собраны, создаем пользователя
-                await self._create_user_from_registration(update, registration_data)
+                await self._create_user_from_registration(update, registration_data, password)
 
             except ValueError:
                 await update.message.reply_text("Некорректная дата. Введите дату в формате ДД.ММ.ГГГГ:")
                 return
 
-    async def _create_user_from_registration(self, update, registration_data):
+    async def _create_user_from_registration(self, update, registration_data, password):
         """Создание пользователя из данных регистрации"""
         telegram_id = update.effective_user.id
 
-        db = self._get_db_session()
-
+        # bcrypt — в пуле хэширования, чтобы не занимать потоки БД бота
         try:
-            # Создаем пользователя с предоставленными данными
-            user = User(
-                email=registration_data["email"],
-                full_name=registration_data["full_name"],
-                password_hash=hash_password(registration_data["password"]),
-                date_of_birth=registration_data["date_of_birth"],
-                role="employee",
-                is_active=True,
-                telegram_id=telegram_id,  # Сохраняем Telegram ID для связи
-                web_username=registration_data["email"],  # Email как логин для веб
-                web_password_plain=registration_data["password"]  # Сохраняем пароль в открытом виде
-            )
-
-            db.add(user)
-            db.commit()
-            db.refresh(user)
+            password_hash = await hash_password_async(password)
+        except PasswordHashBusy:
+            self.user_sessions.put_secret(telegram_id, "password", password)
+            await update.message.reply_text("Сервер перегружен. Отправьте дату рождения еще раз через минуту.")
+            return
+        result = await self._run_db(
+            self._create_user, telegram_id, {**registration_data, "password": password, "password_hash": password_hash}
+        )
 
+        if result["status"] == "created":
             # Обновляем сессию
-            self.user_sessions[telegram_id] = {"user_id": user.id, "step": "main_menu"}
+            self.user_sessions[telegram_id] = {"user_id": result["user_id"], "step": "main_menu"}
 
             await update.message.reply_text(
                 f"✅ Регистрация завершена!\n\n"
                 f"Добро пожаловать, {registration_data['full_name']}!\n\n"
                 f"🔑 Ваши учетные данные для веб-версии:\n"
                 f"Логин: {registration_data['email']}\n"
-                f"Пароль: {registration_data['password']}\n\n"
+                f"Пароль: {password}\n\n"
                 "Сохраните эти данные для входа на сайт.\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user.id)
+                reply_markup=self._get_main_menu_keyboard(False)
             )
-
-        except IntegrityError:
-            db.rollback()
+        elif result["status"] == "integrity_error":
+            self.user_sessions.put_secret(telegram_id, "password", password)
             await update.message.reply_text("Ошибка: этот email уже зарегистрирован. Попробуйте другой email.")
-        except Exception as e:
-            db.rollback()
+        else:
+            # Повтор даты рождения не должен снова спрашивать пароль
+            self.user_sessions.put_secret(telegram_id, "password", password)
             await update.message.reply_text("Ошибка при регистрации. Попробуйте еще раз.")
 
-    async def _handle_main_menu(self, update, text):
+    async def _handle_main_menu(self, update, text, session):
         """Обработка команд главного меню"""
-        telegram_id = update.effective_user.id
-        user_id = self.user_sessions[telegram_id]["user_id"]
+        user_id = session["user_id"]
 
         if text == "✅ Приход":
             await self._handle_checkin(update, user_id)
@@ -327,200 +853,95 @@ class TelegramBot:
 
     async def _handle_checkin(self, update, user_id):
         """Обработка прихода на работу"""
-        db = self._get_db_session()
-        user = db.query(User).filter(User.id == user_id).first()
+        result = await self._run_db(self._checkin, user_id, True, f"tg:{update.update_id}")
+        status = result["status"]
+        keyboard = self._get_main_menu_keyboard(result["on_shift"])
 
-        if not user:
+        if status == "not_found":
             await update.message.reply_text("Пользователь не найден")
             return
 
-        # Проверяем разрешение для отметки прихода
-        is_allowed, message = self._check_telegram_user_allowed(user_id)
-        if not is_allowed:
+        if status == "forbidden":
             await update.message.reply_text(
-                f"❌ Доступ запрещен!\n\n{message}\n\n"
+                f"❌ Доступ запрещен!\n\n{result['message']}\n\n"
                 "Обратитесь к администратору для решения проблемы.\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
         # Если есть предупреждение, показываем его
-        if "⚠️" in message:
+        if result.get("warning"):
             await update.message.reply_text(
-                f"{message}\n\n"
+                f"{result['warning']}\n\n"
                 "Продолжаем выполнение действия...\n"
             )
 
-        now = self._get_moscow_time()
-        today = now.date()
-
-        # Проверяем, есть ли запись на сегодня
-        existing = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today
-        ).first()
-
-        if existing:
-            if existing.ended_at is None:
-                # Уже есть активная смена на сегодня
-                await update.message.reply_text(
-                    f"У вас уже активная смена на сегодня!\n"
-                    f"Начало: {existing.started_at.strftime('%d.%m.%Y %H:%M')}\n\n"
-                    "Используйте 'Я ушел' для завершения смены",
-                    reply_markup=self._get_main_menu_keyboard(user_id)
-                )
-                return
-            else:
-                # Есть завершенная смена, начинаем новую смену в тот же день
-                existing.started_at = now
-                existing.ended_at = None
-                # Не сбрасываем hours, чтобы суммировать время
-                db.add(existing)
-                db.commit()
-                await update.message.reply_text(
-                    f"✅ Приход зафиксирован!\n"
-                    f"Время: {now.strftime('%d.%m.%Y %H:%M')}\n\n"
-                    "Удачной работы!",
-                    reply_markup=self._get_main_menu_keyboard(user_id)
-                )
-                return
-
-        # Создаем новую запись на сегодня
-        record = Attendance(
-            user_id=user_id,
-            started_at=now,
-            work_date=today
-        )
-
-        try:
-            db.add(record)
-            db.commit()
+        if status == "already_active":
+            # Уже есть активная смена на сегодня
+            await update.message.reply_text(
+                f"У вас уже активная смена на сегодня!\n"
+                f"Начало: {result['started_at'].strftime('%d.%m.%Y %H:%M')}\n\n"
+                "Используйте 'Я ушел' для завершения смены",
+                reply_markup=keyboard
+            )
+        elif status == "started":
             await update.message.reply_text(
                 f"✅ Приход зафиксирован!\n"
-                f"Время: {now.strftime('%d.%m.%Y %H:%M')}\n\n"
+                f"Время: {result['time'].strftime('%d.%m.%Y %H:%M')}\n\n"
                 "Удачной работы!",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
-        except Exception as e:
-            db.rollback()
+        else:
             await update.message.reply_text("Ошибка при фиксации прихода")
 
     async def _handle_checkout(self, update, user_id):
         """Обработка ухода с работы"""
-        db = self._get_db_session()
+        result = await self._run_db(self._checkout, user_id, True)
+        status = result["status"]
+        keyboard = self._get_main_menu_keyboard(result["on_shift"])
 
-        # Проверяем разрешение для отметки ухода
-        is_allowed, message = self._check_telegram_user_allowed(user_id)
-        if not is_allowed:
+        if status == "forbidden":
             await update.message.reply_text(
-                f"❌ Доступ запрещен!\n\n{message}\n\n"
+                f"❌ Доступ запрещен!\n\n{result['message']}\n\n"
                 "Обратитесь к администратору для решения проблемы.\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
         # Если есть предупреждение, показываем его
-        if "⚠️" in message:
+        if result.get("warning"):
             await update.message.reply_text(
-                f"{message}\n\n"
+                f"{result['warning']}\n\n"
                 "Продолжаем выполнение действия...\n"
             )
 
-        now = self._get_moscow_time()
-        today = now.date()
-
-        # Находим активную смену на сегодня
-        active = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today,
-            Attendance.ended_at.is_(None)
-        ).first()
-
-        if not active:
+        if status == "no_active":
             await update.message.reply_text(
                 "У вас нет активной смены на сегодня\n\n"
                 "Используйте 'Я пришел' для начала смены",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
-            return
-
-        # Завершаем смену
-        active.ended_at = now
-
-        # Calculate total work time for today including all previous sessions
-        total_work_seconds = 0
-        
-        # Get all attendance records for today
-        today_records = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today
-        ).order_by(Attendance.started_at).all()
-        
-        # Calculate total time from all completed sessions
-        for record in today_records:
-            if record.ended_at is not None:
-                # This session is completed, add its duration
-                started_at = record.started_at
-                ended_at = record.ended_at
-                
-                # Handle timezone-aware and naive datetimes
-                if started_at.tzinfo is None:
-                    utc_tz = timezone.utc
-                    started_at = started_at.replace(tzinfo=utc_tz)
-                if ended_at.tzinfo is None:
-                    utc_tz = timezone.utc
-                    ended_at = ended_at.replace(tzinfo=utc_tz)
-                    
-                session_seconds = (ended_at - started_at).total_seconds()
-                total_work_seconds += session_seconds
-        
-        # Add current session time
-        current_started_at = active.started_at
-        if current_started_at.tzinfo is None:
-            utc_tz = timezone.utc
-            current_started_at = current_started_at.replace(tzinfo=utc_tz)
-        
-        current_session_seconds = (now - current_started_at).total_seconds()
-        total_work_seconds += current_session_seconds
-        
-        # Update the current record
-        active.hours = round(total_work_seconds / 3600.0, 4)
-
-        try:
-            db.add(active)
-            db.commit()
-
-            hours = int(active.hours)
-            minutes = int((active.hours - hours) * 60)
+        elif status == "stopped":
+            hours = int(result["hours"])
+            minutes = int((result["hours"] - hours) * 60)
 
             await update.message.reply_text(
                 f"❌ Уход зафиксирован!\n"
-                f"Время: {now.strftime('%d.%m.%Y %H:%M')}\n"
+                f"Время: {result['time'].strftime('%d.%m.%Y %H:%M')}\n"
                 f"Отработано сегодня: {hours}ч {minutes}мин\n\n"
                 "Хорошего отдыха!",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
-        except Exception as e:
-            db.rollback()
+        else:
             await update.message.reply_text("Ошибка при фиксации ухода")
 
-    async def _handle_status(self, update, user_id):
-        """Показать текущий статус"""
-        db = self._get_db_session()
-        today = date.today()
-
-        # Получаем активную смену на сегодня
-        active = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today,
-            Attendance.ended_at.is_(None)
-        ).first()
-
-        if active:
+    def _format_status(self, result: Dict) -> str:
+        """Текст текущего статуса смены (без завершающей подсказки)"""
+        if result["active"]:
             now = self._get_moscow_time()
-            started_at = active.started_at
+            started_at = result["started_at"]
             if started_at.tzinfo is None:
                 # Если время naive, предполагаем что оно в московском времени
                 moscow_tz = timezone(timedelta(hours=3))
@@ -531,80 +952,64 @@ class TelegramBot:
             minutes = int((elapsed_seconds % 3600) / 60)
 
             # Показываем общее время за день
-            total_hours = active.hours or 0
+            total_hours = result["total_hours"]
             total_h = int(total_hours)
             total_m = int((total_hours - total_h) * 60)
 
-            await update.message.reply_text(
+            return (
                 f"📊 Текущий статус:\n\n"
                 f"🟢 На работе\n"
-                f"Начало смены: {active.started_at.strftime('%d.%m.%Y %H:%M')}\n"
+                f"Начало смены: {result['started_at'].strftime('%d.%m.%Y %H:%M')}\n"
                 f"Отработано в этой смене: {hours}ч {minutes}мин\n"
-                f"Всего за сегодня: {total_h}ч {total_m}мин",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                f"Всего за сегодня: {total_h}ч {total_m}мин"
             )
-        else:
-            # Проверяем, есть ли завершенная смена на сегодня
-            completed = db.query(Attendance).filter(
-                Attendance.user_id == user_id,
-                Attendance.work_date == today,
-                Attendance.ended_at.isnot(None)
-            ).first()
-
-            if completed:
-                total_hours = completed.hours or 0
-                total_h = int(total_hours)
-                total_m = int((total_hours - total_h) * 60)
-                await update.message.reply_text(
-                    f"📊 Текущий статус:\n\n"
-                    f"🔴 Не на работе\n"
-                    f"Отработано сегодня: {total_h}ч {total_m}мин\n\n"
-                    "Используйте кнопку 'Я пришел' для начала новой смены",
-                    reply_markup=self._get_main_menu_keyboard(user_id)
-                )
-            else:
-                await update.message.reply_text(
-                    f"📊 Текущий статус:\n\n"
-                    f"🔴 Не на работе\n\n"
-                    "Используйте кнопку 'Я пришел' для начала смены",
-                    reply_markup=self._get_main_menu_keyboard(user_id)
-                )
 
-    def _get_main_menu_keyboard(self, user_id=None):
-        """Создает клавиатуру главного меню в зависимости от статуса пользователя"""
-        if user_id:
-            # Проверяем, есть ли активная смена на сегодня
-            db = self._get_db_session()
-            today = date.today()
-            active = db.query(Attendance).filter(
-                Attendance.user_id == user_id,
-                Attendance.work_date == today,
-                Attendance.ended_at.is_(None)
-            ).first()
-
-            if active:
-                # Пользователь на работе - показываем "я ушел" и "статус"
-                keyboard = [
-                    [InlineKeyboardButton("❌ Я ушел", callback_data="checkout")],
-                    [InlineKeyboardButton("📊 Статус", callback_data="status")],
-                    [InlineKeyboardButton("📅 Мой график", callback_data="my_schedule")],
-                    [InlineKeyboardButton(" Логин/Пароль", callback_data="show_credentials")]
-                ]
-            else:
-                # Пользователь не на работе - показываем "я пришел" и "статус"
-                keyboard = [
-                    [InlineKeyboardButton("✅ Я пришел", callback_data="checkin")],
-                    [InlineKeyboardButton("📊 Статус", callback_data="status")],
-                    [InlineKeyboardButton("📅 Мой график", callback_data="my_schedule")],
-                    [InlineKeyboardButton("🔑 Логин/Пароль", callback_data="show_credentials")]
-                ]
+        if result["completed_hours"] is not None:
+            total_hours = result["completed_hours"]
+            total_h = int(total_hours)
+            total_m = int((total_hours - total_h) * 60)
+            return (
+                f"📊 Текущий статус:\n\n"
+                f"🔴 Не на работе\n"
+                f"Отработано сегодня: {total_h}ч {total_m}мин\n\n"
+                "Используйте кнопку 'Я пришел' для начала новой смены"
+            )
+
+        return (
+            f"📊 Текущий статус:\n\n"
+            f"🔴 Не на работе\n\n"
+            "Используйте кнопку 'Я пришел' для начала смены"
+        )
+
+    async def _handle_status(self, update, user_id):
+        """Показать текущий статус"""
+        result = await self._run_db(self._status, user_id)
+        await update.message.reply_text(
+            self._format_status(result),
+            reply_markup=self._get_main_menu_keyboard(result["on_shift"])
+        )
+
+    def _get_main_menu_keyboard(self, on_shift: bool = False):
+        """Создает клавиатуру главного меню в зависимости от статуса пользователя.
+
+        Состояние смены передается вызывающим кодом (его уже знает операция с БД),
+        поэтому построение клавиатуры не обращается к базе.
+        """
+        if on_shift:
+            # Пользователь на работе - показываем "я ушел" и "статус"
+            keyboard = [
+                [InlineKeyboardButton("❌ Я ушел", callback_data="checkout")],
+                [InlineKeyboardButton("📊 Статус", callback_data="status")],
+                [InlineKeyboardButton("📅 Мой график", callback_data="my_schedule")],
+                [InlineKeyboardButton(" Логин/Пароль", callback_data="show_credentials")]
+            ]
         else:
-            # По умолчанию показываем "я пришел" и "статус"
+            # Пользователь не на работе - показываем "я пришел" и "статус"
             keyboard = [
                 [InlineKeyboardButton("✅ Я пришел", callback_data="checkin")],
                 [InlineKeyboardButton("📊 Статус", callback_data="status")],
                 [InlineKeyboardButton("📅 Мой график", callback_data="my_schedule")],
-                [InlineKeyboardButton(" Логин/Пароль", callback_data="show_credentials")]
+                [InlineKeyboardButton("🔑 Логин/Пароль", callback_data="show_credentials")]
             ]
 
         return InlineKeyboardMarkup(keyboard)
@@ -615,16 +1020,18 @@ class TelegramBot:
         await query.answer()
 
         telegram_id = query.from_user.id
-        if telegram_id not in self.user_sessions:
+        session = await self._get_session(telegram_id)
+        if session is None or not session.get("user_id"):
             await query.edit_message_text("Сессия истекла. Используйте /start")
             return
 
-        user_id = self.user_sessions[telegram_id]["user_id"]
+        user_id = session["user_id"]
+        action = query.data
+
+        result = await self._run_db(self._process_callback, user_id, action, update.update_id)
 
         # Если пользователь был удален или деактивирован в вебе — очищаем сессию и просим зарегистрироваться заново
-        db = self._get_db_session()
-        user_exists = db.query(User).filter(User.id == user_id, User.is_active == True).first()
-        if not user_exists:
+        if result is None:
             self.user_sessions[telegram_id] = {"step": "register_full_name", "registration_data": {}}
             await query.edit_message_text(
                 "Ваш аккаунт был удален или деактивирован администратором.\n\n"
@@ -632,344 +1039,161 @@ class TelegramBot:
                 "📝 Шаг 1 из 4: Введите ваше полное имя (Фамилия Имя Отчество):"
             )
             return
-        action = query.data
 
         if action == "checkin":
-            await self._handle_checkin_via_callback(query, user_id)
+            await self._handle_checkin_via_callback(query, result)
         elif action == "checkout":
-            await self._handle_checkout_via_callback(query, user_id)
+            await self._handle_checkout_via_callback(query, result)
         elif action == "status":
-            await self._handle_status_via_callback(query, user_id)
+            await self._handle_status_via_callback(query, result)
         elif action == "my_schedule":
-            await self._handle_my_schedule_via_callback(query, user_id)
+            await self._handle_my_schedule_via_callback(query, result)
         elif action == "show_credentials":
-            await self._handle_show_credentials_via_callback(query, user_id)
+            await self._handle_show_credentials_via_callback(query, result)
 
-    async def _handle_checkin_via_callback(self, query, user_id):
+    async def _handle_checkin_via_callback(self, query, result):
         """Обработка прихода через callback"""
-        db = self._get_db_session()
-        user = db.query(User).filter(User.id == user_id).first()
+        status = result["status"]
+        keyboard = self._get_main_menu_keyboard(result["on_shift"])
 
-        if not user:
+        if status == "not_found":
             await query.edit_message_text("Пользователь не найден")
             return
 
-        # Проверяем разрешение для отметки прихода
-        is_allowed, message = self._check_telegram_user_allowed(user_id)
-        if not is_allowed:
+        if status == "forbidden":
             await query.edit_message_text(
-                f"❌ Доступ запрещен!\n\n{message}\n\n"
+                f"❌ Доступ запрещен!\n\n{result['message']}\n\n"
                 "Обратитесь к администратору для решения проблемы.\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
         # Если есть предупреждение, показываем его
-        if "⚠️" in message:
+        if status == "warning":
             await query.edit_message_text(
-                f"{message}\n\n"
+                f"{result['message']}\n\n"
                 "Продолжаем выполнение действия...\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
-        now = self._get_moscow_time()
-        today = now.date()
-
-        # Проверяем, есть ли запись на сегодня
-        existing = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today
-        ).first()
-
-        if existing:
-            if existing.ended_at is None:
-                # Уже есть активная смена на сегодня
-                await query.edit_message_text(
-                    f"У вас уже активная смена на сегодня!\n"
-                    f"Начало: {existing.started_at.strftime('%d.%m.%Y %H:%M')}\n\n"
-                    "Используйте 'Я ушел' для завершения смены\n\n"
-                    "Выберите действие:",
-                    reply_markup=self._get_main_menu_keyboard(user_id)
-                )
-                return
-            else:
-                # Есть завершенная смена, начинаем новую смену в тот же день
-                existing.started_at = now
-                existing.ended_at = None
-                # Не сбрасываем hours, чтобы суммировать время
-                db.add(existing)
-                db.commit()
-                try:
-                    await query.edit_message_text(
-                        f"✅ Приход зафиксирован!\n"
-                        f"Время: {now.strftime('%d.%m.%Y %H:%M')}\n\n"
-                        "Удачной работы!\n\n"
-                        "Выберите действие:",
-                        reply_markup=self._get_main_menu_keyboard(user_id)
-                    )
-                except Exception as e:
-                    if "Message is not modified" in str(e):
-                        await query.answer("Приход уже зафиксирован")
-                    else:
-                        await query.answer("Ошибка при фиксации прихода")
-                return
+        if status == "already_active":
+            # Уже есть активная смена на сегодня
+            await query.edit_message_text(
+                f"У вас уже активная смена на сегодня!\n"
+                f"Начало: {result['started_at'].strftime('%d.%m.%Y %H:%M')}\n\n"
+                "Используйте 'Я ушел' для завершения смены\n\n"
+                "Выберите действие:",
+                reply_markup=keyboard
+            )
+            return
 
-        # Создаем новую запись на сегодня
-        record = Attendance(
-            user_id=user_id,
-            started_at=now,
-            work_date=today
-        )
+        if status != "started":
+            await query.answer("Ошибка при фиксации прихода")
+            return
 
         try:
-            db.add(record)
-            db.commit()
-            try:
-                await query.edit_message_text(
-                    f"✅ Приход зафиксирован!\n"
-                    f"Время: {now.strftime('%d.%m.%Y %H:%M')}\n\n"
-                    "Удачной работы!\n\n"
-                    "Выберите действие:",
-                    reply_markup=self._get_main_menu_keyboard(user_id)
-                )
-            except Exception as e:
-                if "Message is not modified" in str(e):
-                    await query.answer("Приход уже зафиксирован")
-                else:
-                    await query.answer("Ошибка при фиксации прихода")
+            await query.edit_message_text(
+                f"✅ Приход зафиксирован!\n"
+                f"Время: {result['time'].strftime('%d.%m.%Y %H:%M')}\n\n"
+                "Удачной работы!\n\n"
+                "Выберите действие:",
+                reply_markup=keyboard
+            )
         except Exception as e:
-            db.rollback()
-            await query.answer("Ошибка при фиксации прихода")
+            if "Message is not modified" in str(e):
+                await query.answer("Приход уже зафиксирован")
+            else:
+                await query.answer("Ошибка при фиксации прихода")
 
-    async def _handle_checkout_via_callback(self, query, user_id):
+    async def _handle_checkout_via_callback(self, query, result):
         """Обработка ухода через callback"""
-        db = self._get_db_session()
+        status = result["status"]
+        keyboard = self._get_main_menu_keyboard(result["on_shift"])
 
-        # Проверяем разрешение для отметки ухода
-        is_allowed, message = self._check_telegram_user_allowed(user_id)
-        if not is_allowed:
+        if status == "forbidden":
             await query.edit_message_text(
-                f"❌ Доступ запрещен!\n\n{message}\n\n"
+                f"❌ Доступ запрещен!\n\n{result['message']}\n\n"
                 "Обратитесь к администратору для решения проблемы.\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
         # Если есть предупреждение, показываем его
-        if "⚠️" in message:
+        if status == "warning":
             await query.edit_message_text(
-                f"{message}\n\n"
+                f"{result['message']}\n\n"
                 "Продолжаем выполнение действия...\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
-        now = self._get_moscow_time()
-        today = now.date()
-
-        # Находим активную смену на сегодня
-        active = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today,
-            Attendance.ended_at.is_(None)
-        ).first()
-
-        if not active:
+        if status == "no_active":
             await query.edit_message_text(
                 "У вас нет активной смены на сегодня\n\n"
                 "Используйте 'Я пришел' для начала смены\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
-        # Завершаем смену
-        active.ended_at = now
+        if status != "stopped":
+            await query.answer("Ошибка при фиксации ухода")
+            return
 
-        # Calculate total work time for today including all previous sessions
-        total_work_seconds = 0
-        
-        # Get all attendance records for today
-        today_records = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today
-        ).order_by(Attendance.started_at).all()
-        
-        # Calculate total time from all completed sessions
-        for record in today_records:
-            if record.ended_at is not None:
-                # This session is completed, add its duration
-                started_at = record.started_at
-                ended_at = record.ended_at
-                
-                # Handle timezone-aware and naive datetimes
-                if started_at.tzinfo is None:
-                    utc_tz = timezone.utc
-                    started_at = started_at.replace(tzinfo=utc_tz)
-                if ended_at.tzinfo is None:
-                    utc_tz = timezone.utc
-                    ended_at = ended_at.replace(tzinfo=utc_tz)
-                    
-                session_seconds = (ended_at - started_at).total_seconds()
-                total_work_seconds += session_seconds
-        
-        # Add current session time
-        current_started_at = active.started_at
-        if current_started_at.tzinfo is None:
-            utc_tz = timezone.utc
-            current_started_at = current_started_at.replace(tzinfo=utc_tz)
-        
-        current_session_seconds = (now - current_started_at).total_seconds()
-        total_work_seconds += current_session_seconds
-        
-        # Update the current record
-        active.hours = round(total_work_seconds / 3600.0, 4)
+        hours = int(result["hours"])
+        minutes = int((result["hours"] - hours) * 60)
 
         try:
-            db.add(active)
-            db.commit()
-
-            hours = int(active.hours)
-            minutes = int((active.hours - hours) * 60)
-
-            try:
-                await query.edit_message_text(
-                    f"❌ Уход зафиксирован!\n"
-                    f"Время: {now.strftime('%d.%m.%Y %H:%M')}\n"
-                    f"Отработано сегодня: {hours}ч {minutes}мин\n\n"
-                    "Хорошего отдыха!\n\n"
-                    "Выберите действие:",
-                    reply_markup=self._get_main_menu_keyboard(user_id)
-                )
-            except Exception as e:
-                if "Message is not modified" in str(e):
-                    await query.answer("Уход уже зафиксирован")
-                else:
-                    await query.answer("Ошибка при фиксации ухода")
+            await query.edit_message_text(
+                f"❌ Уход зафиксирован!\n"
+                f"Время: {result['time'].strftime('%d.%m.%Y %H:%M')}\n"
+                f"Отработано сегодня: {hours}ч {minutes}мин\n\n"
+                "Хорошего отдыха!\n\n"
+                "Выберите действие:",
+                reply_markup=keyboard
+            )
         except Exception as e:
-            db.rollback()
-            await query.answer("Ошибка при фиксации ухода")
+            if "Message is not modified" in str(e):
+                await query.answer("Уход уже зафиксирован")
+            else:
+                await query.answer("Ошибка при фиксации ухода")
 
-    async def _handle_status_via_callback(self, query, user_id):
+    async def _handle_status_via_callback(self, query, result):
         """Показать статус через callback"""
-        db = self._get_db_session()
-        today = date.today()
-
-        # Получаем активную смену на сегодня
-        active = db.query(Attendance).filter(
-            Attendance.user_id == user_id,
-            Attendance.work_date == today,
-            Attendance.ended_at.is_(None)
-        ).first()
-
-        if active:
-            now = self._get_moscow_time()
-            started_at = active.started_at
-            if started_at.tzinfo is None:
-                # Если время naive, предполагаем что оно в московском времени
-                moscow_tz = timezone(timedelta(hours=3))
-                started_at = started_at.replace(tzinfo=moscow_tz)
-
-            elapsed_seconds = (now - started_at).total_seconds()
-            hours = int(elapsed_seconds / 3600)
-            minutes = int((elapsed_seconds % 3600) / 60)
-
-            # Показываем общее время за день
-            total_hours = active.hours or 0
-            total_h = int(total_hours)
-            total_m = int((total_hours - total_h) * 60)
-
-            try:
-                await query.edit_message_text(
-                    f"📊 Текущий статус:\n\n"
-                    f"🟢 На работе\n"
-                    f"Начало смены: {active.started_at.strftime('%d.%m.%Y %H:%M')}\n"
-                    f"Отработано в этой смене: {hours}ч {minutes}мин\n"
-                    f"Всего за сегодня: {total_h}ч {total_m}мин\n\n"
-                    "Выберите действие:",
-                    reply_markup=self._get_main_menu_keyboard(user_id)
-                )
-            except Exception as e:
-                # Если сообщение не изменилось, просто отвечаем
-                if "Message is not modified" in str(e):
-                    await query.answer("Статус не изменился")
-                else:
-                    await query.answer("Ошибка при обновлении статуса")
-        else:
-            # Проверяем, есть ли завершенная смена на сегодня
-            completed = db.query(Attendance).filter(
-                Attendance.user_id == user_id,
-                Attendance.work_date == today,
-                Attendance.ended_at.isnot(None)
-            ).first()
-
-            if completed:
-                total_hours = completed.hours or 0
-                total_h = int(total_hours)
-                total_m = int((total_hours - total_h) * 60)
-                try:
-                    await query.edit_message_text(
-                        f"📊 Текущий статус:\n\n"
-                        f"🔴 Не на работе\n"
-                        f"Отработано сегодня: {total_h}ч {total_m}мин\n\n"
-                        "Используйте кнопку 'Я пришел' для начала новой смены\n\n"
-                        "Выберите действие:",
-                        reply_markup=self._get_main_menu_keyboard(user_id)
-                    )
-                except Exception as e:
-                    if "Message is not modified" in str(e):
-                        await query.answer("Статус не изменился")
-                    else:
-                        await query.answer("Ошибка при обновлении статуса")
+        try:
+            await query.edit_message_text(
+                f"{self._format_status(result)}\n\n"
+                "Выберите действие:",
+                reply_markup=self._get_main_menu_keyboard(result["on_shift"])
+            )
+        except Exception as e:
+            # Если сообщение не изменилось, просто отвечаем
+            if "Message is not modified" in str(e):
+                await query.answer("Статус не изменился")
             else:
-                try:
-                    await query.edit_message_text(
-                        f"📊 Текущий статус:\n\n"
-                        f"🔴 Не на работе\n\n"
-                        "Используйте кнопку 'Я пришел' для начала смены\n\n"
-                        "Выберите действие:",
-                        reply_markup=self._get_main_menu_keyboard(user_id)
-                    )
-                except Exception as e:
-                    if "Message is not modified" in str(e):
-                        await query.answer("Статус не изменился")
-                    else:
-                        await query.answer("Ошибка при обновлении статуса")
+                await query.answer("Ошибка при обновлении статуса")
 
-    async def _handle_my_schedule_via_callback(self, query, user_id):
+    async def _handle_my_schedule_via_callback(self, query, result):
         """Показать график сотрудника за текущий месяц через callback"""
-        db = self._get_db_session()
-        user = db.query(User).filter(User.id == user_id).first()
-
-        if not user:
+        if result is None:
             await query.edit_message_text("Пользователь не найден")
             return
 
-        # Получаем текущий месяц
-        now = self._get_moscow_time()
-        current_month = now.replace(day=1)
-        next_month = (current_month + timedelta(days=32)).replace(day=1)
-
-        # Получаем опубликованные смены за текущий месяц
-        from app.models import ScheduleEntry
-        schedules = db.query(ScheduleEntry).filter(
-            ScheduleEntry.user_id == user_id,
-            ScheduleEntry.work_date >= current_month,
-            ScheduleEntry.work_date < next_month,
-            ScheduleEntry.published == True
-        ).order_by(ScheduleEntry.work_date).all()
+        current_month = result["current_month"]
+        schedules = result["entries"]
+        keyboard = self._get_main_menu_keyboard(result["on_shift"])
 
         if not schedules:
             await query.edit_message_text(
                 f"📅 Ваш график на {current_month.strftime('%B %Y')}\n\n"
                 "У вас нет опубликованных смен в этом месяце.\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
@@ -979,7 +1203,8 @@ class TelegramBot:
         # Группируем смены по неделям для лучшей читаемости
         current_week = None
         for schedule in schedules:
-            week_start = schedule.work_date - timedelta(days=schedule.work_date.weekday())
+            work_date = schedule["work_date"]
+            week_start = work_date - timedelta(days=work_date.weekday())
             if current_week != week_start:
                 if current_week is not None:
                     schedule_text += "\n"  # Добавляем пустую строку между неделями
@@ -988,33 +1213,34 @@ class TelegramBot:
                 schedule_text += f"📆 Неделя {week_start.strftime('%d.%m')} - {week_end.strftime('%d.%m')}:\n"
 
             # Определяем тип смены
+            shift_type = schedule["shift_type"]
             shift_type_text = ""
-            if schedule.shift_type == "work":
+            if shift_type == "work":
                 shift_type_text = "💼 Рабочий день"
-            elif schedule.shift_type == "off":
+            elif shift_type == "off":
                 shift_type_text = "🏖️ Отгул"
-            elif schedule.shift_type == "vacation":
+            elif shift_type == "vacation":
                 shift_type_text = "🏝️ Отпуск"
-            elif schedule.shift_type == "sick":
+            elif shift_type == "sick":
                 shift_type_text = "🤒 Больничный"
-            elif schedule.shift_type == "weekend":
+            elif shift_type == "weekend":
                 shift_type_text = "🎉 Выходной"
             else:
                 shift_type_text = "❓ Неизвестно"
 
             # Добавляем время, если указано
             time_info = ""
-            if schedule.start_time and schedule.end_time:
-                time_info = f" ({schedule.start_time.strftime('%H:%M')}-{schedule.end_time.strftime('%H:%M')})"
+            if schedule["start_time"] and schedule["end_time"]:
+                time_info = f" ({schedule['start_time'].strftime('%H:%M')}-{schedule['end_time'].strftime('%H:%M')})"
 
-            schedule_text += f"• {schedule.work_date.strftime('%d.%m (%a)')}: {shift_type_text}{time_info}\n"
+            schedule_text += f"• {work_date.strftime('%d.%m (%a)')}: {shift_type_text}{time_info}\n"
 
         # Добавляем итоговую статистику
-        work_days = len([s for s in schedules if s.shift_type == "work"])
-        off_days = len([s for s in schedules if s.shift_type == "off"])
-        vacation_days = len([s for s in schedules if s.shift_type == "vacation"])
-        sick_days = len([s for s in schedules if s.shift_type == "sick"])
-        weekend_days = len([s for s in schedules if s.shift_type == "weekend"])
+        work_days = len([s for s in schedules if s["shift_type"] == "work"])
+        off_days = len([s for s in schedules if s["shift_type"] == "off"])
+        vacation_days = len([s for s in schedules if s["shift_type"] == "vacation"])
+        sick_days = len([s for s in schedules if s["shift_type"] == "sick"])
+        weekend_days = len([s for s in schedules if s["shift_type"] == "weekend"])
 
         schedule_text += f"\n📊 Итого за месяц:\n"
         schedule_text += f"• Рабочих дней: {work_days}\n"
@@ -1032,7 +1258,7 @@ class TelegramBot:
         try:
             await query.edit_message_text(
                 schedule_text,
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
         except Exception as e:
             if "Message is not modified" in str(e):
@@ -1040,33 +1266,32 @@ class TelegramBot:
             else:
                 await query.answer("Ошибка при показе графика")
 
-    async def _handle_show_credentials_via_callback(self, query, user_id):
+    async def _handle_show_credentials_via_callback(self, query, result):
         """Показать логин и пароль для веб-версии через callback"""
-        db = self._get_db_session()
-        user = db.query(User).filter(User.id == user_id).first()
-
-        if not user:
+        if result is None:
             await query.edit_message_text("Пользователь не найден")
             return
 
+        keyboard = self._get_main_menu_keyboard(result["on_shift"])
+
         # Используем сохраненные учетные данные
-        if not user.web_username or not user.web_password_plain:
+        if not result["web_username"] or not result["web_password_plain"]:
             await query.edit_message_text(
                 "Учетные данные для веб-версии не найдены.\n"
                 "Возможно, аккаунт был создан до обновления системы.\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
             return
 
         try:
             await query.edit_message_text(
                 f"🔑 Ваши учетные данные для веб-версии:\n\n"
-                f"Логин: {user.web_username}\n"
-                f"Пароль: {user.web_password_plain}\n\n"
+                f"Логин: {result['web_username']}\n"
+                f"Пароль: {result['web_password_plain']}\n\n"
                 "Используйте эти данные для входа на сайт.\n\n"
                 "Выберите действие:",
-                reply_markup=self._get_main_menu_keyboard(user_id)
+                reply_markup=keyboard
             )
         except Exception as e:
             if "Message is not modified" in str(e):
@@ -1074,9 +1299,98 @@ class TelegramBot:
             else:
                 await query.answer("Ошибка при показе учетных данных")
 
-    def setup_bot(self, token: str):
-        """Настройка и запуск бота"""
-        self.application = Application.builder().token(token).build()
+    async def _send_now(self, chat_id: int, text: str, reply_markup=None):
+        """Непосредственная отправка сообщения (используется очередью рассылок)"""
+        return await self.application.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+    def send_message(self, telegram_id: int, text: str, reply_markup=None, coalesce_key: Optional[str] = None):
+        """Ставит сообщение в очередь рассылки. Можно вызывать из любого потока процесса бота"""
+        if self.outbox is None:
+            raise RuntimeError("Бот не запущен в этом процессе")
+        self.outbox.enqueue(telegram_id, text, reply_markup=reply_markup, coalesce_key=coalesce_key)
+
+    def _load_broadcast_recipients(self, db: Session, store_id: Optional[int], user_ids: Optional[list]) -> list:
+        """Telegram ID активных сотрудников, которым нужно отправить рассылку"""
+        query = db.query(User.telegram_id).filter(User.is_active == True, User.telegram_id.isnot(None))
+        if store_id is not None:
+            query = query.filter(User.store_id == store_id)
+        if user_ids is not None:
+            query = query.filter(User.id.in_(user_ids))
+        return [telegram_id for (telegram_id,) in query.all()]
+
+    async def broadcast(
+        self,
+        text: str,
+        store_id: Optional[int] = None,
+        user_ids: Optional[Iterable[int]] = None,
+        coalesce_key: Optional[str] = None,
+    ) -> int:
+        """Рассылка активным сотрудникам (всем, одного магазина или выбранным).
+
+        Сообщения уходят через очередь с ограничением частоты; возвращает число получателей.
+        """
+        recipients = await self._run_db(
+            self._load_broadcast_recipients, store_id, list(user_ids) if user_ids is not None else None
+        )
+        for telegram_id in recipients:
+            self.send_message(telegram_id, text, coalesce_key=coalesce_key)
+        return len(recipients)
+
+    def request_reminder_refresh(self):
+        """Сообщает планировщику напоминаний об изменении графика (из любого потока)"""
+        if self.reminders is not None:
+            self.reminders.request_refresh()
+
+    async def _on_start(self, application: Application):
+        """Запускает очередь исходящих сообщений и напоминания в цикле событий бота"""
+        self.outbox = OutboundQueue(self._send_now)
+        self.outbox.start()
+        if BOT_REMINDERS_ENABLED:
+            reminders = ReminderScheduler(self._run_db, self.send_message)
+            if reminders.start():
+                self.reminders = reminders
+
+    async def _on_stop(self, application: Application):
+        """Останавливает напоминания и доотправляет очередь, пока HTTP-клиент бота еще открыт"""
+        if self.reminders is not None:
+            await self.reminders.close()
+            logger.info("Напоминания остановлены: %s", self.reminders.stats())
+            self.reminders = None
+        if self.outbox is not None:
+            await self.outbox.close()
+            logger.info("Очередь рассылок бота остановлена: %s", self.outbox.stats())
+            self.outbox = None
+
+    async def _on_shutdown(self, application: Application):
+        """Дожидается завершения операций с БД, сохраняет состояния диалогов и освобождает пул потоков"""
+        executor, self._db_executor = self._db_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self.user_sessions.close()
+        logger.info("Пул БД бота остановлен: %s; состояния: %s", self.db_stats(), self.user_sessions.stats())
+
+    def setup_bot(self, token: str, request=None):
+        """Настройка и запуск бота
+
+        request — необязательный объект запросов PTB (например, HTTPXRequest
+        с транспортом к поддельному Bot API в тестах).
+        """
+        if self._db_executor is None:
+            # Пул закрыт предыдущей остановкой бота
+            self._db_executor = self._new_db_executor()
+        builder = (
+            Application.builder()
+            .token(token)
+            .base_url(f"{TELEGRAM_API_BASE_URL}/bot")
+            .base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+            .concurrent_updates(ChatOrderedUpdateProcessor(BOT_CONCURRENT_UPDATES))
+            .post_init(self._on_start)
+            .post_stop(self._on_stop)
+            .post_shutdown(self._on_shutdown)
+        )
+        if request is not None:
+            builder = builder.request(request)
+        self.application = builder.build()
 
         # Добавляем обработчики
         self.application.add_handler(CommandHandler("start", self.start_command))
@@ -1091,6 +1405,35 @@ class TelegramBot:
         else:
             raise ValueError("Bot not set up. Call setup_bot() first")
 
+    async def start_webhook(self, token: str, webhook_url: str, secret_token: Optional[str] = None, request=None):
+        """Запуск бота в режиме webhook внутри цикла событий веб-приложения.
+
+        Апдейты приходят POST-запросами на маршрут из app/routers/telegram_webhook.py
+        и кладутся в update_queue приложения.
+        """
+        self.setup_bot(token, request=request)
+        await self.application.initialize()
+        await self.application.start()
+        await self._on_start(self.application)
+        await self.application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info("Telegram webhook установлен: %s", webhook_url)
+
+    async def stop_webhook(self):
+        """Остановка бота, запущенного через start_webhook"""
+        if self.application is None:
+            return
+        await self._on_stop(self.application)
+        if self.application.running:
+            await self.application.stop()
+        await self.application.shutdown()
+        # post_init/post_stop/post_shutdown вызываются только в run_polling/run_webhook, здесь — вручную
+        await self._on_shutdown(self.application)
+
     def run_sync(self):
         """Синхронный запуск бота"""
         if self.application:
@@ -1100,4 +1443,4 @@ class TelegramBot:
 
 
 # Глобальный экземпляр бота
-telegram_bot = TelegramBot()
\ No newline at end of file
+telegram_bot = TelegramBot()
@@ -0,0 +1,174 @@
+"""Прием апдейтов Telegram в веб-приложении (режим webhook).
+
+Под gunicorn запросы от Telegram попадают в любой воркер, а бот (его
+приложение, очередь рассылок, set_webhook) должен работать ровно в одном:
+иначе порядок апдейтов одного чата соблюдается только внутри воркера, а
+лимит рассылок умножается на число воркеров. Воркер, захвативший файловую
+блокировку TELEGRAM_WEBHOOK_LOCK_FILE, запускает бота и слушает Unix-сокет
+TELEGRAM_WEBHOOK_SOCKET; остальные передают ему апдейты через сокет и
+отвечают Telegram только после того, как апдейт поставлен в очередь. Если
+владелец умер, первый воркер, не сумевший передать апдейт, запускает бота сам.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import secrets
+import tempfile
+
+from fastapi import APIRouter, HTTPException, Request
+from starlette.responses import Response
+from telegram import Update
+
+from app.bot_reminders import _acquire_instance_lock
+from app.routers.telegram_bot import telegram_bot
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Публичный адрес, который сообщается Telegram; без него бот в веб-приложении не запускается
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+TELEGRAM_WEBHOOK_LOCK_FILE = os.getenv(
+    "TELEGRAM_WEBHOOK_LOCK_FILE", os.path.join(tempfile.gettempdir(), "time_tracker_telegram_webhook.lock")
+)
+TELEGRAM_WEBHOOK_SOCKET = os.getenv(
+    "TELEGRAM_WEBHOOK_SOCKET", os.path.join(tempfile.gettempdir(), "time_tracker_telegram_webhook.sock")
+)
+FORWARD_TIMEOUT_SECONDS = 5.0
+
+_owner_lock = None  # блокировка владельца бота, если бот работает в этом процессе
+_forward_server: "asyncio.AbstractServer | None" = None
+_start_lock = asyncio.Lock()
+
+
+def _bot_running(bot) -> bool:
+    return bot.application is not None and bot.application.running
+
+
+async def _enqueue(bot, payload: dict) -> None:
+    update = Update.de_json(payload, bot.application.bot)
+    await bot.application.update_queue.put(update)
+
+
+async def start_forward_server(bot, path: str):
+    """Unix-сокет владельца: по строке JSON на апдейт, ответ ok — апдейт в очереди"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not _bot_running(bot):
+                    writer.write(b"unavailable\n")
+                else:
+                    try:
+                        await _enqueue(bot, json.loads(line))
+                        writer.write(b"ok\n")
+                    except ValueError:
+                        writer.write(b"invalid\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        # Сокет умершего владельца; блокировка у нас, значит, он никому не принадлежит
+        os.unlink(path)
+    return await asyncio.start_unix_server(handle, path=path)
+
+
+async def forward_update(payload: dict, path: str) -> bool:
+    """Передает апдейт владельцу бота; False — если владелец недоступен"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(path), FORWARD_TIMEOUT_SECONDS)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        writer.write(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode() + b"\n")
+        await writer.drain()
+        return await asyncio.wait_for(reader.readline(), FORWARD_TIMEOUT_SECONDS) == b"ok\n"
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+@router.post(TELEGRAM_WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    """Прием апдейтов от Telegram: апдейт ставится в очередь бота, ответ — сразу"""
+    if TELEGRAM_WEBHOOK_SECRET:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token, TELEGRAM_WEBHOOK_SECRET):
+            raise HTTPException(status_code=403, detail="Invalid secret token")
+
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    if not _bot_running(telegram_bot) and TELEGRAM_BOT_TOKEN and TELEGRAM_WEBHOOK_URL:
+        # Бот работает в другом воркере — передаем апдейт ему
+        if await forward_update(payload, TELEGRAM_WEBHOOK_SOCKET):
+            return Response(status_code=200)
+        # Владелец не отвечает: пробуем стать им сами (блокировка освобождается при его смерти)
+        await start_telegram_webhook()
+
+    if not _bot_running(telegram_bot):
+        # Telegram повторит доставку позже
+        raise HTTPException(status_code=503, detail="Bot is not running")
+
+    await _enqueue(telegram_bot, payload)
+    return Response(status_code=200)
+
+
+async def start_telegram_webhook() -> bool:
+    """Запускает бота в режиме webhook, если заданы токен и TELEGRAM_WEBHOOK_URL и бот не работает в другом воркере"""
+    global _owner_lock, _forward_server
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_WEBHOOK_URL:
+        return False
+    async with _start_lock:
+        if _bot_running(telegram_bot):
+            return True
+        handle = _acquire_instance_lock(TELEGRAM_WEBHOOK_LOCK_FILE)
+        if handle is None:
+            logger.info("Telegram бот работает в другом воркере, апдейты передаются через %s", TELEGRAM_WEBHOOK_SOCKET)
+            return False
+        try:
+            await telegram_bot.start_webhook(TELEGRAM_BOT_TOKEN, TELEGRAM_WEBHOOK_URL, secret_token=TELEGRAM_WEBHOOK_SECRET)
+            if handle is not True:  # без fcntl (Windows) бот работает в каждом процессе, сокет не нужен
+                _forward_server = await start_forward_server(telegram_bot, TELEGRAM_WEBHOOK_SOCKET)
+        except Exception:
+            # Веб-приложение должно работать и при недоступном Bot API
+            logger.exception("Не удалось запустить Telegram бота в режиме webhook")
+            try:
+                # Бот мог успеть запуститься (упал сокет пересылки) — без блокировки он работать не должен
+                if _bot_running(telegram_bot):
+                    await telegram_bot.stop_webhook()
+            finally:
+                if handle is not True:
+                    handle.close()
+            return False
+        _owner_lock = handle
+        return True
+
+
+async def stop_telegram_webhook():
+    global _owner_lock, _forward_server
+    if _forward_server is not None:
+        _forward_server.close()
+        await _forward_server.wait_closed()
+        _forward_server = None
+    if telegram_bot.application is not None and telegram_bot.application.running:
+        await telegram_bot.stop_webhook()
+    if _owner_lock not in (None, True):
+        _owner_lock.close()
+    _owner_lock = None
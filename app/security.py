@@ -1,11 +1,23 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 
 import jwt
 from passlib.context import CryptContext
 
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Стоимость bcrypt. При изменении старые хэши пересчитываются при следующем входе
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Потоки для хэширования паролей (bcrypt отпускает GIL, поэтому потоки работают параллельно)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+# Сверх этого числа ожидающих операций новые входы отклоняются, а не копятся в очереди
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "256"))
+
+password_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 # JWT settings
 SECRET_KEY = "dev-jwt-secret-change-me"
@@ -22,6 +34,86 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return password_context.verify(plain_password, hashed_password)
 
 
+def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Проверяет пароль; при верном пароле и устаревших параметрах возвращает новый хэш"""
+    return password_context.verify_and_update(plain_password, hashed_password)
+
+
+class PasswordHashBusy(Exception):
+    """Очередь хэширования паролей переполнена"""
+
+
+# Отдельный пул, чтобы bcrypt не занимал общий пул потоков веб-сервера
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_hash_stats_lock = threading.Lock()
+_hash_stats = {
+    "calls": 0,
+    "rejected": 0,
+    "rehashed": 0,
+    "queued": 0,
+    "in_flight": 0,
+    "queue_max": 0,
+    "wait_seconds_total": 0.0,
+    "run_seconds_total": 0.0,
+}
+
+
+async def _run_hash(func, *args):
+    with _hash_stats_lock:
+        if _hash_stats["queued"] + _hash_stats["in_flight"] >= PASSWORD_HASH_MAX_QUEUE:
+            _hash_stats["rejected"] += 1
+            raise PasswordHashBusy()
+        _hash_stats["queued"] += 1
+        _hash_stats["queue_max"] = max(_hash_stats["queue_max"], _hash_stats["queued"])
+    submitted_at = time.perf_counter()
+
+    def _call():
+        started_at = time.perf_counter()
+        with _hash_stats_lock:
+            _hash_stats["queued"] -= 1
+            _hash_stats["in_flight"] += 1
+            _hash_stats["wait_seconds_total"] += started_at - submitted_at
+        try:
+            return func(*args)
+        finally:
+            with _hash_stats_lock:
+                _hash_stats["in_flight"] -= 1
+                _hash_stats["calls"] += 1
+                _hash_stats["run_seconds_total"] += time.perf_counter() - started_at
+
+    return await asyncio.get_running_loop().run_in_executor(_hash_executor, _call)
+
+
+async def hash_password_async(plain_password: str) -> str:
+    """hash_password в пуле хэширования, не блокируя цикл событий"""
+    return await _run_hash(hash_password, plain_password)
+
+
+async def verify_and_update_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """verify_and_update_password в пуле хэширования.
+
+    Raises:
+        PasswordHashBusy: если очередь переполнена
+    """
+    verified, new_hash = await _run_hash(verify_and_update_password, plain_password, hashed_password)
+    if new_hash:
+        with _hash_stats_lock:
+            _hash_stats["rehashed"] += 1
+    return verified, new_hash
+
+
+def password_hash_stats() -> dict:
+    """Метрики пула хэширования: глубина очереди, ожидание и время работы"""
+    with _hash_stats_lock:
+        stats = dict(_hash_stats)
+    calls = stats["calls"]
+    stats["workers"] = PASSWORD_HASH_WORKERS
+    stats["rounds"] = BCRYPT_ROUNDS
+    stats["wait_seconds_avg"] = stats["wait_seconds_total"] / calls if calls else 0.0
+    stats["run_seconds_avg"] = stats["run_seconds_total"] / calls if calls else 0.0
+    return stats
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -0,0 +1,257 @@
+"""Серверные сессии веб-интерфейса.
+
+Вместо подписанного cookie со всем содержимым сессии (SessionMiddleware)
+в cookie хранится только случайный идентификатор. Содержимое лежит в
+таблице web_sessions (ключ — sha256 от идентификатора), перед ней —
+LRU-кэш в памяти процесса. Срок жизни скользящий: при активности сессия
+продлевается, но в БД это пишется не чаще раза в SESSION_TOUCH_SECONDS.
+Истекшие строки удаляются одним запросом по индексу expires_at.
+
+Включается переменной окружения SESSION_BACKEND=server.
+"""
+
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+
+from app.database import dialect_insert, engine, session_scope
+from app.models import WebSession
+
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "cookie")  # cookie | server
+SESSION_COOKIE_NAME = os.getenv("SESSION_COOKIE_NAME", "session")
+SESSION_MAX_AGE = int(os.getenv("SESSION_MAX_AGE", str(14 * 24 * 3600)))
+# Продление срока пишется в БД не чаще, чем раз в столько секунд
+SESSION_TOUCH_SECONDS = int(os.getenv("SESSION_TOUCH_SECONDS", "300"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+# Сколько секунд процесс доверяет кэшу (отзыв сессий в другом процессе виден не позже)
+SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "30"))
+SESSION_PURGE_SECONDS = int(os.getenv("SESSION_PURGE_SECONDS", "3600"))
+SESSION_HTTPS_ONLY = os.getenv("SESSION_HTTPS_ONLY", "0") == "1"
+
+
+def _key(session_id: str) -> str:
+    # В БД хранится хэш: утечка таблицы не дает готовых cookie
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+
+@dataclass
+class SessionRecord:
+    data: Dict
+    expires_at: int
+    user_id: Optional[int]
+
+
+class SessionStore:
+    """LRU в памяти поверх таблицы web_sessions"""
+
+    def __init__(self, max_age: int = SESSION_MAX_AGE, cache_size: int = SESSION_CACHE_SIZE, cache_ttl: int = SESSION_CACHE_TTL):
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()  # ключ -> (SessionRecord, кэширован_в)
+        self._last_purge = 0.0
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "touches": 0, "purged": 0}
+
+    def _remember(self, key: str, record: SessionRecord) -> None:
+        with self._lock:
+            self._cache[key] = (record, time.monotonic())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, key: str) -> None:
+        with self._lock:
+            self._cache.pop(key, None)
+
+    # --- синхронные операции с БД (вызываются из пула потоков) ---
+
+    def _load_db(self, key: str) -> Optional[SessionRecord]:
+        with session_scope() as db:
+            row = db.get(WebSession, key)
+            if row is None:
+                return None
+            return SessionRecord(json.loads(row.data), row.expires_at, row.user_id)
+
+    def _save_db(self, key: str, record: SessionRecord) -> None:
+        values = {
+            "id": key,
+            "user_id": record.user_id,
+            "data": json.dumps(record.data, ensure_ascii=False, default=str),
+            "expires_at": record.expires_at,
+        }
+        with session_scope() as db:
+            insert = dialect_insert(engine.dialect)
+            if insert is not None:
+                stmt = insert(WebSession.__table__).values(**values)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["id"],
+                    set_={"user_id": stmt.excluded.user_id, "data": stmt.excluded.data, "expires_at": stmt.excluded.expires_at},
+                )
+                db.execute(stmt)
+            else:
+                db.merge(WebSession(**values))
+            db.commit()
+
+    def _touch_db(self, key: str, expires_at: int) -> None:
+        with session_scope() as db:
+            db.query(WebSession).filter(WebSession.id == key).update({"expires_at": expires_at}, synchronize_session=False)
+            db.commit()
+
+    def _delete_db(self, key: str) -> None:
+        with session_scope() as db:
+            db.query(WebSession).filter(WebSession.id == key).delete(synchronize_session=False)
+            db.commit()
+
+    def purge_expired(self) -> int:
+        """Удаляет все истекшие сессии одним запросом"""
+        with session_scope() as db:
+            deleted = db.query(WebSession).filter(WebSession.expires_at < int(time.time())).delete(synchronize_session=False)
+            db.commit()
+        with self._lock:
+            self._last_purge = time.monotonic()
+            self._stats["purged"] += deleted
+        return deleted
+
+    def revoke_user(self, db: Session, user_id: int) -> int:
+        """Отзывает все сессии пользователя (в транзакции вызывающего кода)"""
+        deleted = db.query(WebSession).filter(WebSession.user_id == user_id).delete(synchronize_session=False)
+        with self._lock:
+            for key in [key for key, (record, _) in self._cache.items() if record.user_id == user_id]:
+                del self._cache[key]
+        return deleted
+
+    # --- асинхронный интерфейс для middleware ---
+
+    async def load(self, session_id: str) -> Optional[SessionRecord]:
+        key = _key(session_id)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and time.monotonic() - entry[1] <= self.cache_ttl:
+                self._cache.move_to_end(key)
+                self._stats["hits"] += 1
+                record = entry[0]
+            else:
+                record = None
+                self._stats["misses"] += 1
+        if record is None:
+            record = await run_in_threadpool(self._load_db, key)
+            if record is None:
+                return None
+            self._remember(key, record)
+        if record.expires_at < time.time():
+            self._forget(key)
+            return None
+        return record
+
+    async def save(self, session_id: str, data: Dict) -> SessionRecord:
+        key = _key(session_id)
+        user_id = data.get("user_id")
+        record = SessionRecord(dict(data), int(time.time()) + self.max_age, user_id if isinstance(user_id, int) else None)
+        await run_in_threadpool(self._save_db, key, record)
+        self._remember(key, record)
+        with self._lock:
+            self._stats["writes"] += 1
+        return record
+
+    async def touch(self, session_id: str, record: SessionRecord) -> bool:
+        """Продлевает сессию, если с прошлого продления прошло достаточно времени"""
+        expires_at = int(time.time()) + self.max_age
+        if expires_at - record.expires_at < SESSION_TOUCH_SECONDS:
+            return False
+        key = _key(session_id)
+        await run_in_threadpool(self._touch_db, key, expires_at)
+        record.expires_at = expires_at
+        self._remember(key, record)
+        with self._lock:
+            self._stats["touches"] += 1
+        return True
+
+    async def delete(self, session_id: str) -> None:
+        key = _key(session_id)
+        self._forget(key)
+        await run_in_threadpool(self._delete_db, key)
+
+    async def maybe_purge(self) -> None:
+        if time.monotonic() - self._last_purge >= SESSION_PURGE_SECONDS:
+            with self._lock:
+                self._last_purge = time.monotonic()
+            await run_in_threadpool(self.purge_expired)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._cache)
+        return stats
+
+
+session_store = SessionStore()
+
+
+def revoke_user_sessions(db: Session, user_id: int) -> int:
+    """Отзывает веб-сессии пользователя (например, при деактивации). Коммит — за вызывающим"""
+    return session_store.revoke_user(db, user_id)
+
+
+class ServerSessionMiddleware:
+    """ASGI middleware с тем же интерфейсом request.session, что у SessionMiddleware"""
+
+    def __init__(self, app, store: SessionStore = session_store, session_cookie: str = SESSION_COOKIE_NAME,
+                 path: str = "/", same_site: str = "lax", https_only: bool = SESSION_HTTPS_ONLY):
+        self.app = app
+        self.store = store
+        self.session_cookie = session_cookie
+        self.path = path
+        self.security_flags = f"httponly; samesite={same_site}" + ("; secure" if https_only else "")
+
+    def _cookie(self, value: str, max_age: int) -> str:
+        return f"{self.session_cookie}={value}; path={self.path}; Max-Age={max_age}; {self.security_flags}"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        connection = HTTPConnection(scope)
+        session_id = connection.cookies.get(self.session_cookie)
+        record = await self.store.load(session_id) if session_id else None
+        scope["session"] = dict(record.data) if record else {}
+        initial = json.dumps(scope["session"], sort_keys=True, default=str)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                session = scope["session"]
+                headers = MutableHeaders(scope=message)
+                if session:
+                    if record is None or session.get("user_id") != record.data.get("user_id"):
+                        # Новый вход — новый идентификатор (защита от фиксации сессии)
+                        if record is not None:
+                            await self.store.delete(session_id)
+                        new_id = secrets.token_urlsafe(32)
+                        await self.store.save(new_id, session)
+                        headers.append("Set-Cookie", self._cookie(new_id, self.store.max_age))
+                    elif json.dumps(session, sort_keys=True, default=str) != initial:
+                        await self.store.save(session_id, session)
+                        headers.append("Set-Cookie", self._cookie(session_id, self.store.max_age))
+                    elif await self.store.touch(session_id, record):
+                        headers.append("Set-Cookie", self._cookie(session_id, self.store.max_age))
+                elif record is not None:
+                    # Сессию очистили (выход) — удаляем строку и cookie
+                    await self.store.delete(session_id)
+                    headers.append("Set-Cookie", self._cookie("null", 0))
+                await self.store.maybe_purge()
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
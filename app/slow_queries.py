@@ -0,0 +1,275 @@
+"""Журнал медленных SQL-запросов и статистика по «формам» запросов.
+
+Каждый запрос через engine учитывается в статистике по форме (текст без
+значений, списки IN (?, ?, ...) свернуты). Запрос дольше SLOW_QUERY_MS
+пишется в logs/slow_queries.log (JSON, ротация как у основного журнала)
+с параметрами, маршрутом, request_id и числом строк; для новой формы один
+раз снимается план (EXPLAIN QUERY PLAN в SQLite, EXPLAIN в PostgreSQL).
+
+Для SELECT число строк известно только после выборки, поэтому курсор
+медленного запроса оборачивается счетчиком, а запись в журнал делается
+при его закрытии. Статистика процессов сбрасывается в файлы
+SLOW_QUERY_STATS_DIR/<pid>.json и сводится на странице /admin/slow-queries.
+"""
+
+import functools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from app.database import add_query_observer
+from app.logging_config import current_route, setup_file_logger
+
+
+SLOW_QUERY_ENABLED = os.getenv("SLOW_QUERY_ENABLED", "1") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "logs/slow_queries.log")
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+SLOW_QUERY_STATS_DIR = os.getenv("SLOW_QUERY_STATS_DIR", os.path.join(tempfile.gettempdir(), "time_tracker_slow_queries"))
+SLOW_QUERY_FLUSH_SECONDS = float(os.getenv("SLOW_QUERY_FLUSH_SECONDS", "10"))
+# Форм больше этого числа не заводим: защита от запросов с литералами в тексте
+SLOW_QUERY_MAX_SHAPES = int(os.getenv("SLOW_QUERY_MAX_SHAPES", "1000"))
+PARAM_MAX_LENGTH = 200
+
+_IN_LIST = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s)\s*,)+\s*(?:\?|%\(\w+\)s)\s*\)")
+_SPACES = re.compile(r"\s+")
+# План есть только у DML; DDL и служебные команды не объясняем
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+@functools.lru_cache(maxsize=4096)
+def statement_shape(statement: str) -> str:
+    """Текст запроса без переменной части: для группировки"""
+    return _IN_LIST.sub("(?...)", _SPACES.sub(" ", statement).strip())
+
+
+def _short_params(parameters):
+    if isinstance(parameters, (list, tuple)):
+        return [_short_params(value) for value in parameters[:50]]
+    if isinstance(parameters, dict):
+        return {key: _short_params(value) for key, value in list(parameters.items())[:50]}
+    if isinstance(parameters, (int, float, bool)) or parameters is None:
+        return parameters
+    text = str(parameters)
+    return text if len(text) <= PARAM_MAX_LENGTH else text[:PARAM_MAX_LENGTH] + "…"
+
+
+class StatementStats:
+    """Вызовы, суммарное и максимальное время по формам запросов"""
+
+    def __init__(self, directory: str = SLOW_QUERY_STATS_DIR, flush_seconds: float = SLOW_QUERY_FLUSH_SECONDS,
+                 max_shapes: int = SLOW_QUERY_MAX_SHAPES):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.max_shapes = max_shapes
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # запись файла процесса — по одному потоку
+        self._stats: Dict[str, Dict] = {}
+        self._last_flush = time.monotonic()
+
+    def record(self, shape: str, duration_ms: float, slow: bool, route: Optional[str]) -> Optional[Dict]:
+        with self._lock:
+            entry = self._stats.get(shape)
+            if entry is None:
+                if len(self._stats) >= self.max_shapes:
+                    return None
+                entry = self._stats[shape] = {
+                    "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "slow": 0, "rows": 0, "route": None, "plan": None,
+                }
+            entry["calls"] += 1
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+            if slow:
+                entry["slow"] += 1
+                entry["route"] = route
+        return entry
+
+    def add_rows(self, shape: str, rows: int) -> None:
+        with self._lock:
+            if shape in self._stats:
+                self._stats[shape]["rows"] += rows
+
+    def set_plan(self, shape: str, plan: str) -> None:
+        with self._lock:
+            if shape in self._stats:
+                self._stats[shape]["plan"] = plan
+
+    def maybe_flush(self, force: bool = False) -> None:
+        # Быстрая проверка без блокировок: вызывается после каждого запроса
+        if not force and time.monotonic() - self._last_flush < self.flush_seconds:
+            return
+        # Плановый сброс не ждет чужой — файл процесса и так сейчас перезаписывается
+        if not self._flush_lock.acquire(blocking=force):
+            return
+        try:
+            with self._lock:
+                now = time.monotonic()
+                if not force and now - self._last_flush < self.flush_seconds:
+                    return
+                self._last_flush = now
+                data = {"pid": os.getpid(), "stats": {shape: dict(entry) for shape, entry in self._stats.items()}}
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.json")
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{os.getpid()}.", suffix=".tmp", dir=self.directory)
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                    json.dump(data, fh, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        finally:
+            self._flush_lock.release()
+
+    def top(self, limit: int = 50) -> List[Dict]:
+        """Формы с наибольшим суммарным временем по всем процессам"""
+        self.maybe_flush(force=True)
+        merged: Dict[str, Dict] = {}
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, file_name), encoding="utf-8") as fh:
+                    stats = json.load(fh)["stats"]
+            except (OSError, ValueError, KeyError):
+                continue
+            for shape, entry in stats.items():
+                current = merged.get(shape)
+                if current is None:
+                    merged[shape] = dict(entry, statement=shape)
+                    continue
+                for key in ("calls", "total_ms", "slow", "rows"):
+                    current[key] += entry[key]
+                current["max_ms"] = max(current["max_ms"], entry["max_ms"])
+                current["route"] = current["route"] or entry["route"]
+                current["plan"] = current["plan"] or entry["plan"]
+        return sorted(merged.values(), key=lambda item: -item["total_ms"])[:limit]
+
+
+statement_stats = StatementStats()
+_logger = None
+
+
+def _slow_logger():
+    global _logger
+    if _logger is None:
+        _logger = setup_file_logger("app.slow_queries", SLOW_QUERY_LOG)
+    return _logger
+
+
+def explain(conn, statement: str, parameters) -> str:
+    """План запроса на том же соединении, мимо событий engine"""
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif dialect == "postgresql":
+        prefix = "EXPLAIN "
+    else:
+        return ""
+    if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+        return ""
+    if isinstance(parameters, list):  # executemany — план по первому набору
+        parameters = parameters[0] if parameters else ()
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        if dialect == "postgresql":
+            # Ошибка EXPLAIN не должна оборвать транзакцию приложения
+            cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as exc:
+            if dialect == "postgresql":
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            return f"EXPLAIN failed: {type(exc).__name__}: {exc}"
+        if dialect == "postgresql":
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    finally:
+        cursor.close()
+    if dialect == "sqlite":
+        # (id, parent, notused, detail): отступ по глубине вложенности
+        depth = {0: -1}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[node_id] + detail)
+        return "\n".join(lines)
+    return "\n".join(row[0] for row in rows)
+
+
+class _CountingCursor:
+    """Курсор медленного SELECT: считает выбранные строки и пишет журнал при закрытии"""
+
+    def __init__(self, cursor, on_close):
+        self._cursor = cursor
+        self._on_close = on_close
+        self.rows = 0
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self.rows += len(rows)
+        return rows
+
+    def close(self):
+        try:
+            self._cursor.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close(self.rows)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _observe(conn, statement: str, parameters, duration: float, context) -> None:
+    duration_ms = duration * 1000
+    slow = duration_ms >= SLOW_QUERY_MS
+    shape = statement_shape(statement)
+    route = current_route() if slow else None
+    entry = statement_stats.record(shape, duration_ms, slow, route)
+    if slow:
+        plan = None
+        if SLOW_QUERY_EXPLAIN and entry is not None and entry["plan"] is None:
+            plan = explain(conn, statement, parameters)
+            statement_stats.set_plan(shape, plan)
+        extra = {
+            "duration_ms": round(duration_ms, 2),
+            "statement": statement,
+            "parameters": _short_params(parameters),
+            "plan": plan,
+        }
+
+        def write(rows: Optional[int]) -> None:
+            if rows is not None:
+                statement_stats.add_rows(shape, rows)
+            _slow_logger().warning("slow query %.1f ms", duration_ms, extra=dict(extra, rows=rows))
+
+        cursor = getattr(context, "cursor", None)
+        if cursor is not None and cursor.description is not None:
+            context.cursor = _CountingCursor(cursor, write)
+        else:
+            write(cursor.rowcount if cursor is not None and cursor.rowcount >= 0 else None)
+    statement_stats.maybe_flush()
+
+
+if SLOW_QUERY_ENABLED:
+    add_query_observer(_observe)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Benchmark: endpoint latency, SQL queries per request and peak memory on a generated dataset.
+
+Runs the full ASGI app (app.main, with its middleware) in-process against a
+copy of the dataset built by scripts/generate_dataset.py, so the dataset
+itself is never modified. Covers the employee pages and check-in paths,
+the admin scheduling table and reports (HTML and XLSX export), and the
+Telegram bot button actions (the DB work each handler runs through
+TelegramBot._run_db; Telegram API calls are not part of the measurement).
+
+For every scenario it prints p50/p95/p99 latency, the median number of
+SQL statements per request and the peak Python memory allocated during
+one request (a separate pass under tracemalloc, so it does not slow the
+latency samples). Results are compared with benchmarks/baselines/endpoints.json:
+p95 or peak memory above the baseline by more than the tolerance, or any
+extra query, is a regression and the script exits with status 1.
+Latency baselines are only meaningful on the machine that recorded them;
+query counts and memory carry over between machines.
+
+Usage:
+    python scripts/generate_dataset.py --reset --end-date 2026-10-19
+    python benchmarks/bench_endpoints.py [--requests 30] [--only dashboard admin_reports]
+    python benchmarks/bench_endpoints.py --save-baseline
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date
+from typing import Callable, Dict, List, Optional
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+DEFAULT_DATASET = os.path.join(PROJECT_ROOT, "time_tracker_dataset.db")
+DEFAULT_BASELINE = os.path.join(CURRENT_DIR, "baselines", "endpoints.json")
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Scenario:
+    """One measured call plus an unmeasured step that puts the account into the right state"""
+
+    def __init__(self, name: str, call: Callable[[int], object], prepare: Optional[Callable[[int], None]] = None):
+        self.name = name
+        self.call = call
+        self.prepare = prepare
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, statement, parameters, duration, context) -> None:
+        with self._lock:
+            self.count += 1
+
+
+class Suite:
+    def __init__(self, args: argparse.Namespace):
+        # The app reads its configuration at import time, so these imports wait for the environment
+        from fastapi.testclient import TestClient
+        from sqlalchemy import text
+
+        from app.database import SessionLocal
+        from app.main import app
+        from app.models import AllowedIP, Store
+        from app.qr_tokens import generate_qr_token
+        from app.routers.telegram_bot import telegram_bot
+
+        self.bot = telegram_bot
+        self.loop = asyncio.new_event_loop()
+        with SessionLocal() as db:
+            self.report_day = db.execute(text("SELECT MAX(work_date) FROM attendance")).scalar()
+            rows = db.execute(text(
+                "SELECT u.id, u.email, u.store_id FROM users u JOIN stores s ON s.id = u.store_id "
+                "WHERE u.role = 'employee' AND u.is_active AND s.is_active ORDER BY u.id LIMIT :n"
+            ), {"n": args.employees}).all()
+            prefix = db.query(AllowedIP.ip_address).filter(AllowedIP.is_active == True).first()  # noqa: E712
+            stores = {store.id: store for store in db.query(Store).filter(Store.id.in_({row.store_id for row in rows}))}
+            self.qr_tokens = {store_id: generate_qr_token(store, "start") for store_id, store in stores.items()}
+        if not rows:
+            raise SystemExit("No active employees in the dataset; run scripts/generate_dataset.py first")
+        if isinstance(self.report_day, str):
+            self.report_day = date.fromisoformat(self.report_day)
+
+        # A client address inside an allowed range, so the IP check passes
+        ip = ".".join(prefix[0].split(".")[:3] + ["10"]) if prefix else "127.0.0.1"
+        self.headers = {"X-Forwarded-For": ip}
+        self.employees = []
+        for row in rows:
+            client = TestClient(app, follow_redirects=False)
+            self._login(client, row.email, args.password)
+            self.employees.append((row.id, row.store_id, client))
+        self.admin = TestClient(app, follow_redirects=False)
+        self._login(self.admin, args.admin_email, args.password)
+
+    @staticmethod
+    def _login(client, email: str, password: str) -> None:
+        response = client.post("/login", data={"email": email, "password": password})
+        if response.status_code != 303:
+            raise SystemExit(f"Login failed for {email}: {response.status_code}")
+
+    def _employee(self, i: int):
+        return self.employees[i % len(self.employees)]
+
+    def _post(self, i: int, path: str):
+        return self._employee(i)[2].post(path, headers=self.headers)
+
+    def _bot(self, i: int, action: str):
+        user_id = self._employee(i)[0]
+        return self.loop.run_until_complete(
+            self.bot._run_db(self.bot._process_callback, user_id, action, 10_000_000 + i)
+        )
+
+    def scenarios(self) -> List[Scenario]:
+        month = {"month": self.report_day.month, "year": self.report_day.year}
+        report = {"report_type": "month", **month}
+        return [
+            Scenario("dashboard", lambda i: self._employee(i)[2].get("/dashboard")),
+            Scenario("attendance_start", lambda i: self._post(i, "/attendance/start"),
+                     prepare=lambda i: self._post(i, "/attendance/stop")),
+            Scenario("attendance_stop", lambda i: self._post(i, "/attendance/stop"),
+                     prepare=lambda i: self._post(i, "/attendance/start")),
+            Scenario("qr_start", lambda i: self._employee(i)[2].get(f"/q/start/{self.qr_tokens[self._employee(i)[1]]}"),
+                     prepare=lambda i: self._post(i, "/attendance/stop")),
+            Scenario("admin_scheduling_table", lambda i: self.admin.get("/admin/scheduling-table", params=month)),
+            Scenario("admin_reports", lambda i: self.admin.get("/admin/reports", params=report)),
+            Scenario("admin_reports_export", lambda i: self.admin.get("/admin/reports/export", params=report)),
+            Scenario("bot_status", lambda i: self._bot(i, "status")),
+            Scenario("bot_my_schedule", lambda i: self._bot(i, "my_schedule")),
+            Scenario("bot_checkin", lambda i: self._bot(i, "checkin"), prepare=lambda i: self._bot(i, "checkout")),
+            Scenario("bot_checkout", lambda i: self._bot(i, "checkout"), prepare=lambda i: self._bot(i, "checkin")),
+        ]
+
+
+def check(name: str, result) -> None:
+    status_code = getattr(result, "status_code", None)
+    if status_code is None:
+        if result is None:
+            raise RuntimeError(f"{name}: the bot treated the account as deleted")
+        return
+    location = result.headers.get("location", "")
+    if status_code >= 400 or "error=" in location or location.startswith("/login"):
+        raise RuntimeError(f"{name}: {status_code} {location or result.text[:200]}")
+
+
+def measure(scenario: Scenario, counter: QueryCounter, requests: int, warmup: int, memory_samples: int) -> Dict:
+    latencies, queries = [], []
+    for i in range(warmup + requests):
+        if scenario.prepare:
+            scenario.prepare(i)
+        counter.count = 0
+        started = time.perf_counter()
+        result = scenario.call(i)
+        elapsed = (time.perf_counter() - started) * 1000
+        check(scenario.name, result)
+        if i >= warmup:
+            latencies.append(elapsed)
+            queries.append(counter.count)
+
+    peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(memory_samples):
+            if scenario.prepare:
+                scenario.prepare(i)
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            scenario.call(i)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "mean_ms": round(statistics.fmean(latencies), 2),
+        "queries": int(statistics.median(queries)),
+        "peak_kb": peak // 1024,
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], latency_tolerance: float,
+            memory_tolerance: float) -> Dict[str, List[str]]:
+    regressions: Dict[str, List[str]] = {}
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        problems = []
+        if current["p95_ms"] > previous["p95_ms"] * (1 + latency_tolerance):
+            problems.append(f"p95 {previous['p95_ms']} -> {current['p95_ms']} ms")
+        if current["queries"] > previous["queries"]:
+            problems.append(f"queries {previous['queries']} -> {current['queries']}")
+        if current["peak_kb"] > previous["peak_kb"] * (1 + memory_tolerance) + 64:
+            problems.append(f"peak {previous['peak_kb']} -> {current['peak_kb']} KB")
+        if problems:
+            regressions[name] = problems
+    return regressions
+
+
+def dataset_summary(db_path: str) -> Dict[str, int]:
+    import sqlite3
+
+    with sqlite3.connect(db_path) as connection:
+        return {
+            table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("stores", "users", "schedule_entries", "attendance")
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="SQLite file from scripts/generate_dataset.py")
+    parser.add_argument("--password", default="password", help="password the dataset was generated with")
+    parser.add_argument("--admin-email", default="admin1@example.com")
+    parser.add_argument("--employees", type=int, default=10, help="employee accounts to rotate through")
+    parser.add_argument("--requests", type=int, default=30, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, help="unmeasured requests per scenario; default one per account, "
+                        "so per-user caches are warm and query counts do not depend on --requests")
+    parser.add_argument("--memory-samples", type=int, default=3, help="requests per scenario under tracemalloc")
+    parser.add_argument("--only", nargs="+", metavar="SCENARIO")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--latency-tolerance", type=float, default=0.25, help="allowed p95 growth, 0.25 = +25%%")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dataset):
+        raise SystemExit(f"{args.dataset} not found; run scripts/generate_dataset.py --reset first")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        shutil.copyfile(args.dataset, db_path)
+        summary = dataset_summary(db_path)
+        os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+        os.environ["METRICS_DIR"] = os.path.join(tmp, "metrics")
+        os.environ["SLOW_QUERY_STATS_DIR"] = os.path.join(tmp, "slow_queries")
+        os.environ.setdefault("SLOW_QUERY_LOG", os.path.join(tmp, "slow_queries.log"))
+        # Limits and per-request logging would measure the benchmark, not the endpoints
+        os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+        os.environ.setdefault("LOG_ACCESS_ENABLED", "0")
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+        from app.database import add_query_observer
+
+        counter = QueryCounter()
+        add_query_observer(counter)
+        suite = Suite(args)
+        scenarios = [s for s in suite.scenarios() if not args.only or s.name in args.only]
+        warmup = args.warmup if args.warmup is not None else len(suite.employees)
+        results = {}
+        for scenario in scenarios:
+            results[scenario.name] = measure(scenario, counter, args.requests, warmup, args.memory_samples)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as fh:
+            stored = json.load(fh)
+        baseline = stored.get("scenarios", {})
+        if stored.get("dataset") != summary:
+            print(f"warning: baseline was recorded on a different dataset {stored.get('dataset')}")
+    regressions = compare(results, baseline, args.latency_tolerance, args.memory_tolerance)
+
+    print(f"dataset={summary} requests={args.requests} employees={args.employees}")
+    print(f"{'scenario':<24} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'peak KB':>8} {'base p95':>9}")
+    for name, result in results.items():
+        base = baseline.get(name, {}).get("p95_ms")
+        flag = "  REGRESSION: " + "; ".join(regressions[name]) if name in regressions else ""
+        print(
+            f"{name:<24} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+            f"{result['queries']:>8} {result['peak_kb']:>8} {base if base is not None else '-':>9}{flag}"
+        )
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        scenarios_to_save = {**baseline, **results}
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump({"dataset": summary, "scenarios": scenarios_to_save}, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+        print(f"baseline saved to {args.baseline}")
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Load test: the 08:50-09:10 morning check-in rush against a running server.
+
+Replays the arrival curve of the busiest window against a local
+uvicorn/gunicorn instance. Every selected employee arrives once, at a time
+drawn from a bell curve peaking at 09:00, shifted by a per-store offset
+(stores open at slightly different times), and checks in through one
+channel:
+  qr   GET /q/start/{token}                          (scanning the store QR)
+  web  GET /dashboard, then POST /attendance/start   (the dashboard button)
+  bot  GET /tgapi/v2/state, then POST /tgapi/v2/checkin (the bot's WebApp)
+
+The window is compressed by --speedup (20 by default: 20 minutes in one).
+Bot traffic uses the WebApp API because webhook updates are acknowledged
+before they are processed, so a client would not see their failures; both
+paths end in the same check-in service.
+
+Employees, stores and QR tokens are read from the database the server
+uses. Sessions are opened with POST /login before the rush, so run this
+with the same environment as the server (QR_TOKEN_FORMAT, secrets), and on
+a dataset where nobody is checked in yet today, for example:
+
+    python scripts/generate_dataset.py --reset --end-date $(date -d yesterday +%F)
+    DATABASE_URL=sqlite:///time_tracker_dataset.db gunicorn app.main:app -k uvicorn.workers.UvicornWorker -w 4
+    DATABASE_URL=sqlite:///time_tracker_dataset.db python benchmarks/bench_morning_rush.py --employees 600
+
+Reports throughput (overall and the busiest second), error rate and
+latency per endpoint, plus how many "database is locked" errors the server
+wrote to its log (--server-log) during the run; a 500 response alone does
+not say why it failed.
+
+Usage:
+    python benchmarks/bench_morning_rush.py [--base-url http://127.0.0.1:8000] [--employees 300]
+        [--stores 20] [--mix qr=0.6,web=0.25,bot=0.15] [--speedup 20] [--store-jitter 120]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import httpx  # noqa: E402
+from sqlalchemy import create_engine, text  # noqa: E402
+
+from app.qr_tokens import QR_TOKEN_FORMAT, generate_qr_token  # noqa: E402
+from app.models import Store  # noqa: E402
+from app.routers.attendance import _generate_compact_token  # noqa: E402
+
+
+WINDOW_SECONDS = 20 * 60  # 08:50-09:10
+LOCK_MARKER = "database is locked"
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        channel, _, weight = part.partition("=")
+        if channel not in ("qr", "web", "bot"):
+            raise argparse.ArgumentTypeError(f"unknown channel {channel!r}")
+        mix[channel] = float(weight)
+    return mix
+
+
+class Employee:
+    def __init__(self, user_id: int, email: str, store_id: int, ip: str):
+        self.user_id = user_id
+        self.email = email
+        self.store_id = store_id
+        self.ip = ip
+        self.cookie: Optional[str] = None
+
+
+class Results:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.outcomes: Dict[str, Counter] = defaultdict(Counter)
+        self.per_second: Counter = Counter()
+        self.locked_in_body = 0
+
+    def record(self, endpoint: str, started: float, elapsed: float, outcome: str) -> None:
+        self.latencies[endpoint].append(elapsed * 1000)
+        self.outcomes[endpoint][outcome] += 1
+        self.per_second[int(started)] += 1
+
+
+def load_employees(database_url: str, count: int, stores: int, seed: int) -> Tuple[List[Employee], Dict[int, str]]:
+    engine = create_engine(database_url)
+    with engine.connect() as connection:
+        store_rows = connection.execute(text(
+            "SELECT id, qr_token, qr_generation FROM stores WHERE is_active ORDER BY id LIMIT :n"
+        ), {"n": stores}).all()
+        store_ids = [row.id for row in store_rows]
+        rows = connection.execute(text(
+            "SELECT id, email, store_id FROM users WHERE role = 'employee' AND is_active "
+            "AND store_id IN (SELECT id FROM stores WHERE is_active ORDER BY id LIMIT :n) ORDER BY id"
+        ), {"n": stores}).all()
+        prefixes = [
+            ".".join(ip.split(".")[:3])
+            for (ip,) in connection.execute(text("SELECT ip_address FROM allowed_ips WHERE is_active")).all()
+        ]
+    engine.dispose()
+    if not rows:
+        raise SystemExit("No active employees in the selected stores; run scripts/generate_dataset.py first")
+
+    qr_tokens = {}
+    for row in store_rows:
+        if QR_TOKEN_FORMAT == "signed":
+            qr_tokens[row.id] = generate_qr_token(Store(id=row.id, qr_generation=row.qr_generation), "start")
+        else:
+            qr_tokens[row.id] = row.qr_token
+
+    rng = random.Random(seed)
+    selected = rng.sample(list(rows), min(count, len(rows)))
+    employees = []
+    for number, row in enumerate(selected):
+        # Distinct client addresses inside allowed ranges: the IP check passes and per-IP limits stay per person
+        prefix = prefixes[number % len(prefixes)] if prefixes else "127.0.0"
+        host = 2 + (number // max(len(prefixes), 1)) % 250
+        employees.append(Employee(row.id, row.email, row.store_id, f"{prefix}.{host}"))
+    print(f"stores={len(store_ids)} employees={len(employees)} qr_format={QR_TOKEN_FORMAT}")
+    return employees, qr_tokens
+
+
+async def login_all(client: httpx.AsyncClient, employees: List[Employee], password: str, concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login(employee: Employee) -> None:
+        async with semaphore:
+            response = await client.post(
+                "/login", data={"email": employee.email, "password": password},
+                headers={"X-Forwarded-For": employee.ip},
+            )
+        if response.status_code != 303:
+            raise SystemExit(f"Login failed for {employee.email}: {response.status_code}")
+        employee.cookie = "; ".join(f"{name}={value}" for name, value in response.cookies.items())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(login(employee) for employee in employees))
+    print(f"logged in {len(employees)} employees in {time.perf_counter() - started:.1f}s")
+
+
+def classify(response: httpx.Response) -> str:
+    if response.status_code == 429:
+        return "rate_limited"
+    if response.status_code >= 500:
+        return "error"
+    if response.status_code >= 400:
+        return "rejected"
+    location = response.headers.get("location", "")
+    if "error=" in location or location.startswith("/login"):
+        return "rejected"
+    return "ok"
+
+
+async def request(client: httpx.AsyncClient, results: Results, endpoint: str, method: str, url: str,
+                  **kwargs) -> bool:
+    started = time.time()
+    clock = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError as exc:
+        results.record(endpoint, started, time.perf_counter() - clock, f"transport:{type(exc).__name__}")
+        return False
+    outcome = classify(response)
+    results.record(endpoint, started, time.perf_counter() - clock, outcome)
+    if outcome == "error" and LOCK_MARKER in response.text:
+        results.locked_in_body += 1
+    return outcome == "ok"
+
+
+async def arrive(client: httpx.AsyncClient, results: Results, employee: Employee, channel: str,
+                 qr_tokens: Dict[int, str], delay: float) -> None:
+    await asyncio.sleep(delay)
+    headers = {"X-Forwarded-For": employee.ip}
+    if channel == "qr":
+        headers["Cookie"] = employee.cookie
+        await request(client, results, "qr /q/start", "GET", f"/q/start/{qr_tokens[employee.store_id]}", headers=headers)
+    elif channel == "web":
+        headers["Cookie"] = employee.cookie
+        if await request(client, results, "web /dashboard", "GET", "/dashboard", headers=headers):
+            await request(client, results, "web /attendance/start", "POST", "/attendance/start", headers=headers)
+    else:
+        headers["Authorization"] = f"Bearer {_generate_compact_token(employee.user_id)}"
+        if await request(client, results, "bot /tgapi/v2/state", "GET", "/tgapi/v2/state", headers=headers):
+            await request(client, results, "bot /tgapi/v2/checkin", "POST", "/tgapi/v2/checkin", headers=headers)
+
+
+def arrival_plan(employees: List[Employee], mix: Dict[str, float], speedup: float, store_jitter: float,
+                 seed: int) -> List[Tuple[Employee, str, float]]:
+    rng = random.Random(seed + 1)
+    store_offsets: Dict[int, float] = {}
+    channels, weights = zip(*mix.items())
+    plan = []
+    for employee in employees:
+        if employee.store_id not in store_offsets:
+            store_offsets[employee.store_id] = rng.gauss(0, store_jitter)
+        # Bell curve over the window, peaking at 09:00
+        at = rng.gauss(WINDOW_SECONDS / 2, WINDOW_SECONDS / 6) + store_offsets[employee.store_id]
+        at = min(max(at, 0.0), WINDOW_SECONDS)
+        plan.append((employee, rng.choices(channels, weights)[0], at / speedup))
+    return plan
+
+
+def count_lock_errors(path: Optional[str], offset: int) -> Optional[int]:
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as fh:
+        fh.seek(offset)
+        return sum(line.count(LOCK_MARKER.encode()) for line in fh)
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    employees, qr_tokens = load_employees(args.database_url, args.employees, args.stores, args.seed)
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    timeout = httpx.Timeout(args.timeout)
+    # Logins get their own client: its cookie jar would otherwise send one employee's session for all
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=timeout) as client:
+        await login_all(client, employees, args.password, args.login_concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=timeout) as client:
+        plan = arrival_plan(employees, args.mix, args.speedup, args.store_jitter, args.seed)
+        log_offset = os.path.getsize(args.server_log) if args.server_log and os.path.exists(args.server_log) else 0
+
+        results = Results()
+        print(f"rush: {len(plan)} arrivals over {WINDOW_SECONDS / args.speedup:.0f}s "
+              f"({Counter(channel for _, channel, _ in plan)})")
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            arrive(client, results, employee, channel, qr_tokens, delay) for employee, channel, delay in plan
+        ))
+        elapsed = time.perf_counter() - started
+
+    # The server writes its log from a queue, so give the last records a moment to land
+    await asyncio.sleep(1.0)
+    return report(results, elapsed, count_lock_errors(args.server_log, log_offset))
+
+
+def report(results: Results, elapsed: float, locked_in_log: Optional[int]) -> Dict:
+    total = sum(len(samples) for samples in results.latencies.values())
+    errors = sum(outcomes[kind] for outcomes in results.outcomes.values()
+                 for kind in outcomes if kind == "error" or kind.startswith("transport:"))
+    summary = {
+        "requests": total,
+        "elapsed_s": round(elapsed, 1),
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "peak_rps": max(results.per_second.values(), default=0),
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "database_locked": {"server_log": locked_in_log, "responses": results.locked_in_body},
+        "endpoints": {},
+    }
+    print(f"\n{total} requests in {elapsed:.1f}s: {summary['throughput_rps']} req/s, "
+          f"busiest second {summary['peak_rps']} req/s, error rate {summary['error_rate']:.2%}")
+    print(f"{'endpoint':<24} {'n':>6} {'ok':>6} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'mean ms':>8}")
+    for endpoint in sorted(results.latencies):
+        samples = results.latencies[endpoint]
+        outcomes = results.outcomes[endpoint]
+        failed = len(samples) - outcomes["ok"]
+        summary["endpoints"][endpoint] = {
+            "requests": len(samples),
+            "outcomes": dict(outcomes),
+            "p50_ms": round(percentile(samples, 0.50), 1),
+            "p95_ms": round(percentile(samples, 0.95), 1),
+            "p99_ms": round(percentile(samples, 0.99), 1),
+        }
+        print(
+            f"{endpoint:<24} {len(samples):>6} {outcomes['ok']:>6} {failed:>7} {percentile(samples, 0.50):>8.1f} "
+            f"{percentile(samples, 0.95):>8.1f} {percentile(samples, 0.99):>8.1f} {statistics.fmean(samples):>8.1f}"
+        )
+        other = {kind: count for kind, count in outcomes.items() if kind != "ok"}
+        if other:
+            print(f"{'':<24} {other}")
+    locked = "n/a (no --server-log)" if locked_in_log is None else locked_in_log
+    print(f'"{LOCK_MARKER}": {locked} in server log, {results.locked_in_body} in responses')
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", f"sqlite:///{os.path.join(PROJECT_ROOT, 'time_tracker_dataset.db')}"),
+                        help="database the server uses (employees, stores and QR tokens are read from it)")
+    parser.add_argument("--employees", type=int, default=300, help="employees arriving in the window")
+    parser.add_argument("--stores", type=int, default=20, help="take employees from the first N active stores")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("qr=0.6,web=0.25,bot=0.15"))
+    parser.add_argument("--speedup", type=float, default=20.0, help="how many times faster than real time")
+    parser.add_argument("--store-jitter", type=float, default=120.0, help="std-dev of per-store offset, real seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--password", default="password", help="password the dataset was generated with")
+    parser.add_argument("--connections", type=int, default=200, help="client connection pool size")
+    parser.add_argument("--login-concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--server-log", default=os.path.join(PROJECT_ROOT, "logs", "app.log"),
+                        help='server log to count "database is locked" in; empty to skip')
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(summary, fh, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
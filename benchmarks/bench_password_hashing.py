@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Benchmark: password verifications (logins) per second.
+
+Measures verify throughput for several bcrypt costs, first on a single
+thread and then through the app's password-hash executor with
+PASSWORD_HASH_WORKERS threads. Prints logins/second overall and per core,
+so BCRYPT_ROUNDS and PASSWORD_HASH_WORKERS can be chosen for the expected
+shift-start login burst.
+
+Usage:
+    python benchmarks/bench_password_hashing.py [--rounds 10 11 12] [--logins 64]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from passlib.context import CryptContext  # noqa: E402
+
+from app import security  # noqa: E402
+
+
+def bench_single_thread(context: CryptContext, hashed: str, logins: int) -> float:
+    started = time.perf_counter()
+    for _ in range(logins):
+        context.verify("correct horse", hashed)
+    return logins / (time.perf_counter() - started)
+
+
+async def bench_executor(hashed: str, logins: int) -> float:
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(security.verify_and_update_password_async("correct horse", hashed) for _ in range(logins))
+    )
+    return logins / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 11, 12])
+    parser.add_argument("--logins", type=int, default=64, help="verifications per measurement")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f"cores={cores} executor_workers={security.PASSWORD_HASH_WORKERS}")
+    print(f"{'rounds':>6} {'1 thread/s':>11} {'executor/s':>11} {'per core/s':>11} {'ms/login':>9}")
+    for rounds in args.rounds:
+        context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds)
+        hashed = context.hash("correct horse")
+        # Executor runs the app's context, so point it at the cost under test
+        security.password_context = context
+
+        single = bench_single_thread(context, hashed, max(4, args.logins // 4))
+        pooled = asyncio.run(bench_executor(hashed, args.logins))
+        per_core = pooled / min(cores, security.PASSWORD_HASH_WORKERS)
+        print(f"{rounds:>6} {single:>11.1f} {pooled:>11.1f} {per_core:>11.1f} {1000 / single:>9.1f}")
+
+    stats = security.password_hash_stats()
+    print(f"queue_max={stats['queue_max']} wait_avg={stats['wait_seconds_avg'] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
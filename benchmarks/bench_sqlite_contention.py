@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Lock contention on SQLite: several writer and reader processes, one file.
+
+Reproduces what gunicorn workers and the bot runner do to the same SQLite
+database, without HTTP in between. Every process imports the app's own
+SessionLocal and runs the real code paths:
+  writers  bot check-in / check-out callbacks (TelegramBot._process_callback,
+           which ends in app.checkin.check_in and the bot's check-out)
+  readers  the admin report aggregation (admin._report_stats) for one store
+           over the current month
+
+Each configuration (journal mode x synchronous x busy timeout x BEGIN mode,
+the SQLITE_* settings of app/database.py) runs on a fresh copy of the
+dataset for --duration seconds. Per operation it reports throughput,
+latency percentiles, the time spent waiting for locks and the number of
+busy errors ("database is locked"), including the ones the bot handlers
+catch and turn into an "error" reply.
+
+Lock wait is the time spent in the statements where SQLite takes its
+locks: the first statement of a transaction (BEGIN IMMEDIATE or the first
+read/write) and COMMIT. It includes their own work, which is small next to
+a busy wait.
+
+Usage:
+    python scripts/generate_dataset.py --reset
+    python benchmarks/bench_sqlite_contention.py [--database time_tracker_dataset.db]
+        [--writers 4] [--readers 4] [--duration 10] [--journal-modes delete,wal]
+        [--synchronous default] [--busy-timeouts 5000] [--begin default,immediate]
+        [--json results.json]
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+# No app imports at module level: the app reads DATABASE_URL and SQLITE_* at
+# import time, so each worker process imports it after setting its environment.
+
+BUSY_MARKERS = ("database is locked", "database is busy", "database table is locked")
+DEFAULT = "default"
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def parse_list(value: str) -> List[str]:
+    return [item.strip().lower() for item in value.split(",") if item.strip()]
+
+
+def load_population(db_path: str, seed: int):
+    """Active employees (for writers) and store -> employee ids (for readers)"""
+    connection = sqlite3.connect(db_path)
+    try:
+        rows = connection.execute(
+            "SELECT id, store_id FROM users WHERE role = 'employee' AND is_active AND store_id IS NOT NULL ORDER BY id"
+        ).fetchall()
+    finally:
+        connection.close()
+    if not rows:
+        raise SystemExit("No active employees in the database; run scripts/generate_dataset.py first")
+    stores: Dict[int, List[int]] = defaultdict(list)
+    for user_id, store_id in rows:
+        stores[store_id].append(user_id)
+    employees = [user_id for user_id, _ in rows]
+    random.Random(seed).shuffle(employees)
+    return employees, dict(stores)
+
+
+def config_env(config: Dict[str, str]) -> Dict[str, str]:
+    return {
+        "SQLITE_JOURNAL_MODE": "" if config["journal"] == DEFAULT else config["journal"],
+        "SQLITE_SYNCHRONOUS": "" if config["synchronous"] == DEFAULT else config["synchronous"],
+        "SQLITE_BUSY_TIMEOUT_MS": config["busy_timeout"],
+        "SQLITE_BEGIN": "" if config["begin"] == DEFAULT else config["begin"],
+    }
+
+
+def config_label(config: Dict[str, str]) -> str:
+    return (f"journal={config['journal']} synchronous={config['synchronous']} "
+            f"busy_timeout={config['busy_timeout']}ms begin={config['begin']}")
+
+
+def is_busy(exc: BaseException) -> bool:
+    text = str(exc).lower()
+    return any(marker in text for marker in BUSY_MARKERS)
+
+
+def worker(role: str, number: int, env: Dict[str, str], user_ids: List[int], stores: Dict[int, List[int]],
+           duration: float, think_ms: float, seed: int, barrier, results) -> None:
+    os.environ.update(env)
+
+    from sqlalchemy import event  # noqa: E402
+    from sqlalchemy.exc import OperationalError  # noqa: E402
+
+    from app.database import SessionLocal, engine, session_scope  # noqa: E402
+    from app.routers.admin import _report_stats  # noqa: E402
+    from app.routers.telegram_bot import telegram_bot  # noqa: E402
+
+    probe = {"lock": 0.0, "busy": 0, "in_transaction": False, "first": False, "started": 0.0, "commit_started": 0.0}
+
+    # The first statement after COMMIT/ROLLBACK opens the transaction: BEGIN IMMEDIATE or the first read/write
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        probe["first"] = not probe["in_transaction"]
+        probe["in_transaction"] = True
+        probe["started"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        if probe["first"]:
+            probe["first"] = False
+            probe["lock"] += time.perf_counter() - probe["started"]
+
+    @event.listens_for(engine, "rollback")
+    def _on_rollback(conn):
+        probe["in_transaction"] = False
+
+    @event.listens_for(engine, "commit")
+    def _on_commit(conn):
+        probe["in_transaction"] = False
+        probe["commit_started"] = time.perf_counter()
+
+    @event.listens_for(SessionLocal, "after_commit")
+    def _after_commit(session):
+        probe["lock"] += time.perf_counter() - probe["commit_started"]
+
+    @event.listens_for(engine, "handle_error")
+    def _on_error(context):
+        # Counted here as well: the bot handlers catch errors and reply "error"
+        if is_busy(context.original_exception):
+            probe["busy"] += 1
+        if probe["first"]:
+            # A statement that gave up waiting never reaches after_cursor_execute
+            probe["first"] = False
+            probe["lock"] += time.perf_counter() - probe["started"]
+
+    ops: Dict[str, Dict] = defaultdict(lambda: {"latency": [], "lock": [], "outcomes": Counter()})
+    rng = random.Random(seed * 1000 + number)
+    today = telegram_bot._get_moscow_time().date()
+    month_start = today.replace(day=1)
+    store_ids = sorted(stores)
+
+    def run(op: str, action) -> None:
+        probe["lock"] = 0.0
+        probe["in_transaction"] = False
+        started = time.perf_counter()
+        try:
+            with session_scope() as db:
+                outcome = action(db)
+        except OperationalError as exc:
+            outcome = "busy_error" if is_busy(exc) else "db_error"
+        except Exception as exc:  # the harness keeps going; the outcome says what broke
+            outcome = f"exception:{type(exc).__name__}"
+        entry = ops[op]
+        entry["latency"].append((time.perf_counter() - started) * 1000)
+        entry["lock"].append(probe["lock"] * 1000)
+        entry["outcomes"][outcome] += 1
+
+    def bot_action(user_id: int, action: str):
+        def call(db):
+            result = telegram_bot._process_callback(db, user_id, action)
+            return result.get("status", "ok") if result else "inactive"
+        return call
+
+    def report(db):
+        employee_ids = stores[rng.choice(store_ids)]
+        _report_stats(db, employee_ids, month_start, today)
+        return "ok"
+
+    barrier.wait(timeout=300)
+    deadline = time.monotonic() + duration
+    users = itertools.cycle(user_ids) if role == "writer" else None
+    while time.monotonic() < deadline:
+        if role == "writer":
+            user_id = next(users)
+            run("checkin", bot_action(user_id, "checkin"))
+            run("checkout", bot_action(user_id, "checkout"))
+        else:
+            run("report", report)
+        if think_ms:
+            time.sleep(think_ms / 1000)
+
+    results.put({
+        "role": role,
+        "busy": probe["busy"],
+        "ops": {op: {"latency": entry["latency"], "lock": entry["lock"], "outcomes": dict(entry["outcomes"])}
+                for op, entry in ops.items()},
+    })
+    engine.dispose()
+
+
+def prepare_copy(source: str, target: str, journal: str) -> None:
+    shutil.copyfile(source, target)
+    if journal != DEFAULT:
+        # Switching to WAL needs the file to itself; workers would race for it
+        connection = sqlite3.connect(target)
+        try:
+            connection.execute(f"PRAGMA journal_mode={journal}")
+        finally:
+            connection.close()
+
+
+def run_config(args, config: Dict[str, str], employees: List[int], stores: Dict[int, List[int]], tmp: str) -> Dict:
+    db_path = os.path.join(tmp, "contention.db")
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    prepare_copy(args.database, db_path, config["journal"])
+
+    env = dict(config_env(config))
+    env.update({
+        "DATABASE_URL": f"sqlite:///{db_path}",
+        "LOG_FILE": os.path.join(tmp, "app.log"),
+        # Busy errors caught by the bot are logged with a traceback; the harness counts them instead
+        "LOG_LEVEL": "CRITICAL",
+        "LOG_ACCESS_ENABLED": "0",
+        "SLOW_QUERY_ENABLED": "0",
+        "SLOW_QUERY_STATS_DIR": os.path.join(tmp, "slow_queries"),
+        "METRICS_DIR": os.path.join(tmp, "metrics"),
+        "BOT_REMINDERS_ENABLED": "0",
+    })
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.writers + args.readers + 1)
+    results = context.Queue()
+    processes = []
+    for number in range(args.writers):
+        # Each writer owns its own employees: one person never checks in from two processes
+        share = employees[number::args.writers]
+        processes.append(context.Process(target=worker, args=(
+            "writer", number, env, share, stores, args.duration, args.think_ms, args.seed, barrier, results)))
+    for number in range(args.readers):
+        processes.append(context.Process(target=worker, args=(
+            "reader", args.writers + number, env, [], stores, args.duration, args.think_ms, args.seed, barrier, results)))
+    for process in processes:
+        process.start()
+
+    try:
+        barrier.wait(timeout=300)
+    except threading.BrokenBarrierError:
+        for process in processes:
+            process.terminate()
+        raise SystemExit("A worker failed to start; run one configuration with --writers 1 --readers 0 to see why")
+
+    collected = []
+    for _ in processes:
+        collected.append(results.get(timeout=args.duration + 300))
+    for process in processes:
+        process.join()
+
+    ops: Dict[str, Dict] = defaultdict(lambda: {"latency": [], "lock": [], "outcomes": Counter()})
+    busy = 0
+    for item in collected:
+        busy += item["busy"]
+        for op, entry in item["ops"].items():
+            ops[op]["latency"].extend(entry["latency"])
+            ops[op]["lock"].extend(entry["lock"])
+            ops[op]["outcomes"].update(entry["outcomes"])
+
+    summary = {"config": config, "busy_errors": busy, "ops": {}}
+    for op, entry in sorted(ops.items()):
+        latency, lock = entry["latency"], entry["lock"]
+        failed = sum(count for outcome, count in entry["outcomes"].items()
+                     if outcome in ("error", "busy_error", "db_error") or outcome.startswith("exception:"))
+        summary["ops"][op] = {
+            "count": len(latency),
+            "per_second": round(len(latency) / args.duration, 1),
+            "failed": failed,
+            "latency_ms": {
+                "mean": round(statistics.fmean(latency), 2) if latency else 0.0,
+                "p50": round(percentile(latency, 0.50), 2),
+                "p95": round(percentile(latency, 0.95), 2),
+                "p99": round(percentile(latency, 0.99), 2),
+                "max": round(max(latency, default=0.0), 2),
+            },
+            "lock_wait_ms": {
+                "total": round(sum(lock), 1),
+                "p50": round(percentile(lock, 0.50), 2),
+                "p95": round(percentile(lock, 0.95), 2),
+                "p99": round(percentile(lock, 0.99), 2),
+                "max": round(max(lock, default=0.0), 2),
+            },
+            "outcomes": dict(entry["outcomes"]),
+        }
+    return summary
+
+
+def print_summary(summary: Dict) -> None:
+    print(f"\n{config_label(summary['config'])}   busy errors: {summary['busy_errors']}")
+    print(f"  {'op':<9} {'ops/s':>8} {'failed':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+          f" {'lock p50':>9} {'lock p95':>9} {'lock p99':>9} {'lock max':>9}")
+    for op, stats in summary["ops"].items():
+        latency, lock = stats["latency_ms"], stats["lock_wait_ms"]
+        print(f"  {op:<9} {stats['per_second']:>8.1f} {stats['failed']:>7}"
+              f" {latency['p50']:>8.1f} {latency['p95']:>8.1f} {latency['p99']:>8.1f} {latency['max']:>8.1f}"
+              f" {lock['p50']:>9.1f} {lock['p95']:>9.1f} {lock['p99']:>9.1f} {lock['max']:>9.1f}")
+        unusual = {outcome: count for outcome, count in stats["outcomes"].items()
+                   if outcome not in ("ok", "started", "stopped", "already_active")}
+        if unusual:
+            print(f"  {'':<9} outcomes: {', '.join(f'{key}={value}' for key, value in sorted(unusual.items()))}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=os.path.join(PROJECT_ROOT, "time_tracker_dataset.db"),
+                        help="SQLite dataset to copy for every configuration (never modified)")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per configuration")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="pause between operations in each process")
+    parser.add_argument("--journal-modes", type=parse_list, default=["delete", "wal"])
+    parser.add_argument("--synchronous", type=parse_list, default=[DEFAULT], help="e.g. default,normal,full")
+    parser.add_argument("--busy-timeouts", type=parse_list, default=["5000"], help="milliseconds, e.g. 0,1000,5000")
+    parser.add_argument("--begin", type=parse_list, default=[DEFAULT, "immediate"], help="default,deferred,immediate")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write all results to this file")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        raise SystemExit(f"{args.database} not found; run scripts/generate_dataset.py first")
+    if args.writers < 0 or args.readers < 0 or args.writers + args.readers == 0:
+        raise SystemExit("Need at least one writer or reader")
+
+    employees, stores = load_population(args.database, args.seed)
+    print(f"database={args.database} employees={len(employees)} stores={len(stores)} "
+          f"writers={args.writers} readers={args.readers} duration={args.duration:g}s")
+
+    configs = [
+        {"journal": journal, "synchronous": synchronous, "busy_timeout": busy_timeout, "begin": begin}
+        for journal, synchronous, busy_timeout, begin in itertools.product(
+            args.journal_modes, args.synchronous, args.busy_timeouts, args.begin)
+    ]
+    summaries = []
+    with tempfile.TemporaryDirectory(prefix="sqlite_contention_") as tmp:
+        for config in configs:
+            summary = run_config(args, config, employees, stores, tmp)
+            print_summary(summary)
+            summaries.append(summary)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"writers": args.writers, "readers": args.readers, "duration": args.duration,
+                       "results": summaries}, fh, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
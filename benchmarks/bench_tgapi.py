@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmark: Telegram WebApp check-in/check-out latency, form API v1 vs JSON API v2.
+
+Creates a throwaway SQLite database with --users employees, each with
+--history earlier sessions today, then runs check-in/check-out cycles
+through both APIs in-process (no network) and prints p50/p95/p99 per
+endpoint. v1 re-reads all of today's rows on checkout; v2 reads the
+daily_totals row.
+
+Usage:
+    python benchmarks/bench_tgapi.py [--users 50] [--history 6] [--cycles 5]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.database import Base, get_db  # noqa: E402
+from app.models import Attendance, User  # noqa: E402
+from app.routers import attendance  # noqa: E402
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def build_app(db_path: str, users: int, history: int) -> tuple[TestClient, list[str]]:
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+
+    now = attendance._get_moscow_time().replace(tzinfo=None)
+    tokens = []
+    with Session() as db:
+        for i in range(users):
+            user = User(email=f"bench{i}@example.com", full_name=f"Bench {i}", password_hash="x")
+            db.add(user)
+            db.flush()
+            for k in range(history):
+                started = now - timedelta(minutes=10 * (history - k) + 5)
+                db.add(Attendance(user_id=user.id, started_at=started, ended_at=started + timedelta(minutes=5),
+                                  work_date=now.date()))
+            tokens.append(attendance._generate_compact_token(user.id))
+        db.commit()
+
+    app = FastAPI()
+    app.include_router(attendance.router)
+
+    def override_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_db
+    return TestClient(app), tokens
+
+
+def timed(samples: list[float], call) -> None:
+    started = time.perf_counter()
+    response = call()
+    samples.append((time.perf_counter() - started) * 1000)
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.request.url}: {response.status_code} {response.text}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--history", type=int, default=6, help="closed sessions per user today before the run")
+    parser.add_argument("--cycles", type=int, default=5, help="check-in/check-out cycles per user and API")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client, tokens = build_app(os.path.join(tmp, "bench.db"), args.users, args.history)
+        results = {name: [] for name in ("v1 checkin", "v1 checkout", "v2 checkin", "v2 checkout", "v2 state")}
+        for _ in range(args.cycles):
+            for token in tokens:
+                timed(results["v1 checkin"], lambda: client.post("/tgapi/checkin", data={"token": token}))
+                timed(results["v1 checkout"], lambda: client.post("/tgapi/checkout", data={"token": token}))
+            for token in tokens:
+                headers = {"Authorization": f"Bearer {token}"}
+                timed(results["v2 checkin"], lambda: client.post("/tgapi/v2/checkin", headers=headers))
+                timed(results["v2 state"], lambda: client.get("/tgapi/v2/state", headers=headers))
+                timed(results["v2 checkout"], lambda: client.post("/tgapi/v2/checkout", headers=headers))
+
+    print(f"users={args.users} history={args.history} cycles={args.cycles} json={attendance.FastJSONResponse.__name__}")
+    print(f"{'endpoint':<12} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'mean ms':>8}")
+    for name, samples in results.items():
+        print(
+            f"{name:<12} {len(samples):>6} {percentile(samples, 0.50):>8.2f} {percentile(samples, 0.95):>8.2f} "
+            f"{percentile(samples, 0.99):>8.2f} {statistics.fmean(samples):>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
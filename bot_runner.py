@@ -25,6 +25,11 @@ def main():
         print("4. Copy token and add to .env file")
         return
 
+    if os.getenv("TELEGRAM_WEBHOOK_URL"):
+        print("TELEGRAM_WEBHOOK_URL is set: updates are received by the web app (webhook mode)")
+        print("Unset TELEGRAM_WEBHOOK_URL to run the bot with polling")
+        return
+
     print("Starting Telegram bot...")
     print("Press Ctrl+C to stop")
 
@@ -20,6 +20,7 @@ PROJECT_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
+from app.checkin import note_overdue_sweep  # type: ignore
 from app.database import SessionLocal  # type: ignore
 from app.models import Attendance  # type: ignore
 
@@ -65,6 +66,8 @@ def close_overdue_sessions() -> int:
 
 def main() -> None:
     count = close_overdue_sessions()
+    # Seen by /health/ready as last_sweep_seconds_ago
+    note_overdue_sweep()
     print(f"Auto-closed overdue attendance sessions: {count}")
 
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Telegram Bot API, for tests and local runs.
+
+Implements the handful of methods the bot uses (getMe, setWebhook,
+deleteWebhook, sendMessage, editMessageText, answerCallbackQuery) and
+records every call in app.state.calls. Unknown methods answer with
+{"ok": true, "result": true}.
+
+Run standalone and point the bot at it:
+
+    python scripts/fake_telegram_api.py 8081
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 python bot_runner.py
+
+or use create_app() in-process with httpx.ASGITransport.
+"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import sys
+import time
+
+from fastapi import FastAPI, Request
+
+
+BOT_USER = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "Time Tracker",
+    "username": "time_tracker_test_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+def _parse_params(raw: dict) -> dict:
+    """PTB sends form fields; nested objects (reply_markup etc.) arrive JSON-encoded"""
+    params = {}
+    for key, value in raw.items():
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        params[key] = value
+    return params
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(title="Fake Telegram Bot API")
+    app.state.calls = []
+    app.state.webhook = None
+    message_ids = itertools.count(1)
+
+    def _message(params: dict) -> dict:
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id"), "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    @app.post("/bot{token}/{method}")
+    async def bot_method(token: str, method: str, request: Request):
+        content_type = request.headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            raw = await request.json()
+        else:
+            raw = dict(await request.form())
+        params = _parse_params(raw or {})
+        app.state.calls.append((method, params))
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "setWebhook":
+            app.state.webhook = params
+            result = True
+        elif method == "deleteWebhook":
+            app.state.webhook = None
+            result = True
+        elif method == "getWebhookInfo":
+            result = {"url": (app.state.webhook or {}).get("url", ""), "has_custom_certificate": False, "pending_update_count": 0}
+        elif method in ("sendMessage", "editMessageText"):
+            result = _message(params)
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    return app
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    uvicorn.run(app, host="127.0.0.1", port=port)
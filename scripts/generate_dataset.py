@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic dataset for load and scale testing.
+
+Fills the schema from app/models.py with stores, employees and several
+years of history: published schedules (5/2 and 2/2 patterns, vacations,
+sick leave) plus an unpublished draft for the weeks ahead, and attendance
+sessions that follow the schedule with jitter, no-shows, split shifts and
+forgotten check-outs (stored the way the nightly sweep leaves them:
+ended_at = started_at, 0 hours). On the last generated day employees who
+came in still have an open session. AllowedIP holds /24 prefixes per store.
+daily_totals is filled from the same data.
+
+Rows are written with driver-level executemany in large batches inside
+one transaction, with explicit primary keys, so a few million rows take well
+under a minute on SQLite. The output depends only on --seed and
+--end-date: the same arguments give the same database.
+
+Every generated account has the password given by --password; the first
+admin is admin1@example.com, employees are emp1@example.com ... .
+
+Usage:
+    python scripts/generate_dataset.py --reset [--stores 20] [--employees 400] [--years 2] [--seed 42]
+    python scripts/generate_dataset.py --database-url sqlite:///big.db --reset --employees 1500 --years 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import functools
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import date, datetime, time as dtime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from sqlalchemy import create_engine, event, inspect, text  # noqa: E402
+from sqlalchemy.engine import Connection, Engine  # noqa: E402
+
+from app.database import Base  # noqa: E402
+from app.migrations import run_sqlite_migrations  # noqa: E402
+from app.models import AllowedIP, Attendance, DailyTotal, ScheduleEntry, Store, User, to_epoch  # noqa: E402
+from app.security import BCRYPT_ROUNDS, password_context  # noqa: E402
+
+
+DEFAULT_DATABASE_URL = f"sqlite:///{os.path.join(PROJECT_ROOT, 'time_tracker_dataset.db')}"
+
+FIRST_NAMES = [
+    "Александр", "Алексей", "Анна", "Андрей", "Виктория", "Дарья", "Дмитрий", "Екатерина", "Елена", "Иван",
+    "Ирина", "Кирилл", "Мария", "Максим", "Наталья", "Никита", "Ольга", "Павел", "Светлана", "Сергей",
+    "Татьяна", "Юлия", "Артем", "Ксения", "Михаил", "Полина", "Роман", "Софья", "Егор", "Алина",
+]
+LAST_NAMES = [
+    "Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Петров", "Соколов", "Михайлов", "Новиков",
+    "Федоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семенов", "Егоров", "Павлов", "Козлов",
+    "Степанов", "Николаев", "Орлов", "Андреев", "Макаров", "Никитин", "Захаров",
+]
+STREETS = ["Ленина", "Гагарина", "Мира", "Советская", "Садовая", "Лесная", "Школьная", "Центральная"]
+
+# (pattern, cycle length, working days in cycle, shift start, shift end)
+SHIFT_PATTERNS = [
+    ("5/2", 7, 5, dtime(9, 0), dtime(18, 0)),
+    ("5/2", 7, 5, dtime(10, 0), dtime(19, 0)),
+    ("2/2", 4, 2, dtime(8, 0), dtime(20, 0)),
+    ("2/2", 4, 2, dtime(10, 0), dtime(22, 0)),
+]
+
+NO_SHOW_RATE = 0.02
+SPLIT_SHIFT_RATE = 0.07
+FORGOT_CHECKOUT_RATE = 0.015
+SICK_START_RATE = 0.008
+INACTIVE_EMPLOYEE_RATE = 0.05
+PUBLISHED_DAYS_AHEAD = 14
+DRAFT_DAYS_AHEAD = 45
+
+BCRYPT64 = "./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+BULK_MODELS = (ScheduleEntry, Attendance, DailyTotal)
+# Columns with few distinct values, whose bind conversion is worth caching
+LOW_CARDINALITY_COLUMNS = {"work_date", "start_time", "end_time", "created_at", "updated_at"}
+
+
+class Writer:
+    """Buffers rows per table and flushes them with a driver-level executemany.
+
+    Going through insert() costs more per row than SQLite itself, so the
+    INSERT is rendered once per table and only columns whose type needs a
+    bind processor (dates, times) are converted per value.
+    """
+
+    def __init__(self, connection: Connection, batch_size: int):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.buffers: Dict[str, List[dict]] = defaultdict(list)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self._statements: Dict[str, tuple] = {}
+
+    def add(self, model, row: dict) -> None:
+        buffer = self.buffers[model.__tablename__]
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            # Parents first, so foreign keys hold on databases that enforce them
+            self.flush()
+
+    def _statement(self, table, columns: List[str]) -> tuple:
+        key = table.name
+        if key not in self._statements:
+            dialect = self.connection.dialect
+            marker = "?" if dialect.paramstyle == "qmark" else "%s"
+            sql = (f"INSERT INTO {table.name} ({', '.join(columns)}) "
+                   f"VALUES ({', '.join(marker for _ in columns)})")
+            processors = []
+            for name in columns:
+                processor = table.c[name].type._cached_bind_processor(dialect)
+                if processor is not None and name in LOW_CARDINALITY_COLUMNS:
+                    # A few thousand distinct days and shift times: convert each once
+                    processor = functools.lru_cache(maxsize=None)(processor)
+                processors.append(processor)
+            self._statements[key] = (sql, processors)
+        return self._statements[key]
+
+    def _flush(self, table) -> None:
+        buffer = self.buffers[table.name]
+        if not buffer:
+            return
+        columns = list(buffer[0])
+        sql, processors = self._statement(table, columns)
+        converted = [(index, processor) for index, processor in enumerate(processors) if processor]
+        params = []
+        for row in buffer:
+            values = [row[name] for name in columns]
+            for index, processor in converted:
+                values[index] = processor(values[index])
+            params.append(tuple(values))
+        self.connection.exec_driver_sql(sql, params)
+        self.counts[table.name] += len(buffer)
+        buffer.clear()
+
+    def flush(self) -> None:
+        for model in (Store, User, AllowedIP, ScheduleEntry, Attendance, DailyTotal):
+            self._flush(model.__table__)
+
+
+def _sqlite_bulk_pragmas(engine: Engine) -> None:
+    # Only for this process and this load: a crash mid-load just means regenerating
+    @event.listens_for(engine, "connect")
+    def _pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-200000")
+        cursor.close()
+
+
+def prepare_schema(engine: Engine, reset: bool) -> None:
+    if reset:
+        Base.metadata.drop_all(bind=engine)
+    elif inspect(engine).has_table("users"):
+        with engine.connect() as connection:
+            if connection.execute(text("SELECT 1 FROM users LIMIT 1")).first() is not None:
+                raise SystemExit("Database already has users; pass --reset to drop and regenerate it")
+    Base.metadata.create_all(bind=engine)
+    if engine.dialect.name == "sqlite":
+        run_sqlite_migrations(engine)
+
+
+def _deterministic_hash(rng: random.Random, password: str) -> str:
+    # bcrypt normally draws a random salt; take it from the seeded generator instead
+    salt = "".join(rng.choice(BCRYPT64) for _ in range(21)) + rng.choice(".Oeu")
+    return password_context.handler("bcrypt").using(salt=salt, rounds=BCRYPT_ROUNDS).hash(password)
+
+
+def _at(day: date, moment: dtime, shift_minutes: float) -> datetime:
+    return datetime.combine(day, moment) + timedelta(minutes=shift_minutes)
+
+
+def _session(user_id: int, day: date, started: datetime, ended: Optional[datetime]) -> dict:
+    started_ts = to_epoch(started)
+    ended_ts = to_epoch(ended) if ended is not None else None
+    duration = max(0, ended_ts - started_ts) if ended_ts is not None else None
+    return {
+        "user_id": user_id,
+        "started_at": started,
+        "ended_at": ended,
+        "work_date": day,
+        "hours": round(duration / 3600, 2) if duration is not None else None,
+        "checkin_key": None,
+        "started_ts": started_ts,
+        "ended_ts": ended_ts,
+        "duration_s": duration,
+    }
+
+
+def _attendance_for_day(rng: random.Random, user_id: int, day: date, start: dtime, end: dtime,
+                        last_day: bool) -> Iterator[dict]:
+    started = _at(day, start, rng.gauss(-5, 8))
+    ended = _at(day, end, rng.gauss(5, 15))
+    if rng.random() < SPLIT_SHIFT_RATE:
+        # Left in the middle of the shift and came back after a break
+        break_start = started + (ended - started) * rng.uniform(0.3, 0.6)
+        break_end = break_start + timedelta(minutes=rng.randint(30, 120))
+        yield _session(user_id, day, started, break_start)
+        started = break_end
+    if last_day:
+        yield _session(user_id, day, started, None)
+    elif rng.random() < FORGOT_CHECKOUT_RATE:
+        yield _session(user_id, day, started, started)
+    else:
+        yield _session(user_id, day, started, ended)
+
+
+def generate(connection: Connection, args: argparse.Namespace) -> Dict[str, int]:
+    rng = random.Random(args.seed)
+    writer = Writer(connection, args.batch_size)
+    end_date: date = args.end_date
+    start_date = end_date - timedelta(days=round(365.25 * args.years))
+    draft_until = end_date + timedelta(days=DRAFT_DAYS_AHEAD)
+    published_until = end_date + timedelta(days=PUBLISHED_DAYS_AHEAD)
+    created_at = datetime.combine(start_date, dtime(9, 0))
+    password_hash = _deterministic_hash(rng, args.password)
+
+    for store_id in range(1, args.stores + 1):
+        writer.add(Store, {
+            "id": store_id,
+            "name": f"Магазин №{store_id}",
+            "address": f"ул. {rng.choice(STREETS)}, {rng.randint(1, 150)}",
+            "phone": f"+7{rng.randint(9000000000, 9999999999)}",
+            "qr_token": f"{rng.getrandbits(128):032x}",
+            "qr_generation": 0,
+            "is_active": store_id == 1 or rng.random() > 0.05,
+        })
+        for subnet in range(rng.choice((1, 1, 2))):
+            # The check-in IP check compares the first three octets, so each row is a /24 range
+            network = store_id * 2 + subnet
+            writer.add(AllowedIP, {
+                "ip_address": f"10.{network // 256}.{network % 256}.0",
+                "description": f"Магазин №{store_id}, сеть {subnet + 1}",
+                "is_active": True,
+                "created_at": created_at,
+                "created_by": 1 if args.admins else None,
+            })
+
+    for admin in range(1, args.admins + 1):
+        writer.add(User, {
+            "id": admin,
+            "email": f"admin{admin}@example.com",
+            "full_name": f"Администратор {admin}",
+            "password_hash": password_hash,
+            "is_active": True,
+            "role": "admin",
+            "date_of_birth": None,
+            "store_id": None,
+            "telegram_id": None,
+            "web_username": f"admin{admin}",
+            "web_password_plain": None,
+        })
+
+    for number in range(1, args.employees + 1):
+        user_id = args.admins + number
+        store_id = rng.randint(1, args.stores)
+        _, cycle, working, shift_start, shift_end = rng.choice(SHIFT_PATTERNS)
+        offset = rng.randrange(cycle)
+        # Employees who left: history stops on a random day and there is no draft schedule
+        last_day = draft_until
+        if rng.random() < INACTIVE_EMPLOYEE_RATE:
+            last_day = start_date + timedelta(days=rng.randrange((end_date - start_date).days))
+        vacation_starts = {
+            date(year, 1, 1) + timedelta(days=rng.randrange(340))
+            for year in range(start_date.year, draft_until.year + 1)
+        }
+        writer.add(User, {
+            "id": user_id,
+            "email": f"emp{number}@example.com",
+            "full_name": f"{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}",
+            "password_hash": password_hash,
+            "is_active": last_day == draft_until,
+            "role": "employee",
+            "date_of_birth": date(rng.randint(1965, 2005), rng.randint(1, 12), rng.randint(1, 28)),
+            "store_id": store_id,
+            "telegram_id": 100_000_000 + user_id if rng.random() < 0.8 else None,
+            "web_username": f"emp{number}",
+            "web_password_plain": None,
+        })
+
+        sick_until: Optional[date] = None
+        vacation_until: Optional[date] = None
+        totals: Dict[date, Tuple[float, int, Optional[datetime]]] = {}
+        for index in range((last_day - start_date).days + 1):
+            day = start_date + timedelta(days=index)
+            if day in vacation_starts:
+                vacation_until = day + timedelta(days=13)
+            working_day = (index + offset) % cycle < working
+            if vacation_until is not None and day <= vacation_until:
+                shift_type = "vacation"
+            elif sick_until is not None and day <= sick_until:
+                shift_type = "sick"
+            elif working_day and day <= end_date and rng.random() < SICK_START_RATE:
+                sick_until = day + timedelta(days=rng.randint(2, 7))
+                shift_type = "sick"
+            else:
+                shift_type = "work" if working_day else "off"
+            work = shift_type == "work"
+            writer.add(ScheduleEntry, {
+                "user_id": user_id,
+                "work_date": day,
+                "start_time": shift_start if work else None,
+                "end_time": shift_end if work else None,
+                "store_id": store_id,
+                "notes": None,
+                "shift_type": shift_type,
+                "published": day <= published_until,
+                "created_at": created_at,
+                "updated_at": datetime.combine(min(day, end_date) - timedelta(days=7), dtime(12, 0)),
+            })
+
+            if not work or day > end_date or rng.random() < NO_SHOW_RATE:
+                continue
+            closed, sessions, open_started = 0.0, 0, None
+            for row in _attendance_for_day(rng, user_id, day, shift_start, shift_end, day == end_date):
+                writer.add(Attendance, row)
+                if row["ended_at"] is None:
+                    open_started = row["started_at"]
+                else:
+                    closed += row["duration_s"]
+                    sessions += 1
+            totals[day] = (closed, sessions, open_started)
+
+        for day, (closed, sessions, open_started) in totals.items():
+            writer.add(DailyTotal, {
+                "user_id": user_id,
+                "work_date": day,
+                "closed_seconds": closed,
+                "sessions": sessions,
+                "open_started_at": open_started,
+            })
+
+    writer.flush()
+    return dict(writer.counts)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("DATASET_DATABASE_URL", DEFAULT_DATABASE_URL))
+    parser.add_argument("--reset", action="store_true", help="drop and recreate all tables first")
+    parser.add_argument("--stores", type=int, default=20)
+    parser.add_argument("--employees", type=int, default=400)
+    parser.add_argument("--admins", type=int, default=2)
+    parser.add_argument("--years", type=float, default=2.0)
+    parser.add_argument("--end-date", type=date.fromisoformat, default=date.today(),
+                        help="last day with attendance (YYYY-MM-DD); default today")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--password", default="password", help="password of every generated account")
+    parser.add_argument("--batch-size", type=int, default=20000)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    if engine.dialect.name == "sqlite":
+        _sqlite_bulk_pragmas(engine)
+    prepare_schema(engine, args.reset)
+
+    started = time.perf_counter()
+    # Building secondary indexes once at the end is cheaper than maintaining them row by row
+    indexes = sorted((index for model in BULK_MODELS for index in model.__table__.indexes), key=lambda index: index.name)
+    with engine.begin() as connection:
+        for index in indexes:
+            index.drop(bind=connection)
+        counts = generate(connection, args)
+        for index in indexes:
+            index.create(bind=connection)
+    elapsed = time.perf_counter() - started
+    with engine.begin() as connection:
+        if engine.dialect.name == "postgresql":
+            # Explicit ids bypass the sequences; move them past the generated rows
+            for table in ("stores", "users"):
+                connection.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), MAX(id)) FROM {table}"))
+        # Planner statistics should match the new volume, otherwise plans stay the empty-database ones
+        connection.execute(text("ANALYZE"))
+
+    total = sum(counts.values())
+    print(f"database={engine.url.render_as_string(hide_password=True)} seed={args.seed} end_date={args.end_date}")
+    for table, count in sorted(counts.items()):
+        print(f"  {table:<18} {count:>10}")
+    print(f"{total} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
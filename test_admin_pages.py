@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Тест служебных страниц администратора: шаблоны рендерятся, данные экранируются
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from starlette.middleware.sessions import SessionMiddleware
+
+from app.database import Base, get_db
+from app.models import ScheduleEntry, Store, User
+from app.routers import admin
+
+
+@pytest.fixture
+def env():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        admin_user = User(email="admin@example.com", full_name="Админ", password_hash="x", role="admin")
+        store = Store(name="<Центр>", qr_token="qr-center")
+        db.add_all([admin_user, store])
+        db.commit()
+        admin_id, store_id = admin_user.id, store.id
+
+    app = FastAPI()
+    app.include_router(admin.router)
+
+    @app.post("/test-login/{user_id}")
+    def login(user_id: int, request: Request):
+        request.session["user_id"] = user_id
+        return {}
+
+    app.add_middleware(SessionMiddleware, secret_key="admin-pages")
+
+    sessions = []
+
+    def override_db():
+        db = Session()
+        sessions.append(db)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_db
+    client = TestClient(app)
+    client.post(f"/test-login/{admin_id}")
+    yield {"client": client, "Session": Session, "store_id": store_id, "sessions": sessions}
+    engine.dispose()
+
+
+def test_store_qr_live(env):
+    """Экран QR магазина: оба кода, период обновления, название экранировано"""
+    response = env["client"].get(f"/admin/stores/{env['store_id']}/qr-live")
+    assert response.status_code == 200
+    assert "QR — &lt;Центр&gt;" in response.text
+    assert f"/admin/stores/{env['store_id']}/qr.png" in response.text
+    assert f"/admin/stores/{env['store_id']}/qr-stop.png?t=" in response.text
+    assert "}, 300000);" in response.text
+
+
+def test_qr_sheet_refused_with_rotating_tokens(env, monkeypatch):
+    """Подписанные токены с ротацией не печатаются: лист с ними быстро перестал бы работать"""
+    monkeypatch.setattr(admin, "QR_TOKEN_FORMAT", "signed")
+    monkeypatch.setattr(admin, "QR_TOKEN_ROTATION_SECONDS", 60)
+    response = env["client"].get("/admin/stores/qr-sheet", follow_redirects=False)
+    assert response.status_code == 303
+    assert response.headers["location"] == "/admin/stores?error=qr_sheet_rotating"
+
+    # Без ротации подписанный токен бессрочный — лист отдается
+    monkeypatch.setattr(admin, "QR_TOKEN_ROTATION_SECONDS", 0)
+    response = env["client"].get("/admin/stores/qr-sheet", follow_redirects=False)
+    assert response.status_code == 200
+    assert response.content.startswith(b"%PDF")
+
+
+def test_admin_profiles(env, monkeypatch):
+    """Список профилей: ссылки на HTML и folded, пустой список — подсказка"""
+    monkeypatch.setattr(admin, "list_profiles", lambda: [])
+    assert "Профилей пока нет" in env["client"].get("/admin/profiles").text
+
+    monkeypatch.setattr(admin, "list_profiles", lambda: [{"id": "20250101-p1", "size": 4096, "mtime": 1735689600}])
+    response = env["client"].get("/admin/profiles")
+    assert response.status_code == 200
+    assert '<a href="/admin/profiles/20250101-p1?format=folded">folded</a>' in response.text
+    assert "4 КБ" in response.text
+
+
+def test_admin_slow_queries(env, monkeypatch):
+    """Сводка медленных запросов: текст запроса и план экранируются"""
+    statements = [{"statement": "SELECT * FROM users WHERE email = ? AND name <> '<b>'", "calls": 4,
+                   "total_ms": 500.0, "max_ms": 300.0, "slow": 2, "route": "/login", "plan": "SCAN users"}]
+    monkeypatch.setattr(admin.statement_stats, "top", lambda: statements)
+    response = env["client"].get("/admin/slow-queries")
+    assert response.status_code == 200
+    assert "name &lt;&gt; &#39;&lt;b&gt;&#39;" in response.text
+    assert "<td>125.00</td>" in response.text and "<pre>SCAN users</pre>" in response.text
+
+
+def test_scheduling_table_saves_drafts(env):
+    """Черновики графика на незаполненные дни сохраняются один раз, настройки сессии запроса не меняются"""
+    assert env["client"].get("/admin/scheduling-table", params={"month": 2, "year": 2025}).status_code == 200
+    assert all(db.expire_on_commit for db in env["sessions"])
+    with env["Session"]() as db:
+        drafts = db.query(ScheduleEntry).filter(ScheduleEntry.published.is_(False)).count()
+    assert drafts == 28
+
+    assert env["client"].get("/admin/scheduling-table", params={"month": 2, "year": 2025}).status_code == 200
+    with env["Session"]() as db:
+        assert db.query(ScheduleEntry).count() == 28
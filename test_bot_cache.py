@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Тест кэша состояния пользователей бота: повторные нажатия кнопок без запросов к БД
+"""
+
+import os
+import sys
+from datetime import date, datetime
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.bot_cache import UserSnapshotCache, user_snapshots
+from app.database import Base
+from app.models import AllowedIP, Attendance, User
+from app.routers.telegram_bot import TelegramBot
+
+
+def test_button_presses_served_from_snapshot(tmp_path, monkeypatch):
+    """После первого нажатия статус и учетные данные не читают БД; запись сбрасывает снимок"""
+    monkeypatch.setattr(user_snapshots, "marker_file", str(tmp_path / "bot_cache.gen"))
+    user_snapshots.invalidate_all()
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    bot = TelegramBot()
+    with Session() as db:
+        user = User(email="cache@example.com", full_name="Кэш", password_hash="x", telegram_id=777,
+                    web_username="cache@example.com", web_password_plain="secret1")
+        db.add(user)
+        db.add(AllowedIP(ip_address="10.0.0.1"))
+        db.commit()
+        user_id = user.id
+
+        assert bot._process_callback(db, user_id, "status")["on_shift"] is False
+        statements.clear()
+        for action in ("status", "show_credentials", "status"):
+            bot._process_callback(db, user_id, action)
+        assert statements == []
+
+        # Приход через веб (любая запись Attendance) сбрасывает снимок пользователя
+        db.add(Attendance(user_id=user_id, started_at=bot._get_moscow_time(), work_date=date.today()))
+        db.commit()
+        assert bot._process_callback(db, user_id, "status")["on_shift"] is True
+        assert bot._check_telegram_user_allowed(db, user_id)[0] is True
+
+
+def test_global_invalidation_crosses_processes(tmp_path):
+    """Инвалидация через файл-маркер видна другому экземпляру кэша"""
+    marker = str(tmp_path / "bot_cache.gen")
+    first = UserSnapshotCache(marker_file=marker)
+    second = UserSnapshotCache(marker_file=marker)
+    second.put(1, {"on_shift": False})
+    assert second.get(1) is not None
+    first.invalidate_all()
+    assert second.get(1) is None
+
+
+def test_invalidation_after_commit_only(tmp_path, monkeypatch):
+    """Снимок сбрасывается после коммита, а не при flush; откат ничего не сбрасывает"""
+    monkeypatch.setattr(user_snapshots, "marker_file", str(tmp_path / "bot_cache.gen"))
+    user_snapshots.invalidate_all()
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+
+    with Session() as db:
+        user = User(email="commit@example.com", full_name="Коммит", password_hash="x")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+
+        user_snapshots.put(user_id, {"on_shift": False})
+        db.add(Attendance(user_id=user_id, started_at=datetime.now(), work_date=date.today()))
+        db.flush()
+        # Запись еще не закоммичена — читатель снимка видел бы старые данные
+        assert user_snapshots.get(user_id) is not None
+        db.rollback()
+        assert user_snapshots.get(user_id) is not None
+
+        db.add(Attendance(user_id=user_id, started_at=datetime.now(), work_date=date.today()))
+        db.flush()
+        with db.begin_nested():
+            db.add(AllowedIP(ip_address="10.0.0.2"))
+        # Точка сохранения закоммичена, внешняя транзакция — нет
+        assert user_snapshots.get(user_id) is not None
+        db.commit()
+        assert user_snapshots.get(user_id) is None
+        assert user_snapshots.stats()["cached"] == 0
+
+
+def test_user_invalidation_crosses_processes(tmp_path, monkeypatch):
+    """Сброс снимка пользователя (например, приход через веб) виден боту в другом процессе"""
+    marker = str(tmp_path / "bot_cache.gen")
+    web = UserSnapshotCache(marker_file=marker)
+    bot = UserSnapshotCache(marker_file=marker)
+    web.invalidate_all()
+    bot.put(1, {"on_shift": False})
+    bot.put(2, {"on_shift": False})
+
+    web.invalidate_users([1])
+    assert bot.get(1) is None
+    assert bot.get(2) is not None
+    assert bot.stats()["remote_invalidations"] == 1
+
+    # Снимок, прочитанный до чужой инвалидации, в кэш не попадает
+    epoch = bot.epoch()
+    web.invalidate_user(2)
+    bot.put(2, {"on_shift": False}, epoch)
+    assert bot.get(2) is None
+
+    # Свои строки журнала процесс не применяет повторно: обновленный снимок остается
+    bot.invalidate_user(3)
+    bot.put(3, {"on_shift": True})
+    assert bot.get(3) == {"on_shift": True}
+
+    # Переполненный журнал заменяется — это глобальный сброс
+    monkeypatch.setattr("app.bot_cache.BOT_CACHE_JOURNAL_SIZE", os.path.getsize(marker))
+    web.invalidate_user(4)
+    assert bot.get(3) is None
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Тест пула БД бота: ограничение потоков, коммит и откат в session_scope, метрики bot_db_*
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import database, metrics
+from app.database import Base, session_scope
+from app.models import Store
+from app.routers.telegram_bot import TelegramBot
+
+
+@pytest.fixture
+def Session(monkeypatch, tmp_path):
+    # Файловая база: у каждого потока пула свое соединение (общее соединение StaticPool
+    # перемешивало бы транзакции параллельных операций)
+    engine = create_engine(f"sqlite:///{tmp_path / 'bot.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+def test_session_scope_commits_and_rolls_back(Session):
+    """Коммит остается за вызывающим; при исключении незакоммиченное откатывается, сессия закрывается"""
+    with session_scope() as db:
+        db.add(Store(name="Закоммичен"))
+        db.commit()
+
+    with pytest.raises(RuntimeError):
+        with session_scope() as db:
+            db.add(Store(name="Откачен"))
+            db.flush()
+            raise RuntimeError("сбой")
+    assert not db.in_transaction()
+
+    with Session() as db:
+        assert [store.name for store in db.query(Store).all()] == ["Закоммичен"]
+
+
+def test_run_db_bounded_pool_and_metrics(Session, tmp_path, monkeypatch):
+    """Одновременно работает не больше потоков пула; ошибка доходит до вызывающего и попадает в метрики"""
+    registry = metrics.MetricsRegistry(directory=str(tmp_path), flush_seconds=0, enabled=True)
+    monkeypatch.setattr(metrics, "registry", registry)
+    bot = TelegramBot()
+    bot._db_executor = ThreadPoolExecutor(max_workers=2)
+
+    lock = threading.Lock()
+    running = {"now": 0, "max": 0}
+
+    def slow_insert(db, number):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.05)
+        db.add(Store(name=f"Магазин {number}"))
+        db.commit()
+        with lock:
+            running["now"] -= 1
+        return number
+
+    def broken(db):
+        db.add(Store(name="Не сохранится"))
+        db.flush()
+        raise ValueError("сбой")
+
+    async def scenario():
+        results = await asyncio.gather(*(bot._run_db(slow_insert, number) for number in range(6)))
+        with pytest.raises(ValueError):
+            await bot._run_db(broken)
+        return results
+
+    assert asyncio.run(scenario()) == list(range(6))
+    bot._db_executor.shutdown()
+    assert running["max"] == 2
+
+    stats = bot.db_stats()
+    assert stats["calls"] == 7 and stats["errors"] == 1
+    assert stats["queued"] == 0 and stats["in_flight"] == 0
+    with Session() as db:
+        assert db.query(Store).count() == 6
+
+    text = registry.collect()
+    assert 'bot_db_run_seconds_count{operation="slow_insert"} 6' in text
+    assert 'bot_db_errors_total{operation="broken"} 1' in text
+    assert "bot_db_in_flight 0" in text and "bot_db_queued 0" in text
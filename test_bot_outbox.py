@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Тест очереди исходящих сообщений бота: лимиты, повтор после 429, склейка
+"""
+
+import asyncio
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from telegram.error import Forbidden, RetryAfter
+
+from app.bot_outbox import OutboundQueue
+
+
+def test_broadcast_respects_global_rate():
+    """Рассылка идет не быстрее общего лимита, но и не медленнее"""
+    sent = []
+
+    async def send(chat_id, text, reply_markup):
+        sent.append((time.monotonic(), chat_id))
+
+    async def scenario():
+        outbox = OutboundQueue(send, rate=100, chat_rate=1, chat_burst=1, concurrency=4)
+        outbox.start()
+        started = time.monotonic()
+        for chat_id in range(300):
+            outbox.enqueue(chat_id, "Магазин сегодня закрывается в 18:00")
+        assert await outbox.join(timeout=10)
+        elapsed = time.monotonic() - started
+        await outbox.close()
+        return outbox.stats(), elapsed
+
+    stats, elapsed = asyncio.run(scenario())
+    assert stats["sent"] == 300 and stats["failed"] == 0
+    # Первые 100 уходят сразу (емкость ведра), остальные 200 — по 100 в секунду
+    assert 1.8 <= elapsed < 4
+
+
+def test_retry_after_and_coalescing():
+    """После 429 отправка ждет и повторяется; сообщения одному чату склеиваются"""
+    calls = []
+
+    async def send(chat_id, text, reply_markup):
+        calls.append((chat_id, text))
+        if len(calls) == 1:
+            raise RetryAfter(1)
+        if chat_id == 3:
+            raise Forbidden("bot was blocked by the user")
+
+    async def scenario():
+        outbox = OutboundQueue(send, rate=50, chat_rate=1, chat_burst=1)
+        outbox.start()
+        outbox.enqueue(1, "первое")
+        outbox.enqueue(1, "второе")
+        outbox.enqueue(2, "график v1", coalesce_key="schedule")
+        outbox.enqueue(2, "график v2", coalesce_key="schedule")
+        outbox.enqueue(3, "недоставляемое")
+        assert await outbox.join(timeout=10)
+        await outbox.close()
+        return outbox.stats()
+
+    stats = asyncio.run(scenario())
+    # Склеенное сообщение отправлено дважды: отклонено с 429 и повторено
+    assert [text for chat_id, text in calls if chat_id == 1] == ["первое\n\nвторое"] * 2
+    assert (2, "график v2") in calls and (2, "график v1") not in calls
+    assert stats["rate_limited"] == 1
+    assert stats["sent_messages"] == 3
+    assert stats["failed"] == 1
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Тест напоминаний бота: таймеры по опубликованному графику и инкрементальное обновление
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import bot_reminders
+from app.bot_reminders import ReminderScheduler
+from app.database import Base
+from app.models import Attendance, ScheduleEntry, User
+
+
+def test_reminders_follow_published_schedule(monkeypatch):
+    """Напоминание о приходе — без открытой смены, об уходе — только с открытой"""
+    monkeypatch.setattr(bot_reminders, "BOT_REMINDER_BEFORE_START", 0)
+    monkeypatch.setattr(bot_reminders, "BOT_REMINDER_AFTER_END", 0)
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+
+    now = bot_reminders._moscow_now().replace(microsecond=0, tzinfo=None)
+    with Session() as db:
+        users = [
+            User(email=f"u{i}@example.com", full_name=f"Сотрудник {i}", password_hash="x", telegram_id=100 + i)
+            for i in range(3)
+        ]
+        db.add_all(users)
+        db.flush()
+        shift = dict(work_date=now.date(), shift_type="work", published=True)
+        # 0: смена вот-вот начнется; 1: смена закончилась, а уход не отмечен; 2: не опубликована
+        db.add(ScheduleEntry(user_id=users[0].id, start_time=(now + timedelta(seconds=1)).time(),
+                             end_time=(now + timedelta(hours=1)).time(), **shift))
+        db.add(ScheduleEntry(user_id=users[1].id, start_time=(now - timedelta(hours=1)).time(),
+                             end_time=(now + timedelta(seconds=1)).time(), **shift))
+        db.add(ScheduleEntry(user_id=users[2].id, work_date=now.date(), shift_type="work", published=False,
+                             start_time=(now + timedelta(seconds=1)).time(), end_time=(now + timedelta(hours=1)).time()))
+        db.add(Attendance(user_id=users[1].id, started_at=now - timedelta(hours=1), work_date=now.date()))
+        db.commit()
+        late_user_id = users[2].id
+
+    sent = []
+
+    async def run_db(func, *args):
+        with Session() as db:
+            return func(db, *args)
+
+    def send(telegram_id, text, coalesce_key=None):
+        sent.append((telegram_id, coalesce_key))
+
+    async def scenario():
+        scheduler = ReminderScheduler(run_db, send, refresh_seconds=3600, lock_file=None)
+        scheduler.start()
+        await asyncio.sleep(0.2)
+        # Публикуем третью смену: подхватывается по request_refresh без полной перезагрузки
+        with Session() as db:
+            entry = db.query(ScheduleEntry).filter(ScheduleEntry.user_id == late_user_id).one()
+            entry.published = True
+            entry.start_time = (datetime.combine(now.date(), now.time()) + timedelta(seconds=2)).time()
+            db.commit()
+        scheduler.request_refresh()
+        await asyncio.sleep(3)
+        await scheduler.close()
+        return scheduler.stats()
+
+    stats = asyncio.run(scenario())
+    keys = {telegram_id for telegram_id, _ in sent}
+    assert keys == {100, 101, 102}
+    assert any(key.endswith(":start") for telegram_id, key in sent if telegram_id == 100)
+    assert any(key.endswith(":end") for telegram_id, key in sent if telegram_id == 101)
+    assert stats["loads"] == 1 and stats["refreshes"] >= 1
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Тест состояний диалога бота: перечитывание кэша после TTL, пароль регистрации не попадает в таблицу
+"""
+
+import asyncio
+import json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import database
+from app.bot_state import MISSING, ConversationStateStore
+from app.database import Base
+from app.models import User
+from app.security import verify_password
+from app.routers.telegram_bot import TelegramBot
+
+
+class SharedBackend:
+    """Общая «таблица» для нескольких процессов; запоминает все записанное"""
+
+    def __init__(self):
+        self.rows = {}
+        self.saved = []
+
+    def load(self, db, telegram_id):
+        row = self.rows.get(telegram_id)
+        return (json.loads(row[0]), float(row[1])) if row else None
+
+    def save_many(self, items):
+        for telegram_id, step, raw, updated_at in items:
+            self.saved.append(raw)
+            if raw is None:
+                self.rows.pop(telegram_id, None)
+            else:
+                self.rows[telegram_id] = (raw, updated_at)
+
+    def purge_expired(self, cutoff):
+        return 0
+
+
+def test_cache_revalidated_after_ttl():
+    """Шаг, продвинутый другим процессом, виден после TTL; свои несохраненные изменения не теряются"""
+    backend = SharedBackend()
+    first = ConversationStateStore(backend=backend, cache_ttl=0)
+    second = ConversationStateStore(backend=backend, cache_ttl=0)
+
+    first[1] = {"step": "register_full_name", "registration_data": {}}
+    # Несохраненное свое изменение отдается из памяти и после TTL
+    assert first.get_cached(1)["step"] == "register_full_name"
+    first.flush()
+
+    assert second.get_cached(1) is MISSING
+    session = second.load(None, 1)
+    session["step"] = "register_email"
+    second.mark_dirty(1)
+    second.flush()
+
+    assert first.get_cached(1) is MISSING
+    assert first.load(None, 1)["step"] == "register_email"
+
+
+class _Message:
+    def __init__(self, replies):
+        self.replies = replies
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class _Update:
+    def __init__(self, telegram_id, replies):
+        self.effective_user = type("TgUser", (), {"id": telegram_id})()
+        self.message = _Message(replies)
+
+
+def test_registration_password_not_persisted(monkeypatch):
+    """Пароль живет только в памяти; в сохраненных состояниях его нет, пользователь создается с хэшем"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", Session)
+
+    backend = SharedBackend()
+    bot = TelegramBot()
+    bot.user_sessions = ConversationStateStore(backend=backend)
+    replies = []
+    update = _Update(77, replies)
+
+    async def scenario():
+        bot.user_sessions[77] = {"step": "register_password",
+                                 "registration_data": {"full_name": "Тест", "email": "reg@example.com"}}
+        await bot._handle_registration_step(update, "secret-pass", bot.user_sessions.get_cached(77))
+        bot.user_sessions.flush()
+        await bot._handle_registration_step(update, "15.05.1990", bot.user_sessions.get_cached(77))
+        bot.user_sessions.flush()
+
+    asyncio.run(scenario())
+    bot._db_executor.shutdown()
+
+    assert backend.saved and not any("secret-pass" in raw for raw in backend.saved if raw)
+    assert "Регистрация завершена" in replies[-1]
+    with Session() as db:
+        user = db.query(User).filter(User.email == "reg@example.com").one()
+        assert verify_password("secret-pass", user.password_hash)
+        assert user.telegram_id == 77
+
+
+def test_lost_password_asked_again():
+    """Без пароля в памяти (перезапуск) бот возвращается к шагу пароля"""
+    bot = TelegramBot()
+    bot.user_sessions = ConversationStateStore(backend=SharedBackend())
+    replies = []
+    session = {"step": "register_date_of_birth", "registration_data": {"full_name": "Тест", "email": "x@example.com"}}
+    bot.user_sessions[5] = session
+
+    asyncio.run(bot._handle_registration_step(_Update(5, replies), "15.05.1990", session))
+    bot._db_executor.shutdown()
+
+    assert session["step"] == "register_password"
+    assert "Пароль не сохранился" in replies[-1]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Тест единого сервиса прихода: одна открытая смена при двойных нажатиях и повторах
+"""
+
+import os
+import sys
+import threading
+from datetime import timedelta
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import checkin, daily_totals
+from app.checkin import _moscow_now, check_in
+from app.database import Base
+from app.models import Attendance, DailyTotal, User
+
+
+def test_concurrent_checkins_open_one_session(tmp_path):
+    """Параллельные нажатия открывают одну смену; повтор с ключом возвращает ту же; зависшая закрывается"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'checkin.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    now = _moscow_now()
+
+    with Session() as db:
+        user = User(email="tap@example.com", full_name="Двойное нажатие", password_hash="x")
+        db.add(user)
+        db.flush()
+        # Забытая смена вчерашнего дня
+        db.add(Attendance(user_id=user.id, started_at=(now - timedelta(days=1)).replace(tzinfo=None),
+                          work_date=(now - timedelta(days=1)).date()))
+        db.commit()
+        user_id = user.id
+
+    results = []
+    barrier = threading.Barrier(6)
+
+    def tap():
+        with Session() as db:
+            barrier.wait()
+            results.append(check_in(db, user_id, now).status)
+
+    threads = [threading.Thread(target=tap) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == ["already_active"] * 5 + ["started"]
+    with Session() as db:
+        open_sessions = db.query(Attendance).filter(Attendance.user_id == user_id, Attendance.ended_at.is_(None)).all()
+        assert [row.work_date for row in open_sessions] == [now.date()]
+        assert db.get(DailyTotal, (user_id, now.date())).open_started_at is not None
+
+        # Смена закрыта, клиент повторяет старый запрос с тем же ключом — новая не открывается
+        open_sessions[0].ended_at = open_sessions[0].started_at + timedelta(hours=1)
+        db.commit()
+        first = check_in(db, user_id, now + timedelta(hours=2), idempotency_key="kiosk-1")
+        again = check_in(db, user_id, now + timedelta(hours=2), idempotency_key="kiosk-1")
+        assert first.status == "started" and again.replayed and again.attendance_id == first.attendance_id
+        assert db.query(Attendance).filter(Attendance.user_id == user_id).count() == 3
+
+
+def test_checkin_without_on_conflict(tmp_path, monkeypatch):
+    """В БД без ON CONFLICT приход и итоги дня работают обычными запросами"""
+    monkeypatch.setattr(checkin, "dialect_insert", lambda dialect: None)
+    monkeypatch.setattr(daily_totals, "dialect_insert", lambda dialect: None)
+    engine = create_engine(f"sqlite:///{tmp_path / 'checkin.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    now = _moscow_now()
+
+    with Session() as db:
+        user = User(email="plain@example.com", full_name="Без upsert", password_hash="x")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+
+        first = check_in(db, user_id, now)
+        assert first.status == "started"
+        assert check_in(db, user_id, now).status == "already_active"
+        assert db.get(DailyTotal, (user_id, now.date())).open_started_at is not None
+
+        active = db.get(Attendance, first.attendance_id)
+        active.ended_at = active.started_at + timedelta(hours=1)
+        db.commit()
+        total = db.get(DailyTotal, (user_id, now.date()))
+        assert total.sessions == 1 and total.open_started_at is None
+        assert check_in(db, user_id, now + timedelta(hours=2)).status == "started"
+        assert db.query(Attendance).filter(Attendance.user_id == user_id).count() == 2
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Тест итогов дня и JSON API WebApp v2: отметки без перечитывания всех смен за день
+"""
+
+import os
+import sys
+from datetime import timedelta
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.daily_totals import day_state, rebuild_daily_totals
+from app.database import Base, get_db
+from app.models import Attendance, DailyTotal, User
+from app.routers import attendance
+from app.routers.telegram_bot import TelegramBot
+
+
+def test_daily_total_follows_attendance_and_v2_api():
+    """Итог дня обновляется при каждой записи отметки; v2 отдает то же состояние"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+
+    app = FastAPI()
+    app.include_router(attendance.router)
+
+    def override_db():
+        with Session() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_db
+    client = TestClient(app)
+
+    now = attendance._get_moscow_time().replace(tzinfo=None)
+    with Session() as db:
+        user = User(email="wa@example.com", full_name="WebApp", password_hash="x")
+        db.add(user)
+        db.flush()
+        db.add(Attendance(user_id=user.id, started_at=now - timedelta(hours=3),
+                          ended_at=now - timedelta(hours=2), work_date=now.date()))
+        db.commit()
+        user_id = user.id
+        assert day_state(db, user_id, now.date(), now)["worked_seconds"] == 3600
+
+    headers = {"Authorization": f"Bearer {attendance._generate_compact_token(user_id)}"}
+    body = client.post("/tgapi/v2/checkin", headers=headers).json()
+    assert body["status"] == "started" and body["on_shift"] is True
+    assert client.post("/tgapi/v2/checkin", headers=headers).json()["status"] == "already_active"
+    body = client.post("/tgapi/v2/checkout", headers=headers).json()
+    assert body["status"] == "stopped" and body["on_shift"] is False
+    assert 3600 <= body["worked_seconds"] < 3700
+    assert client.get("/tgapi/v2/state", headers={"Authorization": "Bearer bad"}).status_code == 401
+
+    with Session() as db:
+        total = db.get(DailyTotal, (user_id, now.date()))
+        assert total.sessions == 2 and total.open_started_at is None
+        # В закрытой смене — итог дня в часах, без поправок на часовой пояс
+        closed = db.query(Attendance).filter(Attendance.user_id == user_id, Attendance.ended_at > now - timedelta(hours=1)).one()
+        assert closed.hours == round(body["worked_seconds"] / 3600.0, 4)
+        assert 1.0 <= closed.hours < 1.03
+        # Пересборка с нуля дает тот же итог
+        with engine.begin() as connection:
+            rebuild_daily_totals(connection)
+        db.expire_all()
+        assert db.get(DailyTotal, (user_id, now.date())).sessions == 2
+
+
+def test_bot_checkout_uses_daily_total():
+    """Уход через бота: итог дня из daily_totals плюс закрываемая смена, без чтения всех смен дня"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    bot = TelegramBot()
+
+    now = bot._get_moscow_time().replace(tzinfo=None)
+    with Session() as db:
+        user = User(email="bot-out@example.com", full_name="Бот", password_hash="x")
+        db.add(user)
+        db.flush()
+        db.add_all([
+            Attendance(user_id=user.id, started_at=now - timedelta(hours=3),
+                       ended_at=now - timedelta(hours=2), work_date=now.date()),
+            Attendance(user_id=user.id, started_at=now - timedelta(minutes=30), work_date=now.date()),
+        ])
+        db.commit()
+        user_id = user.id
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    with Session() as db:
+        result = bot._checkout(db, user_id, proceed_on_warning=True)
+    assert result["status"] == "stopped"
+    assert 1.5 <= result["hours"] < 1.53
+    # Целиком строки отметок читаются только при поиске открытой смены, без выборки всех смен за день
+    assert sum(statement.startswith("SELECT attendance.id") for statement in statements) == 1
+
+    with Session() as db:
+        closed = db.query(Attendance).filter(Attendance.user_id == user_id, Attendance.started_at > now - timedelta(hours=1)).one()
+        assert closed.hours == result["hours"]
+        assert db.get(DailyTotal, (user_id, now.date())).open_started_at is None
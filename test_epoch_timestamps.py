@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Тест секундных меток отметок: started_ts/ended_ts/duration_s и отчеты агрегатами SQL
+"""
+
+import os
+import sys
+from datetime import date, datetime, timedelta, timezone
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.database import Base
+from app.models import Attendance, ScheduleEntry, User, to_epoch
+from app.routers.admin import _report_stats
+
+
+def test_epoch_columns_and_report_stats():
+    """Метки заполняются при записи, отчет считается двумя запросами на всех сотрудников"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+
+    day = date(2025, 3, 3)
+    start = datetime(2025, 3, 3, 9, 0)
+    with Session() as db:
+        users = [User(email=f"ts{i}@example.com", full_name=f"TS {i}", password_hash="x") for i in range(3)]
+        db.add_all(users)
+        db.flush()
+        first, second = users[:2]
+        closed = Attendance(user_id=first.id, started_at=start, ended_at=start + timedelta(hours=4), work_date=day)
+        db.add_all([
+            closed,
+            Attendance(user_id=first.id, started_at=start + timedelta(hours=5),
+                       ended_at=start + timedelta(hours=7, minutes=30), work_date=day),
+            Attendance(user_id=first.id, started_at=start + timedelta(days=1), ended_at=start + timedelta(days=1, hours=1),
+                       work_date=day + timedelta(days=1)),
+            # Открытая смена не попадает ни в часы, ни в число смен
+            Attendance(user_id=second.id, started_at=start, work_date=day),
+            ScheduleEntry(user_id=first.id, work_date=day, shift_type="work", published=True),
+            ScheduleEntry(user_id=first.id, work_date=day + timedelta(days=2), shift_type="sick", published=True),
+            ScheduleEntry(user_id=second.id, work_date=day, shift_type="vacation", published=False),
+        ])
+        db.commit()
+
+        # 09:00 по Москве — 06:00 UTC
+        assert closed.started_ts == to_epoch(start) == int(datetime(2025, 3, 3, 6, 0, tzinfo=timezone.utc).timestamp())
+        assert closed.duration_s == 4 * 3600
+
+        user_ids = [u.id for u in users]
+        statements = []
+        event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        stats = _report_stats(db, user_ids, day, day + timedelta(days=6))
+        assert len(statements) == 2
+
+        first_stats, second_stats, idle_stats = (stats[user_id] for user_id in user_ids)
+        assert first_stats["total_hours"] == 7.5
+        assert first_stats["working_shifts"] == 2
+        assert first_stats["work_days"] == 1 and first_stats["sick_days"] == 1
+        assert second_stats == idle_stats == {
+            "total_hours": 0, "working_shifts": 0, "work_days": 0, "days_off": 0, "vacations": 0, "sick_days": 0,
+        }
+
+        # Правка времени пересчитывает метки и длительность
+        closed.ended_at = start + timedelta(hours=1)
+        db.commit()
+        assert closed.ended_ts - closed.started_ts == closed.duration_s == 3600
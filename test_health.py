@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Тест проб готовности: проверки зависимостей с задержками, отказ при отставшей схеме, кэш результата
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from app import checkin
+from app.checkin import note_overdue_sweep
+from app.database import Base
+from app.routers import health
+
+
+def _client():
+    app = FastAPI()
+    app.include_router(health.router)
+    return TestClient(app)
+
+
+def test_ready_reports_checks_and_fails_on_pending_schema(monkeypatch):
+    """Готовность — 200 с задержкой каждой проверки; без колонки модели — 503 до истечения кэша"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(health, "engine", engine)
+    monkeypatch.setattr(health, "_ready_cache", None)
+    client = _client()
+
+    assert client.get("/health/live").json()["status"] == "ok"
+    response = client.get("/health/ready")
+    body = response.json()
+    assert response.status_code == 200 and body["status"] == "ok"
+    assert set(body["checks"]) == {"database", "migrations", "disk", "overdue_shifts", "bot"}
+    assert all("latency_ms" in check for check in body["checks"].values())
+
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE attendance DROP COLUMN duration_s"))
+    # Пока действует кэш, проба отдает прошлый результат без обращения к БД
+    assert client.get("/health/ready").json()["checked_at"] == body["checked_at"]
+
+    monkeypatch.setattr(health, "_ready_cache", None)
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["migrations"]["pending"] == ["attendance.duration_s"]
+
+
+def test_ready_fails_when_disk_is_low(monkeypatch):
+    """Мало места под резервные копии — сервис не готов"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(health, "engine", engine)
+    monkeypatch.setattr(health, "_ready_cache", None)
+    monkeypatch.setattr(health, "HEALTH_MIN_FREE_MB", 10 ** 12)
+
+    response = _client().get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["disk"]["ok"] is False
+    assert response.json()["checks"]["database"]["ok"] is True
+
+
+def test_last_sweep_seen_by_every_process(monkeypatch, tmp_path):
+    """Время закрытия зависших смен берется из файла, который пишет скрипт из cron"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(health, "engine", engine)
+    monkeypatch.setattr(checkin, "OVERDUE_SWEEP_FILE", str(tmp_path / "state" / "overdue_sweep"))
+
+    monkeypatch.setattr(health, "_ready_cache", None)
+    assert _client().get("/health/ready").json()["checks"]["overdue_shifts"]["last_sweep_seconds_ago"] is None
+
+    note_overdue_sweep()
+    os.utime(checkin.OVERDUE_SWEEP_FILE, (0, os.stat(checkin.OVERDUE_SWEEP_FILE).st_mtime - 120))
+    monkeypatch.setattr(health, "_ready_cache", None)
+    swept_ago = _client().get("/health/ready").json()["checks"]["overdue_shifts"]["last_sweep_seconds_ago"]
+    assert 120 <= swept_ago < 130
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Тест журналирования: JSON с контекстом запроса, прореживание журнала доступа, ротация
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from starlette.middleware.sessions import SessionMiddleware
+
+from app.logging_config import (
+    AccessLogMiddleware,
+    AccessLogSampler,
+    JsonFormatter,
+    RequestContextFilter,
+    SizeAndTimeRotatingFileHandler,
+)
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(json.loads(self.format(record)))
+
+
+def test_records_carry_request_context():
+    """Запись из обработчика и строка доступа несут request_id, user_id и шаблон маршрута"""
+    handler = _ListHandler()
+    handler.addFilter(RequestContextFilter())
+    handler.setFormatter(JsonFormatter())
+    for name in ("test.route", "app.access"):
+        logger = logging.getLogger(name)
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+    app = FastAPI()
+    app.add_middleware(SessionMiddleware, secret_key="test")
+    app.add_middleware(AccessLogMiddleware)
+
+    @app.get("/login/{user_id}")
+    def login(user_id: int, request: Request):
+        request.session["user_id"] = user_id
+        logging.getLogger("test.route").info("вход", extra={"attempt": 1})
+        return {"ok": True}
+
+    try:
+        response = TestClient(app).get("/login/42", headers={"X-Request-ID": "req-1"})
+    finally:
+        for name in ("test.route", "app.access"):
+            logging.getLogger(name).removeHandler(handler)
+
+    assert response.headers["X-Request-ID"] == "req-1"
+    route_line, access_line = handler.lines
+    assert route_line["message"] == "вход" and route_line["attempt"] == 1
+    assert route_line["request_id"] == access_line["request_id"] == "req-1"
+    assert route_line["user_id"] == access_line["user_id"] == 42
+    assert access_line["route"] == "/login/{user_id}"
+    assert access_line["status"] == 200 and access_line["duration_ms"] >= 0
+
+
+def test_access_log_sampled_but_errors_kept():
+    """Сверх порога в секунду успешные запросы прореживаются, ошибки пишутся всегда"""
+    sampler = AccessLogSampler(burst=2, rate=0.0, slow_ms=1000)
+
+    def record(status):
+        rec = logging.LogRecord("app.access", logging.INFO, __file__, 0, "GET /", None, None)
+        rec.status, rec.duration_ms = status, 1.0
+        return rec
+
+    kept = [sampler.filter(record(200)) for _ in range(5)]
+    assert kept[:2] == [True, True] and not any(kept[2:])
+    assert sampler.filter(record(500)) is True
+
+
+def test_rotation_by_time(tmp_path):
+    """Файл ротируется по истечении интервала, даже если не достиг лимита размера"""
+    path = tmp_path / "app.log"
+    handler = SizeAndTimeRotatingFileHandler(str(path), max_bytes=10 ** 6, interval_seconds=3600, backup_count=2)
+    record = logging.LogRecord("app", logging.INFO, __file__, 0, "строка", None, None)
+    handler.emit(record)
+    handler.rollover_at = 0
+    handler.emit(record)
+    handler.close()
+    assert (tmp_path / "app.log.1").exists()
+    assert path.read_text(encoding="utf-8").count("строка") == 1
+
+
+def test_rotation_shared_by_processes(tmp_path):
+    """Несколько писателей одного файла: ротирует один, строки не теряются, ротация по времени — одна"""
+    path = tmp_path / "app.log"
+    # Отдельные обработчики — как отдельные процессы: свои потоки файла и свои открытия файла блокировки
+    handlers = [SizeAndTimeRotatingFileHandler(str(path), max_bytes=2_000, interval_seconds=0, backup_count=100)
+                for _ in range(4)]
+
+    def write(number, handler):
+        for line in range(500):
+            handler.emit(logging.LogRecord("app", logging.INFO, __file__, 0, f"w{number} {line:04d}", None, None))
+
+    threads = [threading.Thread(target=write, args=(number, handler)) for number, handler in enumerate(handlers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for handler in handlers:
+        handler.close()
+
+    files = [name for name in os.listdir(tmp_path) if name.startswith("app.log") and not name.endswith(".lock")]
+    lines = [line for name in files for line in (tmp_path / name).read_text(encoding="utf-8").splitlines()]
+    assert len(lines) == len(set(lines)) == 2000
+    assert len(files) > 2
+    assert all(os.path.getsize(tmp_path / name) < 2_000 + 4 * 10 for name in files)
+
+    # Граница интервала общая: ее пересекают оба «процесса», а ротация одна
+    first, second = (SizeAndTimeRotatingFileHandler(str(tmp_path / "time.log"), max_bytes=0, interval_seconds=3600,
+                                                    backup_count=5) for _ in range(2))
+    record = logging.LogRecord("app", logging.INFO, __file__, 0, "строка", None, None)
+    first.emit(record)
+    second.emit(record)
+    first.rollover_at = second.rollover_at = 0
+    first.emit(record)
+    second.emit(record)
+    first.close()
+    second.close()
+    assert (tmp_path / "time.log.1").read_text(encoding="utf-8").count("строка") == 2
+    assert (tmp_path / "time.log").read_text(encoding="utf-8").count("строка") == 2
+    assert not (tmp_path / "time.log.2").exists()
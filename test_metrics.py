@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Тест /metrics: гистограммы по шаблону маршрута, слияние файлов процессов, отметки по магазинам
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import metrics
+from app.checkin import check_in
+from app.database import Base
+from app.models import Attendance, Store, User
+
+
+def test_metrics_endpoint_merges_processes(tmp_path, monkeypatch):
+    """Маршрут с параметром — один ряд; счетчики умерших процессов остаются, их gauge — нет"""
+    registry = metrics.MetricsRegistry(directory=str(tmp_path), flush_seconds=0, enabled=True)
+    monkeypatch.setattr(metrics, "registry", registry)
+
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware, metrics=registry)
+
+    @app.get("/items/{item_id}")
+    def item(item_id: int):
+        return {"id": item_id}
+
+    client = TestClient(app)
+    for item_id in (1, 2, 3):
+        assert client.get(f"/items/{item_id}").status_code == 200
+    assert client.get("/nothing").status_code == 404
+
+    # Снимок завершившегося воркера
+    dead = {"pid": 2 ** 22 + 11, "values": [
+        ["attendance_checkins_total", [["store", "7"]], 5],
+        ["http_requests_in_flight", [], 3],
+    ]}
+    (tmp_path / f"{dead['pid']}.json").write_text(json.dumps(dead))
+    # Давно завершившийся воркер: файл удаляется
+    stale = {"pid": 2 ** 22 + 13, "values": [["attendance_checkins_total", [["store", "8"]], 2]]}
+    stale_path = tmp_path / f"{stale['pid']}.json"
+    stale_path.write_text(json.dumps(stale))
+    os.utime(stale_path, (time.time() - 3600, time.time() - 3600))
+
+    text = registry.collect()
+    assert 'http_request_duration_seconds_count{method="GET",route="/items/{item_id}",status="200"} 3' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="<other>",status="404",le="+Inf"} 1' in text
+    assert 'attendance_checkins_total{store="7"} 5' in text
+    assert "http_requests_in_flight 0" in text
+    assert 'store="8"' not in text and not stale_path.exists()
+
+
+def test_checkins_and_checkouts_counted_per_store(tmp_path, monkeypatch):
+    """Приход считается сервисом отметок, уход — после коммита закрытия смены"""
+    registry = metrics.MetricsRegistry(directory=str(tmp_path), flush_seconds=0, enabled=True)
+    monkeypatch.setattr(metrics, "registry", registry)
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        store = Store(name="Магазин", qr_token="m1")
+        db.add(store)
+        db.flush()
+        user = User(email="m@example.com", full_name="Метрики", password_hash="x", store_id=store.id)
+        db.add(user)
+        db.commit()
+        user_id, store_id = user.id, store.id
+
+        check_in(db, user_id, now=datetime(2025, 3, 3, 9, 0))
+        active = db.query(Attendance).filter(Attendance.user_id == user_id).one()
+        # Откаченное закрытие не считается
+        active.ended_at = datetime(2025, 3, 3, 17, 0)
+        db.flush()
+        db.rollback()
+        active.ended_at = datetime(2025, 3, 3, 18, 0)
+        db.commit()
+
+    text = registry.collect()
+    assert f'attendance_checkins_total{{store="{store_id}"}} 1' in text
+    assert f'attendance_checkouts_total{{store="{store_id}"}} 1' in text
+
+
+def test_concurrent_flushes(tmp_path):
+    """Сброс из нескольких потоков сразу не падает и не оставляет временных файлов"""
+    registry = metrics.MetricsRegistry(directory=str(tmp_path), flush_seconds=0, enabled=True)
+    errors = []
+
+    def work():
+        try:
+            for _ in range(200):
+                registry.inc("db_pool_checkouts_total")
+                registry.flush(force=True)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sorted(os.listdir(tmp_path)) == [f"{os.getpid()}.json"]
+    assert "db_pool_checkouts_total 800" in registry.collect()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Тест пула хэширования паролей: отказ при переполненной очереди, 503 на /login и /register,
+пересчет хэша при входе после смены BCRYPT_ROUNDS
+"""
+
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from starlette.middleware.sessions import SessionMiddleware
+
+from app import security
+from app.database import Base, get_db
+from app.models import User
+from app.routers import auth
+
+
+def test_busy_at_max_queue(monkeypatch):
+    """Операции сверх PASSWORD_HASH_MAX_QUEUE (в очереди и в работе) отклоняются сразу"""
+    monkeypatch.setattr(security, "PASSWORD_HASH_MAX_QUEUE", 2)
+    monkeypatch.setattr(security, "_hash_executor", ThreadPoolExecutor(max_workers=1))
+    release = threading.Event()
+    rejected_before = security.password_hash_stats()["rejected"]
+
+    async def scenario():
+        blocked = [asyncio.ensure_future(security._run_hash(release.wait, 5)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        stats = security.password_hash_stats()
+        assert stats["in_flight"] == 1 and stats["queued"] == 1
+        with pytest.raises(security.PasswordHashBusy):
+            await security.hash_password_async("secret")
+        release.set()
+        await asyncio.gather(*blocked)
+        # Очередь освободилась — снова принимаем
+        return await security._run_hash(len, "ok")
+
+    assert asyncio.run(scenario()) == 2
+    security._hash_executor.shutdown()
+    assert security.password_hash_stats()["rejected"] == rejected_before + 1
+
+
+@pytest.fixture
+def client(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+
+    app = FastAPI()
+    app.include_router(auth.router)
+    app.add_middleware(SessionMiddleware, secret_key="password-hashing")
+
+    def override_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_db
+    with Session() as db:
+        db.add(User(email="user@example.com", full_name="Пользователь",
+                    password_hash=CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("secret")))
+        db.commit()
+    yield TestClient(app), Session
+    engine.dispose()
+
+
+def test_login_and_register_busy(client, monkeypatch):
+    """При переполненной очереди /login и /register отвечают 503, пользователь не создается"""
+    test_client, Session = client
+    monkeypatch.setattr(security, "PASSWORD_HASH_MAX_QUEUE", 0)
+
+    response = test_client.post("/login", data={"email": "user@example.com", "password": "secret"},
+                                follow_redirects=False)
+    assert response.status_code == 503
+    assert "Сервер перегружен" in response.text
+
+    response = test_client.post("/register", data={"email": "new@example.com", "password": "secret"},
+                                follow_redirects=False)
+    assert response.status_code == 503
+    with Session() as db:
+        assert db.query(User).filter(User.email == "new@example.com").first() is None
+
+
+def test_rehash_on_login(client, monkeypatch):
+    """После смены числа раундов верный вход сохраняет новый хэш, повторный вход его не меняет"""
+    test_client, Session = client
+    monkeypatch.setattr(security, "password_context", CryptContext(schemes=["bcrypt"], deprecated="auto",
+                                                                   bcrypt__rounds=5))
+    rehashed_before = security.password_hash_stats()["rehashed"]
+
+    wrong = test_client.post("/login", data={"email": "user@example.com", "password": "wrong"}, follow_redirects=False)
+    assert wrong.status_code == 400
+    with Session() as db:
+        assert db.query(User.password_hash).scalar().startswith("$2b$04$")
+
+    response = test_client.post("/login", data={"email": "user@example.com", "password": "secret"},
+                                follow_redirects=False)
+    assert response.status_code == 303
+    with Session() as db:
+        new_hash = db.query(User.password_hash).scalar()
+    assert new_hash.startswith("$2b$05$")
+    assert security.verify_password("secret", new_hash)
+    assert security.password_hash_stats()["rehashed"] == rehashed_before + 1
+
+    assert test_client.post("/login", data={"email": "user@example.com", "password": "secret"},
+                            follow_redirects=False).status_code == 303
+    with Session() as db:
+        assert db.query(User.password_hash).scalar() == new_hash
+
+
+def test_auth_queries_off_event_loop(client):
+    """Асинхронные /login и /register не выполняют SQL в потоке цикла событий"""
+    test_client, Session = client
+    on_loop = []
+
+    def check_thread(conn, cursor, statement, *args):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        on_loop.append(statement)
+
+    event.listen(Session.kw["bind"], "before_cursor_execute", check_thread)
+    assert test_client.post("/register", data={"email": "loop@example.com", "password": "secret"},
+                            follow_redirects=False).status_code == 303
+    assert test_client.post("/login", data={"email": "loop@example.com", "password": "secret"},
+                            follow_redirects=False).status_code == 303
+    # Вход с пересчетом хэша (у пользователя из фикстуры 4 раунда) — коммит тоже вне цикла
+    assert test_client.post("/login", data={"email": "user@example.com", "password": "secret"},
+                            follow_redirects=False).status_code == 303
+    assert on_loop == []
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Тест профилирования по требованию: только для администратора, стеки потока обработчика
+"""
+
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from starlette.middleware.sessions import SessionMiddleware
+
+from app.profiler import ProfilerMiddleware, list_profiles, profile_path
+
+
+def _busy_report():
+    started = time.perf_counter()
+    while time.perf_counter() - started < 0.15:
+        sum(range(1000))
+
+
+def test_admin_request_profiled_into_flame_graph(tmp_path):
+    """Заголовок X-Profile у сотрудника игнорируется, у администратора — профиль с кодом обработчика"""
+    app = FastAPI()
+    app.add_middleware(ProfilerMiddleware, directory=str(tmp_path), interval_ms=1)
+    app.add_middleware(SessionMiddleware, secret_key="test")
+
+    @app.get("/login/{role}")
+    def login(role: str, request: Request):
+        request.session["role"] = role
+        return {}
+
+    @app.get("/admin/reports")
+    def reports(request: Request):
+        _busy_report()
+        return {}
+
+    client = TestClient(app)
+    client.get("/login/employee")
+    assert "x-profile-id" not in client.get("/admin/reports", headers={"X-Profile": "1"}).headers
+
+    client.get("/login/admin")
+    profile_id = client.get("/admin/reports?_profile=1").headers["x-profile-id"]
+    assert [item["id"] for item in list_profiles(str(tmp_path))] == [profile_id]
+
+    folded = open(profile_path(profile_id, ".folded", str(tmp_path)), encoding="utf-8").read()
+    assert "reports (" in folded and "_busy_report (" in folded
+    assert "<h2>GET /admin/reports</h2>" in open(profile_path(profile_id, directory=str(tmp_path)), encoding="utf-8").read()
+    assert profile_path("../" + profile_id, directory=str(tmp_path)) is None
+
+
+def test_sampling_every_nth_request(tmp_path):
+    """PROFILER_SAMPLE_EVERY профилирует каждый N-й запрос без участия администратора"""
+    app = FastAPI()
+    app.add_middleware(ProfilerMiddleware, directory=str(tmp_path), sample_every=3)
+
+    @app.get("/dashboard")
+    def dashboard():
+        return {}
+
+    client = TestClient(app)
+    profiled = ["x-profile-id" in client.get("/dashboard").headers for _ in range(6)]
+    assert profiled == [False, False, True, False, False, True]
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Тест печатных листов QR: PDF по странице на магазин, ZIP из кэша PNG
+"""
+
+import io
+import os
+import sys
+import zipfile
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import qr_sheets
+from app.qr_sheets import QRImageCache, build_qr_pdf, build_qr_zip
+
+
+def test_qr_sheet_pdf_and_zip(monkeypatch):
+    """Каждый код рендерится один раз; PDF содержит страницу на магазин"""
+    cache = QRImageCache()
+    monkeypatch.setattr(qr_sheets, "qr_images", cache)
+    stores = [
+        (f"Магазин {i}", [("Приход", f"https://example.com/q/start/t{i}"), ("Уход", f"https://example.com/q/stop/t{i}")])
+        for i in range(3)
+    ]
+
+    pdf = build_qr_pdf(stores)
+    assert pdf.startswith(b"%PDF") and b"/Count 3" in pdf
+    assert cache.stats()["cached"] == 6
+
+    archive = zipfile.ZipFile(io.BytesIO(build_qr_zip(stores)))
+    assert sorted(archive.namelist())[:2] == ["001_Магазин_0/Приход.png", "001_Магазин_0/Уход.png"]
+    assert cache.stats()["cached"] == 6 and cache.stats()["hits"] == 6
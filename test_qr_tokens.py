@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Тест подписанных QR-токенов: проверка без БД, ротация и отзыв перевыпуском
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import qr_tokens
+from app.database import Base
+from app.models import Store
+from app.qr_tokens import QRRevocationList, generate_qr_token, verify_qr_token
+
+
+def test_signed_qr_tokens(monkeypatch):
+    """Токен принимается из кэша списка отзыва; ротация и перевыпуск делают старый QR недействительным"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    revocations = QRRevocationList(ttl=3600, session_factory=Session)
+    monkeypatch.setattr(qr_tokens, "qr_revocations", revocations)
+    monkeypatch.setattr(qr_tokens, "QR_TOKEN_ROTATION_SECONDS", 60)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    with Session() as db:
+        store = Store(name="Центральный", qr_token="legacy")
+        db.add(store)
+        db.commit()
+
+        token = generate_qr_token(store, "start", now=6000)
+        assert verify_qr_token(token, "start", now=6000) == store.id
+        statements.clear()
+        for now in (6000, 6059, 6061):  # текущее и следующее окно
+            assert verify_qr_token(token, "start", now=now) == store.id
+        assert statements == []
+
+        assert verify_qr_token(token, "stop", now=6000) is None
+        assert verify_qr_token(token, "start", now=6130) is None  # фото старого QR
+        assert verify_qr_token(token[:-1] + "0", "start", now=6000) is None
+
+        # Перевыпуск QR увеличивает поколение и сбрасывает кэш через событие ORM
+        store.qr_generation += 1
+        db.commit()
+        assert verify_qr_token(token, "start", now=6000) is None
+        assert verify_qr_token(generate_qr_token(store, "start", now=6000), "start", now=6000) == store.id
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Тест числа SQL-запросов на горячих маршрутах: граница не зависит от числа сотрудников
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from starlette.middleware.sessions import SessionMiddleware
+
+from app import database
+from app.bot_cache import user_snapshots
+from app.daily_totals import rebuild_daily_totals
+from app.database import Base, _after_cursor_execute, _before_cursor_execute, get_db
+from app.models import Attendance, ScheduleEntry, Store, User
+from app.routers import admin, attendance
+from app.routers.telegram_bot import telegram_bot
+
+
+class QueryCounter:
+    """Наблюдатель engine: запоминает тексты выполненных запросов"""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, statement, parameters, duration, context):
+        self.statements.append(statement)
+
+    @contextmanager
+    def at_most(self, limit: int, what: str):
+        """Не больше limit запросов внутри блока"""
+        self.statements = []
+        yield
+        count = len(self.statements)
+        assert count <= limit, f"{what}: {count} запросов (граница {limit}):\n" + "\n".join(self.statements)
+
+
+@pytest.fixture(params=[3, 30], ids=lambda employees: f"{employees}_employees")
+def env(request, monkeypatch):
+    """Приложение на SQLite в памяти с params сотрудниками; отметки и график за текущий месяц"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", Session)
+
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    monkeypatch.setattr(database, "_query_observers", [counter])
+
+    today = date.today()
+    with Session() as db:
+        stores = [Store(name=f"Магазин {number}", qr_token=f"qr-{number}") for number in range(3)]
+        db.add_all(stores)
+        db.flush()
+        admin_user = User(email="admin@example.com", full_name="Админ", password_hash="x", role="admin")
+        db.add(admin_user)
+        employees = [
+            User(email=f"emp{number}@example.com", full_name=f"Сотрудник {number}", password_hash="x",
+                 store_id=stores[number % len(stores)].id)
+            for number in range(request.param)
+        ]
+        db.add_all(employees)
+        db.flush()
+        for employee in employees:
+            for day in range(1, today.day):
+                work_date = today.replace(day=day)
+                started = datetime.combine(work_date, time(9))
+                db.add(Attendance(user_id=employee.id, started_at=started, ended_at=started + timedelta(hours=8),
+                                  work_date=work_date))
+            for day in range(1, 29):
+                db.add(ScheduleEntry(user_id=employee.id, work_date=today.replace(day=day), shift_type="work",
+                                     start_time=time(9), end_time=time(17), store_id=employee.store_id,
+                                     published=True))
+        db.commit()
+        admin_id, employee_id = admin_user.id, employees[0].id
+    with engine.begin() as connection:
+        rebuild_daily_totals(connection)
+
+    app = FastAPI()
+    app.include_router(attendance.router)
+    app.include_router(admin.router)
+
+    @app.post("/test-login/{user_id}")
+    def login(user_id: int, request: Request):
+        request.session["user_id"] = user_id
+        return {}
+
+    app.add_middleware(SessionMiddleware, secret_key="query-counts")
+
+    def override_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_db
+    user_snapshots.invalidate_all()
+    yield {"app": app, "Session": Session, "counter": counter, "admin_id": admin_id, "employee_id": employee_id}
+    user_snapshots.invalidate_all()
+    engine.dispose()
+
+
+def _client(env, user_id):
+    client = TestClient(env["app"])
+    client.post(f"/test-login/{user_id}")
+    return client
+
+
+def test_pages_query_count(env):
+    """Кабинет, отчеты и таблица планирования: число запросов не растет с числом сотрудников"""
+    counter = env["counter"]
+    employee = _client(env, env["employee_id"])
+    admin_client = _client(env, env["admin_id"])
+
+    with counter.at_most(12, "/dashboard"):
+        assert employee.get("/dashboard").status_code == 200
+    with counter.at_most(5, "/admin/reports"):
+        assert admin_client.get("/admin/reports").status_code == 200
+    with counter.at_most(5, "/admin/reports?store_id"):
+        assert admin_client.get("/admin/reports", params={"store_id": 1}).status_code == 200
+    # Первый просмотр создает черновики на незаполненные дни, второй только читает
+    with counter.at_most(5, "/admin/scheduling-table (черновики)"):
+        assert admin_client.get("/admin/scheduling-table").status_code == 200
+    with counter.at_most(4, "/admin/scheduling-table"):
+        assert admin_client.get("/admin/scheduling-table").status_code == 200
+
+
+def test_checkin_query_count(env):
+    """Приход и уход через веб и WebApp API"""
+    counter = env["counter"]
+    employee = _client(env, env["employee_id"])
+    headers = {"Authorization": f"Bearer {attendance._generate_compact_token(env['employee_id'])}"}
+
+    with counter.at_most(4, "/attendance/start"):
+        assert employee.post("/attendance/start", follow_redirects=False).status_code == 303
+    with counter.at_most(7, "/attendance/stop"):
+        assert employee.post("/attendance/stop", follow_redirects=False).status_code == 303
+    with counter.at_most(4, "/tgapi/v2/checkin"):
+        assert employee.post("/tgapi/v2/checkin", headers=headers).json()["status"] == "started"
+    with counter.at_most(6, "/tgapi/v2/checkout"):
+        assert employee.post("/tgapi/v2/checkout", headers=headers).json()["status"] == "stopped"
+
+
+def test_bot_callbacks_query_count(env):
+    """Кнопки бота с пустым кэшем снимков — худший случай"""
+    counter = env["counter"]
+    for action, limit in (("status", 5), ("my_schedule", 6), ("checkin", 8), ("checkout", 11)):
+        user_snapshots.invalidate_all()
+        with env["Session"]() as db, counter.at_most(limit, f"бот: {action}"):
+            assert telegram_bot._process_callback(db, env["employee_id"], action) is not None
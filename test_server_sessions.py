@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Тест серверных сессий: в cookie только идентификатор, выход и деактивация удаляют строки
+"""
+
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import database
+from app.database import Base
+from app.models import WebSession
+from app.sessions import ServerSessionMiddleware, SessionStore, revoke_user_sessions
+
+
+def test_server_sessions_lifecycle(monkeypatch):
+    """Вход выдает новый идентификатор, выход и отзыв удаляют сессию, истекшие чистятся пакетно"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", Session)
+
+    store = SessionStore(max_age=3600, cache_size=10, cache_ttl=0)
+    app = FastAPI()
+    app.add_middleware(ServerSessionMiddleware, store=store)
+
+    @app.post("/login/{user_id}")
+    def login(user_id: int, request: Request):
+        request.session["user_id"] = user_id
+        return {}
+
+    @app.get("/me")
+    def me(request: Request):
+        return {"user_id": request.session.get("user_id")}
+
+    @app.post("/logout")
+    def logout(request: Request):
+        request.session.clear()
+        return {}
+
+    first, second = TestClient(app), TestClient(app)
+    first.post("/login/1")
+    second.post("/login/2")
+    cookie = first.cookies.get("session")
+    assert len(cookie) < 64
+    assert first.get("/me").json() == {"user_id": 1}
+
+    # Повторный вход под другим пользователем меняет идентификатор
+    first.post("/login/3")
+    assert first.cookies.get("session") != cookie
+    assert first.get("/me").json() == {"user_id": 3}
+
+    first.post("/logout")
+    assert first.get("/me").json() == {"user_id": None}
+
+    with Session() as db:
+        assert db.query(WebSession).count() == 1
+        assert revoke_user_sessions(db, 2) == 1
+        db.commit()
+    assert second.get("/me").json() == {"user_id": None}
+
+    with Session() as db:
+        db.add(WebSession(id="old", user_id=5, data="{}", expires_at=int(time.time()) - 1))
+        db.commit()
+    assert store.purge_expired() == 1
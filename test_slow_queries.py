@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Тест журнала медленных запросов: формы запросов, число строк и план EXPLAIN
+"""
+
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import create_engine, event, text
+
+from app import slow_queries
+from app.database import _after_cursor_execute, _before_cursor_execute
+from app.slow_queries import StatementStats, explain, statement_shape
+
+
+def test_in_lists_collapse_to_one_shape():
+    """Запросы с разной длиной списка IN попадают в одну форму"""
+    first = statement_shape("SELECT * FROM users WHERE id IN (?, ?)")
+    second = statement_shape("SELECT *\n  FROM users WHERE id IN (?,?,?, ?)")
+    assert first == second == "SELECT * FROM users WHERE id IN (?...)"
+
+
+def test_slow_select_logged_with_rows_and_plan(tmp_path, monkeypatch):
+    """Медленный SELECT пишется один раз при закрытии курсора, план снимается для новой формы"""
+    stats = StatementStats(directory=str(tmp_path), flush_seconds=0)
+    written = []
+    monkeypatch.setattr(slow_queries, "statement_stats", stats)
+    monkeypatch.setattr(slow_queries, "SLOW_QUERY_MS", 0.0)
+    monkeypatch.setattr(slow_queries, "_slow_logger", lambda: _Recorder(written))
+
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE t (id INTEGER PRIMARY KEY, v TEXT)"))
+        conn.execute(text("INSERT INTO t (v) VALUES ('a'), ('b'), ('c')"))
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    monkeypatch.setattr("app.database._query_observers", [slow_queries._observe])
+    with engine.connect() as conn:
+        assert len(conn.execute(text("SELECT * FROM t WHERE id IN (1, 2)")).all()) == 2
+        conn.execute(text("SELECT * FROM t WHERE id IN (1, 2)")).all()
+
+    assert [extra["rows"] for extra in written] == [2, 2]
+    assert "USING INTEGER PRIMARY KEY" in written[0]["plan"]
+    assert written[1]["plan"] is None
+    (entry,) = stats.top()
+    assert entry["calls"] == 2 and entry["rows"] == 4 and entry["plan"] == written[0]["plan"]
+
+
+def test_explain_skips_ddl():
+    engine = create_engine("sqlite://")
+    with engine.connect() as conn:
+        assert explain(conn, "CREATE TABLE t (id INTEGER)", ()) == ""
+        assert explain(conn, "SELECT 1", ()) != ""
+
+
+class _Recorder:
+    def __init__(self, written):
+        self.written = written
+
+    def warning(self, message, *args, extra):
+        self.written.append(extra)
+
+
+def test_concurrent_flushes_write_once(tmp_path, monkeypatch):
+    """Потоки, одновременно заметившие срок сброса, пишут файл процесса один раз и без общих .tmp"""
+    stats = StatementStats(directory=str(tmp_path), flush_seconds=60)
+    stats.record("SELECT 1", 1.0, False, None)
+    stats._last_flush -= 120
+    replaced = []
+    real_replace = os.replace
+
+    def counting_replace(source, target):
+        replaced.append(source)
+        real_replace(source, target)
+
+    monkeypatch.setattr(slow_queries.os, "replace", counting_replace)
+    barrier = threading.Barrier(8)
+
+    def flush():
+        barrier.wait()
+        stats.maybe_flush()
+
+    threads = [threading.Thread(target=flush) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(replaced) == 1
+    # Принудительные сбросы идут по очереди, каждый через свой временный файл
+    threads = [threading.Thread(target=stats.maybe_flush, args=(True,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(replaced)) == 9
+    assert os.listdir(tmp_path) == [f"{os.getpid()}.json"]
+    assert stats.top()[0]["calls"] == 1
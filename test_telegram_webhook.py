@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Тест режима webhook: апдейты через маршрут веб-приложения, ответы — в поддельный Bot API
+"""
+
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from telegram.request import HTTPXRequest
+
+from app.bot_state import ConversationStateStore, MemoryStateBackend
+from app.database import Base, SessionLocal, engine
+from app.routers import telegram_webhook
+from app.routers.telegram_bot import TelegramBot
+from scripts.fake_telegram_api import create_app as create_fake_api
+
+TOKEN = "123456:TEST"
+SECRET = "s3cret"
+CHAT_ID = 555
+
+
+def _update(update_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": CHAT_ID, "type": "private"},
+            "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Иван"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        },
+    }
+
+
+async def _scenario(bot, fake_api):
+    web_app = FastAPI()
+    web_app.include_router(telegram_webhook.router)
+    request = HTTPXRequest(httpx_kwargs={"transport": httpx.ASGITransport(app=fake_api)})
+    await bot.start_webhook(TOKEN, "https://example.test" + telegram_webhook.TELEGRAM_WEBHOOK_PATH, SECRET, request=request)
+    try:
+        transport = httpx.ASGITransport(app=web_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            path = telegram_webhook.TELEGRAM_WEBHOOK_PATH
+            denied = await client.post(path, json=_update(1, "/start"), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+            assert denied.status_code == 403
+
+            # Три сообщения подряд: шаги регистрации должны пройти строго по порядку
+            for update_id, text in enumerate(["/start", "Иван Иванов", "ivan@example.com"], start=1):
+                response = await client.post(path, json=_update(update_id, text), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                assert response.status_code == 200
+
+            for _ in range(200):
+                replies = [params["text"] for method, params in fake_api.state.calls if method == "sendMessage"]
+                if len(replies) >= 3:
+                    break
+                await asyncio.sleep(0.05)
+    finally:
+        await bot.stop_webhook()
+    return replies
+
+
+def test_webhook_updates_processed_in_order(monkeypatch):
+    """Апдейты одного чата обрабатываются по порядку, несмотря на параллельную обработку"""
+    test_engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=test_engine)
+    SessionLocal.configure(bind=test_engine)
+    try:
+        bot = TelegramBot()
+        bot.user_sessions = ConversationStateStore(backend=MemoryStateBackend())
+        monkeypatch.setattr(telegram_webhook, "telegram_bot", bot)
+        monkeypatch.setattr(telegram_webhook, "TELEGRAM_WEBHOOK_SECRET", SECRET)
+        fake_api = create_fake_api()
+
+        replies = asyncio.run(_scenario(bot, fake_api))
+    finally:
+        SessionLocal.configure(bind=engine)
+
+    assert fake_api.state.webhook["secret_token"] == SECRET
+    assert len(replies) == 3
+    assert "Шаг 1 из 4" in replies[0]
+    assert "Шаг 2 из 4" in replies[1]
+    assert "Шаг 3 из 4" in replies[2]
+
+
+async def _forward_scenario(owner, fake_api, socket_path):
+    web_app = FastAPI()
+    web_app.include_router(telegram_webhook.router)
+    request = HTTPXRequest(httpx_kwargs={"transport": httpx.ASGITransport(app=fake_api)})
+    await owner.start_webhook(TOKEN, "https://example.test" + telegram_webhook.TELEGRAM_WEBHOOK_PATH, SECRET, request=request)
+    server = await telegram_webhook.start_forward_server(owner, socket_path)
+    try:
+        transport = httpx.ASGITransport(app=web_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            path = telegram_webhook.TELEGRAM_WEBHOOK_PATH
+            for update_id, text in enumerate(["/start", "Иван Иванов"], start=1):
+                response = await client.post(path, json=_update(update_id, text), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                assert response.status_code == 200
+
+            for _ in range(200):
+                replies = [params["text"] for method, params in fake_api.state.calls if method == "sendMessage"]
+                if len(replies) >= 2:
+                    break
+                await asyncio.sleep(0.05)
+    finally:
+        server.close()
+        await server.wait_closed()
+        await owner.stop_webhook()
+    # Владелец остановлен — передать апдейт некому
+    assert not await telegram_webhook.forward_update(_update(9, "/start"), socket_path)
+    return replies
+
+
+def test_worker_without_bot_forwards_to_owner(monkeypatch, tmp_path):
+    """Воркер, где бот не запущен, передает апдейты владельцу и сам бота не стартует"""
+    test_engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=test_engine)
+    SessionLocal.configure(bind=test_engine)
+    lock_path = str(tmp_path / "webhook.lock")
+    # Блокировку держит «другой воркер»
+    holder = telegram_webhook._acquire_instance_lock(lock_path)
+    try:
+        owner = TelegramBot()
+        owner.user_sessions = ConversationStateStore(backend=MemoryStateBackend())
+        worker = TelegramBot()
+        monkeypatch.setattr(telegram_webhook, "telegram_bot", worker)
+        monkeypatch.setattr(telegram_webhook, "TELEGRAM_BOT_TOKEN", TOKEN)
+        monkeypatch.setattr(telegram_webhook, "TELEGRAM_WEBHOOK_URL", "https://example.test/telegram/webhook")
+        monkeypatch.setattr(telegram_webhook, "TELEGRAM_WEBHOOK_SECRET", SECRET)
+        monkeypatch.setattr(telegram_webhook, "TELEGRAM_WEBHOOK_LOCK_FILE", lock_path)
+        monkeypatch.setattr(telegram_webhook, "TELEGRAM_WEBHOOK_SOCKET", str(tmp_path / "webhook.sock"))
+        fake_api = create_fake_api()
+
+        replies = asyncio.run(_forward_scenario(owner, fake_api, str(tmp_path / "webhook.sock")))
+        # Блокировка занята — второй экземпляр бота не запускается
+        assert asyncio.run(telegram_webhook.start_telegram_webhook()) is False
+    finally:
+        holder.close()
+        SessionLocal.configure(bind=engine)
+
+    assert worker.application is None
+    assert len(replies) == 2
+    assert "Шаг 1 из 4" in replies[0]
+    assert "Шаг 2 из 4" in replies[1]
+
+
+async def _failed_start_scenario(bot, fake_api, lock_path):
+    request = HTTPXRequest(httpx_kwargs={"transport": httpx.ASGITransport(app=fake_api)})
+    started = await telegram_webhook.start_telegram_webhook()
+    # Бот остановлен и блокировка освобождена — ее может взять другой воркер
+    assert not telegram_webhook._bot_running(bot)
+    handle = telegram_webhook._acquire_instance_lock(lock_path)
+    assert handle is not None
+    handle.close()
+
+    # Повторный запуск того же экземпляра: пул БД пересоздан
+    await bot.start_webhook(TOKEN, "https://example.test/telegram/webhook", SECRET, request=request)
+    try:
+        assert await bot._run_db(lambda db: 42) == 42
+    finally:
+        await bot.stop_webhook()
+    return started
+
+
+def test_failed_forward_server_stops_bot(monkeypatch, tmp_path):
+    """Если сокет пересылки не поднялся, бот останавливается до освобождения блокировки"""
+    lock_path = str(tmp_path / "webhook.lock")
+    bot = TelegramBot()
+    bot.user_sessions = ConversationStateStore(backend=MemoryStateBackend())
+    fake_api = create_fake_api()
+    original_start = bot.start_webhook
+
+    async def start_with_fake_api(token, url, secret_token=None, request=None):
+        request = request or HTTPXRequest(httpx_kwargs={"transport": httpx.ASGITransport(app=fake_api)})
+        await original_start(token, url, secret_token, request=request)
+
+    async def broken_forward_server(bot, path):
+        raise OSError("address in use")
+
+    monkeypatch.setattr(bot, "start_webhook", start_with_fake_api)
+    monkeypatch.setattr(telegram_webhook, "telegram_bot", bot)
+    monkeypatch.setattr(telegram_webhook, "start_forward_server", broken_forward_server)
+    monkeypatch.setattr(telegram_webhook, "TELEGRAM_BOT_TOKEN", TOKEN)
+    monkeypatch.setattr(telegram_webhook, "TELEGRAM_WEBHOOK_URL", "https://example.test/telegram/webhook")
+    monkeypatch.setattr(telegram_webhook, "TELEGRAM_WEBHOOK_LOCK_FILE", lock_path)
+
+    assert asyncio.run(_failed_start_scenario(bot, fake_api, lock_path)) is False
+    assert telegram_webhook._owner_lock is None
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Тест подбора веб-логинов: занятые base и base_N, символы шаблонов LIKE, уникальность в пачке
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.database import Base
+from app.models import User
+from app.routers.telegram_bot import TelegramBot
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as session:
+        for number, username in enumerate(["иван_иванов", "иван_иванов_1", "иван_иванов_3", "100x_a", "a_bx", "ab_1"]):
+            session.add(User(email=f"user{number}@example.com", full_name=username, password_hash="x",
+                             web_username=username))
+        session.commit()
+        yield session
+    engine.dispose()
+
+
+def test_taken_usernames(db):
+    """Находятся base и base_N; «%» и «_» в базовом логине не работают как шаблоны"""
+    bot = TelegramBot()
+    taken = bot._taken_usernames(db, ["иван_иванов", "100%_a", "a_b", "петр"])
+    assert taken == {"иван_иванов", "иван_иванов_1", "иван_иванов_3"}
+
+    assert bot._generate_web_credentials("Иван Иванов", db)[0] == "иван_иванов_2"
+    assert bot._generate_web_credentials("100% a", db)[0] == "100%_a"
+    assert bot._generate_web_credentials("a b", db)[0] == "a_b"
+
+
+def test_bulk_credentials_unique(db):
+    """Одинаковые имена в пачке получают разные логины, занятые в базе пропускаются"""
+    bot = TelegramBot()
+    names = ["Иван Иванов", "Иван Иванов", "Иван-Иванов", "Петр", "петр"]
+    # Больше 200 разных имен — несколько запросов
+    names += [f"Сотрудник {number}" for number in range(250)]
+
+    credentials = bot._generate_web_credentials_bulk(names, db)
+
+    usernames = [username for username, _ in credentials]
+    assert usernames[:5] == ["иван_иванов_2", "иван_иванов_4", "иван_иванов_5", "петр", "петр_1"]
+    assert len(set(usernames)) == len(names)
+    existing = {username for (username,) in db.query(User.web_username)}
+    assert not existing & set(usernames)
+    assert all(len(password) == 8 for _, password in credentials)